@@ -1,6 +1,23 @@
+import os
+import tempfile
+
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class CodeeditorConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'codeeditor'
+
+    def ready(self):
+        # Connect the file_changed (and connection_created) receivers
+        from . import changes, collab, diagnostics, listings, quickopen, search, snapshots, storage  # noqa: F401
+        from .cbuild import check_cache_dir
+        from .rustbuild import check_workspace_dir
+        from .sandbox import check_rootfs_dir
+        from .metrics import REGISTRY
+        check_rootfs_dir()
+        check_cache_dir()
+        check_workspace_dir()
+        REGISTRY.share(getattr(settings, 'METRICS_DIR', '')
+                       or os.path.join(tempfile.gettempdir(), 'codeeditor-metrics'))
@@ -0,0 +1,365 @@
+"""
+Streamed project export and import.
+
+Exports are generated chunk by chunk while the response is sent: each file
+is fed to the compressor ARCHIVE_CHUNK_SIZE bytes at a time and the
+compressed output is yielded as it is produced, so a zip or tar.gz of any
+size is never held in memory. Local files are streamed from disk; with
+other storage backends files are fetched ARCHIVE_READ_BATCH at a time.
+
+Imports read the uploaded archive (which Django spools to a temporary file
+once it is larger than FILE_UPLOAD_MAX_MEMORY_SIZE) one member at a time
+into a temporary directory. The file count and the number of bytes actually
+written are checked as extraction goes, so archive headers that lie about
+sizes can't get past the limits. The extracted tree is then moved into
+place (local backend, which stages imports next to the projects) or
+uploaded through the storage backend before the files it replaces are
+deleted.
+"""
+import gzip
+import io
+import os
+import posixpath
+import shutil
+import stat
+import tarfile
+import tempfile
+import time
+import zipfile
+import zlib
+
+from django.conf import settings
+
+from .storage import STAGING_PREFIX, walk_project
+
+FORMATS = {
+    'zip': ('application/zip', '.zip'),
+    'tar.gz': ('application/gzip', '.tar.gz'),
+}
+
+# Earliest timestamp a zip entry can hold (plus a day for time zones)
+ZIP_EPOCH = 315619200
+
+
+class ArchiveError(Exception):
+    """The uploaded archive is malformed or exceeds the import limits."""
+
+
+class _ChunkBuffer:
+    """Write-only file object that collects output until it is drained."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def _chunk_size():
+    return getattr(settings, 'ARCHIVE_CHUNK_SIZE', 64 * 1024)
+
+
+class _Entry:
+    """A project file to archive: its path, size, mtime, mode and an open binary file."""
+
+    def __init__(self, path, size, mtime, mode, src):
+        self.path, self.size, self.mtime, self.mode, self.src = path, size, mtime, mode, src
+
+
+def _local_files(root):
+    for path, file_stat in sorted(walk_project(root)):
+        try:
+            src = open(os.path.join(root, path), 'rb')
+        except OSError:
+            continue
+        with src:
+            yield _Entry(path, file_stat.st_size, file_stat.st_mtime, file_stat.st_mode, src)
+
+
+def _stored_files(storage, project_id):
+    # The backend keeps no mtime or mode; files are archived as regular files written now
+    paths = sorted(path for path, is_folder in storage.walk(project_id) if not is_folder)
+    batch_size = getattr(settings, 'ARCHIVE_READ_BATCH', 16)
+    now = time.time()
+    for start in range(0, len(paths), batch_size):
+        batch = paths[start:start + batch_size]
+        results = storage.read_many(project_id, batch)
+        for path in batch:
+            data = results.pop(path)
+            if not isinstance(data, OSError):
+                yield _Entry(path, len(data), now, stat.S_IFREG | 0o644, io.BytesIO(data))
+
+
+def _project_files(storage, project_id):
+    if storage.is_local:
+        return _local_files(storage.local_path(project_id))
+    return _stored_files(storage, project_id)
+
+
+def iter_zip(files):
+    """Yield a zip of the given files (_Entry objects), in chunks."""
+    buffer = _ChunkBuffer()
+    chunk_size = _chunk_size()
+    # On an unseekable output, zipfile writes sizes after each entry's data
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for entry in files:
+            info = zipfile.ZipInfo(entry.path, time.localtime(max(entry.mtime, ZIP_EPOCH))[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = (entry.mode & 0xFFFF) << 16
+            info.file_size = entry.size
+            with archive.open(info, 'w', force_zip64=entry.size > zipfile.ZIP64_LIMIT // 2) as dest:
+                while True:
+                    chunk = entry.src.read(chunk_size)
+                    if not chunk:
+                        break
+                    dest.write(chunk)
+                    data = buffer.drain()
+                    if data:
+                        yield data
+            yield buffer.drain()
+    yield buffer.drain()
+
+
+def iter_tar_gz(files):
+    """Yield a gzipped tar of the given files (_Entry objects), in chunks."""
+    buffer = _ChunkBuffer()
+    chunk_size = _chunk_size()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=6) as output:
+        for entry in files:
+            info = tarfile.TarInfo(entry.path)
+            info.size = entry.size
+            info.mtime = int(entry.mtime)
+            info.mode = stat.S_IMODE(entry.mode)
+            output.write(info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape'))
+            # Exactly info.size bytes, even if the file changes while being read
+            remaining = info.size
+            while remaining > 0:
+                chunk = entry.src.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                output.write(chunk)
+                remaining -= len(chunk)
+                data = buffer.drain()
+                if data:
+                    yield data
+            output.write(b'\0' * (remaining + -info.size % tarfile.BLOCKSIZE))
+            yield buffer.drain()
+        # End-of-archive marker
+        output.write(b'\0' * (2 * tarfile.BLOCKSIZE))
+    yield buffer.drain()
+
+
+def iter_archive(storage, project_id, archive_format):
+    """Yield an archive of a project's files, in chunks."""
+    files = _project_files(storage, project_id)
+    if archive_format == 'zip':
+        return iter_zip(files)
+    return iter_tar_gz(files)
+
+
+def _member_path(name):
+    """Safe relative '/'-separated path for an archive member, or None to skip it."""
+    name = name.replace('\\', '/')
+    if name.startswith('/') or (len(name) > 1 and name[1] == ':'):
+        raise ArchiveError(f'Absolute path in archive: {name}')
+    path = posixpath.normpath(name)
+    if path == '..' or path.startswith('../'):
+        raise ArchiveError(f'Path escapes the project: {name}')
+    if path in ('', '.') or '__MACOSX' in path.split('/'):
+        return None
+    return path
+
+
+class _Extractor:
+    def __init__(self, dest):
+        self.dest = dest
+        self.files = 0
+        self.size = 0
+        self.max_files = getattr(settings, 'ARCHIVE_MAX_FILES', 10000)
+        self.max_size = getattr(settings, 'ARCHIVE_MAX_SIZE', 200 * 1024 * 1024)
+        self.chunk_size = _chunk_size()
+
+    def directory(self, name):
+        path = _member_path(name)
+        if path is not None:
+            os.makedirs(os.path.join(self.dest, path), exist_ok=True)
+
+    def file(self, name, src, mode=0):
+        path = _member_path(name)
+        if path is None:
+            return
+        self.files += 1
+        if self.files > self.max_files:
+            raise ArchiveError(f'Archive has more than {self.max_files} files')
+        full_path = os.path.join(self.dest, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'wb') as dest:
+            while True:
+                chunk = src.read(self.chunk_size)
+                if not chunk:
+                    break
+                self.size += len(chunk)
+                if self.size > self.max_size:
+                    raise ArchiveError(f'Archive expands to more than {self.max_size} bytes')
+                dest.write(chunk)
+        if mode & 0o111:
+            os.chmod(full_path, 0o755)
+
+
+def _extract_zip(fileobj, extractor):
+    with zipfile.ZipFile(fileobj) as archive:
+        for info in archive.infolist():
+            mode = info.external_attr >> 16
+            if info.is_dir():
+                extractor.directory(info.filename)
+            elif not stat.S_ISLNK(mode):
+                with archive.open(info) as src:
+                    extractor.file(info.filename, src, mode)
+
+
+def _extract_tar(fileobj, extractor):
+    # Stream mode: members are read in order, without seeking back
+    with tarfile.open(fileobj=fileobj, mode='r|*') as archive:
+        for member in archive:
+            if member.isdir():
+                extractor.directory(member.name)
+            elif member.isfile():
+                extractor.file(member.name, archive.extractfile(member), member.mode)
+            # Links and device files are skipped
+
+
+def extract_archive(fileobj, dest):
+    """
+    Extract a zip or tar (optionally gzip/bz2/xz-compressed) archive into
+    dest. Returns (file count, total size). Raises ArchiveError.
+    """
+    extractor = _Extractor(dest)
+    try:
+        if zipfile.is_zipfile(fileobj):
+            fileobj.seek(0)
+            _extract_zip(fileobj, extractor)
+        else:
+            fileobj.seek(0)
+            _extract_tar(fileobj, extractor)
+    except ArchiveError:
+        raise
+    except (zipfile.BadZipFile, tarfile.TarError, EOFError, zlib.error, NotImplementedError) as e:
+        raise ArchiveError(f'Invalid archive: {str(e)}')
+    except (IsADirectoryError, NotADirectoryError, FileExistsError) as e:
+        raise ArchiveError(f'Conflicting paths in archive: {e.filename}')
+    return extractor.files, extractor.size
+
+
+def _upload(storage, project_id, root):
+    """
+    Write an extracted tree to the storage backend, a batch of files at a
+    time. Returns the paths of the files and folders written.
+    """
+    batch_size = getattr(settings, 'ARCHIVE_READ_BATCH', 16)
+    files = {}
+    written = set()
+    for dir_path, dir_names, file_names in os.walk(root):
+        rel_dir = os.path.relpath(dir_path, root).replace(os.sep, '/')
+        prefix = '' if rel_dir == '.' else rel_dir + '/'
+        if prefix:
+            written.add(rel_dir)
+        if not dir_names and not file_names and prefix:
+            storage.make_dir(project_id, prefix)
+        for name in file_names:
+            with open(os.path.join(dir_path, name), 'rb') as f:
+                files[prefix + name] = f.read()
+            written.add(prefix + name)
+            if len(files) >= batch_size:
+                storage.write_many(project_id, files)
+                files = {}
+    if files:
+        storage.write_many(project_id, files)
+    return written
+
+
+def _delete_paths(storage, project_id, paths):
+    """Delete files and folders, the deepest first so folders are empty by then."""
+    for path in sorted(paths, key=lambda path: (-path.count('/'), path)):
+        try:
+            storage.delete(project_id, path)
+        except FileNotFoundError:
+            # A folder that only existed through the files just deleted
+            pass
+
+
+def _replace_remote(storage, project_id, root):
+    """
+    Make a project on a remote backend match an extracted tree. Everything
+    is uploaded before anything is deleted, so a failure part way leaves
+    the old files (with some new ones) rather than a half-empty project.
+    """
+    old = dict(storage.walk(project_id))
+    new_files, new_folders = set(), set()
+    for dir_path, dir_names, file_names in os.walk(root):
+        rel_dir = os.path.relpath(dir_path, root).replace(os.sep, '/')
+        prefix = '' if rel_dir == '.' else rel_dir + '/'
+        new_folders.update(prefix + name for name in dir_names)
+        new_files.update(prefix + name for name in file_names)
+    # A file where the archive has a folder, or the other way round, has to go first
+    clashes = {path for path, is_folder in old.items()
+               if (path in new_folders and not is_folder) or (path in new_files and is_folder)}
+    clashes.update(path for path in old for clash in list(clashes) if path.startswith(clash + '/'))
+    _delete_paths(storage, project_id, clashes)
+    written = _upload(storage, project_id, root)
+    _delete_paths(storage, project_id, [path for path in old if path not in written and path not in clashes])
+
+
+def import_archive(fileobj, storage, project_id, replace=False):
+    """
+    Extract an archive into a new project, or in place of an existing one
+    if replace is set. The project only changes once extraction has
+    succeeded. An archive with everything inside one top-level folder (as
+    GitHub produces) is imported from that folder. Returns (file count,
+    total size). Raises ArchiveError, or FileExistsError if the project
+    exists and replace is not set.
+    """
+    if storage.is_local:
+        # Next to the project, so moving it into place is a rename on one file system
+        project_dir = storage.local_path(project_id)
+        os.makedirs(os.path.dirname(project_dir), exist_ok=True)
+        staging = tempfile.mkdtemp(prefix=STAGING_PREFIX, dir=os.path.dirname(project_dir))
+    else:
+        staging = tempfile.mkdtemp(prefix='import-')
+    try:
+        extract_dir = os.path.join(staging, 'project')
+        os.mkdir(extract_dir)
+        result = extract_archive(fileobj, extract_dir)
+        entries = os.listdir(extract_dir)
+        if len(entries) == 1 and os.path.isdir(os.path.join(extract_dir, entries[0])):
+            extract_dir = os.path.join(extract_dir, entries[0])
+        exists = storage.project_exists(project_id)
+        if exists and not replace:
+            raise FileExistsError(project_id)
+        if storage.is_local:
+            # Two renames, so the project is never half replaced
+            previous = os.path.join(staging, 'previous')
+            if exists:
+                os.rename(project_dir, previous)
+            try:
+                os.rename(extract_dir, project_dir)
+            except BaseException:
+                if exists:
+                    os.rename(previous, project_dir)
+                raise
+        elif exists:
+            _replace_remote(storage, project_id, extract_dir)
+        else:
+            storage.create_project(project_id)
+            _upload(storage, project_id, extract_dir)
+        return result
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
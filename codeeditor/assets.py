@@ -0,0 +1,42 @@
+"""
+Static file storage for collectstatic.
+
+This is WhiteNoise's CompressedManifestStaticFilesStorage with a
+minification pass. It gives content-hashed file names, which WhiteNoise
+serves with far-future cache headers, and precompressed .gz copies (plus
+.br ones when Brotli is installed). CSS and JavaScript are minified first
+with rcssmin and rjsmin, when installed; files that are already minified
+(*.min.css, *.min.js) are copied as they are.
+"""
+from django.core.files.base import ContentFile
+from whitenoise.storage import CompressedManifestStaticFilesStorage
+
+try:
+    import rcssmin
+except ImportError:
+    rcssmin = None
+
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+
+
+def minifier(name):
+    """A function minifying the text of the static file called name, or None."""
+    if name.endswith(('.min.css', '.min.js')):
+        return None
+    if name.endswith('.css') and rcssmin is not None:
+        return lambda text: rcssmin.cssmin(text, keep_bang_comments=True)
+    if name.endswith('.js') and rjsmin is not None:
+        return lambda text: rjsmin.jsmin(text, keep_bang_comments=True)
+    return None
+
+
+class MinifiedManifestStaticFilesStorage(CompressedManifestStaticFilesStorage):
+    def _save(self, name, content):
+        # Before hashing, so the hash is of what is served
+        minify = minifier(name)
+        if minify is not None:
+            content = ContentFile(minify(b''.join(content.chunks()).decode('utf-8')).encode('utf-8'))
+        return super()._save(name, content)
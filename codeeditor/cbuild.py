@@ -0,0 +1,315 @@
+"""
+Faster C and C++ builds for prepare_program.
+
+Most of a typical submission's compile time goes to parsing standard
+headers (<bits/stdc++.h> alone is about a second with g++). Builds are
+sped up in three ways:
+
+- Precompiled headers. The standard #include lines at the top of a
+  source file are precompiled per header list, compiler and flags, in the
+  background once the list has been seen CPP_PCH_MIN_USES times. Later
+  builds force-include the precompiled copy, which turns the file's own
+  includes into no-ops. At most CPP_PCH_MAX_ENTRIES are kept (each can be
+  ~100MB for <bits/stdc++.h>).
+- A build cache. Executables are kept under a hash of the source, the
+  compiler and the flags, so running the same code again skips the
+  compiler. The cache holds at most CPP_BUILD_CACHE_SIZE bytes.
+- ccache, when CPP_USE_CCACHE is set and ccache is installed. It needs
+  sloppiness=pch_defines,time_macros to cache builds that use a
+  precompiled header.
+
+The optimization level is selectable per build (OPTIMIZATION_LEVELS).
+"""
+import hashlib
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from . import metrics
+from .executor import probe_process, run_process
+from .sandbox import bindable
+
+logger = logging.getLogger(__name__)
+
+# language -> (compiler, -x language, -x language for headers)
+COMPILERS = {
+    'c': ('gcc', 'c', 'c-header'),
+    'cpp': ('g++', 'c++', 'c++-header'),
+}
+
+OPTIMIZATION_LEVELS = ('O0', 'O1', 'O2', 'O3', 'Os')
+
+_INCLUDE = re.compile(r'^\s*#\s*include\s*<([\w./+-]+)>\s*(//.*)?$')
+_LINE_COMMENT = re.compile(r'^\s*(//.*)?$')
+
+
+def build_flags(optimization=None):
+    """Compiler flags for an optimization level; ValueError if it isn't one of OPTIMIZATION_LEVELS."""
+    optimization = optimization or getattr(settings, 'CPP_OPTIMIZATION', 'O0')
+    if optimization not in OPTIMIZATION_LEVELS:
+        raise ValueError(f'Optimization must be one of {", ".join(OPTIMIZATION_LEVELS)}')
+    return ['-pipe', f'-{optimization}']
+
+
+def leading_includes(source):
+    """The <...> headers a source file includes before anything else, in order."""
+    headers = []
+    in_comment = False
+    for line in source.splitlines():
+        if in_comment:
+            if '*/' in line:
+                in_comment = False
+                if line.split('*/', 1)[1].strip():
+                    break
+            continue
+        if line.lstrip().startswith('/*'):
+            in_comment = '*/' not in line
+            if not in_comment and line.split('*/', 1)[1].strip():
+                break
+            continue
+        match = _INCLUDE.match(line)
+        if match:
+            if '..' not in match.group(1):
+                headers.append(match.group(1))
+            continue
+        if not _LINE_COMMENT.match(line):
+            break
+    return tuple(headers)
+
+
+_identities = {}
+_identities_lock = threading.Lock()
+
+
+def compiler_identity(compiler):
+    """Version and target of a compiler, so cached output from another compiler is never used."""
+    with _identities_lock:
+        if compiler not in _identities:
+            try:
+                result = probe_process([compiler, '-dumpfullversion', '-dumpmachine'],
+                                       capture_output=True, text=True, timeout=10)
+                _identities[compiler] = f'{compiler} {result.stdout.strip()}'
+            except (OSError, subprocess.SubprocessError):
+                return None
+        return _identities[compiler]
+
+
+def _digest(*parts):
+    return hashlib.sha256('\0'.join(parts).encode('utf-8', 'surrogatepass')).hexdigest()
+
+
+def _cache_dir(*parts):
+    return os.path.join(getattr(settings, 'CPP_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'codeeditor-cbuild')),
+                        *parts)
+
+
+def check_cache_dir():
+    """Refuse to start if sandboxed builds couldn't bind the precompiled headers in CPP_CACHE_DIR."""
+    if (getattr(settings, 'SANDBOX_ENABLED', False) and getattr(settings, 'CPP_PRECOMPILED_HEADERS', True)
+            and not bindable(_cache_dir())):
+        raise ImproperlyConfigured(f'CPP_CACHE_DIR must be under /tmp when SANDBOX_ENABLED is set, '
+                                   f'since precompiled headers are bound into the sandbox: {_cache_dir()}')
+
+
+class PrecompiledHeaders:
+    def __init__(self):
+        self.root = _cache_dir('pch')
+        self.uses = {}
+        self.building = set()
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='pch')
+
+    def lookup(self, language, headers, flags, identity):
+        """The header to force-include for these headers, or None (starting a build once they are common)."""
+        key = _digest(identity, language, ' '.join(flags), *headers)
+        header = os.path.join(self.root, key, 'pch.h')
+        if os.path.exists(header + '.gch'):
+            try:
+                # Recently used entries are kept when the cache is trimmed
+                os.utime(os.path.join(self.root, key))
+            except OSError:
+                pass
+            return header
+        with self.lock:
+            self.uses[key] = self.uses.get(key, 0) + 1
+            if len(self.uses) > 10000:
+                self.uses.clear()
+            if self.uses[key] >= getattr(settings, 'CPP_PCH_MIN_USES', 2) and key not in self.building:
+                self.building.add(key)
+                self.pool.submit(self._build, key, language, headers, flags)
+        return None
+
+    def _build(self, key, language, headers, flags):
+        compiler, _, header_language = COMPILERS[language]
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            build_dir = tempfile.mkdtemp(dir=self.root, prefix='.build-')
+            try:
+                with open(os.path.join(build_dir, 'pch.h'), 'w') as f:
+                    f.writelines(f'#include <{header}>\n' for header in headers)
+                result = run_process([compiler, '-x', header_language, *flags, 'pch.h', '-o', 'pch.h.gch'],
+                                     timeout=getattr(settings, 'CPP_PCH_TIMEOUT', 120), cwd=build_dir,
+                                     binds=[build_dir], language=language, phase='compile')
+                if result.returncode != 0:
+                    logger.info(f"Not precompiling {', '.join(headers)}: {result.stderr.strip()[:500]}")
+                    return
+                self._trim()
+                os.rename(build_dir, os.path.join(self.root, key))
+            finally:
+                shutil.rmtree(build_dir, ignore_errors=True)
+        except Exception as e:
+            logger.error(f"Error precompiling {', '.join(headers)}: {str(e)}")
+        finally:
+            with self.lock:
+                self.building.discard(key)
+
+    def _trim(self):
+        """Make room for one more entry by removing the least recently used ones."""
+        limit = max(getattr(settings, 'CPP_PCH_MAX_ENTRIES', 8) - 1, 0)
+        entries = []
+        for name in os.listdir(self.root):
+            if not name.startswith('.'):
+                path = os.path.join(self.root, name)
+                entries.append((os.stat(path).st_mtime, path))
+        entries.sort()
+        for _, path in entries[:max(len(entries) - limit, 0)]:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+class CachedBuild(subprocess.CompletedProcess):
+    """A successful compile answered from the build cache, without running the compiler."""
+
+    def __init__(self, compiler):
+        super().__init__([compiler], 0, '', '')
+
+
+class BuildCache:
+    """Executables by content hash, trimmed to max_bytes, least recently used first."""
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.size = None
+        self.lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key, output):
+        """Copy the cached executable for key to output; False if there is none."""
+        path = self._path(key)
+        try:
+            shutil.copy2(path, output)
+            os.utime(path)
+            return True
+        except OSError:
+            return False
+
+    def put(self, key, output):
+        try:
+            size = os.path.getsize(output)
+            if size > self.max_bytes:
+                return
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f'{path}.{threading.get_ident()}.tmp'
+            shutil.copy2(output, temp_path)
+            os.replace(temp_path, path)
+        except OSError as e:
+            logger.error(f"Error caching build {key}: {str(e)}")
+            return
+        with self.lock:
+            if self.size is None:
+                self.size = sum(size for _, size, _ in self._entries())
+            else:
+                self.size += size
+            if self.size > self.max_bytes:
+                self._trim()
+
+    def _entries(self):
+        for directory in os.listdir(self.root):
+            directory = os.path.join(self.root, directory)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                try:
+                    stat = os.stat(os.path.join(directory, name))
+                except OSError:
+                    continue
+                yield stat.st_mtime, stat.st_size, os.path.join(directory, name)
+
+    def _trim(self):
+        # Down to three quarters, so trimming doesn't run on every new build
+        for _, size, path in sorted(self._entries()):
+            if self.size <= self.max_bytes * 3 // 4:
+                break
+            try:
+                os.remove(path)
+                self.size -= size
+            except OSError:
+                pass
+
+
+_precompiled_headers = None
+_build_cache = None
+_singletons_lock = threading.Lock()
+
+
+def _caches():
+    global _precompiled_headers, _build_cache
+    with _singletons_lock:
+        if _precompiled_headers is None:
+            _precompiled_headers = PrecompiledHeaders()
+            _build_cache = BuildCache(_cache_dir('bin'), getattr(settings, 'CPP_BUILD_CACHE_SIZE', 512 * 1024 * 1024))
+        return _precompiled_headers, _build_cache
+
+
+def compile_program(source_file, language, output, work_dir, optimization=None):
+    """
+    Compile a C or C++ source file to output, like `gcc source -o output`.
+
+    Returns a subprocess.CompletedProcess-like result; a build cache hit
+    returns a CachedBuild without running the compiler. Raises
+    ValueError for an unknown optimization level.
+    """
+    compiler, source_language, _ = COMPILERS[language]
+    flags = build_flags(optimization)
+    identity = compiler_identity(compiler)
+    if identity is None:
+        raise FileNotFoundError(compiler)
+    with open(source_file, encoding='utf-8', errors='surrogateescape') as f:
+        source = f.read()
+
+    precompiled_headers, build_cache = _caches()
+    use_build_cache = getattr(settings, 'CPP_BUILD_CACHE', True)
+    key = _digest(identity, language, ' '.join(flags), source)
+    if use_build_cache:
+        if build_cache.get(key, output):
+            metrics.build_cache_lookups.inc(language=language, result='hit')
+            return CachedBuild(compiler)
+        metrics.build_cache_lookups.inc(language=language, result='miss')
+
+    args = [compiler, *flags]
+    binds = [work_dir]
+    headers = leading_includes(source)
+    if headers and getattr(settings, 'CPP_PRECOMPILED_HEADERS', True):
+        header = precompiled_headers.lookup(language, headers, flags, identity)
+        if header is not None:
+            args += ['-include', header]
+            binds.append(os.path.dirname(header))
+    if getattr(settings, 'CPP_USE_CCACHE', False) and shutil.which('ccache'):
+        args.insert(0, 'ccache')
+    args += ['-x', source_language, source_file, '-o', output]
+
+    result = run_process(args, cwd=work_dir, binds=binds, language=language, phase='compile')
+    if result.returncode == 0 and use_build_cache:
+        build_cache.put(key, output)
+    return result
@@ -0,0 +1,481 @@
+"""
+Live file-change feed for a project (/ws/changes/<project_id>/).
+
+Every file_changed signal (saves, creates, renames, deletes, bulk
+operations, restores, imports, collaborative saves) is pushed to the
+project's subscribers as
+    {"type": "change", "id": N, "event": "created" | "modified" | "renamed"
+     | "deleted" | "reset", "path": "...", "old_path": "...",
+     "is_folder": bool, "source": "editor" | "external"}
+is_folder is given for created and renamed paths; "reset" (path "") means
+anything may have changed and the client should reload the tree.
+
+For local storage, each subscribed project is also watched with inotify,
+so changes made outside the app (a terminal, git, another program) are
+reported too, with source "external". They are sent as file_changed
+themselves, so the search index, storage cache and open collaborative
+documents see them as well. Events the watcher sees for paths the app has
+just changed are its own writes echoing back and are skipped.
+
+On connect the server sends {"type": "ready", "feed": token, "id": N}. A
+client reconnecting with ?feed=<token>&since=<last id seen> gets the
+events it missed, or {"type": "reset"} if they are no longer held (after
+CHANGES_HISTORY newer events, or a server restart). A subscriber that
+can't keep up gets a reset instead of its backlog.
+"""
+import asyncio
+import collections
+import ctypes
+import json
+import logging
+import os
+import posixpath
+import select
+import struct
+import sys
+import threading
+import time
+import uuid
+from urllib.parse import parse_qs
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.dispatch import receiver
+
+from .signals import file_changed
+from .storage import clean_path, clean_project_id, get_storage
+from .websocket import WebSocketDisconnect
+
+logger = logging.getLogger(__name__)
+
+# Watcher events are collected this long, so a burst (a save, a checkout) goes out merged
+DEBOUNCE = 0.1
+# How long after the app changes a path the watcher's events for it are treated as echoes
+ECHO_WINDOW = 1.0
+SEND_QUEUE_SIZE = 1000
+
+_IN_CLOSE_WRITE = 0x8
+_IN_MOVED_FROM = 0x40
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_Q_OVERFLOW = 0x4000
+_IN_IGNORED = 0x8000
+_IN_ONLYDIR = 0x1000000
+_IN_DONT_FOLLOW = 0x2000000
+_IN_EXCL_UNLINK = 0x4000000
+_IN_ISDIR = 0x40000000
+_WATCH_MASK = (_IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+               | _IN_ONLYDIR | _IN_DONT_FOLLOW | _IN_EXCL_UNLINK)
+_EVENT_HEADER = struct.Struct('iIII')
+
+# (project_id, path) -> when the app last changed it, to recognise the watcher's echoes
+_recent_changes = {}
+_recent_lock = threading.Lock()
+
+
+def _remember_change(project_id, *paths):
+    now = time.monotonic()
+    with _recent_lock:
+        if len(_recent_changes) > 10000:
+            for key in [key for key, when in _recent_changes.items() if now - when > ECHO_WINDOW]:
+                del _recent_changes[key]
+        for path in paths:
+            if path is not None:
+                _recent_changes[(project_id, path)] = now
+
+
+def _is_echo(project_id, path):
+    """True if the app changed path, or a folder containing it, within ECHO_WINDOW."""
+    now = time.monotonic()
+    candidates = [path]
+    while path:
+        path = posixpath.dirname(path)
+        candidates.append(path)
+    with _recent_lock:
+        return any(now - _recent_changes.get((project_id, candidate), -ECHO_WINDOW) < ECHO_WINDOW
+                   for candidate in candidates)
+
+
+class InotifyWatcher:
+    """
+    Watches the folders of subscribed local projects with one inotify
+    instance and a reader thread, and sends what changed outside the app as
+    file_changed with this class as sender.
+    """
+
+    def __init__(self):
+        libc = ctypes.CDLL(None, use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self.ignored = set(getattr(settings, 'SEARCH_IGNORED_DIRS', []))
+        self.lock = threading.Lock()
+        self.roots = {}     # project_id -> its directory
+        self.folders = {}   # project_id -> {folder path ('' for the root): watch descriptor}
+        self.watches = {}   # watch descriptor -> (project_id, folder path)
+        threading.Thread(target=self._run, name='inotify-watcher', daemon=True).start()
+
+    def watch(self, project_id, root):
+        with self.lock:
+            if project_id not in self.roots:
+                self.roots[project_id] = root
+                self.folders[project_id] = {}
+                self._watch_tree(project_id, '')
+
+    def unwatch(self, project_id):
+        with self.lock:
+            self.roots.pop(project_id, None)
+            for wd in self.folders.pop(project_id, {}).values():
+                self.watches.pop(wd, None)
+                self._rm_watch(self.fd, wd)
+
+    def _watch_tree(self, project_id, folder):
+        """Watch folder and every folder under it; returns the [(path, is_folder)] found inside."""
+        root = self.roots[project_id]
+        found = []
+        for dirpath, dirnames, filenames in os.walk(os.path.join(root, folder) if folder else root):
+            dirnames[:] = [name for name in dirnames
+                           if name not in self.ignored and not os.path.islink(os.path.join(dirpath, name))]
+            relative = os.path.relpath(dirpath, root).replace(os.sep, '/')
+            relative = '' if relative == '.' else relative
+            wd = self._add_watch(self.fd, os.fsencode(dirpath), _WATCH_MASK)
+            if wd < 0:
+                # Usually fs.inotify.max_user_watches; the folder just goes unwatched
+                error = ctypes.get_errno()
+                logger.error(f"Can't watch {dirpath}: {os.strerror(error)}")
+                continue
+            self.watches[wd] = (project_id, relative)
+            self.folders[project_id][relative] = wd
+            found += [(posixpath.join(relative, name), True) for name in dirnames]
+            found += [(posixpath.join(relative, name), False) for name in filenames]
+        return found
+
+    def _move_watches(self, project_id, old_path, new_path):
+        folders = self.folders.get(project_id, {})
+        for folder in [f for f in folders if f == old_path or f.startswith(old_path + '/')]:
+            wd = folders.pop(folder)
+            moved = new_path + folder[len(old_path):]
+            folders[moved] = wd
+            self.watches[wd] = (project_id, moved)
+
+    def _drop_watches(self, project_id, path):
+        folders = self.folders.get(project_id, {})
+        for folder in [f for f in folders if f == path or f.startswith(path + '/')]:
+            wd = folders.pop(folder)
+            self.watches.pop(wd, None)
+            self._rm_watch(self.fd, wd)
+
+    def _run(self):
+        pending = {}   # (project_id, path) -> (event, old_path), merged while debouncing
+        moves = {}     # inotify cookie -> (project_id, path, is_folder) of a move's first half
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            ready, _, _ = select.select([self.fd], [], [], timeout)
+            if ready:
+                try:
+                    data = os.read(self.fd, 64 * 1024)
+                except BlockingIOError:
+                    continue
+                with self.lock:
+                    try:
+                        self._parse(data, pending, moves)
+                    except Exception as e:
+                        logger.error(f"Error handling inotify events: {str(e)}")
+                if deadline is None and (pending or moves):
+                    deadline = time.monotonic() + DEBOUNCE
+            # Checked even while events keep arriving, so a steady stream still goes out
+            if deadline is not None and time.monotonic() >= deadline:
+                with self.lock:
+                    # A move whose other half never came: the path left the watched tree
+                    for project_id, path, is_folder in moves.values():
+                        self._record(pending, project_id, path, 'deleted')
+                        if is_folder:
+                            self._drop_watches(project_id, path)
+                moves.clear()
+                # A deleted folder is reported once, not along with everything that was in it
+                deleted = {key for key, (event, _) in pending.items() if event == 'deleted'}
+                changes = [(key, change) for key, change in pending.items()
+                           if change[0] != 'deleted' or not self._inside_any(key, deleted)]
+                pending.clear()
+                deadline = None
+                self._report(changes)
+
+    @staticmethod
+    def _inside_any(key, folders):
+        project_id, path = key
+        while '/' in path:
+            path = path.rpartition('/')[0]
+            if (project_id, path) in folders:
+                return True
+        return False
+
+    def _parse(self, data, pending, moves):
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & _IN_Q_OVERFLOW:
+                # Events were lost; every watched project may have changed
+                for project_id in self.roots:
+                    self._record(pending, project_id, '', 'reset')
+                continue
+            if mask & _IN_IGNORED:
+                watch = self.watches.pop(wd, None)
+                if watch and self.folders.get(watch[0], {}).get(watch[1]) == wd:
+                    del self.folders[watch[0]][watch[1]]
+                continue
+            watch = self.watches.get(wd)
+            if watch is None or not name:
+                continue
+            project_id, folder = watch
+            is_folder = bool(mask & _IN_ISDIR)
+            if is_folder and name in self.ignored:
+                continue
+            path = posixpath.join(folder, name) if folder else name
+            if mask & _IN_MOVED_FROM:
+                moves[cookie] = (project_id, path, is_folder)
+            elif mask & _IN_MOVED_TO:
+                source = moves.pop(cookie, None)
+                if source and source[0] == project_id:
+                    self._record(pending, project_id, path, 'renamed', source[1])
+                    if is_folder:
+                        self._move_watches(project_id, source[1], path)
+                else:
+                    if source:
+                        self._record(pending, source[0], source[1], 'deleted')
+                        if source[2]:
+                            self._drop_watches(source[0], source[1])
+                    self._created(pending, project_id, path, is_folder)
+            elif mask & _IN_CREATE:
+                self._created(pending, project_id, path, is_folder)
+            elif mask & _IN_CLOSE_WRITE:
+                self._record(pending, project_id, path, 'modified')
+            elif mask & _IN_DELETE:
+                self._record(pending, project_id, path, 'deleted')
+
+    def _created(self, pending, project_id, path, is_folder):
+        self._record(pending, project_id, path, 'created')
+        if is_folder and project_id in self.roots:
+            # Anything put inside before the new folder's watch was added
+            for found, _ in self._watch_tree(project_id, path):
+                self._record(pending, project_id, found, 'created')
+
+    @staticmethod
+    def _record(pending, project_id, path, event, old_path=None):
+        key = (project_id, path)
+        previous = pending.pop(key, None)
+        if event == 'renamed' and pending.get((project_id, old_path), (None,))[0] == 'created':
+            # Written under a temporary name, then moved into place
+            del pending[(project_id, old_path)]
+            event, old_path = 'created', None
+        elif previous is not None:
+            if previous[0] == 'created' and event == 'deleted':
+                return
+            if previous[0] in ('created', 'renamed') and event == 'modified':
+                event, old_path = previous
+            elif previous[0] == 'deleted' and event == 'created':
+                event = 'modified'
+        pending[key] = (event, old_path)
+
+    def _report(self, changes):
+        try:
+            for (project_id, path), (event, old_path) in changes:
+                if event != 'reset' and (_is_echo(project_id, path) or (old_path and _is_echo(project_id, old_path))):
+                    continue
+                for handler, result in file_changed.send_robust(sender=InotifyWatcher, project_id=project_id,
+                                                                path=path, event=event, old_path=old_path):
+                    if isinstance(result, Exception):
+                        logger.error(f"Error in file_changed receiver {handler.__name__}: {str(result)}")
+        finally:
+            close_old_connections()
+
+
+class _Subscriber:
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+
+    def send(self, text):
+        try:
+            self.queue.put_nowait(text)
+        except asyncio.QueueFull:
+            # Too far behind to be worth catching up: have it reload the tree instead
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(json.dumps({'type': 'reset'}))
+
+    async def write(self):
+        try:
+            while True:
+                await self.websocket.send_text(await self.queue.get())
+        except Exception:
+            # The connection is gone; the reader side will notice and clean up
+            pass
+
+
+class ChangeFeed:
+    """Subscribers and recent events per project, in this process."""
+
+    def __init__(self):
+        self.loop = None
+        # Identifies this process's event ids, so resumes across a restart reset instead
+        self.token = uuid.uuid4().hex[:12]
+        self.last_id = 0
+        self.subscribers = collections.defaultdict(set)
+        self.history = {}   # project_id -> deque of recent events
+        self.horizon = {}   # project_id -> newest event id no longer in history
+        self.release_handles = {}
+        self.watcher = None
+        self.watcher_lock = threading.Lock()
+        self.watcher_failed = False
+
+    def subscribe(self, project_id, subscriber):
+        handle = self.release_handles.pop(project_id, None)
+        if handle:
+            handle.cancel()
+        if project_id not in self.history:
+            self.history[project_id] = collections.deque(maxlen=getattr(settings, 'CHANGES_HISTORY', 500))
+            self.horizon[project_id] = self.last_id
+        self.subscribers[project_id].add(subscriber)
+
+    def unsubscribe(self, project_id, subscriber):
+        subscribers = self.subscribers.get(project_id)
+        if subscribers is None:
+            return
+        subscribers.discard(subscriber)
+        if not subscribers:
+            del self.subscribers[project_id]
+            # Keep watching for a while, so a client that reconnects can resume
+            self.release_handles[project_id] = self.loop.call_later(
+                getattr(settings, 'CHANGES_LINGER', 60), self.release, project_id)
+
+    def release(self, project_id):
+        self.release_handles.pop(project_id, None)
+        if project_id in self.subscribers:
+            return
+        self.history.pop(project_id, None)
+        self.horizon.pop(project_id, None)
+        if self.watcher:
+            self.watcher.unwatch(project_id)
+
+    def missed(self, project_id, since):
+        """Events after since, or None if some of them are no longer held."""
+        if since < self.horizon.get(project_id, self.last_id) or since > self.last_id:
+            return None
+        return [change for change in self.history[project_id] if change['id'] > since]
+
+    def publish(self, project_id, change):
+        history = self.history.get(project_id)
+        if history is None:
+            return
+        self.last_id += 1
+        change['id'] = self.last_id
+        if len(history) == history.maxlen:
+            self.horizon[project_id] = history[0]['id']
+        history.append(change)
+        text = json.dumps({'type': 'change', **change})
+        for subscriber in list(self.subscribers.get(project_id, ())):
+            subscriber.send(text)
+
+    def watch(self, project_id):
+        """Start watching a local project's folder, if inotify is available (run in a thread)."""
+        if not getattr(settings, 'CHANGES_WATCH_FILES', True) or not sys.platform.startswith('linux'):
+            return
+        storage = get_storage()
+        if not storage.is_local:
+            return
+        with self.watcher_lock:
+            if self.watcher is None and not self.watcher_failed:
+                try:
+                    self.watcher = InotifyWatcher()
+                except (OSError, AttributeError) as e:
+                    self.watcher_failed = True
+                    logger.error(f"File watching unavailable, only changes made through the app are reported: {str(e)}")
+        if self.watcher:
+            self.watcher.watch(project_id, storage.local_path(project_id))
+
+
+_feed = ChangeFeed()
+
+
+@receiver(file_changed)
+def publish_change(sender, project_id, path, event, old_path=None, **kwargs):
+    try:
+        path = clean_path(path) if path else ''
+        old_path = clean_path(old_path) if old_path else None
+    except ValueError:
+        return
+    if sender is not InotifyWatcher and _feed.watcher is not None:
+        _remember_change(project_id, path, old_path)
+    loop = _feed.loop
+    if loop is None or project_id not in _feed.history:
+        return
+    change = {'event': event, 'path': path,
+              'source': 'external' if sender is InotifyWatcher else 'editor'}
+    if old_path:
+        change['old_path'] = old_path
+    if event in ('created', 'renamed') and path:
+        try:
+            change['is_folder'] = get_storage().kind(project_id, path) == 'folder'
+        except Exception as e:
+            logger.error(f"Error checking {project_id}/{path}: {str(e)}")
+    try:
+        loop.call_soon_threadsafe(_feed.publish, project_id, change)
+    except RuntimeError:
+        # The event loop has shut down
+        pass
+
+
+def _project_exists(project_id):
+    try:
+        return get_storage().project_exists(project_id)
+    finally:
+        close_old_connections()
+
+
+async def change_feed(websocket, project_id):
+    await websocket.accept()
+    query = parse_qs(websocket.query_string)
+    loop = asyncio.get_running_loop()
+    try:
+        project_id = clean_project_id(project_id)
+        since = int(query['since'][0]) if 'since' in query else None
+    except ValueError as e:
+        await websocket.send_json({'type': 'error', 'error': str(e)})
+        await websocket.close()
+        return
+    if not await loop.run_in_executor(None, _project_exists, project_id):
+        await websocket.send_json({'type': 'error', 'error': 'Project not found'})
+        await websocket.close()
+        return
+    _feed.loop = loop
+    await loop.run_in_executor(None, _feed.watch, project_id)
+
+    subscriber = _Subscriber(websocket)
+    _feed.subscribe(project_id, subscriber)
+    subscriber.send(json.dumps({'type': 'ready', 'feed': _feed.token, 'id': _feed.last_id}))
+    if since is not None:
+        missed = _feed.missed(project_id, since) if query.get('feed', [''])[0] == _feed.token else None
+        if missed is None:
+            subscriber.send(json.dumps({'type': 'reset'}))
+        for change in missed or ():
+            subscriber.send(json.dumps({'type': 'change', **change}))
+
+    writer = asyncio.create_task(subscriber.write())
+    try:
+        while True:
+            # Nothing is expected from the client; this just waits for it to go away
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        _feed.unsubscribe(project_id, subscriber)
+        writer.cancel()
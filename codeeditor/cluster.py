@@ -0,0 +1,335 @@
+"""
+Running executions on a fleet of runner nodes.
+
+A runner node is this same application with CLUSTER_SECRET set: it accepts
+jobs at /editor/runner/jobs/ and reports its load at /editor/runner/health/,
+both behind a bearer token. A dispatching server lists the nodes' runner
+URLs in CLUSTER_NODES; run_code and run_batch then forward each job to a
+node over HTTP instead of executing it locally.
+
+- Routing is least-loaded (by the load each node last reported) or a
+  consistent hash of the routing key (the language and source), so the
+  same code keeps landing on the node whose build caches already have it.
+  Hashing is load-bounded: a node already running more than
+  CLUSTER_LOAD_FACTOR times its share of the jobs in flight passes the job
+  to the next node on the ring, and if that one is overloaded too the job
+  goes to the least loaded node. Each job's build cache hit or miss is
+  counted per node, so the hit rate shows whether routing keeps caches
+  warm.
+- A background thread checks every node's health every
+  CLUSTER_HEALTH_INTERVAL seconds. Nodes that fail a check or a job
+  request are skipped until they pass a check again.
+- A job that can't be delivered, or that a node turns away because it is
+  busy or draining, is retried on the next node, up to CLUSTER_RETRIES
+  times. Once a job has been delivered it is never sent again, even if
+  the answer times out or is lost, since the node may have run it; that
+  fails the job with JobLost instead.
+- POSTing to /editor/runner/drain/ (or creating CLUSTER_DRAIN_FILE) makes
+  a node refuse new jobs and report itself as draining while the jobs it
+  has finish, so it can be taken out of service without failing any runs.
+"""
+import bisect
+import hashlib
+import hmac
+import http.client
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from . import metrics, tracing
+from .scheduler import get_scheduler
+
+logger = logging.getLogger(__name__)
+
+ROUTING_POLICIES = ('least_loaded', 'consistent_hash')
+
+# Node answers that mean "try another node": busy, draining or no sandbox
+RETRY_STATUSES = (429, 502, 503, 504)
+
+
+class ClusterUnavailable(Exception):
+    pass
+
+
+class JobLost(Exception):
+    """A node took a job but its answer never came; status is the HTTP status to answer with."""
+
+    def __init__(self, message, status=502):
+        super().__init__(message)
+        self.status = status
+
+
+class Node:
+    def __init__(self, url):
+        self.url = url.rstrip('/') + '/'
+        self.healthy = True
+        self.draining = False
+        self.running = 0
+        self.queued = 0
+        self.capacity = 1
+        self.in_flight = 0
+        self.checked = None
+        self.cache_hits = 0
+        self.cache_lookups = 0
+
+    def active(self):
+        """Jobs on the node: the ones sent from here, or what it last reported if more."""
+        return max(self.in_flight, self.running) + self.queued
+
+    def load(self):
+        return self.active() / max(self.capacity, 1)
+
+    def stats(self):
+        return {'url': self.url, 'healthy': self.healthy, 'draining': self.draining,
+                'running': self.running, 'queued': self.queued, 'capacity': self.capacity,
+                'in_flight': self.in_flight,
+                'cache_hit_rate': self.cache_hits / self.cache_lookups if self.cache_lookups else None}
+
+
+def _point(value):
+    return int.from_bytes(hashlib.sha1(value.encode('utf-8', 'surrogatepass')).digest()[:8], 'big')
+
+
+def routing_key(language, code):
+    return f'{language}:{hashlib.sha256(code.encode("utf-8", "surrogatepass")).hexdigest()}'
+
+
+class Cluster:
+    def __init__(self, urls, secret, routing='consistent_hash', retries=2, virtual_nodes=64, load_factor=1.25,
+                 health_interval=5.0, health_timeout=2.0, request_timeout=120.0):
+        if routing not in ROUTING_POLICIES:
+            raise ValueError(f'CLUSTER_ROUTING must be one of {", ".join(ROUTING_POLICIES)}')
+        self.nodes = [Node(url) for url in urls]
+        self.secret = secret
+        self.routing = routing
+        self.retries = retries
+        self.load_factor = load_factor
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.request_timeout = request_timeout
+        self.lock = threading.Lock()
+        self.thread = None
+        # Each node appears virtual_nodes times on the ring, which evens out its share of keys
+        self.ring = sorted((_point(f'{node.url}#{i}'), index)
+                           for index, node in enumerate(self.nodes) for i in range(virtual_nodes))
+        self.points = [point for point, _ in self.ring]
+
+    def _ring_order(self, key):
+        start = bisect.bisect(self.points, _point(key))
+        order = []
+        for i in range(len(self.ring)):
+            node = self.nodes[self.ring[(start + i) % len(self.ring)][1]]
+            if node not in order:
+                order.append(node)
+                if len(order) == len(self.nodes):
+                    break
+        return order
+
+    def _candidates(self, key):
+        """
+        Healthy, non-draining nodes in the order to try them, and how the
+        first was picked: 'home' (the key's node), 'spill' (the next one on
+        the ring) or 'least_loaded'.
+        """
+        available = [node for node in self.nodes if node.healthy and not node.draining]
+        by_load = sorted(available, key=Node.load)
+        if self.routing != 'consistent_hash' or key is None or not available:
+            return by_load, 'least_loaded'
+
+        order = [node for node in self._ring_order(key) if node in available]
+        # Bounded loads: a node may take at most load_factor times its share
+        # of the jobs in flight, counting this one
+        jobs = sum(node.active() for node in available) + 1
+        capacity = sum(max(node.capacity, 1) for node in available)
+        within = lambda node: node.active() + 1 <= math.ceil(
+            self.load_factor * jobs * max(node.capacity, 1) / capacity)
+        if within(order[0]):
+            return order, 'home'
+        if len(order) > 1 and within(order[1]):
+            return order[1:] + order[:1], 'spill'
+        # Skewed: the key's nodes are all busy, so spread the job out instead
+        return by_load, 'least_loaded'
+
+    def dispatch(self, kind, user, args, key=None, weight=1.0):
+        """
+        Run a job on a node and return the node's (JSON body, status code).
+        Raises ClusterUnavailable if no node could take it, and JobLost if
+        one took it but didn't answer.
+        """
+        self._start_health_checks()
+        body = json.dumps({'kind': kind, 'user': user, 'weight': weight, 'args': args}).encode('utf-8')
+        with self.lock:
+            candidates, decision = self._candidates(key)
+            candidates = candidates[:self.retries + 1]
+        if not candidates:
+            raise ClusterUnavailable('No runner node is available')
+        metrics.cluster_routes.inc(decision=decision)
+        for node in candidates:
+            with self.lock:
+                node.in_flight += 1
+            try:
+                with tracing.span('dispatch', node=node.url, kind=kind):
+                    data, status = self._post(node, body)
+            except urllib.error.URLError as e:
+                # Not delivered (refused, unreachable, timed out connecting), so safe to send elsewhere
+                logger.error(f"Runner node {node.url} failed: {str(e)}")
+                metrics.cluster_dispatches.inc(node=node.url, outcome='failed')
+                with self.lock:
+                    node.healthy = False
+                continue
+            except (OSError, http.client.HTTPException, ValueError) as e:
+                # Delivered, then timed out, dropped or garbled: the job may have run, so don't run it twice
+                logger.error(f"Runner node {node.url} took a job but didn't answer: {str(e)}")
+                metrics.cluster_dispatches.inc(node=node.url, outcome='lost')
+                raise JobLost(f'The runner node did not answer: {e}',
+                              status=504 if isinstance(e, TimeoutError) else 502)
+            finally:
+                with self.lock:
+                    node.in_flight -= 1
+            if status in RETRY_STATUSES:
+                metrics.cluster_dispatches.inc(node=node.url, outcome='refused')
+                if data.get('draining'):
+                    with self.lock:
+                        node.draining = True
+                continue
+            metrics.cluster_dispatches.inc(node=node.url, outcome='ok')
+            cached = data.get('build_cached')
+            if cached is not None:
+                metrics.cluster_build_cache_lookups.inc(node=node.url, result='hit' if cached else 'miss')
+                with self.lock:
+                    node.cache_lookups += 1
+                    node.cache_hits += bool(cached)
+            return data, status
+        raise ClusterUnavailable('No runner node could take the job')
+
+    def _headers(self):
+        headers = {'Content-Type': 'application/json', 'Authorization': f'Bearer {self.secret}'}
+        traceparent = tracing.traceparent()
+        if traceparent:
+            headers['traceparent'] = traceparent
+        return headers
+
+    def _post(self, node, body):
+        request = urllib.request.Request(node.url + 'jobs/', data=body, headers=self._headers())
+        try:
+            with urllib.request.urlopen(request, timeout=self.request_timeout) as response:
+                return json.loads(response.read()), response.status
+        except urllib.error.HTTPError as e:
+            with e:
+                return json.loads(e.read() or b'{}'), e.code
+
+    def check(self, node):
+        """Refresh a node's health and load from its health endpoint."""
+        request = urllib.request.Request(node.url + 'health/', headers=self._headers())
+        try:
+            with urllib.request.urlopen(request, timeout=self.health_timeout) as response:
+                data = json.loads(response.read())
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            if node.healthy:
+                logger.error(f"Runner node {node.url} failed its health check: {str(e)}")
+            with self.lock:
+                node.healthy = False
+                node.checked = time.monotonic()
+            return
+        with self.lock:
+            node.healthy = True
+            node.draining = data.get('status') == 'draining'
+            node.running = data.get('running', 0)
+            node.queued = data.get('queued', 0)
+            node.capacity = data.get('capacity', 1)
+            node.checked = time.monotonic()
+
+    def _start_health_checks(self):
+        with self.lock:
+            # Started lazily so forked server workers each get their own thread
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._check_forever, daemon=True)
+                self.thread.start()
+
+    def _check_forever(self):
+        while True:
+            for node in self.nodes:
+                self.check(node)
+            time.sleep(self.health_interval)
+
+    def stats(self):
+        with self.lock:
+            return [node.stats() for node in self.nodes]
+
+
+_cluster = None
+_cluster_lock = threading.Lock()
+
+
+def get_cluster():
+    """The dispatcher for CLUSTER_NODES, or None when runs execute locally."""
+    global _cluster
+    with _cluster_lock:
+        if _cluster is None and getattr(settings, 'CLUSTER_NODES', []):
+            _cluster = Cluster(
+                settings.CLUSTER_NODES,
+                getattr(settings, 'CLUSTER_SECRET', ''),
+                routing=getattr(settings, 'CLUSTER_ROUTING', 'consistent_hash'),
+                retries=getattr(settings, 'CLUSTER_RETRIES', 2),
+                load_factor=getattr(settings, 'CLUSTER_LOAD_FACTOR', 1.25),
+                health_interval=getattr(settings, 'CLUSTER_HEALTH_INTERVAL', 5.0),
+                health_timeout=getattr(settings, 'CLUSTER_HEALTH_TIMEOUT', 2.0),
+                request_timeout=getattr(settings, 'CLUSTER_REQUEST_TIMEOUT', 120.0),
+            )
+        return _cluster
+
+
+# Runner side
+
+_active = 0
+_active_lock = threading.Lock()
+
+
+def authorized(request):
+    """Whether a request carries the cluster's bearer token; runner endpoints are off without one."""
+    secret = getattr(settings, 'CLUSTER_SECRET', '')
+    return bool(secret) and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {secret}')
+
+
+def _drain_file():
+    return getattr(settings, 'CLUSTER_DRAIN_FILE', os.path.join(tempfile.gettempdir(), 'codeeditor-draining'))
+
+
+def draining():
+    # A file rather than a flag, so every server worker on the node sees it
+    return os.path.exists(_drain_file())
+
+
+def set_draining(value):
+    if value:
+        open(_drain_file(), 'a').close()
+    else:
+        try:
+            os.remove(_drain_file())
+        except FileNotFoundError:
+            pass
+
+
+@contextmanager
+def running_job():
+    global _active
+    with _active_lock:
+        _active += 1
+    try:
+        yield
+    finally:
+        with _active_lock:
+            _active -= 1
+
+
+def node_status():
+    return {'status': 'draining' if draining() else 'ok', 'active': _active, **get_scheduler().stats()}
@@ -0,0 +1,564 @@
+"""
+Real-time collaborative editing over a WebSocket
+(/ws/collab/<project_id>/?path=src/main.py&name=alice).
+
+Each file being edited is held in memory as a Document: its text, a
+revision number, and the operations applied since the oldest revision a
+connected client may still build on. Edits are operational transforms in
+the ot.js format, a list of components covering the whole text:
+
+    5        keep the next 5 characters
+    "abc"    insert "abc"
+    -3       delete the next 3 characters
+
+Positions count UTF-16 code units, as JavaScript strings and CodeMirror do.
+
+On connect the server sends
+    {"type": "init", "client_id": N, "revision": R, "content": "...", "clients": [...]}
+The client sends {"type": "op", "revision": R, "ops": [...]} built on
+revision R and keeps at most one op in flight. The server transforms it
+past everything applied since R, applies it, replies {"type": "ack",
+"revision": R2} and sends {"type": "op", "client_id", "revision", "ops"}
+to everyone else. {"type": "cursor", "revision", "position", "anchor"} is
+relayed to the others, and "join"/"leave" messages announce presence. A
+client whose op can't be applied, or that fell further behind than the
+retained history, gets {"type": "resync", "revision", "content"} and
+starts over from there. So does everyone when the file is changed outside
+the session (a save, restore or import in this process); "renamed" and
+"closed" follow the file being moved or deleted.
+
+Documents are written back through the storage backend every
+COLLAB_SAVE_INTERVAL seconds while they have unsaved edits, and when the
+last client leaves; those writes are what file history records. Every
+client has its own send queue, so one slow connection never holds up the
+others; a client whose queue fills up is disconnected.
+
+Documents live in one server process, so a project's sessions must all
+be served by the same one. The process hosting any document of a project
+holds an exclusive lock on a file in COLLAB_LOCK_DIR until its last
+document of that project closes; other server processes on the host
+refuse collaboration on the project meanwhile instead of keeping a second
+copy that would overwrite the first. Run one ASGI worker, or route
+/ws/collab/<project_id>/ by project to a fixed worker (and host).
+"""
+import asyncio
+import fcntl
+import hashlib
+import itertools
+import json
+import logging
+import os
+import tempfile
+from urllib.parse import parse_qs
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.dispatch import receiver
+
+from .signals import file_changed
+from .storage import clean_path, clean_project_id, get_storage
+from .websocket import WebSocketDisconnect
+
+logger = logging.getLogger(__name__)
+
+
+def _units(text):
+    """Length of text in UTF-16 code units."""
+    if text.isascii():
+        return len(text)
+    return len(text.encode('utf-16-le')) // 2
+
+
+def normalize(ops):
+    """Validate a list of components, dropping empty ones and merging neighbours of the same kind."""
+    if not isinstance(ops, list):
+        raise ValueError('ops must be a list')
+    result = []
+    for component in ops:
+        if isinstance(component, bool) or not isinstance(component, (int, str)):
+            raise ValueError(f'Invalid component: {component!r}')
+        if isinstance(component, str):
+            try:
+                component.encode('utf-16-le')
+            except UnicodeEncodeError:
+                raise ValueError('Inserted text has an unpaired surrogate')
+        if component == 0 or component == '':
+            continue
+        previous = result[-1] if result else None
+        if isinstance(component, str) and isinstance(previous, str):
+            result[-1] = previous + component
+        elif (isinstance(component, int) and isinstance(previous, int)
+              and (component > 0) == (previous > 0)):
+            result[-1] = previous + component
+        else:
+            result.append(component)
+    return result
+
+
+def apply(text, ops):
+    """Apply ops to text. Raises ValueError if they don't cover it exactly."""
+    wide = not text.isascii()
+    source = text.encode('utf-16-le') if wide else text
+    unit = 2 if wide else 1
+    parts = []
+    index = 0
+    for component in ops:
+        if isinstance(component, str):
+            parts.append(component.encode('utf-16-le') if wide else component)
+            continue
+        end = index + abs(component) * unit
+        if end > len(source):
+            raise ValueError('Operation is longer than the document')
+        if component > 0:
+            parts.append(source[index:end])
+        index = end
+    if index != len(source):
+        raise ValueError('Operation is shorter than the document')
+    if not wide:
+        return ''.join(parts)
+    try:
+        return b''.join(parts).decode('utf-16-le')
+    except UnicodeDecodeError:
+        raise ValueError('Operation splits a surrogate pair')
+
+
+def transform(a, b):
+    """
+    Transform a and b, both built on the same text, into (a2, b2) such that
+    applying a then b2 gives the same text as b then a2. Where both insert
+    at the same place, a's text goes first.
+    """
+    a2, b2 = [], []
+    a_iter, b_iter = iter(a), iter(b)
+    ca, cb = next(a_iter, None), next(b_iter, None)
+    while ca is not None or cb is not None:
+        if isinstance(ca, str):
+            a2.append(ca)
+            b2.append(_units(ca))
+            ca = next(a_iter, None)
+            continue
+        if isinstance(cb, str):
+            a2.append(_units(cb))
+            b2.append(cb)
+            cb = next(b_iter, None)
+            continue
+        if ca is None or cb is None:
+            raise ValueError('Operations are built on different documents')
+        length = min(abs(ca), abs(cb))
+        if ca > 0 and cb > 0:
+            a2.append(length)
+            b2.append(length)
+        elif ca < 0 and cb > 0:
+            a2.append(-length)
+        elif ca > 0 and cb < 0:
+            b2.append(-length)
+        # Both deleting the same text: nothing left for either to do
+        ca = ca - length if ca > 0 else ca + length
+        cb = cb - length if cb > 0 else cb + length
+        if ca == 0:
+            ca = next(a_iter, None)
+        if cb == 0:
+            cb = next(b_iter, None)
+    return normalize(a2), normalize(b2)
+
+
+def transform_position(position, ops):
+    """Where a position in the text before ops ends up after them."""
+    new_position = position
+    index = 0
+    for component in ops:
+        if isinstance(component, str):
+            new_position += _units(component)
+        elif component > 0:
+            index += component
+        else:
+            new_position -= min(position - index, -component)
+            index -= component
+        if index > position:
+            break
+    return new_position
+
+
+class DocumentError(Exception):
+    """A file can't be opened for collaborative editing."""
+
+
+class _Client:
+    _ids = itertools.count(1)
+
+    def __init__(self, websocket, name, revision):
+        self.websocket = websocket
+        self.id = next(self._ids)
+        self.name = name
+        # The oldest revision this client can still send ops against
+        self.revision = revision
+        self.queue = asyncio.Queue(maxsize=getattr(settings, 'COLLAB_SEND_QUEUE', 1000))
+        self.dropped = False
+
+    def info(self):
+        return {'id': self.id, 'name': self.name}
+
+    def send(self, text):
+        if self.dropped:
+            return
+        try:
+            self.queue.put_nowait(text)
+        except asyncio.QueueFull:
+            # Too slow to keep up; it can reconnect and start from the current text
+            self.disconnect()
+
+    def send_json(self, data):
+        self.send(json.dumps(data))
+
+    def disconnect(self, discard=True):
+        """Close the connection once the writer gets to it, by default dropping anything not yet sent."""
+        if self.dropped:
+            return
+        self.dropped = True
+        if discard or self.queue.full():
+            while not self.queue.empty():
+                self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+    async def write(self):
+        try:
+            while True:
+                text = await self.queue.get()
+                if text is None:
+                    await self.websocket.close(1013)
+                    return
+                await self.websocket.send_text(text)
+        except Exception:
+            # The connection is gone; the reader side will notice and clean up
+            pass
+
+
+def _write_file(project_id, path, text):
+    try:
+        get_storage().write(project_id, path, text.encode('utf-8'))
+        for handler, result in file_changed.send_robust(sender=Document, project_id=project_id,
+                                                        path=path, event='modified'):
+            if isinstance(result, Exception):
+                logger.error(f"Error in file_changed receiver {handler.__name__}: {str(result)}")
+    finally:
+        close_old_connections()
+
+
+def _read_file(project_id, path):
+    try:
+        return get_storage().read(project_id, path)
+    finally:
+        close_old_connections()
+
+
+class Document:
+    def __init__(self, registry, project_id, path, text):
+        self.registry = registry
+        self.project_id = project_id
+        self.path = path
+        self.text = text
+        self.revision = 0
+        # history[i] took the text from revision base_revision + i to the next one
+        self.history = []
+        self.base_revision = 0
+        self.clients = {}
+        self.dirty = False
+        self.closed = False
+        self.save_lock = asyncio.Lock()
+        self.autosave_task = None
+        self.history_limit = getattr(settings, 'COLLAB_HISTORY_LIMIT', 1000)
+        self.max_size = getattr(settings, 'COLLAB_MAX_DOCUMENT_SIZE', 2 * 1024 * 1024)
+
+    def broadcast(self, data, exclude=None):
+        # Serialized once however many clients there are
+        text = json.dumps(data)
+        for client in list(self.clients.values()):
+            if client is not exclude:
+                client.send(text)
+
+    def join(self, websocket, name):
+        if len(self.clients) >= getattr(settings, 'COLLAB_MAX_CLIENTS', 500):
+            raise DocumentError('Too many people are editing this file')
+        client = _Client(websocket, name, self.revision)
+        client.send_json({'type': 'init', 'client_id': client.id, 'revision': self.revision,
+                          'content': self.text, 'path': self.path,
+                          'clients': [other.info() for other in self.clients.values()]})
+        self.broadcast({'type': 'join', 'client': client.info()})
+        self.clients[client.id] = client
+        return client
+
+    def leave(self, client):
+        if self.clients.pop(client.id, None) is not None:
+            self.broadcast({'type': 'leave', 'client_id': client.id})
+
+    def resync(self, client):
+        client.revision = self.revision
+        client.send_json({'type': 'resync', 'revision': self.revision, 'content': self.text})
+
+    def handle(self, client, message):
+        if self.closed:
+            return
+        kind = message.get('type') if isinstance(message, dict) else None
+        if kind == 'op':
+            self._receive_op(client, message.get('revision'), message.get('ops'))
+        elif kind == 'cursor':
+            self._receive_cursor(client, message)
+        else:
+            client.send_json({'type': 'error', 'error': 'Unknown message type'})
+
+    def _receive_op(self, client, revision, ops):
+        if not isinstance(revision, int) or isinstance(revision, bool) or revision > self.revision:
+            client.send_json({'type': 'error', 'error': 'Unknown revision'})
+            self.resync(client)
+            return
+        if revision < self.base_revision:
+            self.resync(client)
+            return
+        try:
+            ops = normalize(ops)
+            for concurrent in self.history[revision - self.base_revision:]:
+                ops, _ = transform(ops, concurrent)
+            text = apply(self.text, ops)
+            if len(text) > self.max_size:
+                raise ValueError(f'Documents are limited to {self.max_size} characters')
+        except ValueError as e:
+            client.send_json({'type': 'error', 'error': str(e)})
+            self.resync(client)
+            return
+        self.text = text
+        self.history.append(ops)
+        self.revision += 1
+        self.dirty = True
+        client.revision = self.revision
+        client.send_json({'type': 'ack', 'revision': self.revision})
+        self.broadcast({'type': 'op', 'client_id': client.id, 'revision': self.revision, 'ops': ops},
+                       exclude=client)
+        if len(self.history) > 2 * self.history_limit:
+            self.compact()
+
+    def _receive_cursor(self, client, message):
+        revision = message.get('revision')
+        if not isinstance(revision, int) or not self.base_revision <= revision <= self.revision:
+            return
+        # The client has seen this revision, so it won't send ops built on older ones
+        client.revision = max(client.revision, revision)
+        positions = []
+        for key in ('position', 'anchor'):
+            position = message.get(key, message.get('position'))
+            if not isinstance(position, int) or position < 0:
+                return
+            for ops in self.history[revision - self.base_revision:]:
+                position = transform_position(position, ops)
+            positions.append(position)
+        self.broadcast({'type': 'cursor', 'client_id': client.id, 'revision': self.revision,
+                        'position': positions[0], 'anchor': positions[1]}, exclude=client)
+
+    def compact(self):
+        """Drop history no connected client can still build on, keeping at most history_limit ops."""
+        oldest = min((client.revision for client in self.clients.values()), default=self.revision)
+        oldest = max(oldest, self.revision - self.history_limit)
+        if oldest > self.base_revision:
+            del self.history[:oldest - self.base_revision]
+            self.base_revision = oldest
+
+    async def save(self):
+        async with self.save_lock:
+            if not self.dirty or self.closed:
+                return
+            self.dirty = False
+            loop = asyncio.get_running_loop()
+            try:
+                await loop.run_in_executor(None, _write_file, self.project_id, self.path, self.text)
+            except Exception as e:
+                self.dirty = True
+                logger.error(f"Error saving {self.project_id}/{self.path}: {str(e)}")
+
+    async def autosave(self):
+        interval = getattr(settings, 'COLLAB_SAVE_INTERVAL', 5)
+        while True:
+            await asyncio.sleep(interval)
+            await self.save()
+            self.compact()
+
+    async def reload(self):
+        """Take the stored text, when the file was changed outside the session."""
+        loop = asyncio.get_running_loop()
+        try:
+            data = await loop.run_in_executor(None, _read_file, self.project_id, self.path)
+            text = data.decode('utf-8')
+        except (OSError, UnicodeDecodeError) as e:
+            logger.error(f"Error reloading {self.project_id}/{self.path}: {str(e)}")
+            return
+        if self.closed or text == self.text:
+            return
+        self.text = text
+        self.revision += 1
+        self.history = []
+        self.base_revision = self.revision
+        self.dirty = False
+        for client in self.clients.values():
+            client.revision = self.revision
+        self.broadcast({'type': 'resync', 'revision': self.revision, 'content': self.text})
+
+    def close(self, reason):
+        """Disconnect everyone without saving, e.g. because the file was deleted."""
+        self.closed = True
+        if self.autosave_task:
+            self.autosave_task.cancel()
+        self.broadcast({'type': 'closed', 'reason': reason})
+        for client in self.clients.values():
+            client.disconnect(discard=False)
+
+
+def _lock_dir():
+    return getattr(settings, 'COLLAB_LOCK_DIR', '') or os.path.join(tempfile.gettempdir(), 'codeeditor-collab')
+
+
+class Registry:
+    """The documents open in this process, by (project_id, path)."""
+
+    def __init__(self):
+        self.documents = {}
+        self.loading = {}
+        self.loop = None
+        # project_id -> open lock file, for projects this process hosts documents of
+        self.locks = {}
+
+    def _claim(self, project_id):
+        """Become the process hosting project_id's documents, or raise DocumentError."""
+        if project_id in self.locks:
+            return
+        os.makedirs(_lock_dir(), exist_ok=True)
+        name = hashlib.sha1(project_id.encode('utf-8', 'surrogatepass')).hexdigest()
+        fd = os.open(os.path.join(_lock_dir(), name), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            raise DocumentError('Another server process hosts the editing sessions of this project')
+        self.locks[project_id] = fd
+
+    def _release(self, project_id):
+        """Let another process host the project once nothing of it is open or loading here."""
+        if any(key[0] == project_id for key in (*self.documents, *self.loading)):
+            return
+        fd = self.locks.pop(project_id, None)
+        if fd is not None:
+            os.close(fd)
+
+    async def open(self, project_id, path):
+        self.loop = asyncio.get_running_loop()
+        key = (project_id, path)
+        while key not in self.documents:
+            if key in self.loading:
+                await asyncio.shield(self.loading[key])
+                continue
+            self._claim(project_id)
+            self.loading[key] = self.loop.create_future()
+            try:
+                document = await self._load(project_id, path)
+                self.documents[key] = document
+                document.autosave_task = asyncio.create_task(document.autosave())
+            finally:
+                self.loading.pop(key).set_result(None)
+                self._release(project_id)
+        return self.documents[key]
+
+    async def _load(self, project_id, path):
+        try:
+            data = await self.loop.run_in_executor(None, _read_file, project_id, path)
+        except FileNotFoundError:
+            raise DocumentError('File not found')
+        except IsADirectoryError:
+            raise DocumentError('Path is a folder')
+        max_size = getattr(settings, 'COLLAB_MAX_DOCUMENT_SIZE', 2 * 1024 * 1024)
+        if len(data) > max_size:
+            raise DocumentError(f'Files over {max_size} bytes can\'t be edited together')
+        try:
+            text = data.decode('utf-8')
+        except UnicodeDecodeError:
+            raise DocumentError('Not a text file')
+        return Document(self, project_id, path, text)
+
+    async def leave(self, document, client):
+        document.leave(client)
+        if document.clients:
+            return
+        await document.save()
+        # Someone may have joined while it was saving
+        key = (document.project_id, document.path)
+        if not document.clients and self.documents.get(key) is document:
+            document.closed = True
+            document.autosave_task.cancel()
+            del self.documents[key]
+            self._release(document.project_id)
+
+    def external_change(self, project_id, path, event, old_path):
+        for key, document in list(self.documents.items()):
+            if key[0] != project_id:
+                continue
+            inside = not path or key[1] == path or key[1].startswith(path + '/')
+            if event == 'deleted' and inside:
+                del self.documents[key]
+                document.close('deleted')
+                self._release(project_id)
+            elif event == 'renamed' and old_path and (key[1] == old_path or key[1].startswith(old_path + '/')):
+                document.path = path + key[1][len(old_path):]
+                del self.documents[key]
+                self.documents[(project_id, document.path)] = document
+                document.broadcast({'type': 'renamed', 'path': document.path})
+            elif event in ('created', 'modified', 'reset') and inside:
+                asyncio.create_task(document.reload())
+
+
+_registry = Registry()
+
+
+@receiver(file_changed)
+def reload_documents(sender, project_id, path, event, old_path=None, **kwargs):
+    """Bring open documents in line with changes made outside the session."""
+    loop = _registry.loop
+    if sender is Document or loop is None or not _registry.documents:
+        return
+    try:
+        path = clean_path(path) if path else ''
+        old_path = clean_path(old_path) if old_path else None
+    except ValueError:
+        return
+    try:
+        loop.call_soon_threadsafe(_registry.external_change, project_id, path, event, old_path)
+    except RuntimeError:
+        # The event loop has shut down
+        pass
+
+
+async def collaborate(websocket, project_id):
+    await websocket.accept()
+    query = parse_qs(websocket.query_string)
+    try:
+        project_id = clean_project_id(project_id)
+        path = clean_path(query.get('path', [''])[0])
+        if not path:
+            raise ValueError('path is required')
+        document = await _registry.open(project_id, path)
+        client = document.join(websocket, query.get('name', [''])[0][:100])
+    except (ValueError, DocumentError) as e:
+        await websocket.send_json({'type': 'error', 'error': str(e)})
+        await websocket.close()
+        return
+
+    writer = asyncio.create_task(client.write())
+    try:
+        while not client.dropped:
+            try:
+                message = await websocket.receive_json()
+            except ValueError:
+                client.send_json({'type': 'error', 'error': 'Invalid JSON data'})
+                continue
+            document.handle(client, message)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        await _registry.leave(document, client)
+        if not client.dropped:
+            writer.cancel()
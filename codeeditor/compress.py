@@ -0,0 +1,78 @@
+"""
+Content-Encoding negotiation for large JSON responses.
+
+gzip is always available; zstd and brotli are used when the zstandard or
+brotli package is installed. The client's Accept-Encoding q-values decide
+first, then the order in PREFERENCE.
+"""
+import gzip
+
+from django.http import JsonResponse
+from django.utils.cache import patch_vary_headers
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Best first: zstd and brotli compress source text better than gzip, and zstd is fastest
+PREFERENCE = ('zstd', 'br', 'gzip')
+
+
+def available_encodings():
+    encodings = []
+    if zstandard is not None:
+        encodings.append('zstd')
+    if brotli is not None:
+        encodings.append('br')
+    encodings.append('gzip')
+    return encodings
+
+
+def negotiate(accept_encoding):
+    """The best encoding the client accepts, or None for identity."""
+    accepted = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.strip().partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name:
+            accepted[name.strip().lower()] = quality
+    candidates = []
+    for encoding in available_encodings():
+        quality = accepted.get(encoding, accepted.get('*', 0.0))
+        if quality > 0:
+            candidates.append((-quality, PREFERENCE.index(encoding), encoding))
+    return min(candidates)[-1] if candidates else None
+
+
+def compress(data, encoding):
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=6).compress(data)
+    if encoding == 'br':
+        return brotli.compress(data, quality=5)
+    return gzip.compress(data, compresslevel=6)
+
+
+def compressed_json_response(request, data, min_size=1024, **kwargs):
+    """A JsonResponse, compressed with the best encoding the client accepts if it is big enough."""
+    response = JsonResponse(data, **kwargs)
+    patch_vary_headers(response, ('Accept-Encoding',))
+    if len(response.content) < min_size:
+        return response
+    encoding = negotiate(request.headers.get('Accept-Encoding', ''))
+    if encoding is not None:
+        response.content = compress(response.content, encoding)
+        response['Content-Encoding'] = encoding
+    return response
@@ -0,0 +1,441 @@
+"""
+Syntax checking and linting for the editor (/editor/diagnostics/).
+
+Checks run without going through the execution path, so the editor can
+show errors as the user types:
+
+- Python is parsed and compiled in-process (no code runs), and linted
+  with pyflakes when it is installed.
+- JSON is parsed in-process.
+- JavaScript is parsed by a resident Node.js process that stays alive
+  between checks (vm.Script, which compiles without running anything).
+- C and C++ use the compiler's -fsyntax-only mode, in a temporary
+  directory holding copies of the project's header files for its local
+  includes. Like runs, each compiler check takes an execution slot from
+  the scheduler.
+
+Results are cached per file and content hash, so an unchanged buffer is
+never checked twice, and files saved through the editor are re-checked in
+the background so the next request for them is a cache hit.
+
+A diagnostic is {line, column, end_line, end_column, severity, message,
+source}, with 1-based lines and columns; severity is 'error' or 'warning'.
+"""
+import ast
+import hashlib
+import json
+import logging
+import os
+import posixpath
+import re
+import select
+import subprocess
+import threading
+import time
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.dispatch import receiver
+
+from . import tracing
+from .executor import run_process, spawn_process, work_directory
+from .sandbox import SandboxError
+from .scheduler import AdmissionRejected, get_scheduler
+from .signals import file_changed
+
+try:
+    from pyflakes import checker as pyflakes_checker
+except ImportError:
+    pyflakes_checker = None
+
+logger = logging.getLogger(__name__)
+
+EXTENSIONS = {
+    '.py': 'python',
+    '.pyw': 'python',
+    '.json': 'json',
+    '.js': 'javascript',
+    '.mjs': 'javascript',
+    '.cjs': 'javascript',
+    '.c': 'c',
+    '.h': 'c',
+    '.cpp': 'cpp',
+    '.cc': 'cpp',
+    '.cxx': 'cpp',
+    '.hpp': 'cpp',
+}
+
+# Resident JavaScript checker: one JSON request per line in, one reply per line out
+NODE_DRIVER = r'''
+const vm = require('vm');
+const childProcess = require('child_process');
+const readline = require('readline');
+
+// Node prints a SyntaxError's location as "file:line", the source line and a caret line
+function located(stack, message) {
+  const lines = stack.split('\n');
+  const where = /:(\d+)$/.exec(lines[0]);
+  if (!where) return {line: 1, column: 1, end_column: 1, message};
+  const carets = lines[2] || '';
+  const start = carets.indexOf('^');
+  const end = carets.lastIndexOf('^');
+  return {
+    line: Number(where[1]),
+    column: start >= 0 ? start + 1 : 1,
+    end_column: start >= 0 ? end + 2 : 1,
+    message,
+  };
+}
+
+function checkModule(source) {
+  const result = childProcess.spawnSync(process.execPath, ['--check', '--input-type=module'],
+                                        {input: source, encoding: 'utf8'});
+  if (result.status === 0) return [];
+  const stderr = result.stderr || '';
+  const message = /^SyntaxError: (.*)$/m.exec(stderr);
+  return [located(stderr, message ? message[1] : stderr.trim().split('\n').pop())];
+}
+
+function check(source) {
+  try {
+    new vm.Script(source, {filename: 'main.js'});
+    return [];
+  } catch (e) {
+    if (!(e instanceof SyntaxError)) return [];
+    if (/import statement outside a module|Unexpected token 'export'|import\.meta/.test(e.message)) {
+      return checkModule(source);
+    }
+    return [located(e.stack || '', e.message)];
+  }
+}
+
+readline.createInterface({input: process.stdin}).on('line', (line) => {
+  let reply;
+  try {
+    reply = {diagnostics: check(JSON.parse(line).source)};
+  } catch (e) {
+    reply = {error: String(e)};
+  }
+  process.stdout.write(JSON.stringify(reply) + '\n');
+});
+'''
+
+# Files copied next to a C or C++ source for its #include "..." lines
+HEADER_EXTENSIONS = ('.h', '.hh', '.hpp', '.hxx', '.inc')
+
+# Who background re-checks are admitted as
+BACKGROUND_USER = 'system:diagnostics'
+
+# file:line:column: severity: message, as printed by gcc and clang
+_COMPILER_MESSAGE = re.compile(r'^<stdin>:(\d+):(\d+): (fatal error|error|warning): (.*)$')
+
+
+class DiagnosticsError(Exception):
+    """A checker could not produce a result (crashed, timed out or is missing)."""
+
+
+def language_for(path):
+    """The checkable language of a file, from its extension, or None."""
+    return EXTENSIONS.get(os.path.splitext(path or '')[1].lower())
+
+
+def diagnostic(line, column, message, severity='error', source=None, end_line=None, end_column=None):
+    return {
+        'line': max(line or 1, 1),
+        'column': max(column or 1, 1),
+        'end_line': max(end_line or line or 1, 1),
+        'end_column': max(end_column or column or 1, 1),
+        'severity': severity,
+        'message': message,
+        'source': source,
+    }
+
+
+_compile_lock = threading.Lock()
+
+
+def check_python(source, **kwargs):
+    try:
+        # Compiling (not just parsing) also catches errors like 'return' outside a function
+        with _compile_lock, warnings.catch_warnings(record=True) as caught:
+            # Older Pythons warn about invalid escape sequences with DeprecationWarning
+            warnings.simplefilter('always', SyntaxWarning)
+            warnings.simplefilter('always', DeprecationWarning)
+            tree = ast.parse(source, 'main.py')
+            compile(tree, 'main.py', 'exec', dont_inherit=True)
+    except SyntaxError as e:
+        end_line = getattr(e, 'end_lineno', None)
+        end_column = getattr(e, 'end_offset', None)
+        return [diagnostic(e.lineno, e.offset, f'{type(e).__name__}: {e.msg}', source='python',
+                           end_line=end_line, end_column=end_column if end_column and end_column > 0 else None)]
+    except (ValueError, RecursionError, MemoryError) as e:
+        return [diagnostic(1, 1, f'{type(e).__name__}: {e}', source='python')]
+    diagnostics = [diagnostic(w.lineno, 1, str(w.message), severity='warning', source='python')
+                   for w in caught if issubclass(w.category, (SyntaxWarning, DeprecationWarning))]
+    if pyflakes_checker is not None:
+        for message in pyflakes_checker.Checker(tree, filename='main.py').messages:
+            diagnostics.append(diagnostic(message.lineno, getattr(message, 'col', 0) + 1,
+                                          message.message % message.message_args,
+                                          severity='warning', source='pyflakes'))
+    return sorted(diagnostics, key=lambda d: (d['line'], d['column']))
+
+
+def check_json(source, **kwargs):
+    try:
+        json.loads(source)
+    except json.JSONDecodeError as e:
+        return [diagnostic(e.lineno, e.colno, e.msg, source='json')]
+    except RecursionError:
+        return [diagnostic(1, 1, 'Nested too deeply', source='json')]
+    return []
+
+
+class ResidentChecker:
+    """
+    A long-lived checker process answering one JSON request per line.
+
+    Started on first use and restarted if it dies or stops answering, so
+    each check only costs a round trip instead of a process start.
+    """
+
+    def __init__(self, args, language, name):
+        self.args = args
+        self.language = language
+        self.name = name
+        self.process = None
+        self.buffer = b''
+        self.lock = threading.Lock()
+
+    def _start(self):
+        self.process = spawn_process(self.args, timeout=24 * 3600, language=self.language,
+                                     memory_limit_mb=getattr(settings, 'DIAGNOSTICS_MEMORY_LIMIT_MB', 1024) or None)
+        self.buffer = b''
+        # Nothing reads the checker's stderr; keep it from filling the pipe
+        self.process.stderr.close()
+
+    def _stop(self):
+        if self.process is None:
+            return
+        try:
+            self.process.kill()
+            self.process.wait(timeout=5)
+        except Exception:
+            pass
+        for stream in (self.process.stdin, self.process.stdout):
+            try:
+                stream.close()
+            except OSError:
+                pass
+        self.process = None
+
+    def _read_line(self, deadline):
+        fd = self.process.stdout.fileno()
+        while b'\n' not in self.buffer:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise DiagnosticsError(f'The {self.name} checker timed out')
+            ready, _, _ = select.select([fd], [], [], remaining)
+            if ready:
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    raise DiagnosticsError(f'The {self.name} checker exited')
+                self.buffer += chunk
+        line, _, self.buffer = self.buffer.partition(b'\n')
+        return line
+
+    def request(self, payload, timeout):
+        with self.lock:
+            try:
+                if self.process is None or self.process.poll() is not None:
+                    self._stop()
+                    self._start()
+                self.process.stdin.write(json.dumps(payload).encode('utf-8') + b'\n')
+                self.process.stdin.flush()
+                reply = json.loads(self._read_line(time.monotonic() + timeout))
+            except (OSError, ValueError) as e:
+                self._stop()
+                raise DiagnosticsError(f'The {self.name} checker failed: {e}')
+            except DiagnosticsError:
+                self._stop()
+                raise
+        if 'error' in reply:
+            raise DiagnosticsError(f'The {self.name} checker failed: {reply["error"]}')
+        return reply
+
+    def close(self):
+        with self.lock:
+            self._stop()
+
+
+_node_checker = ResidentChecker(['node', '-e', NODE_DRIVER], 'javascript', 'JavaScript')
+
+
+def check_javascript(source, **kwargs):
+    reply = _node_checker.request({'source': source}, getattr(settings, 'DIAGNOSTICS_TIMEOUT', 5))
+    return [diagnostic(d['line'], d['column'], d['message'], source='javascript', end_column=d.get('end_column'))
+            for d in reply['diagnostics']]
+
+
+def project_headers(project_id):
+    """The project's header files as {path: bytes}, up to DIAGNOSTICS_MAX_SIZE bytes in all."""
+    from .storage import get_storage
+    storage = get_storage()
+    ignored_dirs = set(getattr(settings, 'SEARCH_IGNORED_DIRS', []))
+    paths = sorted(path for path in storage.versions(project_id, ignored_dirs=ignored_dirs)
+                   if os.path.splitext(path)[1].lower() in HEADER_EXTENSIONS)
+    limit = getattr(settings, 'DIAGNOSTICS_MAX_SIZE', 1024 * 1024)
+    headers = {}
+    total = 0
+    for path, data in storage.read_many(project_id, paths).items():
+        if isinstance(data, OSError):
+            continue
+        total += len(data)
+        if total > limit:
+            break
+        headers[path] = data
+    return headers
+
+
+def _compiler_checker(compiler, language):
+    def check(source, project_id=None, path=None, admit=None, **kwargs):
+        args = [compiler, '-fsyntax-only', '-fdiagnostics-color=never', '-Wall', '-x', language, '-']
+        with work_directory() as work_dir:
+            # Reading the source from stdin, #include "..." is resolved from the
+            # working directory: the file's folder among copies of the headers
+            headers = project_headers(project_id) if project_id and path else {}
+            for name, data in headers.items():
+                target = os.path.join(work_dir, *name.split('/'))
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                with open(target, 'wb') as f:
+                    f.write(data)
+            cwd = os.path.join(work_dir, *posixpath.dirname(path or '').split('/'))
+            os.makedirs(cwd, exist_ok=True)
+            try:
+                with admit() if admit else get_scheduler().admit(BACKGROUND_USER, rate_limited=False):
+                    result = run_process(args, timeout=getattr(settings, 'DIAGNOSTICS_TIMEOUT', 5),
+                                         input=source, cwd=cwd, binds=[work_dir], language=language,
+                                         phase='check')
+            except subprocess.TimeoutExpired:
+                raise DiagnosticsError(f'{compiler} timed out')
+            except OSError as e:
+                raise DiagnosticsError(f'{compiler} is not available: {e}')
+        diagnostics = []
+        for line in result.stderr.splitlines():
+            match = _COMPILER_MESSAGE.match(line)
+            if match:
+                severity = 'warning' if match.group(3) == 'warning' else 'error'
+                diagnostics.append(diagnostic(int(match.group(1)), int(match.group(2)), match.group(4),
+                                              severity=severity, source=compiler))
+        return diagnostics
+    return check
+
+
+CHECKERS = {
+    'python': check_python,
+    'json': check_json,
+    'javascript': check_javascript,
+    'c': _compiler_checker('gcc', 'c'),
+    'cpp': _compiler_checker('g++', 'c++'),
+}
+
+
+class ResultCache:
+    """LRU of check results, keyed by file (or content) and validated by content hash."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, digest):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != digest:
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, digest, diagnostics):
+        with self.lock:
+            self.entries[key] = (digest, diagnostics)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def discard(self, project_id, path):
+        """Forget results for a file, or everything under a folder ('' for the whole project)."""
+        prefix = path + '/' if path else ''
+        with self.lock:
+            for key in [key for key in self.entries
+                        if key[0] == project_id and (not path or key[1] == path or key[1].startswith(prefix))]:
+                del self.entries[key]
+
+
+_cache = ResultCache(getattr(settings, 'DIAGNOSTICS_CACHE_SIZE', 5000))
+
+
+def check(source, language=None, project_id=None, path=None, admit=None):
+    """
+    Diagnostics for source, as (diagnostics, cached), or None if its language has no checker.
+
+    With project_id and path the result is cached for that file, and a
+    compiler finds the file's local includes among the project's headers;
+    otherwise it is cached for the content itself. admit() returns the
+    scheduler admission a compiler check runs under (by default one for
+    BACKGROUND_USER).
+    """
+    language = language or language_for(path)
+    checker = CHECKERS.get(language)
+    if checker is None:
+        return None
+    digest = hashlib.sha1(source.encode('utf-8', 'surrogatepass')).hexdigest()
+    key = (project_id, path, language) if project_id and path else ('', digest, language)
+    diagnostics = _cache.get(key, digest)
+    if diagnostics is not None:
+        return diagnostics, True
+    with tracing.span('diagnostics', language=language):
+        diagnostics = checker(source, project_id=project_id, path=path, admit=admit)
+    _cache.put(key, digest, diagnostics)
+    return diagnostics, False
+
+
+_recheck_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='diagnostics')
+_pending = set()
+_pending_lock = threading.Lock()
+
+
+def _recheck(project_id, path):
+    from .storage import get_storage
+    with _pending_lock:
+        _pending.discard((project_id, path))
+    try:
+        data = get_storage().read(project_id, path)
+        if len(data) > getattr(settings, 'DIAGNOSTICS_MAX_SIZE', 1024 * 1024):
+            return
+        check(data.decode('utf-8'), project_id=project_id, path=path)
+    except (OSError, UnicodeDecodeError, DiagnosticsError, AdmissionRejected, SandboxError):
+        pass
+    except Exception as e:
+        logger.error(f"Error re-checking {project_id}/{path}: {str(e)}")
+
+
+@receiver(file_changed)
+def recheck_file(sender, project_id, path, event, old_path=None, **kwargs):
+    """Re-check saved files in the background, and forget results for deleted ones."""
+    path = posixpath.normpath(path).strip('/') if path else ''
+    if path.startswith('..'):
+        return
+    if event in ('deleted', 'reset') or not path:
+        _cache.discard(project_id, path)
+        return
+    if event == 'renamed' and old_path:
+        _cache.discard(project_id, posixpath.normpath(old_path).strip('/'))
+    if not getattr(settings, 'DIAGNOSTICS_RECHECK_ON_SAVE', True) or language_for(path) is None:
+        return
+    with _pending_lock:
+        if (project_id, path) in _pending:
+            return
+        _pending.add((project_id, path))
+    _recheck_pool.submit(_recheck, project_id, path)
@@ -3,9 +3,299 @@ import tempfile
 import os
 import json
 import sys
+import signal
+import threading
+import time
+import resource
+import shutil
 import traceback
+from contextlib import contextmanager
+from django.conf import settings
+from . import metrics, sandbox, tracing
 
-def execute_code(code, language='python', filename=''):
+# Wall-clock limit for each compile or run step, in seconds
+EXECUTION_TIMEOUT = 10
+
+def run_process(args, timeout=EXECUTION_TIMEOUT, input=None, cwd=None, binds=(), language=None,
+                phase='run'):
+    """
+    Run a compiler or user program and capture its output.
+
+    With SANDBOX_ENABLED the process runs in a fresh namespace sandbox, and
+    binds lists the temp files/directories it needs to see. Otherwise it runs
+    directly on the host. Either way the result looks like subprocess.run
+    with capture_output=True, text=True. phase ('compile' or 'run') labels
+    the step in the execution metrics and trace.
+    """
+    start = time.monotonic()
+    outcome = 'failed'
+    try:
+        with tracing.span(phase, language=language):
+            if getattr(settings, 'SANDBOX_ENABLED', False):
+                result = sandbox.run(args, timeout=timeout, input=input, cwd=cwd,
+                                     binds=binds, language=language)
+            else:
+                # An empty input gives the program EOF instead of the server's own stdin
+                result = subprocess.run(args,
+                                        capture_output=True,
+                                        text=True,
+                                        timeout=timeout,
+                                        input=input or '',
+                                        cwd=cwd)
+        outcome = 'ok' if result.returncode == 0 else 'error'
+        return result
+    except subprocess.TimeoutExpired:
+        outcome = 'timeout'
+        raise
+    finally:
+        metrics.record_execution(language, phase, outcome, time.monotonic() - start)
+
+def _limit_address_space(process, memory_limit_mb):
+    """
+    Cap a just-started program's address space. It is set from here rather
+    than in a preexec_fn, which can deadlock in a threaded server; whatever
+    the program maps before this lands still counts in its peak memory.
+    """
+    if not memory_limit_mb:
+        return
+    limit = memory_limit_mb * 1024 * 1024
+    try:
+        resource.prlimit(process.pid, resource.RLIMIT_AS, (limit, limit))
+    except (OSError, ValueError):
+        pass
+
+def spawn_process(args, timeout=EXECUTION_TIMEOUT, cwd=None, binds=(), language=None, env=None,
+                  memory_limit_mb=None):
+    """
+    Start a user program with stdin, stdout and stderr pipes.
+
+    Returns a Popen-like object. In the sandbox the program is killed after
+    timeout seconds; on the host the caller is responsible for killing it,
+    and it leads a new process group so whatever it starts can be killed
+    with it. memory_limit_mb caps its address space.
+    """
+    if getattr(settings, 'SANDBOX_ENABLED', False):
+        return sandbox.spawn(args, timeout=timeout, cwd=cwd, binds=binds, language=language, env=env,
+                             memory_limit_mb=memory_limit_mb)
+    process = subprocess.Popen(args,
+                               stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE,
+                               cwd=cwd,
+                               env={**os.environ, **env} if env else None,
+                               start_new_session=True)
+    _limit_address_space(process, memory_limit_mb)
+    return process
+
+def _read_pipe(pipe, chunks):
+    for chunk in iter(lambda: pipe.read(65536), b''):
+        chunks.append(chunk)
+
+def _write_pipe(pipe, data):
+    try:
+        pipe.write(data)
+        pipe.close()
+    except (BrokenPipeError, OSError):
+        pass
+
+def run_measured(args, timeout=EXECUTION_TIMEOUT, input=None, cwd=None, binds=(), language=None,
+                 memory_limit_mb=None):
+    """
+    Like run_process, but also reports the run's wall time (elapsed, seconds)
+    and peak resident memory (max_rss, bytes), and can cap its address space.
+    """
+    start = time.monotonic()
+    outcome = 'failed'
+    try:
+        with tracing.span('run', language=language):
+            result = _run_measured(args, timeout, input, cwd, binds, language, memory_limit_mb)
+        outcome = 'ok' if result.returncode == 0 else 'error'
+        return result
+    except subprocess.TimeoutExpired:
+        outcome = 'timeout'
+        raise
+    finally:
+        metrics.record_execution(language, 'run', outcome, time.monotonic() - start)
+
+def _run_measured(args, timeout, input, cwd, binds, language, memory_limit_mb):
+    if getattr(settings, 'SANDBOX_ENABLED', False):
+        return sandbox.run(args, timeout=timeout, input=input, cwd=cwd, binds=binds,
+                           language=language, memory_limit_mb=memory_limit_mb)
+
+    start = time.monotonic()
+    process = subprocess.Popen(args,
+                               stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE,
+                               cwd=cwd)
+    _limit_address_space(process, memory_limit_mb)
+
+    stdout, stderr = [], []
+    threads = [threading.Thread(target=_read_pipe, args=(process.stdout, stdout)),
+               threading.Thread(target=_read_pipe, args=(process.stderr, stderr)),
+               threading.Thread(target=_write_pipe, args=(process.stdin, (input or '').encode('utf-8')))]
+    for thread in threads:
+        thread.start()
+    # Poll instead of blocking: reaping the child ourselves with wait4 keeps
+    # its rusage, and sampling VmHWM gives the program's own peak memory
+    # (ru_maxrss would also count the server image it was forked from).
+    deadline = start + timeout
+    timed_out = False
+    peak = 0
+    interval = 0.0005
+    while True:
+        peak = max(peak, sandbox.read_peak_memory(process.pid))
+        pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+        if pid:
+            break
+        if time.monotonic() >= deadline:
+            timed_out = True
+            os.kill(process.pid, signal.SIGKILL)
+            _, status, rusage = os.wait4(process.pid, 0)
+            break
+        time.sleep(interval)
+        interval = min(interval * 2, 0.01)
+    elapsed = time.monotonic() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    for thread in threads:
+        thread.join()
+    process.stdout.close()
+    process.stderr.close()
+
+    stdout = b''.join(stdout).decode('utf-8', 'replace')
+    stderr = b''.join(stderr).decode('utf-8', 'replace')
+    if timed_out:
+        raise subprocess.TimeoutExpired(args, timeout, output=stdout, stderr=stderr)
+    return sandbox.SandboxResult(args, process.returncode, stdout, stderr,
+                                 elapsed=elapsed, max_rss=peak or rusage.ru_maxrss * 1024)
+
+def python_executable():
+    """The interpreter Python programs run with: the server's own, or SANDBOX_PYTHON inside the sandbox's rootfs."""
+    if getattr(settings, 'SANDBOX_ENABLED', False):
+        return getattr(settings, 'SANDBOX_PYTHON', '/usr/local/bin/python3')
+    return sys.executable
+
+def probe_process(args, **kwargs):
+    """Run a toolchain version check (traced as the probe phase)."""
+    with tracing.span('probe', command=args[0]):
+        return subprocess.run(args, **kwargs)
+
+@contextmanager
+def work_directory():
+    """A temporary directory whose removal is traced as the cleanup phase."""
+    path = tempfile.mkdtemp()
+    try:
+        yield path
+    finally:
+        with tracing.span('cleanup'):
+            shutil.rmtree(path, ignore_errors=True)
+
+# How each language is built and run. '{src}' is the source file, '{dir}' the
+# working directory, '{name}' the program name (the class name for Java) and
+# '{python}' the Python interpreter (see python_executable).
+TOOLCHAINS = {
+    'python': {'source': 'main.py', 'run': ['{python}', '{src}']},
+    'javascript': {'source': 'main.js', 'run': ['node', '{src}']},
+    'php': {'source': 'main.php', 'run': ['php', '{src}']},
+    'ruby': {'source': 'main.rb', 'run': ['ruby', '{src}']},
+    'swift': {'source': 'main.swift', 'run': ['swift', '{src}']},
+    'c': {
+        'source': 'main.c',
+        'compile': ['gcc', '{src}', '-o', '{dir}/program'],
+        'run': ['{dir}/program'],
+    },
+    'cpp': {
+        'source': 'main.cpp',
+        'compile': ['g++', '{src}', '-o', '{dir}/program'],
+        'run': ['{dir}/program'],
+    },
+    'rust': {
+        'source': 'main.rs',
+        'compile': ['rustc', '{src}', '-o', '{dir}/program'],
+        'run': ['{dir}/program'],
+    },
+    'go': {
+        'source': 'main.go',
+        'compile': ['go', 'build', '-o', '{dir}/program', '{src}'],
+        'run': ['{dir}/program'],
+    },
+    'java': {
+        'source': '{name}.java',
+        'compile': ['javac', '{src}'],
+        'run': ['java', '-cp', '{dir}', '{name}'],
+    },
+    'kotlin': {
+        'source': 'main.kt',
+        'compile': ['kotlinc', '{src}', '-include-runtime', '-d', '{dir}/program.jar'],
+        'run': ['java', '-jar', '{dir}/program.jar'],
+    },
+    'typescript': {
+        'source': 'main.ts',
+        'compile': ['tsc', '{src}'],
+        'run': ['node', '{dir}/main.js'],
+    },
+}
+
+def toolchain_command(language, step, src, dir='', name='Main'):
+    """The TOOLCHAINS command for a language's 'compile' or 'run' step."""
+    return [arg.format(src=src, dir=dir, name=name, python=python_executable())
+            for arg in TOOLCHAINS[language][step]]
+
+def prepare_program(code, language, work_dir, filename=None, optimization=None, build_key=None):
+    """
+    Write code into work_dir and compile it if the language needs it, so it
+    can then be run any number of times. C and C++ go through
+    cbuild.compile_program, at the given optimization level ('O0'-'O3',
+    'Os'); Rust goes through rustbuild.compile_program, reusing the
+    incremental build state of earlier builds with the same build_key
+    (e.g. the user) and filename.
+
+    Returns {'args': [...], 'compile_time': seconds} on success (with
+    'cached': True/False for languages with a build cache), or
+    {'error': message} (with 'compile_error': True if compilation failed).
+    """
+    toolchain = TOOLCHAINS.get(language)
+    if toolchain is None:
+        return {'error': f'Unsupported language: {language}'}
+
+    name = filename.split('.')[0] if language == 'java' and filename else 'Main'
+    source_file = os.path.join(work_dir, toolchain['source'].format(name=name))
+    with tracing.span('write_source'), open(source_file, 'w', encoding='utf-8') as f:
+        f.write(code)
+    fill = lambda step: toolchain_command(language, step, source_file, work_dir, name)
+
+    compile_time = 0.0
+    if 'compile' in toolchain:
+        start = time.monotonic()
+        try:
+            if language in ('c', 'cpp'):
+                from .cbuild import compile_program
+                compile_result = compile_program(source_file, language, os.path.join(work_dir, 'program'),
+                                                 work_dir, optimization)
+            elif language == 'rust':
+                from . import rustbuild
+                compile_result = rustbuild.compile_program(source_file, os.path.join(work_dir, 'program'), work_dir,
+                                                           build_key=f'{build_key}/{filename or ""}' if build_key else None)
+            else:
+                compile_result = run_process(fill('compile'), cwd=work_dir,
+                                             binds=[work_dir], language=language, phase='compile')
+        except ValueError as e:
+            return {'error': str(e)}
+        except FileNotFoundError:
+            return {'error': f'The {language} compiler is not installed on the server'}
+        except subprocess.TimeoutExpired:
+            return {'error': 'Compilation timed out', 'compile_error': True}
+        compile_time = time.monotonic() - start
+        if compile_result.returncode != 0:
+            return {'error': compile_result.stderr.strip(), 'compile_error': True}
+        if language in ('c', 'cpp', 'rust'):
+            from .cbuild import CachedBuild
+            return {'args': fill('run'), 'compile_time': compile_time,
+                    'cached': isinstance(compile_result, CachedBuild)}
+
+    return {'args': fill('run'), 'compile_time': compile_time}
+
+def execute_code(code, language='python', filename='', stdin=None):
     """
     Execute code in the specified language and return the output.
     
@@ -13,6 +303,7 @@ def execute_code(code, language='python', filename=''):
         code (str): The code to execute
         language (str): The programming language (python, javascript, etc.)
         filename (str): The name of the file being executed
+        stdin (str): Input fed to the program's standard input
         
     Returns:
         str: The output of the code execution
@@ -20,26 +311,19 @@ def execute_code(code, language='python', filename=''):
     try:
         # Create a temporary file with the appropriate extension
         ext = get_file_extension(language)
-        with tempfile.NamedTemporaryFile(suffix=ext, delete=False) as temp_file:
+        with tracing.span('write_source'), tempfile.NamedTemporaryFile(suffix=ext, delete=False) as temp_file:
             temp_file.write(code.encode('utf-8'))
             temp_file.flush()
             
             # Execute the code based on the language
-            if language == 'python':
-                result = subprocess.run([sys.executable, temp_file.name],
-                                     capture_output=True,
-                                     text=True,
-                                     timeout=10)
-            elif language == 'javascript':
-                result = subprocess.run(['node', temp_file.name],
-                                     capture_output=True,
-                                     text=True,
-                                     timeout=10)
+            if language in ('python', 'javascript'):
+                result = run_process(toolchain_command(language, 'run', temp_file.name), input=stdin, binds=[temp_file.name], language=language)
             else:
                 return f"Unsupported language: {language}"
             
             # Clean up the temporary file
-            os.unlink(temp_file.name)
+            with tracing.span('cleanup'):
+                os.unlink(temp_file.name)
             
             # Return the output or error
             if result.returncode == 0:
@@ -78,23 +362,20 @@ def get_file_extension(language):
     }
     return extensions.get(language.lower(), '.txt')
 
-def execute_python(code, filename=None):
+def execute_python(code, filename=None, stdin=None):
     """
     Execute Python code and return the output
     """
     print("\n=== Python Execution Debug ===")
     
-    with tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False) as f:
+    with tracing.span('write_source'), tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False) as f:
         f.write(code)
         temp_file = f.name
         print(f"Created temporary file: {temp_file}")
 
     try:
-        print(f"Running Python interpreter: {sys.executable}")
-        result = subprocess.run([sys.executable, temp_file], 
-                              capture_output=True, 
-                              text=True, 
-                              timeout=10)
+        print(f"Running Python interpreter: {python_executable()}")
+        result = run_process(toolchain_command('python', 'run', temp_file), input=stdin, binds=[temp_file], language='python')
         
         print(f"Return code: {result.returncode}")
         print(f"stdout: {result.stdout}")
@@ -113,18 +394,19 @@ def execute_python(code, filename=None):
         return {'error': f'Python execution error: {str(e)}'}
     finally:
         try:
-            os.unlink(temp_file)
+            with tracing.span('cleanup'):
+                os.unlink(temp_file)
             print(f"Deleted temporary file: {temp_file}")
         except Exception as e:
             print(f"Error deleting temporary file: {str(e)}")
 
-def execute_javascript(code, filename=None):
+def execute_javascript(code, filename=None, stdin=None):
     """
     Execute JavaScript code and return the output
     """
     print("\n=== JavaScript Execution Debug ===")
     
-    with tempfile.NamedTemporaryFile(mode='w', suffix='.js', delete=False) as f:
+    with tracing.span('write_source'), tempfile.NamedTemporaryFile(mode='w', suffix='.js', delete=False) as f:
         f.write(code)
         temp_file = f.name
         print(f"Created temporary file: {temp_file}")
@@ -132,7 +414,7 @@ def execute_javascript(code, filename=None):
     try:
         # Check if Node.js is installed
         try:
-            node_version = subprocess.run(['node', '--version'], 
+            node_version = probe_process(['node', '--version'], 
                                         capture_output=True, 
                                         text=True, 
                                         check=True)
@@ -142,10 +424,7 @@ def execute_javascript(code, filename=None):
             return {'error': 'Node.js is not installed on the server'}
 
         print(f"Running Node.js on file: {temp_file}")
-        result = subprocess.run(['node', temp_file], 
-                              capture_output=True, 
-                              text=True, 
-                              timeout=10)
+        result = run_process(toolchain_command('javascript', 'run', temp_file), input=stdin, binds=[temp_file], language='javascript')
         
         print(f"Return code: {result.returncode}")
         print(f"stdout: {result.stdout}")
@@ -164,23 +443,24 @@ def execute_javascript(code, filename=None):
         return {'error': f'JavaScript execution error: {str(e)}'}
     finally:
         try:
-            os.unlink(temp_file)
+            with tracing.span('cleanup'):
+                os.unlink(temp_file)
             print(f"Deleted temporary file: {temp_file}")
         except Exception as e:
             print(f"Error deleting temporary file: {str(e)}")
 
-def execute_java(code, filename=None):
+def execute_java(code, filename=None, stdin=None):
     """
     Execute Java code and return the output
     """
     print("\n=== Java Execution Debug ===")
     
     # Create a temporary directory for Java files
-    with tempfile.TemporaryDirectory() as temp_dir:
+    with work_directory() as temp_dir:
         try:
             # Check if Java is installed
             try:
-                java_version = subprocess.run(['java', '-version'], 
+                java_version = probe_process(['java', '-version'], 
                                            capture_output=True, 
                                            text=True)
                 print(f"Java version: {java_version.stderr.split('\n')[0]}")
@@ -188,27 +468,13 @@ def execute_java(code, filename=None):
                 print(f"Error: Java is not installed: {str(e)}")
                 return {'error': 'Java is not installed on the server'}
 
-            # Write the Java code to a file
-            class_name = filename.split('.')[0] if filename else 'Main'
-            java_file = os.path.join(temp_dir, f"{class_name}.java")
-            with open(java_file, 'w') as f:
-                f.write(code)
-            print(f"Created Java file: {java_file}")
-
-            # Compile the Java code
-            compile_result = subprocess.run(['javac', java_file],
-                                         capture_output=True,
-                                         text=True,
-                                         timeout=10)
-            
-            if compile_result.returncode != 0:
-                return {'error': compile_result.stderr.strip()}
+            # Write the Java code to a file and compile it
+            prepared = prepare_program(code, 'java', temp_dir, filename)
+            if 'error' in prepared:
+                return {'error': prepared['error']}
 
             # Run the compiled Java program
-            run_result = subprocess.run(['java', '-cp', temp_dir, class_name],
-                                      capture_output=True,
-                                      text=True,
-                                      timeout=10)
+            run_result = run_process(prepared['args'], input=stdin, binds=[temp_dir], language='java')
             
             if run_result.returncode == 0:
                 return {'output': run_result.stdout.strip()}
@@ -221,23 +487,17 @@ def execute_java(code, filename=None):
             print(traceback.format_exc())
             return {'error': f'Java execution error: {str(e)}'}
 
-def execute_cpp(code, filename=None):
+def execute_cpp(code, filename=None, stdin=None):
     """
     Execute C++ code and return the output
     """
     print("\n=== C++ Execution Debug ===")
     
-    with tempfile.TemporaryDirectory() as temp_dir:
+    with work_directory() as temp_dir:
         try:
-            # Write the C++ code to a file
-            cpp_file = os.path.join(temp_dir, 'main.cpp')
-            with open(cpp_file, 'w') as f:
-                f.write(code)
-            print(f"Created C++ file: {cpp_file}")
-
             # Check if g++ is installed
             try:
-                gpp_version = subprocess.run(['g++', '--version'], 
+                gpp_version = probe_process(['g++', '--version'], 
                                           capture_output=True, 
                                           text=True, 
                                           check=True)
@@ -246,20 +506,13 @@ def execute_cpp(code, filename=None):
                 print(f"Error: g++ is not installed: {str(e)}")
                 return {'error': 'g++ compiler is not installed on the server'}
 
-            # Compile the C++ code
-            compile_result = subprocess.run(['g++', cpp_file, '-o', os.path.join(temp_dir, 'program')],
-                                         capture_output=True,
-                                         text=True,
-                                         timeout=10)
-            
-            if compile_result.returncode != 0:
-                return {'error': compile_result.stderr.strip()}
+            # Write the C++ code to a file and compile it
+            prepared = prepare_program(code, 'cpp', temp_dir, filename)
+            if 'error' in prepared:
+                return {'error': prepared['error']}
 
             # Run the compiled program
-            run_result = subprocess.run([os.path.join(temp_dir, 'program')],
-                                      capture_output=True,
-                                      text=True,
-                                      timeout=10)
+            run_result = run_process(prepared['args'], input=stdin, binds=[temp_dir], language='cpp')
             
             if run_result.returncode == 0:
                 return {'output': run_result.stdout.strip()}
@@ -272,17 +525,17 @@ def execute_cpp(code, filename=None):
             print(traceback.format_exc())
             return {'error': f'C++ execution error: {str(e)}'}
 
-def execute_c(code, filename=None):
+def execute_c(code, filename=None, stdin=None):
     """
     Execute C code and return the output
     """
     print("\n=== C Execution Debug ===")
     
-    with tempfile.TemporaryDirectory() as temp_dir:
+    with work_directory() as temp_dir:
         try:
             # Check if gcc is installed
             try:
-                gcc_version = subprocess.run(['gcc', '--version'], 
+                gcc_version = probe_process(['gcc', '--version'], 
                                           capture_output=True, 
                                           text=True, 
                                           check=True)
@@ -291,26 +544,13 @@ def execute_c(code, filename=None):
                 print(f"Error: gcc is not installed: {str(e)}")
                 return {'error': 'gcc compiler is not installed on the server'}
 
-            # Write the C code to a file
-            c_file = os.path.join(temp_dir, 'main.c')
-            with open(c_file, 'w') as f:
-                f.write(code)
-            print(f"Created C file: {c_file}")
-
-            # Compile the C code
-            compile_result = subprocess.run(['gcc', c_file, '-o', os.path.join(temp_dir, 'program')],
-                                         capture_output=True,
-                                         text=True,
-                                         timeout=10)
-            
-            if compile_result.returncode != 0:
-                return {'error': compile_result.stderr.strip()}
+            # Write the C code to a file and compile it
+            prepared = prepare_program(code, 'c', temp_dir, filename)
+            if 'error' in prepared:
+                return {'error': prepared['error']}
 
             # Run the compiled program
-            run_result = subprocess.run([os.path.join(temp_dir, 'program')],
-                                      capture_output=True,
-                                      text=True,
-                                      timeout=10)
+            run_result = run_process(prepared['args'], input=stdin, binds=[temp_dir], language='c')
             
             if run_result.returncode == 0:
                 return {'output': run_result.stdout.strip()}
@@ -323,13 +563,13 @@ def execute_c(code, filename=None):
             print(traceback.format_exc())
             return {'error': f'C execution error: {str(e)}'}
 
-def execute_php(code, filename=None):
+def execute_php(code, filename=None, stdin=None):
     """
     Execute PHP code and return the output
     """
     print("\n=== PHP Execution Debug ===")
     
-    with tempfile.NamedTemporaryFile(mode='w', suffix='.php', delete=False) as f:
+    with tracing.span('write_source'), tempfile.NamedTemporaryFile(mode='w', suffix='.php', delete=False) as f:
         f.write(code)
         temp_file = f.name
         print(f"Created temporary file: {temp_file}")
@@ -337,7 +577,7 @@ def execute_php(code, filename=None):
     try:
         # Check if PHP is installed
         try:
-            php_version = subprocess.run(['php', '-v'], 
+            php_version = probe_process(['php', '-v'], 
                                       capture_output=True, 
                                       text=True, 
                                       check=True)
@@ -347,10 +587,7 @@ def execute_php(code, filename=None):
             return {'error': 'PHP is not installed on the server'}
 
         print(f"Running PHP on file: {temp_file}")
-        result = subprocess.run(['php', temp_file], 
-                              capture_output=True, 
-                              text=True, 
-                              timeout=10)
+        result = run_process(toolchain_command('php', 'run', temp_file), input=stdin, binds=[temp_file], language='php')
         
         if result.returncode == 0:
             return {'output': result.stdout.strip()}
@@ -364,18 +601,19 @@ def execute_php(code, filename=None):
         return {'error': f'PHP execution error: {str(e)}'}
     finally:
         try:
-            os.unlink(temp_file)
+            with tracing.span('cleanup'):
+                os.unlink(temp_file)
             print(f"Deleted temporary file: {temp_file}")
         except Exception as e:
             print(f"Error deleting temporary file: {str(e)}")
 
-def execute_ruby(code, filename=None):
+def execute_ruby(code, filename=None, stdin=None):
     """
     Execute Ruby code and return the output
     """
     print("\n=== Ruby Execution Debug ===")
     
-    with tempfile.NamedTemporaryFile(mode='w', suffix='.rb', delete=False) as f:
+    with tracing.span('write_source'), tempfile.NamedTemporaryFile(mode='w', suffix='.rb', delete=False) as f:
         f.write(code)
         temp_file = f.name
         print(f"Created temporary file: {temp_file}")
@@ -383,7 +621,7 @@ def execute_ruby(code, filename=None):
     try:
         # Check if Ruby is installed
         try:
-            ruby_version = subprocess.run(['ruby', '-v'], 
+            ruby_version = probe_process(['ruby', '-v'], 
                                        capture_output=True, 
                                        text=True, 
                                        check=True)
@@ -393,10 +631,7 @@ def execute_ruby(code, filename=None):
             return {'error': 'Ruby is not installed on the server'}
 
         print(f"Running Ruby on file: {temp_file}")
-        result = subprocess.run(['ruby', temp_file], 
-                              capture_output=True, 
-                              text=True, 
-                              timeout=10)
+        result = run_process(toolchain_command('ruby', 'run', temp_file), input=stdin, binds=[temp_file], language='ruby')
         
         if result.returncode == 0:
             return {'output': result.stdout.strip()}
@@ -410,22 +645,23 @@ def execute_ruby(code, filename=None):
         return {'error': f'Ruby execution error: {str(e)}'}
     finally:
         try:
-            os.unlink(temp_file)
+            with tracing.span('cleanup'):
+                os.unlink(temp_file)
             print(f"Deleted temporary file: {temp_file}")
         except Exception as e:
             print(f"Error deleting temporary file: {str(e)}")
 
-def execute_go(code, filename=None):
+def execute_go(code, filename=None, stdin=None):
     """
     Execute Go code and return the output
     """
     print("\n=== Go Execution Debug ===")
     
-    with tempfile.TemporaryDirectory() as temp_dir:
+    with work_directory() as temp_dir:
         try:
             # Check if Go is installed
             try:
-                go_version = subprocess.run(['go', 'version'], 
+                go_version = probe_process(['go', 'version'], 
                                          capture_output=True, 
                                          text=True, 
                                          check=True)
@@ -434,17 +670,13 @@ def execute_go(code, filename=None):
                 print(f"Error: Go is not installed: {str(e)}")
                 return {'error': 'Go is not installed on the server'}
 
-            # Write the Go code to a file
-            go_file = os.path.join(temp_dir, 'main.go')
-            with open(go_file, 'w') as f:
-                f.write(code)
-            print(f"Created Go file: {go_file}")
-
-            # Run the Go code
-            result = subprocess.run(['go', 'run', go_file], 
-                                  capture_output=True, 
-                                  text=True, 
-                                  timeout=10)
+            # Write the Go code to a file and compile it
+            prepared = prepare_program(code, 'go', temp_dir, filename)
+            if 'error' in prepared:
+                return {'error': prepared['error']}
+
+            # Run the compiled program
+            result = run_process(prepared['args'], input=stdin, binds=[temp_dir], language='go')
             
             if result.returncode == 0:
                 return {'output': result.stdout.strip()}
@@ -457,17 +689,17 @@ def execute_go(code, filename=None):
             print(traceback.format_exc())
             return {'error': f'Go execution error: {str(e)}'}
 
-def execute_rust(code, filename=None):
+def execute_rust(code, filename=None, stdin=None):
     """
     Execute Rust code and return the output
     """
     print("\n=== Rust Execution Debug ===")
     
-    with tempfile.TemporaryDirectory() as temp_dir:
+    with work_directory() as temp_dir:
         try:
             # Check if Rust is installed
             try:
-                rust_version = subprocess.run(['rustc', '--version'], 
+                rust_version = probe_process(['rustc', '--version'], 
                                            capture_output=True, 
                                            text=True, 
                                            check=True)
@@ -476,26 +708,13 @@ def execute_rust(code, filename=None):
                 print(f"Error: Rust is not installed: {str(e)}")
                 return {'error': 'Rust is not installed on the server'}
 
-            # Write the Rust code to a file
-            rust_file = os.path.join(temp_dir, 'main.rs')
-            with open(rust_file, 'w') as f:
-                f.write(code)
-            print(f"Created Rust file: {rust_file}")
-
-            # Compile the Rust code
-            compile_result = subprocess.run(['rustc', rust_file, '-o', os.path.join(temp_dir, 'program')],
-                                         capture_output=True,
-                                         text=True,
-                                         timeout=10)
-            
-            if compile_result.returncode != 0:
-                return {'error': compile_result.stderr.strip()}
+            # Write the Rust code to a file and compile it
+            prepared = prepare_program(code, 'rust', temp_dir, filename)
+            if 'error' in prepared:
+                return {'error': prepared['error']}
 
             # Run the compiled program
-            run_result = subprocess.run([os.path.join(temp_dir, 'program')],
-                                      capture_output=True,
-                                      text=True,
-                                      timeout=10)
+            run_result = run_process(prepared['args'], input=stdin, binds=[temp_dir], language='rust')
             
             if run_result.returncode == 0:
                 return {'output': run_result.stdout.strip()}
@@ -508,13 +727,13 @@ def execute_rust(code, filename=None):
             print(traceback.format_exc())
             return {'error': f'Rust execution error: {str(e)}'}
 
-def execute_swift(code, filename=None):
+def execute_swift(code, filename=None, stdin=None):
     """
     Execute Swift code and return the output
     """
     print("\n=== Swift Execution Debug ===")
     
-    with tempfile.NamedTemporaryFile(mode='w', suffix='.swift', delete=False) as f:
+    with tracing.span('write_source'), tempfile.NamedTemporaryFile(mode='w', suffix='.swift', delete=False) as f:
         f.write(code)
         temp_file = f.name
         print(f"Created temporary file: {temp_file}")
@@ -522,7 +741,7 @@ def execute_swift(code, filename=None):
     try:
         # Check if Swift is installed
         try:
-            swift_version = subprocess.run(['swift', '--version'], 
+            swift_version = probe_process(['swift', '--version'], 
                                         capture_output=True, 
                                         text=True, 
                                         check=True)
@@ -532,10 +751,7 @@ def execute_swift(code, filename=None):
             return {'error': 'Swift is not installed on the server'}
 
         print(f"Running Swift on file: {temp_file}")
-        result = subprocess.run(['swift', temp_file], 
-                              capture_output=True, 
-                              text=True, 
-                              timeout=10)
+        result = run_process(toolchain_command('swift', 'run', temp_file), input=stdin, binds=[temp_file], language='swift')
         
         if result.returncode == 0:
             return {'output': result.stdout.strip()}
@@ -549,22 +765,23 @@ def execute_swift(code, filename=None):
         return {'error': f'Swift execution error: {str(e)}'}
     finally:
         try:
-            os.unlink(temp_file)
+            with tracing.span('cleanup'):
+                os.unlink(temp_file)
             print(f"Deleted temporary file: {temp_file}")
         except Exception as e:
             print(f"Error deleting temporary file: {str(e)}")
 
-def execute_kotlin(code, filename=None):
+def execute_kotlin(code, filename=None, stdin=None):
     """
     Execute Kotlin code and return the output
     """
     print("\n=== Kotlin Execution Debug ===")
     
-    with tempfile.TemporaryDirectory() as temp_dir:
+    with work_directory() as temp_dir:
         try:
             # Check if Kotlin is installed
             try:
-                kotlin_version = subprocess.run(['kotlinc', '-version'], 
+                kotlin_version = probe_process(['kotlinc', '-version'], 
                                              capture_output=True, 
                                              text=True, 
                                              check=True)
@@ -573,26 +790,13 @@ def execute_kotlin(code, filename=None):
                 print(f"Error: Kotlin is not installed: {str(e)}")
                 return {'error': 'Kotlin is not installed on the server'}
 
-            # Write the Kotlin code to a file
-            kotlin_file = os.path.join(temp_dir, 'main.kt')
-            with open(kotlin_file, 'w') as f:
-                f.write(code)
-            print(f"Created Kotlin file: {kotlin_file}")
-
-            # Compile the Kotlin code
-            compile_result = subprocess.run(['kotlinc', kotlin_file, '-include-runtime', '-d', os.path.join(temp_dir, 'program.jar')],
-                                         capture_output=True,
-                                         text=True,
-                                         timeout=10)
-            
-            if compile_result.returncode != 0:
-                return {'error': compile_result.stderr.strip()}
+            # Write the Kotlin code to a file and compile it
+            prepared = prepare_program(code, 'kotlin', temp_dir, filename)
+            if 'error' in prepared:
+                return {'error': prepared['error']}
 
             # Run the compiled program
-            run_result = subprocess.run(['java', '-jar', os.path.join(temp_dir, 'program.jar')],
-                                      capture_output=True,
-                                      text=True,
-                                      timeout=10)
+            run_result = run_process(prepared['args'], input=stdin, binds=[temp_dir], language='kotlin')
             
             if run_result.returncode == 0:
                 return {'output': run_result.stdout.strip()}
@@ -605,17 +809,17 @@ def execute_kotlin(code, filename=None):
             print(traceback.format_exc())
             return {'error': f'Kotlin execution error: {str(e)}'}
 
-def execute_typescript(code, filename=None):
+def execute_typescript(code, filename=None, stdin=None):
     """
     Execute TypeScript code and return the output
     """
     print("\n=== TypeScript Execution Debug ===")
     
-    with tempfile.TemporaryDirectory() as temp_dir:
+    with work_directory() as temp_dir:
         try:
             # Check if TypeScript is installed
             try:
-                tsc_version = subprocess.run(['tsc', '--version'], 
+                tsc_version = probe_process(['tsc', '--version'], 
                                           capture_output=True, 
                                           text=True, 
                                           check=True)
@@ -624,27 +828,13 @@ def execute_typescript(code, filename=None):
                 print(f"Error: TypeScript is not installed: {str(e)}")
                 return {'error': 'TypeScript is not installed on the server'}
 
-            # Write the TypeScript code to a file
-            ts_file = os.path.join(temp_dir, 'main.ts')
-            with open(ts_file, 'w') as f:
-                f.write(code)
-            print(f"Created TypeScript file: {ts_file}")
-
-            # Compile the TypeScript code
-            compile_result = subprocess.run(['tsc', ts_file],
-                                         capture_output=True,
-                                         text=True,
-                                         timeout=10)
-            
-            if compile_result.returncode != 0:
-                return {'error': compile_result.stderr.strip()}
+            # Write the TypeScript code to a file and compile it
+            prepared = prepare_program(code, 'typescript', temp_dir, filename)
+            if 'error' in prepared:
+                return {'error': prepared['error']}
 
             # Run the compiled JavaScript
-            js_file = os.path.join(temp_dir, 'main.js')
-            run_result = subprocess.run(['node', js_file],
-                                      capture_output=True,
-                                      text=True,
-                                      timeout=10)
+            run_result = run_process(prepared['args'], input=stdin, binds=[temp_dir], language='typescript')
             
             if run_result.returncode == 0:
                 return {'output': run_result.stdout.strip()}
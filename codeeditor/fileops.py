@@ -0,0 +1,239 @@
+"""
+Apply a list of file operations to a project as one unit.
+
+Supported operations (paths are relative to the project):
+
+    {"op": "create", "path": "src/app", "is_folder": true}
+    {"op": "create", "path": "src/app/main.py", "content": "..."}
+    {"op": "write", "path": "README.md", "content": "..."}
+    {"op": "move", "from": "src/old", "to": "lib/new"}
+    {"op": "delete", "path": "build", "recursive": true}
+
+Operations run in order inside a storage write batch, so consecutive
+writes reach the backend together. Every applied step records how to undo
+itself; if any operation fails, the applied ones are undone in reverse and
+the project is left as it was. With the database backend they also run in
+one transaction, so a failure (or a crash) part way is rolled back by the
+database even where undoing a step fails.
+"""
+import logging
+from contextlib import nullcontext
+
+from django.db import transaction
+
+from .storage import clean_path
+
+logger = logging.getLogger(__name__)
+
+OPERATIONS = ('create', 'write', 'move', 'delete')
+
+
+class OperationError(Exception):
+    """An operation can't be applied; index is its position in the request."""
+
+    def __init__(self, index, message, status=400):
+        super().__init__(message)
+        self.index = index
+        self.status = status
+
+
+def _parse(index, operation):
+    if not isinstance(operation, dict) or operation.get('op') not in OPERATIONS:
+        raise OperationError(index, f"Each operation needs an op: {', '.join(OPERATIONS)}")
+    op = operation['op']
+    try:
+        if op == 'move':
+            parsed = {'op': op, 'from': clean_path(operation.get('from') or ''),
+                      'to': clean_path(operation.get('to') or '')}
+            if not parsed['from'] or not parsed['to']:
+                raise ValueError('Move needs from and to')
+            if parsed['to'] == parsed['from'] or parsed['to'].startswith(parsed['from'] + '/'):
+                raise ValueError('Cannot move a folder into itself')
+            return parsed
+        path = clean_path(operation.get('path') or '')
+        if not path:
+            raise ValueError('Path is required')
+    except ValueError as e:
+        raise OperationError(index, str(e))
+    content = operation.get('content', '')
+    if not isinstance(content, str):
+        raise OperationError(index, 'Content must be a string')
+    return {'op': op, 'path': path, 'content': content,
+            'is_folder': bool(operation.get('is_folder')),
+            'recursive': bool(operation.get('recursive'))}
+
+
+class _Batch:
+    def __init__(self, storage, project_id, before_delete):
+        self.storage = storage
+        self.project_id = project_id
+        self.before_delete = before_delete
+        # What earlier operations put where, since batched writes aren't visible to the backend yet
+        self.known = {}
+        self.undo = []
+        self.changes = []
+        self.results = []
+
+    def kind(self, path):
+        if path not in self.known:
+            self.known[path] = self.storage.kind(self.project_id, path)
+        return self.known[path]
+
+    def forget(self, path):
+        prefix = path + '/'
+        for known in [p for p in self.known if p == path or p.startswith(prefix)]:
+            del self.known[known]
+
+    def prepare_parent(self, index, path):
+        """Check the parent folders of path; note the first one that will be created, to undo it."""
+        parts = path.split('/')[:-1]
+        for depth in range(1, len(parts) + 1):
+            ancestor = '/'.join(parts[:depth])
+            kind = self.kind(ancestor)
+            if kind == 'file':
+                raise OperationError(index, f'{ancestor} is a file')
+            if kind is None:
+                self.undo.append(('remove_tree', ancestor))
+                for created in range(depth, len(parts) + 1):
+                    self.known['/'.join(parts[:created])] = 'folder'
+                return
+
+    def entries_under(self, path):
+        """[(path, is_folder)] inside folder path, deepest first."""
+        self.storage.flush()
+        prefix = path + '/'
+        entries = [entry for entry in self.storage.walk(self.project_id) if entry[0].startswith(prefix)]
+        return sorted(entries, key=lambda entry: entry[0].count('/'), reverse=True)
+
+    def apply(self, index, op):
+        handler = getattr(self, f"_{op['op']}")
+        handler(index, op)
+
+    def _create(self, index, op):
+        path = op['path']
+        if self.kind(path) is not None:
+            raise OperationError(index, f'{path} already exists')
+        self.prepare_parent(index, path)
+        if op['is_folder']:
+            self.storage.make_dir(self.project_id, path)
+            self.undo.append(('remove_tree', path))
+            self.known[path] = 'folder'
+        else:
+            self.storage.write(self.project_id, path, op['content'].encode('utf-8'))
+            self.undo.append(('delete', path))
+            self.known[path] = 'file'
+        self.changes.append((path, 'created', None))
+        self.results.append({'op': 'create', 'path': path, 'is_folder': op['is_folder']})
+
+    def _write(self, index, op):
+        path = op['path']
+        kind = self.kind(path)
+        if kind == 'folder':
+            raise OperationError(index, f'{path} is a folder')
+        if kind == 'file':
+            self.undo.append(('write', path, self.storage.read(self.project_id, path)))
+        else:
+            self.prepare_parent(index, path)
+            self.undo.append(('delete', path))
+        self.storage.write(self.project_id, path, op['content'].encode('utf-8'))
+        self.known[path] = 'file'
+        self.changes.append((path, 'modified' if kind else 'created', None))
+        self.results.append({'op': 'write', 'path': path, 'created': kind is None})
+
+    def _move(self, index, op):
+        source, target = op['from'], op['to']
+        kind = self.kind(source)
+        if kind is None:
+            raise OperationError(index, f'{source} not found', status=404)
+        if self.kind(target) is not None:
+            raise OperationError(index, f'{target} already exists')
+        self.prepare_parent(index, target)
+        self.storage.rename(self.project_id, source, target)
+        self.undo.append(('move', target, source))
+        self.forget(source)
+        self.forget(target)
+        self.known[target] = kind
+        self.changes.append((target, 'renamed', source))
+        self.results.append({'op': 'move', 'from': source, 'to': target, 'is_folder': kind == 'folder'})
+
+    def _delete(self, index, op):
+        path = op['path']
+        kind = self.kind(path)
+        if kind is None:
+            raise OperationError(index, f'{path} not found', status=404)
+        if kind == 'folder':
+            entries = self.entries_under(path)
+            if entries and not op['recursive']:
+                raise OperationError(index, f'{path} is not empty (set recursive to delete it)')
+            if self.before_delete:
+                self.before_delete(path)
+            for entry_path, is_folder in entries:
+                self._delete_one(entry_path, is_folder)
+            self._delete_one(path, True)
+        else:
+            if self.before_delete:
+                self.before_delete(path)
+            self._delete_one(path, False)
+        self.forget(path)
+        self.known[path] = None
+        self.changes.append((path, 'deleted', None))
+        self.results.append({'op': 'delete', 'path': path, 'is_folder': kind == 'folder'})
+
+    def _delete_one(self, path, is_folder):
+        if is_folder:
+            self.storage.delete(self.project_id, path)
+            self.undo.append(('make_dir', path))
+        else:
+            content = self.storage.read(self.project_id, path)
+            self.storage.delete(self.project_id, path)
+            self.undo.append(('write', path, content))
+
+    def rollback(self):
+        """Undo applied operations in reverse; best effort, failures are logged."""
+        for step in reversed(self.undo):
+            action, path = step[0], step[1]
+            try:
+                if action == 'write':
+                    self.storage.write(self.project_id, path, step[2])
+                elif action == 'delete':
+                    self.storage.delete(self.project_id, path)
+                elif action == 'make_dir':
+                    self.storage.make_dir(self.project_id, path)
+                elif action == 'move':
+                    self.storage.rename(self.project_id, path, step[2])
+                elif action == 'remove_tree':
+                    if self.storage.kind(self.project_id, path) == 'folder':
+                        for entry_path, _ in self.entries_under(path):
+                            self.storage.delete(self.project_id, entry_path)
+                        self.storage.delete(self.project_id, path)
+            except FileNotFoundError:
+                # A batched write that never reached the backend
+                continue
+            except Exception as e:
+                logger.error(f"Error undoing {action} of {self.project_id}/{path}: {str(e)}")
+
+
+def apply_operations(storage, project_id, operations, before_delete=None):
+    """
+    Apply operations to a project, all or nothing.
+
+    before_delete(path) is called before a file or folder is deleted.
+    Returns (results, changes): one result dict per operation, and the
+    (path, event, old_path) changes made, for file_changed. Raises
+    OperationError.
+    """
+    ops = [_parse(index, operation) for index, operation in enumerate(operations)]
+    batch = _Batch(storage, project_id, before_delete)
+    index = 0
+    with transaction.atomic() if storage.name == 'database' else nullcontext():
+        try:
+            with storage.batch():
+                for index, op in enumerate(ops):
+                    batch.apply(index, op)
+        except OperationError:
+            batch.rollback()
+            raise
+        except Exception as e:
+            batch.rollback()
+            raise OperationError(index, f'{type(e).__name__}: {str(e)}', status=500)
+    return batch.results, batch.changes
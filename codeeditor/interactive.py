@@ -0,0 +1,261 @@
+"""
+Interactive runs over a WebSocket (/ws/run/).
+
+The client opens the socket and sends the submission:
+    {"code": "...", "language": "python", "filename": "main.py"}
+(C and C++ also take "optimization": "O0"-"O3" or "Os"), then any number of
+    {"type": "stdin", "data": "a line\\n"}, {"type": "eof"} or {"type": "stop"}
+The server streams back
+    {"type": "stdout" | "stderr", "data": "..."}
+and finishes with {"type": "exit", "returncode": N}, preceded by
+{"type": "timeout", "reason": "idle" | "limit" | "output"} if the run was
+cut short. A program that sits waiting for input longer than the idle
+timeout is killed so its slot is reclaimed early.
+"""
+import asyncio
+import codecs
+import logging
+import os
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+from importlib import import_module
+from types import SimpleNamespace
+
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.db import close_old_connections
+
+from . import metrics
+from .executor import prepare_program, spawn_process
+from .sandbox import SandboxError
+from .scheduler import AdmissionRejected, get_scheduler, user_weight
+from .websocket import WebSocketDisconnect
+
+logger = logging.getLogger(__name__)
+
+def _is_running_on_cpu(process):
+    """True if the process is currently runnable (not blocked, e.g. on stdin)."""
+    if not process.pid:
+        # Without a pid there is no telling, so never call the program idle
+        return True
+    try:
+        with open(f'/proc/{process.pid}/stat') as f:
+            stat = f.read()
+    except OSError:
+        return False
+    # The state field follows the parenthesised command name
+    return stat[stat.rfind(')') + 2:].startswith('R')
+
+
+def _execution_user(session_key, address):
+    """Who a run is for and their weight, like views.execution_user: the logged-in user, or else the client address."""
+    if session_key:
+        try:
+            session = import_module(settings.SESSION_ENGINE).SessionStore(session_key)
+            user = get_user(SimpleNamespace(session=session))
+            if user.is_authenticated:
+                return f'user:{user.pk}', user_weight(user.get_username())
+        finally:
+            close_old_connections()
+    return f'addr:{address}', 1.0
+
+
+def _close_pipes(process):
+    for stream in (process.stdin, process.stdout, process.stderr):
+        try:
+            stream.close()
+        except OSError:
+            pass
+
+
+class InteractiveSession:
+    def __init__(self, websocket, process, language, idle_timeout, max_duration, output_limit):
+        self.websocket = websocket
+        self.process = process
+        self.language = language
+        self.idle_timeout = idle_timeout
+        self.max_duration = max_duration
+        self.output_limit = output_limit
+        self.started = time.monotonic()
+        self.last_activity = self.started
+        self.output_size = 0
+        self.stop_reason = None
+        self.events = asyncio.Queue()
+        self.loop = asyncio.get_running_loop()
+
+    def _read_stream(self, name, stream):
+        """Reader thread: push decoded chunks of one output stream to the queue."""
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        fd = stream.fileno()
+        while True:
+            try:
+                chunk = os.read(fd, 4096)
+            except OSError:
+                chunk = b''
+            text = decoder.decode(chunk, final=not chunk)
+            if text:
+                self.loop.call_soon_threadsafe(self.events.put_nowait, (name, text))
+            if not chunk:
+                self.loop.call_soon_threadsafe(self.events.put_nowait, (name, None))
+                return
+
+    def kill(self, reason=None):
+        if reason and not self.stop_reason:
+            self.stop_reason = reason
+        try:
+            if isinstance(self.process, subprocess.Popen):
+                # The whole process group, so programs it left in the background can't keep its output open
+                os.killpg(self.process.pid, signal.SIGKILL)
+            else:
+                self.process.kill()
+        except OSError:
+            pass
+
+    async def _forward_output(self):
+        open_streams = 2
+        while open_streams:
+            name, text = await self.events.get()
+            if text is None:
+                open_streams -= 1
+                continue
+            self.last_activity = time.monotonic()
+            self.output_size += len(text)
+            if self.output_size > self.output_limit:
+                self.kill('output')
+                continue
+            await self.websocket.send_json({'type': name, 'data': text})
+
+    async def _write_stdin(self, data):
+        fd = self.process.stdin.fileno()
+        await self.loop.run_in_executor(None, os.write, fd, data)
+
+    async def _forward_input(self):
+        while True:
+            try:
+                message = await self.websocket.receive_json()
+            except WebSocketDisconnect:
+                self.kill()
+                return
+            except ValueError:
+                continue
+            if not isinstance(message, dict):
+                continue
+            message_type = message.get('type')
+            if message_type == 'stdin':
+                self.last_activity = time.monotonic()
+                try:
+                    await self._write_stdin(str(message.get('data', '')).encode('utf-8'))
+                except (BrokenPipeError, ValueError, OSError):
+                    pass
+            elif message_type == 'eof':
+                self.process.stdin.close()
+            elif message_type == 'stop':
+                self.kill()
+
+    async def _watchdog(self):
+        while True:
+            await asyncio.sleep(0.5)
+            now = time.monotonic()
+            if now - self.started > self.max_duration:
+                self.kill('limit')
+            elif now - self.last_activity > self.idle_timeout and not _is_running_on_cpu(self.process):
+                self.kill('idle')
+            elif self.process.poll() is not None:
+                # The program is gone but something it started still holds its output
+                self.kill()
+
+    async def run(self):
+        for name, stream in (('stdout', self.process.stdout), ('stderr', self.process.stderr)):
+            threading.Thread(target=self._read_stream, args=(name, stream), daemon=True).start()
+        input_task = asyncio.create_task(self._forward_input())
+        watchdog_task = asyncio.create_task(self._watchdog())
+        try:
+            await self._forward_output()
+            returncode = await self.loop.run_in_executor(None, self.process.wait)
+        finally:
+            watchdog_task.cancel()
+            input_task.cancel()
+        if getattr(self.process, 'timed_out', False):
+            self.stop_reason = self.stop_reason or 'limit'
+        outcome = 'timeout' if self.stop_reason else 'ok' if returncode == 0 else 'error'
+        metrics.record_execution(self.language, 'interactive', outcome, time.monotonic() - self.started)
+        if self.stop_reason:
+            await self.websocket.send_json({'type': 'timeout', 'reason': self.stop_reason})
+        await self.websocket.send_json({'type': 'exit', 'returncode': returncode})
+
+
+async def run_interactive(websocket):
+    await websocket.accept()
+    try:
+        request = await websocket.receive_json()
+        if not isinstance(request, dict):
+            raise ValueError()
+    except ValueError:
+        await websocket.send_json({'type': 'error', 'error': 'Invalid JSON data'})
+        await websocket.close()
+        return
+
+    code = request.get('code', '')
+    language = request.get('language', 'python')
+    if not code:
+        await websocket.send_json({'type': 'error', 'error': 'No code provided'})
+        await websocket.close()
+        return
+    if not all(isinstance(value, str) for value in (code, language)) or not all(
+            isinstance(request.get(key), (str, type(None))) for key in ('filename', 'optimization')):
+        await websocket.send_json({'type': 'error',
+                                   'error': 'code, language, filename and optimization must be strings'})
+        await websocket.close()
+        return
+
+    idle_timeout = getattr(settings, 'INTERACTIVE_IDLE_TIMEOUT', 30)
+    max_duration = getattr(settings, 'INTERACTIVE_MAX_DURATION', 300)
+    output_limit = getattr(settings, 'SANDBOX_OUTPUT_LIMIT', 1024 * 1024)
+
+    # Interactive sessions count against the same execution slots as runs
+    loop = asyncio.get_running_loop()
+    client = websocket.scope.get('client') or ('', 0)
+    user, weight = await loop.run_in_executor(None, _execution_user,
+                                              websocket.cookies.get(settings.SESSION_COOKIE_NAME), client[0])
+    admission = get_scheduler().admit(user, weight=weight, timed=False)
+    try:
+        await loop.run_in_executor(None, admission.acquire)
+    except AdmissionRejected as e:
+        await websocket.send_json({'type': 'error', 'error': str(e), 'retry_after': e.retry_after})
+        await websocket.close(1013)
+        return
+
+    try:
+        await _run_admitted(websocket, request, user, code, language, idle_timeout, max_duration, output_limit)
+    finally:
+        admission.release()
+    await websocket.close()
+
+
+async def _run_admitted(websocket, request, user, code, language, idle_timeout, max_duration, output_limit):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        loop = asyncio.get_running_loop()
+        prepared = await loop.run_in_executor(None, prepare_program, code, language, temp_dir,
+                                              request.get('filename'), request.get('optimization'), user)
+        if 'error' in prepared:
+            await websocket.send_json({'type': 'error', 'error': prepared['error']})
+            await websocket.close()
+            return
+        try:
+            process = spawn_process(prepared['args'], timeout=max_duration, cwd=temp_dir,
+                                    binds=[temp_dir], language=language,
+                                    env={'PYTHONUNBUFFERED': '1'})
+        except (OSError, SandboxError) as e:
+            logger.error(f"Error starting interactive run: {str(e)}")
+            await websocket.send_json({'type': 'error', 'error': f'Could not start program: {str(e)}'})
+            await websocket.close()
+            return
+        session = InteractiveSession(websocket, process, language, idle_timeout, max_duration, output_limit)
+        try:
+            await session.run()
+        finally:
+            session.kill()
+            _close_pipes(process)
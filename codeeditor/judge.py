@@ -0,0 +1,109 @@
+"""
+Batch judging: compile a submission once, then run it against many test
+cases in parallel and report a verdict per case.
+"""
+import contextvars
+import logging
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from .executor import prepare_program, run_measured, work_directory
+from .sandbox import SandboxError
+
+logger = logging.getLogger(__name__)
+
+ACCEPTED = 'AC'
+WRONG_ANSWER = 'WA'
+TIME_LIMIT_EXCEEDED = 'TLE'
+MEMORY_LIMIT_EXCEEDED = 'MLE'
+RUNTIME_ERROR = 'RE'
+COMPILE_ERROR = 'CE'
+INTERNAL_ERROR = 'IE'
+
+# Overall verdict is the first of these found among the cases
+VERDICT_PRIORITY = [INTERNAL_ERROR, RUNTIME_ERROR, MEMORY_LIMIT_EXCEEDED,
+                    TIME_LIMIT_EXCEEDED, WRONG_ANSWER, ACCEPTED]
+
+# Runtimes that reserve far more address space than they use, so an
+# RLIMIT_AS cap would break them; their memory is checked after the run.
+NO_ADDRESS_SPACE_LIMIT = {'java', 'kotlin', 'go', 'javascript', 'typescript'}
+
+# Signs that a failed run hit the address-space cap rather than a bug
+OUT_OF_MEMORY_MARKERS = ('std::bad_alloc', 'MemoryError', 'out of memory', 'memory allocation of')
+
+
+def normalize_output(text):
+    """Ignore trailing whitespace on each line and trailing blank lines."""
+    lines = [line.rstrip() for line in text.replace('\r\n', '\n').split('\n')]
+    while lines and not lines[-1]:
+        lines.pop()
+    return '\n'.join(lines)
+
+
+def _judge_case(index, case, args, work_dir, language, time_limit, memory_limit_mb):
+    case_dir = os.path.join(work_dir, f'case-{index}')
+    os.mkdir(case_dir)
+    memory_limit = memory_limit_mb * 1024 * 1024
+    result = {'index': index, 'time': None, 'memory': None}
+    try:
+        run = run_measured(args, timeout=time_limit, input=case.get('stdin', ''), cwd=case_dir,
+                           binds=[work_dir], language=language,
+                           memory_limit_mb=None if language in NO_ADDRESS_SPACE_LIMIT else memory_limit_mb)
+    except subprocess.TimeoutExpired:
+        result.update(verdict=TIME_LIMIT_EXCEEDED, time=time_limit)
+        return result
+    except (OSError, SandboxError) as e:
+        logger.error(f"Error running test case {index}: {str(e)}")
+        result.update(verdict=INTERNAL_ERROR, error=str(e))
+        return result
+
+    result.update(time=round(run.elapsed, 4), memory=run.max_rss)
+    if run.max_rss > memory_limit or \
+            (run.returncode != 0 and any(marker in run.stderr for marker in OUT_OF_MEMORY_MARKERS)):
+        result['verdict'] = MEMORY_LIMIT_EXCEEDED
+    elif run.returncode != 0:
+        result.update(verdict=RUNTIME_ERROR, error=run.stderr.strip()[-2000:])
+    elif 'expected_output' in case and \
+            normalize_output(run.stdout) != normalize_output(case['expected_output']):
+        result.update(verdict=WRONG_ANSWER, output=run.stdout[:2000])
+    else:
+        result['verdict'] = ACCEPTED
+    return result
+
+
+def judge_submission(code, language, cases, filename=None, time_limit=2, memory_limit_mb=256,
+                     max_workers=None, optimization=None, build_key=None):
+    """
+    Judge code against cases, each {'stdin': ..., 'expected_output': ...}.
+
+    Cases without expected_output only check that the program runs cleanly.
+    At most max_workers cases run at once: pass the number of execution
+    slots the caller holds.
+    Returns the overall verdict, compile time (and whether the build came
+    from the build cache) and per-case results.
+    """
+    with work_directory() as work_dir:
+        prepared = prepare_program(code, language, work_dir, filename, optimization, build_key)
+        if 'error' in prepared:
+            verdict = COMPILE_ERROR if prepared.get('compile_error') else INTERNAL_ERROR
+            return {'verdict': verdict, 'error': prepared['error'], 'cases': []}
+
+        workers = max_workers or min(len(cases), os.cpu_count() or 1) or 1
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            # Each case runs in a copy of this context so its spans join the request's trace
+            futures = [pool.submit(contextvars.copy_context().run, _judge_case, index, case,
+                                   prepared['args'], work_dir, language, time_limit, memory_limit_mb)
+                       for index, case in enumerate(cases)]
+            results = [future.result() for future in futures]
+
+    verdicts = {result['verdict'] for result in results}
+    verdict = next((v for v in VERDICT_PRIORITY if v in verdicts), ACCEPTED)
+    return {
+        'verdict': verdict,
+        'compile_time': round(prepared['compile_time'], 4),
+        'build_cached': prepared.get('cached'),
+        'passed': sum(1 for result in results if result['verdict'] == ACCEPTED),
+        'total': len(results),
+        'cases': results,
+    }
@@ -0,0 +1,433 @@
+"""
+Persistent Python kernels for session runs (/editor/run/session/).
+
+A kernel is a Python process, one per user and project, that stays alive
+between runs and executes each submitted cell in the same namespace, so
+imports and loaded data carry over and a run only costs the new cell. Like
+a REPL, a cell ending in an expression also returns that value's repr.
+
+Kernels are started through spawn_process, so they run in the sandbox
+when it is enabled, with their address space capped at
+KERNEL_MEMORY_LIMIT_MB. Cells talk to the kernel over a length-prefixed
+JSON protocol on private copies of its stdin and stdout; the program
+itself sees an empty stdin (or the cell's stdin) and its print output is
+captured per cell.
+
+Kernels belong to the logged-in user or, for anonymous visitors, to
+their browser session. Each user holds at most KERNEL_MAX_PER_USER, and
+the whole host at most KERNEL_MAX_KERNELS: a running kernel holds an
+exclusive lock on one of that many slot files in KERNEL_SLOT_DIR, which
+every server process shares. Starting one past either limit shuts down
+this process's least recently used idle kernel, or fails with 503 if
+none is idle. Kernels idle for KERNEL_IDLE_TIMEOUT seconds are reaped.
+
+A kernel lives in the server process that started it, so a user's cells
+only reach it when they land on that process: run a single worker, or
+route each user's requests to the same worker (sticky sessions). A cell
+that lands on another worker starts a fresh kernel there. A cell running past KERNEL_CELL_TIMEOUT is
+interrupted with KeyboardInterrupt, and the kernel is killed if that
+doesn't stop it.
+"""
+import json
+import logging
+import os
+import select
+import shutil
+import signal
+import struct
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+
+from . import metrics, tracing
+from .executor import python_executable, spawn_process
+from .scheduler import Slots
+
+logger = logging.getLogger(__name__)
+
+_HEADER = struct.Struct('>I')
+
+# Run inside the kernel process: reads cells, runs them, writes back results
+DRIVER = r'''
+import ast, contextlib, io, json, os, signal, struct, sys, time, traceback
+
+HEADER = struct.Struct('>I')
+
+
+def read_exactly(stream, size):
+    data = b''
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def truncate(text, limit):
+    return text if len(text) <= limit else text[:limit] + '\n... output truncated'
+
+
+def run_cell(request, namespace, count):
+    filename = f'<cell {count}>'
+    stdout, stderr = io.StringIO(), io.StringIO()
+    result = error = None
+    sys.stdin = io.StringIO(request.get('stdin') or '')
+    start = time.perf_counter()
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    try:
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            tree = ast.parse(request['code'], filename)
+            last = None
+            if tree.body and isinstance(tree.body[-1], ast.Expr):
+                last = ast.Expression(tree.body.pop().value)
+            exec(compile(tree, filename, 'exec'), namespace)
+            if last is not None:
+                value = eval(compile(last, filename, 'eval'), namespace)
+                if value is not None:
+                    namespace['_'] = value
+                    result = repr(value)
+    except SyntaxError as e:
+        error = ''.join(traceback.format_exception_only(type(e), e))
+    except BaseException as e:
+        # Without this function's own frame; SystemExit and KeyboardInterrupt end the cell, not the kernel
+        error = ''.join(traceback.format_exception(type(e), e, e.__traceback__.tb_next))
+    finally:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        sys.stdin = sys.__stdin__
+    limit = request.get('output_limit') or 1024 * 1024
+    return {'output': truncate(stdout.getvalue(), limit), 'stderr': truncate(stderr.getvalue(), limit),
+            'error': error and truncate(error, limit), 'result': result and truncate(result, limit),
+            'execution_count': count, 'elapsed': time.perf_counter() - start}
+
+
+def main():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    requests = os.fdopen(os.dup(0), 'rb', buffering=0)
+    replies = os.fdopen(os.dup(1), 'wb', buffering=0)
+    # Output written straight to fd 1 (C extensions, subprocesses) goes to stderr instead
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.dup2(2, 1)
+    namespace = {'__name__': '__main__', '__builtins__': __builtins__}
+    count = 0
+    while True:
+        header = read_exactly(requests, HEADER.size)
+        if header is None:
+            return
+        request = json.loads(read_exactly(requests, HEADER.unpack(header)[0]))
+        count += 1
+        reply = json.dumps(run_cell(request, namespace, count)).encode('utf-8', 'replace')
+        replies.write(HEADER.pack(len(reply)) + reply)
+
+
+main()
+'''
+
+
+class KernelError(Exception):
+    """A cell couldn't be run; status is the HTTP status to answer with."""
+
+    def __init__(self, message, status=500, kernel_lost=False):
+        super().__init__(message)
+        self.status = status
+        self.kernel_lost = kernel_lost
+
+
+class Kernel:
+    def __init__(self, user, project_id):
+        self.user = user
+        self.project_id = project_id
+        # The Slots descriptor this kernel holds, closed with it
+        self.slot = None
+        self.started = time.time()
+        self.last_used = time.monotonic()
+        self.executions = 0
+        self.lock = threading.Lock()
+        self.work_dir = tempfile.mkdtemp(prefix='kernel-')
+        driver = os.path.join(self.work_dir, '.kernel.py')
+        with open(driver, 'w', encoding='utf-8') as f:
+            f.write(DRIVER)
+        self.process = spawn_process([python_executable(), driver],
+                                     timeout=getattr(settings, 'KERNEL_MAX_LIFETIME', 4 * 3600),
+                                     cwd=self.work_dir, binds=[self.work_dir], language='python',
+                                     memory_limit_mb=getattr(settings, 'KERNEL_MEMORY_LIMIT_MB', 1024) or None)
+        # Anything the kernel writes outside a cell's captured output, kept for the running cell
+        self.stderr = bytearray()
+        self.stderr_lock = threading.Lock()
+        threading.Thread(target=self._read_stderr, daemon=True).start()
+
+    def _read_stderr(self):
+        fd = self.process.stderr.fileno()
+        limit = getattr(settings, 'SANDBOX_OUTPUT_LIMIT', 1024 * 1024)
+        try:
+            while True:
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    return
+                with self.stderr_lock:
+                    if len(self.stderr) < limit:
+                        self.stderr += chunk[:limit - len(self.stderr)]
+        except OSError:
+            pass
+        finally:
+            self.process.stderr.close()
+
+    def _take_stderr(self):
+        with self.stderr_lock:
+            data = bytes(self.stderr)
+            self.stderr.clear()
+        return data.decode('utf-8', 'replace')
+
+    @property
+    def alive(self):
+        return self.process.poll() is None
+
+    @property
+    def busy(self):
+        return self.lock.locked()
+
+    def memory(self):
+        """Resident memory in bytes, None once the process is gone."""
+        if not self.process.pid:
+            return None
+        try:
+            with open(f'/proc/{self.process.pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+    def info(self):
+        return {'project_id': self.project_id, 'started': self.started,
+                'idle_seconds': round(time.monotonic() - self.last_used, 1),
+                'executions': self.executions, 'busy': self.busy, 'memory': self.memory()}
+
+    def execute(self, code, stdin, timeout):
+        if not self.lock.acquire(timeout=timeout):
+            raise KernelError('The session is still running a previous cell', status=409)
+        try:
+            self._take_stderr()
+            request = json.dumps({'code': code, 'stdin': stdin,
+                                  'output_limit': getattr(settings, 'SANDBOX_OUTPUT_LIMIT', 1024 * 1024)})
+            data = request.encode('utf-8', 'replace')
+            try:
+                self.process.stdin.write(_HEADER.pack(len(data)) + data)
+                self.process.stdin.flush()
+            except (BrokenPipeError, OSError, ValueError):
+                raise self._lost('The session has ended')
+            reply = self._read_reply(time.monotonic() + timeout)
+            if reply is None:
+                reply = self._interrupt()
+            self.executions += 1
+            stray = self._take_stderr()
+            if stray:
+                reply['stderr'] = reply['stderr'] + stray
+            return reply
+        finally:
+            self.last_used = time.monotonic()
+            self.lock.release()
+
+    def _read_reply(self, deadline):
+        """The next reply, None if the deadline passes first; raises KernelError if the kernel dies."""
+        fd = self.process.stdout.fileno()
+        data = b''
+        needed = _HEADER.size
+        while len(data) < needed:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            ready, _, _ = select.select([fd], [], [], remaining)
+            if not ready:
+                return None
+            chunk = os.read(fd, needed - len(data))
+            if not chunk:
+                raise self._lost('The session ended unexpectedly')
+            data += chunk
+            if needed == _HEADER.size and len(data) == needed:
+                needed += _HEADER.unpack(data)[0]
+        return json.loads(data[_HEADER.size:])
+
+    def _interrupt(self):
+        """Stop a cell that ran too long, killing the kernel if it doesn't respond."""
+        if self.process.pid:
+            try:
+                os.kill(self.process.pid, signal.SIGINT)
+            except OSError:
+                pass
+            if self._read_reply(time.monotonic() + 2) is not None:
+                raise KernelError('Execution timed out and was interrupted; the session was kept',
+                                  status=408)
+        self.close()
+        raise KernelError('Execution timed out; the session was restarted', status=408, kernel_lost=True)
+
+    def _lost(self, message):
+        details = self._take_stderr().strip()
+        self.close()
+        if details:
+            message = f'{message}:\n{details[-2000:]}'
+        return KernelError(message, kernel_lost=True)
+
+    def close(self):
+        try:
+            self.process.kill()
+        except OSError:
+            pass
+        try:
+            self.process.wait(timeout=5)
+        except Exception:
+            pass
+        for stream in (self.process.stdin, self.process.stdout):
+            try:
+                stream.close()
+            except OSError:
+                pass
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+        if self.slot is not None:
+            os.close(self.slot)
+            self.slot = None
+
+
+class KernelManager:
+    def __init__(self, max_kernels, max_per_user, idle_timeout, slot_dir):
+        self.max_kernels = max_kernels
+        self.max_per_user = max_per_user
+        self.idle_timeout = idle_timeout
+        self.slots = Slots(slot_dir, max_kernels)
+        self.kernels = {}   # (user, project_id) -> Kernel
+        self.lock = threading.Lock()
+        threading.Thread(target=self._reap, name='kernel-reaper', daemon=True).start()
+
+    def _shut_down(self, key, reason):
+        """Remove and stop a kernel; call with the lock held."""
+        kernel = self.kernels.pop(key)
+        metrics.kernel_shutdowns.inc(reason=reason)
+        # Killing and cleaning up can take a moment; don't hold the lock for it
+        threading.Thread(target=kernel.close, daemon=True).start()
+
+    def _take_slot(self, key):
+        """The slot of a kernel about to be shut down, for the one replacing it; call with the lock held."""
+        kernel = self.kernels[key]
+        slot, kernel.slot = kernel.slot, None
+        return slot
+
+    def _make_room(self, user):
+        """
+        A host slot for another of user's kernels, shutting down the least
+        recently used idle kernel to free one if needed; call with the lock
+        held.
+        """
+        mine = [key for key in self.kernels if key[0] == user]
+        if len(mine) < self.max_per_user:
+            slot = self.slots.acquire()
+            if slot is not None:
+                return slot
+            # Every slot is held, by this process or another one; only ours can be freed
+            candidates, reason = list(self.kernels), 'evicted'
+        else:
+            candidates, reason = mine, 'user_limit'
+        idle = [key for key in candidates if not self.kernels[key].busy]
+        if not idle:
+            raise KernelError('Every Python session on this server is busy; try again shortly', status=503)
+        victim = min(idle, key=lambda key: self.kernels[key].last_used)
+        slot = self._take_slot(victim)
+        self._shut_down(victim, reason)
+        return slot
+
+    def get(self, user, project_id):
+        """The user's kernel for project_id, and whether it was just started."""
+        key = (user, project_id)
+        with self.lock:
+            kernel = self.kernels.get(key)
+            if kernel is not None and kernel.alive:
+                kernel.last_used = time.monotonic()
+                return kernel, False
+            if kernel is not None:
+                slot = self._take_slot(key)
+                self._shut_down(key, 'exited')
+            else:
+                slot = self._make_room(user)
+        try:
+            with tracing.span('start_kernel'):
+                kernel = Kernel(user, project_id)
+        except BaseException:
+            os.close(slot)
+            raise
+        kernel.slot = slot
+        with self.lock:
+            existing = self.kernels.get(key)
+            if existing is not None and existing.alive:
+                # Another request started one at the same time
+                threading.Thread(target=kernel.close, daemon=True).start()
+                return existing, False
+            self.kernels[key] = kernel
+        return kernel, True
+
+    def execute(self, user, project_id, code, stdin=''):
+        kernel, started = self.get(user, project_id)
+        timeout = getattr(settings, 'KERNEL_CELL_TIMEOUT', 30)
+        start = time.monotonic()
+        try:
+            with tracing.span('run_cell', started=started):
+                reply = kernel.execute(code, stdin, timeout)
+        except KernelError as e:
+            if e.kernel_lost:
+                with self.lock:
+                    if self.kernels.get((user, project_id)) is kernel:
+                        self._shut_down((user, project_id), 'timeout' if e.status == 408 else 'exited')
+            if e.status != 409:
+                metrics.record_execution('python', 'session', 'timeout' if e.status == 408 else 'failed',
+                                         time.monotonic() - start)
+            raise
+        metrics.record_execution('python', 'session', 'error' if reply['error'] else 'ok', reply['elapsed'])
+        reply['kernel_started'] = started
+        return reply
+
+    def shutdown(self, user, project_id):
+        with self.lock:
+            if (user, project_id) not in self.kernels:
+                return False
+            self._shut_down((user, project_id), 'requested')
+            return True
+
+    def list(self, user):
+        with self.lock:
+            kernels = [kernel for key, kernel in self.kernels.items() if key[0] == user]
+        return [kernel.info() for kernel in kernels]
+
+    def stats(self):
+        with self.lock:
+            return {'kernels': len(self.kernels), 'capacity': self.max_kernels}
+
+    def _reap(self):
+        while True:
+            time.sleep(max(1.0, min(30.0, self.idle_timeout / 4)))
+            now = time.monotonic()
+            with self.lock:
+                for key, kernel in list(self.kernels.items()):
+                    if not kernel.alive:
+                        self._shut_down(key, 'exited')
+                    elif not kernel.busy and now - kernel.last_used > self.idle_timeout:
+                        self._shut_down(key, 'idle')
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_kernel_manager():
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = KernelManager(
+                max_kernels=getattr(settings, 'KERNEL_MAX_KERNELS', 8),
+                max_per_user=getattr(settings, 'KERNEL_MAX_PER_USER', 2),
+                idle_timeout=getattr(settings, 'KERNEL_IDLE_TIMEOUT', 600),
+                slot_dir=(getattr(settings, 'KERNEL_SLOT_DIR', '')
+                          or os.path.join(tempfile.gettempdir(), 'codeeditor-kernels')),
+            )
+        return _manager
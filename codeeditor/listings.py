@@ -0,0 +1,79 @@
+"""
+Cache-aside for the project list and project file trees.
+
+Listings are kept in the default cache (see CACHES in settings) for
+LISTING_CACHE_TIMEOUT seconds. Each listing's key includes a version
+number that is bumped whenever the listing changes: by the file_changed
+signal for files created, deleted or renamed (edits to a file's content
+don't change the tree, so they keep the cache), and by create_project.
+A listing computed while a change was being made is stored under the old
+version, where nobody reads it, so it can't overwrite the invalidation.
+
+With the locmem cache nothing is cached: each server process would keep
+its own copy, and miss the invalidations made by the others.
+"""
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.dispatch import receiver
+
+from .signals import file_changed
+
+# Events that change a project's file tree
+TREE_EVENTS = ('created', 'deleted', 'renamed', 'reset')
+
+
+def _key(*parts):
+    # Project names can hold characters some cache backends reject in keys
+    return 'listing:' + hashlib.sha1('\0'.join(parts).encode('utf-8', 'surrogatepass')).hexdigest()
+
+
+def _version(name):
+    key = _key('version', *name)
+    version = cache.get(key)
+    if version is None:
+        # Start from the clock, so a version key evicted from the cache never comes back with an old number
+        cache.add(key, time.time_ns(), None)
+        version = cache.get(key)
+    return version
+
+
+def invalidate(*name):
+    key = _key('version', *name)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, time.time_ns(), None)
+
+
+def cached(name, compute):
+    """The listing called name (a tuple), computing and storing it on a miss."""
+    if isinstance(caches['default'], LocMemCache):
+        return compute()
+    key = _key(str(_version(name)), *name)
+    value = cache.get(key)
+    if value is None:
+        value = compute()
+        cache.set(key, value, getattr(settings, 'LISTING_CACHE_TIMEOUT', 300))
+    return value
+
+
+def project_list(compute):
+    return cached(('projects',), compute)
+
+
+def file_tree(project_id, compute):
+    return cached(('files', project_id), compute)
+
+
+@receiver(file_changed)
+def invalidate_listings(sender, project_id, path, event, **kwargs):
+    if event not in TREE_EVENTS:
+        return
+    invalidate('files', project_id)
+    if not path:
+        # The whole project was deleted or replaced
+        invalidate('projects')
@@ -0,0 +1,885 @@
+"""
+Language-server gateway (/ws/lsp/<project_id>/).
+
+Completions, hover, go-to-definition and diagnostics come from standard
+language servers (pylsp, clangd, gopls, typescript-language-server) run
+against a workspace: a copy of the project's files in the temp directory,
+which sandboxed servers can see whatever the storage backend. Each
+process keeps one workspace per project while connections or servers use
+it, and updates it from file_changed as files are saved (copying the whole
+project again, with backoff, if an update fails). One WebSocket
+per project carries LSP traffic for every language; each text frame wraps
+one JSON-RPC message:
+
+    {"language": "python", "message": {"jsonrpc": "2.0", "id": 1, "method": "initialize", ...}}
+
+Replies and server notifications come back the same way. The first frame
+the server sends is {"root_uri": ...}, the URI documents must live under.
+A frame {"language": ..., "error": ...} reports a server that could not
+be started or has exited; send initialize again to get a new one.
+
+Servers are pooled per user (the logged-in user, or else the browser
+session, as in views.session_owner), project and server command (C and
+C++ share one clangd) and outlive the connection, so a reconnecting client gets the
+already-initialized server with its warm index: initialize is answered
+from the first one's result. Several connections can share a server; the
+gateway rewrites request ids so replies reach the right one, counts
+references to open documents, and itself answers the requests servers
+send to their client (configuration, capability registration).
+
+Servers without connections are shut down after LSP_IDLE_TIMEOUT seconds.
+When the pool reaches LSP_MAX_SERVERS, or its resident memory exceeds
+LSP_MEMORY_BUDGET_MB, the least recently used idle servers go first.
+"""
+import asyncio
+import functools
+import itertools
+import json
+import logging
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from importlib import import_module
+from types import SimpleNamespace
+
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.db import close_old_connections
+from django.dispatch import receiver
+
+from . import metrics
+from .executor import spawn_process
+from .sandbox import SandboxError
+from .signals import file_changed
+from .storage import clean_project_id, get_storage, is_ignored
+from .websocket import WebSocketDisconnect
+
+logger = logging.getLogger(__name__)
+
+# Commands are looked up on PATH (or in the sandbox rootfs); LSP_SERVERS adds to or overrides these
+SERVERS = {
+    'python': ['pylsp'],
+    'c': ['clangd', '--background-index'],
+    'cpp': ['clangd', '--background-index'],
+    'go': ['gopls'],
+    'javascript': ['typescript-language-server', '--stdio'],
+    'typescript': ['typescript-language-server', '--stdio'],
+}
+
+# Client-side requests a shared server must not see, and their local replies
+SERVER_REQUEST_REPLIES = {
+    'client/registerCapability': None,
+    'client/unregisterCapability': None,
+    'window/workDoneProgress/create': None,
+    'window/showMessageRequest': None,
+    'window/showDocument': {'success': False},
+    'workspace/applyEdit': {'applied': False},
+    'workspace/workspaceFolders': None,
+}
+
+INTERNAL_ERROR = -32603
+METHOD_NOT_FOUND = -32601
+INVALID_REQUEST = -32600
+
+
+class LanguageServerError(Exception):
+    """A language server could not be started, or is not configured."""
+
+
+def server_command(language):
+    servers = {**SERVERS, **getattr(settings, 'LSP_SERVERS', {})}
+    command = servers.get(language)
+    return list(command) if command else None
+
+
+def encode(message):
+    body = json.dumps(message).encode('utf-8')
+    return b'Content-Length: %d\r\n\r\n' % len(body) + body
+
+
+class FrameReader:
+    """Splits a language server's output into JSON-RPC messages."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+        messages = []
+        while True:
+            header_end = self.buffer.find(b'\r\n\r\n')
+            if header_end < 0:
+                return messages
+            length = None
+            for line in bytes(self.buffer[:header_end]).split(b'\r\n'):
+                name, _, value = line.partition(b':')
+                if name.strip().lower() == b'content-length':
+                    length = int(value.strip())
+            if length is None:
+                raise ValueError('Message without Content-Length')
+            end = header_end + 4 + length
+            if len(self.buffer) < end:
+                return messages
+            body = bytes(self.buffer[header_end + 4:end])
+            del self.buffer[:end]
+            messages.append(json.loads(body))
+
+
+def _tree_rss(pid):
+    """Resident memory of a process and its descendants, in bytes."""
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f'/proc/{current}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+                        break
+            for task in os.listdir(f'/proc/{current}/task'):
+                with open(f'/proc/{current}/task/{task}/children') as f:
+                    pending.extend(int(child) for child in f.read().split())
+        except (OSError, ValueError):
+            pass
+    return total
+
+
+class Workspace:
+    """A project's files copied to the temp directory for its language servers."""
+
+    # Files read from storage at a time while copying
+    READ_BATCH = 64
+    # Seconds before retrying a full copy after the first, second, ... failed update in a row
+    RESYNC_DELAYS = (0.1, 1, 5, 30)
+
+    def __init__(self, project_id):
+        self.project_id = project_id
+        self.root = tempfile.mkdtemp(prefix='lsp-')
+        self.root_uri = pathlib.Path(self.root).as_uri()
+        # path -> size of the files copied so far, and their total
+        self.sizes = {}
+        self.size = 0
+        # Connections and servers using the workspace
+        self.users = 0
+        self.ready = None
+        self.closed = False
+        # Set when an update failed, until a full copy brings the files back in line
+        self.stale = False
+        self.failures = 0
+        self.retry = None
+        # Held while changing files, so the initial copy and updates don't interleave
+        self.lock = threading.Lock()
+
+    def _target(self, path):
+        return os.path.join(self.root, *path.split('/'))
+
+    def _remove(self, path):
+        target = self._target(path)
+        if os.path.isdir(target):
+            shutil.rmtree(target, ignore_errors=True)
+        else:
+            try:
+                os.remove(target)
+            except FileNotFoundError:
+                pass
+        for name in [name for name in self.sizes if name == path or name.startswith(path + '/')]:
+            self.size -= self.sizes.pop(name)
+
+    def _copy(self, paths):
+        storage = get_storage()
+        limit = getattr(settings, 'LSP_WORKSPACE_MAX_SIZE', 256 * 1024 * 1024)
+        for start in range(0, len(paths), self.READ_BATCH):
+            for path, data in storage.read_many(self.project_id, paths[start:start + self.READ_BATCH]).items():
+                if isinstance(data, OSError):
+                    if isinstance(data, FileNotFoundError):
+                        self._remove(path)
+                    continue
+                size = self.size - self.sizes.get(path, 0) + len(data)
+                if size > limit:
+                    # Servers still work on a partial copy; open documents come from the editor anyway
+                    logger.warning(f"Workspace for {self.project_id} is over LSP_WORKSPACE_MAX_SIZE")
+                    return
+                self.sizes[path] = len(data)
+                self.size = size
+                target = self._target(path)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                with open(target, 'wb') as f:
+                    f.write(data)
+
+    def populate(self):
+        """Copy the whole project; runs in a thread."""
+        try:
+            with self.lock:
+                ignored_dirs = set(getattr(settings, 'SEARCH_IGNORED_DIRS', []))
+                self._copy(sorted(get_storage().versions(self.project_id, ignored_dirs=ignored_dirs)))
+        finally:
+            close_old_connections()
+
+    def update(self, path, event, old_path=None):
+        """Apply a file_changed event; runs in a thread."""
+        try:
+            with self.lock:
+                if self.closed:
+                    return
+                ignored_dirs = set(getattr(settings, 'SEARCH_IGNORED_DIRS', []))
+                if self.stale and not (event == 'deleted' and not path):
+                    # An earlier event was lost, so this one alone won't do
+                    event, path = 'reset', ''
+                if event == 'reset' or not path:
+                    for name in os.listdir(self.root):
+                        self._remove(name)
+                    if event != 'deleted':
+                        self._copy(sorted(get_storage().versions(self.project_id, ignored_dirs=ignored_dirs)))
+                    self.stale = False
+                    self.failures = 0
+                elif event == 'deleted':
+                    self._remove(path)
+                elif event == 'renamed' and old_path and os.path.exists(self._target(old_path)):
+                    self._remove(path)
+                    os.renames(self._target(old_path), self._target(path))
+                    for name in [name for name in self.sizes if name == old_path or name.startswith(old_path + '/')]:
+                        self.sizes[path + name[len(old_path):]] = self.sizes.pop(name)
+                elif not is_ignored(path, ignored_dirs) and get_storage().kind(self.project_id, path) == 'file':
+                    self._copy([path])
+        except Exception as e:
+            logger.error(f"Error updating the workspace of {self.project_id}: {str(e)}")
+            self._schedule_resync()
+        finally:
+            close_old_connections()
+
+    def _schedule_resync(self):
+        """Mark the copy stale and copy the whole project again soon, backing off while that fails."""
+        with self.lock:
+            self.stale = True
+            self.failures += 1
+            if self.closed or self.retry is not None:
+                return
+            delay = self.RESYNC_DELAYS[min(self.failures, len(self.RESYNC_DELAYS)) - 1]
+            self.retry = threading.Timer(delay, _sync_pool.submit, (self._resync,))
+            self.retry.daemon = True
+            self.retry.start()
+
+    def _resync(self):
+        with self.lock:
+            self.retry = None
+            if not self.stale:
+                return
+        self.update('', 'reset')
+
+    def remove(self):
+        with self.lock:
+            self.closed = True
+            if self.retry is not None:
+                self.retry.cancel()
+                self.retry = None
+            shutil.rmtree(self.root, ignore_errors=True)
+
+
+# project_id -> Workspace
+_workspaces = {}
+_sync_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='lsp-workspace')
+
+
+async def open_workspace(project_id):
+    """The project's workspace, copied from storage if it is new here; release it with close_workspace."""
+    workspace = _workspaces.get(project_id)
+    if workspace is None:
+        workspace = _workspaces[project_id] = Workspace(project_id)
+        workspace.ready = asyncio.get_running_loop().run_in_executor(_sync_pool, workspace.populate)
+    workspace.users += 1
+    try:
+        await asyncio.shield(workspace.ready)
+    except Exception:
+        close_workspace(workspace)
+        raise
+    return workspace
+
+
+def close_workspace(workspace):
+    workspace.users -= 1
+    if workspace.users == 0:
+        if _workspaces.get(workspace.project_id) is workspace:
+            del _workspaces[workspace.project_id]
+        _sync_pool.submit(workspace.remove)
+
+
+@receiver(file_changed)
+def update_workspace(sender, project_id, path, event, old_path=None, **kwargs):
+    """Keep workspaces in line with saved files."""
+    workspace = _workspaces.get(project_id)
+    if workspace is not None:
+        _sync_pool.submit(workspace.update, path.strip('/') if path else '', event,
+                          old_path.strip('/') if old_path else None)
+
+
+def _session_owner(session_key):
+    """Who a connection's servers belong to, named like views.session_owner, or None without a session."""
+    if not session_key:
+        return None
+    try:
+        session = import_module(settings.SESSION_ENGINE).SessionStore(session_key)
+        user = get_user(SimpleNamespace(session=session))
+        if user.is_authenticated:
+            return f'user:{user.pk}'
+        owner = session.get('owner')
+        return f'session:{owner}' if owner else None
+    finally:
+        close_old_connections()
+
+
+def _project_exists(project_id):
+    try:
+        return get_storage().project_exists(project_id)
+    finally:
+        close_old_connections()
+
+
+class _Client:
+    """One WebSocket connection, possibly talking to several servers."""
+
+    def __init__(self, websocket, user):
+        self.websocket = websocket
+        self.user = user
+        # language -> LanguageServer this connection has initialized
+        self.servers = {}
+        self.queue = asyncio.Queue(maxsize=getattr(settings, 'LSP_SEND_QUEUE', 1000))
+        self.dropped = False
+
+    def send_json(self, data):
+        if self.dropped:
+            return
+        try:
+            self.queue.put_nowait(json.dumps(data))
+        except asyncio.QueueFull:
+            # Too slow to keep up; it can reconnect and find its servers still warm
+            self.disconnect()
+
+    def send_message(self, language, message):
+        self.send_json({'language': language, 'message': message})
+
+    def reply(self, language, request_id, result=None, error=None):
+        message = {'jsonrpc': '2.0', 'id': request_id}
+        if error is not None:
+            message['error'] = {'code': error[0], 'message': error[1]}
+        else:
+            message['result'] = result
+        self.send_message(language, message)
+
+    def disconnect(self):
+        if self.dropped:
+            return
+        self.dropped = True
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+    async def write(self):
+        try:
+            while True:
+                text = await self.queue.get()
+                if text is None:
+                    await self.websocket.close(1013)
+                    return
+                await self.websocket.send_text(text)
+        except Exception:
+            # The connection is gone; the reader side will notice and clean up
+            pass
+
+
+class LanguageServer:
+    def __init__(self, pool, key, command, workspace, language):
+        self.pool = pool
+        self.key = key
+        self.command = command
+        # Held until the server exits
+        self.workspace = workspace
+        workspace.users += 1
+        self.root = workspace.root
+        self.root_uri = workspace.root_uri
+        self.language = language
+        self.process = None
+        self.reader = FrameReader()
+        self.outbox = bytearray()
+        self.stderr = bytearray()
+        self.ids = itertools.count(1)
+        # server request id -> asyncio.Future for our own requests, else (client, language, client id)
+        self.pending = {}
+        self.client_requests = {}
+        # client -> the language it speaks to this server as
+        self.clients = {}
+        # uri -> {'clients': set of clients with it open, 'version': our version number}
+        self.documents = {}
+        self.diagnostics = {}
+        self.capabilities = None
+        self.started = None
+        self.stopping = False
+        self.closed = False
+        self.last_used = time.monotonic()
+
+    # -- process I/O ---------------------------------------------------------
+
+    async def start(self, params):
+        loop = asyncio.get_running_loop()
+        try:
+            self.process = await loop.run_in_executor(None, functools.partial(
+                spawn_process, self.command, timeout=getattr(settings, 'LSP_MAX_LIFETIME', 24 * 3600),
+                cwd=self.root, binds=[self.root], language=self.language))
+        except (OSError, SandboxError) as e:
+            self.closed = True
+            close_workspace(self.workspace)
+            raise LanguageServerError(f'{self.command[0]} is not available: {e}')
+        for stream in (self.process.stdin, self.process.stdout, self.process.stderr):
+            os.set_blocking(stream.fileno(), False)
+        loop.add_reader(self.process.stdout.fileno(), self._on_stdout)
+        loop.add_reader(self.process.stderr.fileno(), self._on_stderr)
+
+        params = dict(params or {})
+        params.update({
+            'processId': os.getpid(),
+            'rootUri': self.root_uri,
+            'rootPath': self.root,
+            'workspaceFolders': [{'uri': self.root_uri, 'name': self.key[1]}],
+        })
+        try:
+            result = await asyncio.wait_for(self._request('initialize', params),
+                                            getattr(settings, 'LSP_START_TIMEOUT', 30))
+        except (asyncio.TimeoutError, LanguageServerError) as e:
+            details = self.stderr.decode('utf-8', 'replace').strip()[-1000:]
+            self._exited(notify=False)
+            message = 'timed out starting' if isinstance(e, asyncio.TimeoutError) else str(e)
+            raise LanguageServerError(f'{self.command[0]}: {message}' + (f'\n{details}' if details else ''))
+        self._send({'jsonrpc': '2.0', 'method': 'initialized', 'params': {}})
+        self.capabilities = result
+
+    def _on_stdout(self):
+        try:
+            data = os.read(self.process.stdout.fileno(), 65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self._exited()
+            return
+        try:
+            messages = self.reader.feed(data)
+        except ValueError as e:
+            logger.error(f"Bad output from {self.command[0]} for {self.key[1]}: {str(e)}")
+            self._exited()
+            return
+        for message in messages:
+            try:
+                self._from_server(message)
+            except Exception as e:
+                logger.error(f"Error handling a message from {self.command[0]}: {str(e)}", exc_info=True)
+
+    def _on_stderr(self):
+        try:
+            data = os.read(self.process.stderr.fileno(), 65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            asyncio.get_running_loop().remove_reader(self.process.stderr.fileno())
+            return
+        # Servers log freely to stderr; keep the tail for startup errors
+        self.stderr += data
+        del self.stderr[:-4096]
+
+    def _send(self, message):
+        if self.closed:
+            return
+        self.outbox += encode(message)
+        self._flush()
+
+    def _flush(self):
+        loop = asyncio.get_running_loop()
+        fd = self.process.stdin.fileno()
+        try:
+            while self.outbox:
+                written = os.write(fd, self.outbox)
+                del self.outbox[:written]
+        except BlockingIOError:
+            loop.add_writer(fd, self._flush)
+            return
+        except OSError:
+            self._exited()
+            return
+        loop.remove_writer(fd)
+
+    def _request(self, method, params):
+        future = asyncio.get_running_loop().create_future()
+        request_id = next(self.ids)
+        self.pending[request_id] = future
+        self._send({'jsonrpc': '2.0', 'id': request_id, 'method': method, 'params': params})
+        return future
+
+    def _exited(self, notify=True):
+        """Clean up after the server exits (or is killed), failing anything still waiting on it."""
+        if self.closed:
+            return
+        self.closed = True
+        notify = notify and not self.stopping
+        loop = asyncio.get_running_loop()
+        for stream in (self.process.stdout, self.process.stderr):
+            loop.remove_reader(stream.fileno())
+        loop.remove_writer(self.process.stdin.fileno())
+        try:
+            self.process.kill()
+        except OSError:
+            pass
+        loop.run_in_executor(None, self._reap_process)
+        for request_id, waiter in self.pending.items():
+            if isinstance(waiter, asyncio.Future):
+                if not waiter.done():
+                    waiter.set_exception(LanguageServerError('The language server exited'))
+            else:
+                client, language, client_id = waiter
+                client.reply(language, client_id, error=(INTERNAL_ERROR, 'The language server exited'))
+        self.pending.clear()
+        self.client_requests.clear()
+        for client, language in self.clients.items():
+            if client.servers.get(language) is self:
+                del client.servers[language]
+            if notify:
+                client.send_json({'language': language, 'error': f'{self.command[0]} exited'})
+        self.clients.clear()
+        if notify:
+            metrics.language_server_shutdowns.inc(reason='exited')
+        self.pool.forget(self)
+        close_workspace(self.workspace)
+
+    def _reap_process(self):
+        try:
+            self.process.wait(timeout=10)
+        except Exception:
+            pass
+        for stream in (self.process.stdin, self.process.stdout, self.process.stderr):
+            try:
+                stream.close()
+            except OSError:
+                pass
+
+    async def shutdown(self):
+        """Ask the server to exit, killing it if it doesn't within a few seconds."""
+        if self.closed:
+            return
+        self.stopping = True
+        try:
+            await asyncio.wait_for(self._request('shutdown', None), 3)
+            self._send({'jsonrpc': '2.0', 'method': 'exit'})
+            await asyncio.sleep(0.5)
+        except (asyncio.TimeoutError, LanguageServerError):
+            pass
+        self._exited(notify=False)
+
+    def memory(self):
+        """Resident memory of the server and the processes it started, in bytes."""
+        if self.process is None or not self.process.pid:
+            return 0
+        return _tree_rss(self.process.pid)
+
+    # -- clients -------------------------------------------------------------
+
+    def attach(self, client, language):
+        self.clients[client] = language
+        client.servers[language] = self
+        self.last_used = time.monotonic()
+
+    def detach(self, client):
+        language = self.clients.pop(client, None)
+        if language is not None and client.servers.get(language) is self:
+            del client.servers[language]
+        for key in [key for key in self.client_requests if key[0] is client]:
+            request_id = self.client_requests.pop(key)
+            self.pending.pop(request_id, None)
+            self._send({'jsonrpc': '2.0', 'method': '$/cancelRequest', 'params': {'id': request_id}})
+        for uri in [uri for uri, document in self.documents.items() if client in document['clients']]:
+            self._close_document(client, uri)
+        self.last_used = time.monotonic()
+
+    def _close_document(self, client, uri):
+        document = self.documents[uri]
+        document['clients'].discard(client)
+        if not document['clients']:
+            del self.documents[uri]
+            self.diagnostics.pop(uri, None)
+            self._send({'jsonrpc': '2.0', 'method': 'textDocument/didClose', 'params': {'textDocument': {'uri': uri}}})
+
+    def handle(self, client, language, message):
+        """Pass a message from a client on to the server, translating what a shared server needs."""
+        self.last_used = time.monotonic()
+        method = message.get('method')
+        request_id = message.get('id')
+        params = message.get('params') or {}
+
+        if method == 'initialize':
+            client.reply(language, request_id, self.capabilities)
+            return
+        if method in ('initialized', 'exit'):
+            return
+        if method == 'shutdown':
+            # Only this client is done; the server stays up for others and for reconnects
+            self.detach(client)
+            client.reply(language, request_id, None)
+            return
+        if method == '$/cancelRequest':
+            server_id = self.client_requests.get((client, params.get('id')))
+            if server_id is not None:
+                self._send({'jsonrpc': '2.0', 'method': method, 'params': {'id': server_id}})
+            return
+        if method is None:
+            # A reply to a server request; those are all answered by the gateway
+            return
+
+        uri = (params.get('textDocument') or {}).get('uri') if isinstance(params, dict) else None
+        if uri is not None and not uri.startswith(self.root_uri + '/'):
+            if request_id is not None:
+                client.reply(language, request_id, error=(INVALID_REQUEST, 'Document is outside the project'))
+            return
+
+        if method == 'textDocument/didOpen':
+            self._open_document(client, params)
+            return
+        if method in ('textDocument/didChange', 'textDocument/didClose', 'textDocument/didSave'):
+            document = self.documents.get(uri)
+            if document is None or client not in document['clients']:
+                return
+            if method == 'textDocument/didClose':
+                self._close_document(client, uri)
+                return
+            if method == 'textDocument/didChange':
+                # Every client counts its own versions; the server sees one sequence
+                document['version'] += 1
+                params = {**params, 'textDocument': {'uri': uri, 'version': document['version']}}
+            self._send({'jsonrpc': '2.0', 'method': method, 'params': params})
+            return
+
+        if request_id is None:
+            self._send({'jsonrpc': '2.0', 'method': method, 'params': params})
+            return
+        server_id = next(self.ids)
+        self.pending[server_id] = (client, language, request_id)
+        self.client_requests[(client, request_id)] = server_id
+        self._send({'jsonrpc': '2.0', 'id': server_id, 'method': method, 'params': params})
+
+    def _open_document(self, client, params):
+        item = params.get('textDocument') or {}
+        uri = item.get('uri')
+        document = self.documents.get(uri)
+        if document is None:
+            self.documents[uri] = {'clients': {client}, 'version': 1}
+            self._send({'jsonrpc': '2.0', 'method': 'textDocument/didOpen',
+                        'params': {'textDocument': {**item, 'version': 1}}})
+            return
+        # Already open for another connection: take this client's text as the current one
+        document['clients'].add(client)
+        document['version'] += 1
+        self._send({'jsonrpc': '2.0', 'method': 'textDocument/didChange', 'params': {
+            'textDocument': {'uri': uri, 'version': document['version']},
+            'contentChanges': [{'text': item.get('text', '')}],
+        }})
+        if uri in self.diagnostics:
+            client.send_message(self.clients.get(client, self.language), {
+                'jsonrpc': '2.0', 'method': 'textDocument/publishDiagnostics', 'params': self.diagnostics[uri]})
+
+    def _from_server(self, message):
+        method = message.get('method')
+        if method is None:
+            waiter = self.pending.pop(message.get('id'), None)
+            if isinstance(waiter, asyncio.Future):
+                if waiter.done():
+                    return
+                if 'error' in message:
+                    waiter.set_exception(LanguageServerError(message['error'].get('message', 'Request failed')))
+                else:
+                    waiter.set_result(message.get('result'))
+            elif waiter is not None:
+                client, language, client_id = waiter
+                self.client_requests.pop((client, client_id), None)
+                client.send_message(language, {**message, 'id': client_id})
+            return
+
+        if 'id' in message:
+            self._answer(message)
+            return
+        params = message.get('params') or {}
+        if method == 'textDocument/publishDiagnostics':
+            uri = params.get('uri')
+            self.diagnostics[uri] = params
+            targets = self.documents.get(uri, {}).get('clients', ())
+        else:
+            targets = list(self.clients)
+        for client in targets:
+            client.send_message(self.clients.get(client, self.language), message)
+
+    def _answer(self, message):
+        """Reply to a request the server sent to its client."""
+        method = message['method']
+        reply = {'jsonrpc': '2.0', 'id': message['id']}
+        if method == 'workspace/configuration':
+            reply['result'] = [None] * len((message.get('params') or {}).get('items', []))
+        elif method in SERVER_REQUEST_REPLIES:
+            reply['result'] = SERVER_REQUEST_REPLIES[method]
+        else:
+            reply['error'] = {'code': METHOD_NOT_FOUND, 'message': f'{method} is not supported'}
+        self._send(reply)
+
+    def info(self):
+        return {'user': self.key[0], 'project_id': self.key[1], 'command': self.command,
+                'clients': len(self.clients), 'documents': len(self.documents),
+                'idle_seconds': round(time.monotonic() - self.last_used, 1), 'memory': self.memory()}
+
+
+class ServerPool:
+    def __init__(self):
+        # key -> LanguageServer, least recently used first
+        self.servers = OrderedDict()
+        self.reaper = None
+
+    async def get(self, client, project_id, workspace, language, params):
+        """The server for client's language in a project, started if needed, and attach client to it."""
+        command = server_command(language)
+        if command is None:
+            raise LanguageServerError(f'No language server for {language}')
+        key = (client.user, project_id, tuple(command))
+        server = self.servers.get(key)
+        if server is None or server.closed:
+            await self._make_room()
+            server = LanguageServer(self, key, command, workspace, language)
+            self.servers[key] = server
+            server.started = asyncio.ensure_future(server.start(params))
+        try:
+            # Shielded so one client giving up doesn't abort a start another is waiting on
+            await asyncio.shield(server.started)
+        except LanguageServerError:
+            self.forget(server)
+            raise
+        self.servers.move_to_end(key)
+        server.attach(client, language)
+        if self.reaper is None or self.reaper.done():
+            self.reaper = asyncio.ensure_future(self._reap())
+        return server
+
+    def forget(self, server):
+        if self.servers.get(server.key) is server:
+            del self.servers[server.key]
+
+    def detach(self, client):
+        for server in set(client.servers.values()):
+            server.detach(client)
+
+    def _idle(self):
+        return [server for server in self.servers.values() if not server.clients and server.started.done()]
+
+    async def _make_room(self):
+        max_servers = getattr(settings, 'LSP_MAX_SERVERS', 16)
+        while len(self.servers) >= max_servers:
+            idle = self._idle()
+            if not idle:
+                raise LanguageServerError('Too many language servers are running, try again later')
+            await self._evict(idle[0], 'capacity')
+        await self._fit_budget()
+
+    async def _fit_budget(self):
+        budget = getattr(settings, 'LSP_MEMORY_BUDGET_MB', 4096) * 1024 * 1024
+        loop = asyncio.get_running_loop()
+        while True:
+            idle = self._idle()
+            if not idle:
+                return
+            servers = list(self.servers.values())
+            used = sum(await loop.run_in_executor(None, lambda: [server.memory() for server in servers]))
+            if used <= budget:
+                return
+            await self._evict(idle[0], 'memory')
+
+    async def _evict(self, server, reason):
+        logger.info(f"Shutting down {server.command[0]} for {server.key[1]} ({reason})")
+        metrics.language_server_shutdowns.inc(reason=reason)
+        self.forget(server)
+        await server.shutdown()
+
+    async def _reap(self):
+        while self.servers:
+            await asyncio.sleep(getattr(settings, 'LSP_REAP_INTERVAL', 30))
+            try:
+                idle_timeout = getattr(settings, 'LSP_IDLE_TIMEOUT', 600)
+                now = time.monotonic()
+                for server in self._idle():
+                    if now - server.last_used > idle_timeout:
+                        await self._evict(server, 'idle')
+                await self._fit_budget()
+            except Exception as e:
+                logger.error(f"Error reaping language servers: {str(e)}", exc_info=True)
+
+    def list(self):
+        return [server.info() for server in self.servers.values() if server.started.done() and not server.closed]
+
+
+_pool = ServerPool()
+
+
+def get_pool():
+    return _pool
+
+
+async def language_server(websocket, project_id):
+    await websocket.accept()
+    loop = asyncio.get_running_loop()
+    try:
+        project_id = clean_project_id(project_id)
+        owner = await loop.run_in_executor(None, _session_owner,
+                                           websocket.cookies.get(settings.SESSION_COOKIE_NAME))
+        if owner is None:
+            raise ValueError('No session; reload the editor')
+        if not await loop.run_in_executor(None, _project_exists, project_id):
+            raise ValueError('Project not found')
+        workspace = await open_workspace(project_id)
+    except (ValueError, OSError) as e:
+        await websocket.send_json({'error': str(e)})
+        await websocket.close()
+        return
+
+    client = _Client(websocket, owner)
+    client.send_json({'root_uri': workspace.root_uri})
+    writer = asyncio.create_task(client.write())
+    try:
+        while not client.dropped:
+            try:
+                frame = await websocket.receive_json()
+            except ValueError:
+                client.send_json({'error': 'Invalid JSON data'})
+                continue
+            language = frame.get('language') if isinstance(frame, dict) else None
+            message = frame.get('message') if isinstance(frame, dict) else None
+            if not isinstance(language, str) or not isinstance(message, dict):
+                client.send_json({'error': 'Frames need a language and a message'})
+                continue
+            server = client.servers.get(language)
+            if server is None or server.closed:
+                if message.get('method') != 'initialize':
+                    if 'id' in message and 'method' in message:
+                        client.reply(language, message['id'], error=(INVALID_REQUEST, 'Send initialize first'))
+                    continue
+                try:
+                    server = await _pool.get(client, project_id, workspace, language, message.get('params'))
+                except LanguageServerError as e:
+                    client.send_json({'language': language, 'error': str(e)})
+                    client.reply(language, message.get('id'), error=(INTERNAL_ERROR, str(e)))
+                    continue
+            server.handle(client, language, message)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        _pool.detach(client)
+        close_workspace(workspace)
+        if not client.dropped:
+            writer.cancel()
@@ -0,0 +1,87 @@
+import json
+import statistics
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from django.test import RequestFactory
+
+from codeeditor import storage, views
+from codeeditor.models import FileVersion
+
+PROJECT = '__bench_saves__'
+
+
+class Command(BaseCommand):
+    help = 'Measure file save throughput through save_file with the database storage backend'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8, help='Concurrent savers')
+        parser.add_argument('--saves', type=int, default=200, help='Saves per thread')
+        parser.add_argument('--files', type=int, default=20, help='Files each thread saves in turn')
+
+    def handle(self, *args, **options):
+        threads, saves, files = options['threads'], options['saves'], options['files']
+        latencies = []
+        errors = []
+        lock = threading.Lock()
+        start_barrier = threading.Barrier(threads + 1)
+        factory = RequestFactory()
+
+        def save_loop(worker):
+            local, failed = [], []
+            try:
+                start_barrier.wait()
+                for i in range(saves):
+                    file_id = f'{PROJECT}/worker{worker}/file{i % files}.py'
+                    body = json.dumps({'content': f'# worker {worker}, save {i}\nvalue = {i}\n'})
+                    request = factory.post(f'/editor/files/{file_id}/save/', body, content_type='application/json')
+                    started = time.perf_counter()
+                    # The whole save: storage.write, then the file_changed receivers (version history, ...)
+                    response = views.save_file(request, file_id)
+                    if response.status_code != 200:
+                        failed.append(json.loads(response.content).get('error', response.status_code))
+                        continue
+                    local.append(time.perf_counter() - started)
+            finally:
+                connections.close_all()
+                with lock:
+                    latencies.extend(local)
+                    errors.extend(failed)
+
+        # Saved content lands in the database backend; collect_history_garbage clears its history blobs
+        previous_storage = storage._storage
+        storage._storage = storage.CachedStorage(storage.create_backend('database'), max_bytes=0)
+        try:
+            if storage._storage.project_exists(PROJECT):
+                storage._storage.delete_project(PROJECT)
+            storage._storage.create_project(PROJECT)
+            FileVersion.objects.filter(project_name=PROJECT).delete()
+            workers = [threading.Thread(target=save_loop, args=(worker,)) for worker in range(threads)]
+            for worker in workers:
+                worker.start()
+            start_barrier.wait()
+            started = time.perf_counter()
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - started
+            storage._storage.delete_project(PROJECT)
+            FileVersion.objects.filter(project_name=PROJECT).delete()
+        finally:
+            storage._storage = previous_storage
+
+        description = connection.vendor
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('PRAGMA journal_mode')
+                description += f' (journal_mode={cursor.fetchone()[0]})'
+        self.stdout.write(f'Database:    {description}')
+        self.stdout.write(f'Savers:      {threads} x {saves} saves')
+        self.stdout.write(f'Throughput:  {len(latencies) / elapsed:.0f} saves/s ({elapsed:.2f}s)')
+        if latencies:
+            latencies.sort()
+            percentile = lambda p: latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000
+            self.stdout.write(f'Latency:     p50 {statistics.median(latencies) * 1000:.1f}ms, '
+                              f'p95 {percentile(0.95):.1f}ms, p99 {percentile(0.99):.1f}ms')
+        self.stdout.write(f'Errors:      {len(errors)}' + (f' (first: {errors[0]})' if errors else ''))
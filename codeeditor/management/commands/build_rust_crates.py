@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from codeeditor import rustbuild
+
+
+class Command(BaseCommand):
+    help = 'Build the crates in RUST_CRATES so Rust programs can use them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--offline', action='store_true',
+                            help='Only use crates already downloaded to the cargo registry')
+
+    def handle(self, *args, **options):
+        try:
+            externs = rustbuild.build_crates(offline=options['offline'], output=self.stderr)
+        except (OSError, RuntimeError, ValueError) as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(f"Built {', '.join(sorted(externs)) or 'no crates'}"))
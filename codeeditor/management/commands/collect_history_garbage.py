@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from codeeditor import snapshots
+
+
+class Command(BaseCommand):
+    help = 'Delete file history blobs nothing refers to, optionally forgetting old history first'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep-days', type=int, default=None,
+                            help="Forget snapshots and file versions older than this (each file's latest version stays)")
+
+    def handle(self, *args, **options):
+        if options['keep_days'] is not None and options['keep_days'] < 0:
+            raise CommandError('--keep-days must not be negative')
+        removed = snapshots.collect_garbage(keep_days=options['keep_days'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Removed {removed['versions']} versions, {removed['snapshots']} snapshots and {removed['blobs']} blobs"))
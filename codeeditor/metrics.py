@@ -0,0 +1,388 @@
+"""
+Metrics in the Prometheus text exposition format, served at /metrics.
+
+Each metric keeps its samples in a dict guarded by its own lock, so
+recording a sample is a dict lookup and an addition. Once shared (see
+Registry.share), every server process also writes its samples to a file
+of its own in METRICS_DIR about once a second, and a scrape, whichever
+process serves it, adds up the files: counters and histograms of every
+process that ever ran (those of exited processes are folded into one
+file), gauges of the processes still running. Gauges computed from
+host-wide state (the execution scheduler's) are read by the scraped
+process alone.
+"""
+import bisect
+import fcntl
+import json
+import os
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds; covers quick interpreter runs up to the execution timeout
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = None
+    # Whether samples are added up across processes, and kept after a process exits
+    shared = True
+    cumulative = True
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.samples = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self, samples=None):
+        """Exposition lines for samples ({key: value}, this process's own by default)."""
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        if samples is None:
+            samples = self.snapshot()
+        for key, value in sorted(samples.items()):
+            lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}')
+        return lines
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.samples)
+
+    def add(self, value, other):
+        return value + other
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.samples[key] = self.samples.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+    cumulative = False
+
+    def __init__(self, name, documentation, labelnames=(), function=None, per_process=True):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+        # A gauge computed from state every process sees is read by the scraped one alone
+        self.shared = per_process
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.samples[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.samples[key] = self.samples.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def snapshot(self):
+        # An unlabelled gauge can be computed when scraped instead
+        if self.function is not None:
+            return {(): self.function()}
+        return super().snapshot()
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            sample = self.samples.get(key)
+            if sample is None:
+                # Per-bucket counts (last one is +Inf), sum, count
+                sample = self.samples[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            sample[0][index] += 1
+            sample[1] += value
+            sample[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        with self.lock:
+            return {key: [list(counts), total, count] for key, (counts, total, count) in self.samples.items()}
+
+    def add(self, value, other):
+        return [[a + b for a, b in zip(value[0], other[0])], value[1] + other[1], value[2] + other[2]]
+
+    def render(self, samples=None):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        if samples is None:
+            samples = self.snapshot()
+        for key, (counts, total, count) in sorted(samples.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(float(bound)))])
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Registry:
+    # Where the samples of exited processes are kept
+    EXITED = 'exited.json'
+
+    def __init__(self):
+        self.metrics = []
+        self.directory = None
+        self.interval = 1.0
+        self.path = None
+        self.write_lock = threading.Lock()
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def share(self, directory, interval=1.0):
+        """Write this process's samples to directory, and report every process's on render."""
+        self.directory = directory
+        self.interval = interval
+        os.makedirs(directory, exist_ok=True)
+        self._start_writer()
+        # Forked server workers are separate processes with samples of their own
+        os.register_at_fork(after_in_child=self._start_writer)
+
+    def _start_writer(self):
+        for metric in self.metrics:
+            with metric.lock:
+                metric.samples.clear()
+        # A random part too, so a later process reusing the pid doesn't overwrite this one's samples
+        self.path = os.path.join(self.directory, f'{os.getpid()}-{secrets.token_hex(4)}.json')
+        threading.Thread(target=self._write_forever, args=(self.path,), daemon=True).start()
+
+    def _write_forever(self, path):
+        while path == self.path:
+            self.write()
+            time.sleep(self.interval)
+
+    def snapshot(self):
+        """This process's shared samples, as JSON-friendly lists."""
+        return {metric.name: [[list(key), value] for key, value in metric.snapshot().items()]
+                for metric in self.metrics if metric.shared}
+
+    def write(self):
+        with self.write_lock:
+            temporary = f'{self.path}.tmp'
+            with open(temporary, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(temporary, self.path)
+
+    def _merge(self, totals, data, cumulative_only=False):
+        by_name = {metric.name: metric for metric in self.metrics}
+        for name, samples in data.items():
+            metric = by_name.get(name)
+            if metric is None or (cumulative_only and not metric.cumulative):
+                continue
+            merged = totals.setdefault(name, {})
+            for key, value in samples:
+                key = tuple(key)
+                merged[key] = metric.add(merged[key], value) if key in merged else value
+
+    def collect(self):
+        """Samples of every process, by metric name; exited processes' files are folded into one."""
+        self.write()
+        totals = {}
+        lock = os.open(os.path.join(self.directory, '.lock'), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            exited_path = os.path.join(self.directory, self.EXITED)
+            exited = {}
+            try:
+                with open(exited_path) as f:
+                    self._merge(exited, json.load(f))
+            except (OSError, ValueError):
+                pass
+            folded = []
+            for name in os.listdir(self.directory):
+                pid = name.split('-', 1)[0]
+                if not name.endswith('.json') or not pid.isdigit():
+                    continue
+                path = os.path.join(self.directory, name)
+                try:
+                    with open(path) as f:
+                        data = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                if _alive(int(pid)):
+                    self._merge(totals, data)
+                else:
+                    self._merge(exited, data, cumulative_only=True)
+                    folded.append(path)
+            if folded:
+                temporary = f'{exited_path}.tmp'
+                with open(temporary, 'w') as f:
+                    json.dump({name: [[list(key), value] for key, value in samples.items()]
+                               for name, samples in exited.items()}, f)
+                os.replace(temporary, exited_path)
+                for path in folded:
+                    os.remove(path)
+        finally:
+            os.close(lock)
+        for name, samples in exited.items():
+            self._merge(totals, {name: [[key, value] for key, value in samples.items()]})
+        return totals
+
+    def render(self):
+        totals = self.collect() if self.directory else {}
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render(totals.get(metric.name, {}) if self.directory and metric.shared else None))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+http_requests = REGISTRY.register(Counter(
+    'codeeditor_http_requests_total', 'HTTP requests by view, method and status code.',
+    ['view', 'method', 'status']))
+http_request_duration = REGISTRY.register(Histogram(
+    'codeeditor_http_request_duration_seconds', 'Time spent handling HTTP requests.',
+    ['view', 'method']))
+executions = REGISTRY.register(Counter(
+    'codeeditor_executions_total',
+    'Compile and run steps by language and outcome (ok, error, timeout or failed to start).',
+    ['language', 'phase', 'outcome']))
+execution_duration = REGISTRY.register(Histogram(
+    'codeeditor_execution_duration_seconds', 'Wall time of compile and run steps.',
+    ['language', 'phase']))
+admission_rejections = REGISTRY.register(Counter(
+    'codeeditor_admission_rejections_total', 'Runs turned away by the execution scheduler.',
+    ['reason']))
+
+
+def _scheduler_stat(name):
+    def read():
+        from .scheduler import get_scheduler
+        return get_scheduler().stats()[name]
+    return read
+
+
+REGISTRY.register(Gauge('codeeditor_execution_slots_in_use', 'Executions currently holding a slot.',
+                        function=_scheduler_stat('running'), per_process=False))
+REGISTRY.register(Gauge('codeeditor_execution_queue_depth', 'Executions waiting for a slot.',
+                        function=_scheduler_stat('queued'), per_process=False))
+REGISTRY.register(Gauge('codeeditor_execution_slots', 'Execution slots available on this host.',
+                        function=_scheduler_stat('capacity'), per_process=False))
+
+
+kernel_shutdowns = REGISTRY.register(Counter(
+    'codeeditor_kernel_shutdowns_total',
+    'Python session kernels shut down, by reason (idle, evicted, user_limit, timeout, exited, requested).',
+    ['reason']))
+
+
+def _kernel_count():
+    from .kernels import get_kernel_manager
+    return get_kernel_manager().stats()['kernels']
+
+
+REGISTRY.register(Gauge('codeeditor_kernels', 'Python session kernels alive in the server processes.',
+                        function=_kernel_count))
+
+
+language_server_shutdowns = REGISTRY.register(Counter(
+    'codeeditor_language_server_shutdowns_total',
+    'Pooled language servers shut down, by reason (idle, capacity, memory, exited).',
+    ['reason']))
+
+
+def _language_server_count():
+    from .lsp import get_pool
+    return len(get_pool().servers)
+
+
+REGISTRY.register(Gauge('codeeditor_language_servers', 'Pooled language servers in the server processes.',
+                        function=_language_server_count))
+
+
+build_cache_lookups = REGISTRY.register(Counter(
+    'codeeditor_build_cache_lookups_total', 'Build cache lookups for compiled languages, by result (hit, miss).',
+    ['language', 'result']))
+cluster_dispatches = REGISTRY.register(Counter(
+    'codeeditor_cluster_dispatches_total',
+    'Jobs sent to runner nodes, by node and outcome (ok, refused, failed, lost).',
+    ['node', 'outcome']))
+cluster_routes = REGISTRY.register(Counter(
+    'codeeditor_cluster_routes_total',
+    "How jobs were routed: to the key's node (home), the next one on the ring (spill) or the least loaded.",
+    ['decision']))
+cluster_build_cache_lookups = REGISTRY.register(Counter(
+    'codeeditor_cluster_build_cache_lookups_total',
+    'Build cache hits and misses of jobs sent to runner nodes, by node.',
+    ['node', 'result']))
+
+
+def _healthy_nodes():
+    from .cluster import get_cluster
+    cluster = get_cluster()
+    return sum(1 for node in cluster.stats() if node['healthy'] and not node['draining']) if cluster else 0
+
+
+REGISTRY.register(Gauge('codeeditor_cluster_nodes_available', 'Runner nodes that are healthy and not draining.',
+                        function=_healthy_nodes, per_process=False))
+
+
+def record_execution(language, phase, outcome, duration):
+    language = language or 'unknown'
+    executions.inc(language=language, phase=phase, outcome=outcome)
+    execution_duration.observe(duration, language=language, phase=phase)
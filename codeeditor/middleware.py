@@ -1,10 +1,17 @@
 import json
 import logging
-from django.http import JsonResponse, HttpResponse
+import time
+from django.conf import settings
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
 from django.core.serializers.json import DjangoJSONEncoder
 
+from . import metrics, tracing
+
 logger = logging.getLogger(__name__)
 
+# Methods the request metrics label by name
+HTTP_METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'}
+
 class JSONResponseMiddleware:
     def __init__(self, get_response):
         self.get_response = get_response
@@ -21,63 +28,108 @@ class JSONResponseMiddleware:
             logger.debug(f"Response status: {response.status_code}")
             logger.debug(f"Response headers: {dict(response.headers)}")
             
-            # Check if this is an AJAX request or JSON request
-            is_ajax = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
-            is_json_request = request.headers.get('Accept', '').find('application/json') != -1
-            
-            # If this is an AJAX request or JSON request, ensure JSON response
-            if is_ajax or is_json_request:
-                # If the response is already a JsonResponse, return it as is
-                if isinstance(response, JsonResponse):
-                    return response
-                
-                # For 404 responses, return a proper JSON error
-                if response.status_code == 404:
-                    return JsonResponse({
-                        'error': 'File not found',
-                        'path': request.path
-                    }, status=404)
-                
-                # If the response is an HttpResponse with content, try to parse it as JSON
-                if isinstance(response, HttpResponse) and response.content:
-                    try:
-                        # Try to decode the content
-                        content = response.content.decode('utf-8')
-                        logger.debug(f"Response content: {content[:200]}...")
-                        
-                        # Try to parse as JSON
-                        try:
-                            json_data = json.loads(content)
-                            logger.debug("Successfully parsed response as JSON")
-                            return JsonResponse(json_data, status=response.status_code, encoder=DjangoJSONEncoder)
-                        except json.JSONDecodeError:
-                            logger.warning("Response content is not valid JSON")
-                            # If it's not JSON, return a proper error response
-                            return JsonResponse({
-                                'error': 'Invalid JSON response',
-                                'content': content[:200] + '...' if len(content) > 200 else content
-                            }, status=500)
-                            
-                    except UnicodeDecodeError:
-                        logger.error("Failed to decode response content as UTF-8")
-                        return JsonResponse({
-                            'error': 'Response content is not valid UTF-8',
-                            'content_type': response.get('Content-Type', 'unknown')
-                        }, status=500)
-                        
-                # For any other response type, return a proper error response
-                return JsonResponse({
-                    'error': 'Unexpected response type',
-                    'status_code': response.status_code,
-                    'content_type': response.get('Content-Type', 'unknown')
-                }, status=500)
-            
-            # For non-AJAX requests, return the original response
-            return response
-            
+            with tracing.span('json_middleware'):
+                return self.ensure_json(request, response)
+
         except Exception as e:
             logger.error(f"Error in JSONResponseMiddleware: {str(e)}", exc_info=True)
             return JsonResponse({
                 'error': 'Internal server error',
                 'details': str(e)
-            }, status=500) 
\ No newline at end of file
+            }, status=500)
+
+    def ensure_json(self, request, response):
+        # Check if this is an AJAX request or JSON request
+        is_ajax = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+        is_json_request = request.headers.get('Accept', '').find('application/json') != -1
+
+        # If this is an AJAX request or JSON request, ensure JSON response
+        if is_ajax or is_json_request:
+            # If the response is already a JsonResponse, return it as is
+            if isinstance(response, JsonResponse):
+                return response
+
+            # Streamed downloads (project exports) can't be buffered into JSON
+            if isinstance(response, StreamingHttpResponse) and response.status_code == 200:
+                return response
+
+            # For 404 responses, return a proper JSON error
+            if response.status_code == 404:
+                return JsonResponse({
+                    'error': 'File not found',
+                    'path': request.path
+                }, status=404)
+
+            # If the response is an HttpResponse with content, try to parse it as JSON
+            if isinstance(response, HttpResponse) and response.content:
+                try:
+                    # Try to decode the content
+                    content = response.content.decode('utf-8')
+                    logger.debug(f"Response content: {content[:200]}...")
+
+                    # Try to parse as JSON
+                    try:
+                        json_data = json.loads(content)
+                        logger.debug("Successfully parsed response as JSON")
+                        return JsonResponse(json_data, status=response.status_code, encoder=DjangoJSONEncoder)
+                    except json.JSONDecodeError:
+                        logger.warning("Response content is not valid JSON")
+                        # If it's not JSON, return a proper error response
+                        return JsonResponse({
+                            'error': 'Invalid JSON response',
+                            'content': content[:200] + '...' if len(content) > 200 else content
+                        }, status=500)
+
+                except UnicodeDecodeError:
+                    logger.error("Failed to decode response content as UTF-8")
+                    return JsonResponse({
+                        'error': 'Response content is not valid UTF-8',
+                        'content_type': response.get('Content-Type', 'unknown')
+                    }, status=500)
+
+            # For any other response type, return a proper error response
+            return JsonResponse({
+                'error': 'Unexpected response type',
+                'status_code': response.status_code,
+                'content_type': response.get('Content-Type', 'unknown')
+            }, status=500)
+
+        # For non-AJAX requests, return the original response
+        return response
+
+
+class MetricsMiddleware:
+    """Record the count and latency of every request, labelled by view name."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        response = self.get_response(request)
+        duration = time.perf_counter() - start
+        match = getattr(request, 'resolver_match', None)
+        # Label by URL name rather than path so file ids don't explode the series
+        view = match.url_name or match.view_name if match else 'unmatched'
+        # Any token is a valid method, so unknown ones share a label too
+        method = request.method if request.method in HTTP_METHODS else 'other'
+        metrics.http_requests.inc(view=view, method=method, status=response.status_code)
+        metrics.http_request_duration.observe(duration, view=view, method=method)
+        return response
+
+
+class TracingMiddleware:
+    """Trace each request and report the time per span in a Server-Timing header."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.TRACING_ENABLED:
+            return self.get_response(request)
+        with tracing.start_trace('request', request.headers.get('traceparent'),
+                                 method=request.method, path=request.path) as root:
+            response = self.get_response(request)
+            root.set(status=response.status_code)
+        response['Server-Timing'] = root.trace.server_timing()
+        return response
@@ -0,0 +1,45 @@
+# Generated by Django 4.2.7 on 2026-10-19 18:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('codeeditor', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProjectSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('project_name', models.CharField(db_index=True, max_length=255)),
+                ('label', models.CharField(blank=True, max_length=255)),
+                ('manifest', models.CharField(max_length=64)),
+                ('file_count', models.IntegerField(default=0)),
+                ('total_size', models.BigIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['-id'],
+            },
+        ),
+        migrations.CreateModel(
+            name='FileVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('project_name', models.CharField(max_length=255)),
+                ('path', models.CharField(max_length=1000)),
+                ('old_path', models.CharField(blank=True, max_length=1000)),
+                ('event', models.CharField(max_length=16)),
+                ('blob', models.CharField(blank=True, max_length=64)),
+                ('size', models.BigIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['-id'],
+                'indexes': [models.Index(fields=['project_name', 'path'], name='codeeditor__project_52f041_idx')],
+            },
+        ),
+    ]
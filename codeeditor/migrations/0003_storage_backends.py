@@ -0,0 +1,25 @@
+# Generated by Django 4.2.7 on 2026-10-19 18:21
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('codeeditor', '0002_file_history'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='project',
+            name='owner',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(fields=['project', 'path'], name='codeeditor__project_672f8a_idx'),
+        ),
+    ]
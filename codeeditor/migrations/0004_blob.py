@@ -0,0 +1,49 @@
+# Generated by Django 4.2.7 on 2026-10-19 21:40
+
+import os
+import zlib
+
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def import_blob_dir(apps, schema_editor):
+    """Move blobs from the on-disk store used before into the table."""
+    Blob = apps.get_model('codeeditor', 'Blob')
+    root = os.path.join(getattr(settings, 'SNAPSHOT_DIR', os.path.join(settings.BASE_DIR, 'snapshots')), 'objects')
+    if not os.path.isdir(root):
+        return
+    now = timezone.now()
+    for prefix in sorted(os.listdir(root)):
+        directory = os.path.join(root, prefix)
+        if len(prefix) != 2 or not os.path.isdir(directory):
+            continue
+        blobs = []
+        for name in sorted(os.listdir(directory)):
+            if len(prefix + name) != 64:
+                continue
+            with open(os.path.join(directory, name), 'rb') as f:
+                data = f.read()
+            blobs.append(Blob(digest=prefix + name, data=data, size=len(zlib.decompress(data)), stored_at=now))
+        Blob.objects.bulk_create(blobs, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('codeeditor', '0003_storage_backends'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('digest', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('data', models.BinaryField()),
+                ('size', models.BigIntegerField(default=0)),
+                ('stored_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+        migrations.RunPython(import_blob_dir, migrations.RunPython.noop),
+    ]
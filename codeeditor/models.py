@@ -5,7 +5,7 @@ from django.contrib.auth.models import User
 
 class Project(models.Model):
     name = models.CharField(max_length=255)
-    owner = models.ForeignKey(User, on_delete=models.CASCADE)
+    owner = models.ForeignKey(User, null=True, blank=True, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     def __str__(self):
@@ -20,6 +20,9 @@ class File(models.Model):
     parent = models.ForeignKey('self', null=True, blank=True, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['project', 'path'])]
     
     def __str__(self):
         return self.name
@@ -32,3 +35,46 @@ class UserSession(models.Model):
     
     def __str__(self):
         return f"{self.user.username} - {self.project.name}"
+
+class Blob(models.Model):
+    """Content kept for file history, zlib-compressed and addressed by its SHA-256"""
+    digest = models.CharField(max_length=64, primary_key=True)
+    data = models.BinaryField()
+    size = models.BigIntegerField(default=0)
+    # Bumped whenever the content is stored again, so a collection can't drop it in between
+    stored_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return self.digest
+
+class FileVersion(models.Model):
+    """One recorded state of a project file; content is a Blob"""
+    project_name = models.CharField(max_length=255)
+    path = models.CharField(max_length=1000)
+    old_path = models.CharField(max_length=1000, blank=True)
+    event = models.CharField(max_length=16)
+    blob = models.CharField(max_length=64, blank=True)  # sha256 of the content, empty once deleted
+    size = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-id']
+        indexes = [models.Index(fields=['project_name', 'path'])]
+
+    def __str__(self):
+        return f"{self.project_name}/{self.path} ({self.event})"
+
+class ProjectSnapshot(models.Model):
+    """The whole file tree of a project at one point; manifest is a blob of {path: blob}"""
+    project_name = models.CharField(max_length=255, db_index=True)
+    label = models.CharField(max_length=255, blank=True)
+    manifest = models.CharField(max_length=64)
+    file_count = models.IntegerField(default=0)
+    total_size = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-id']
+
+    def __str__(self):
+        return f"{self.project_name} @ {self.created_at} {self.label}"
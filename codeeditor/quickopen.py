@@ -0,0 +1,267 @@
+"""
+Fuzzy "go to file" over a per-project index of file paths.
+
+The index is built by listing the project's files once through the
+storage backend, then kept current by the file_changed signal (plus a
+background re-listing every QUICK_OPEN_REFRESH_INTERVAL seconds for changes
+made elsewhere), so a query never touches the backend.
+
+A query matches a path if its characters appear in order. Candidates are
+found with one regex pass over all basenames joined into a single string
+(and over the full paths if that isn't enough), then scored in Python:
+matches at word boundaries, consecutive runs and matches in the file name
+rank higher, shorter paths break ties.
+"""
+import bisect
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.dispatch import receiver
+
+from .signals import file_changed
+from .storage import clean_path, get_storage
+
+# Characters after which a match counts as the start of a word
+SEPARATORS = '/\\_-. '
+
+
+def match_positions(query, path):
+    """
+    Indexes in path where the characters of (lower-cased) query match, or
+    None. Each character prefers a word start, else the next occurrence.
+    """
+    lower = path.lower()
+    positions = []
+    start = 0
+    for char in query:
+        index = lower.find(char, start)
+        if index < 0:
+            return None
+        # Look ahead for the same character at a word boundary
+        boundary = index
+        while boundary >= 0 and not _is_word_start(path, boundary):
+            boundary = lower.find(char, boundary + 1)
+        if boundary >= 0 and _rest_matches(query, lower, len(positions) + 1, boundary + 1):
+            index = boundary
+        positions.append(index)
+        start = index + 1
+    return positions
+
+
+def _is_word_start(path, index):
+    if index == 0 or path[index - 1] in SEPARATORS:
+        return True
+    return path[index].isupper() and path[index - 1].islower()
+
+
+def _rest_matches(query, lower, offset, start):
+    for char in query[offset:]:
+        start = lower.find(char, start) + 1
+        if not start:
+            return False
+    return True
+
+
+def score_path(query, path):
+    positions = match_positions(query, path)
+    if positions is None:
+        return None, None
+    name_start = path.rfind('/') + 1
+    score = 0
+    previous = -2
+    for index in positions:
+        score += 1
+        if index == previous + 1:
+            score += 5
+        if _is_word_start(path, index):
+            score += 8
+        if index >= name_start:
+            score += 2
+        previous = index
+    name = path[name_start:].lower()
+    if name.startswith(query):
+        score += 15
+    elif query in name:
+        score += 10
+    # Prefer compact matches and shorter paths
+    score -= (positions[-1] - positions[0]) * 0.1 + len(path) * 0.01
+    return score, positions
+
+
+class PathIndex:
+    def __init__(self, project_id):
+        self.project_id = project_id
+        self.lock = threading.Lock()
+        self.paths = set()
+        self.ready = threading.Event()
+        self.refreshed = 0.0
+        self.refreshing = False
+        self._snapshot = None
+
+    def build(self):
+        try:
+            self.refresh()
+        finally:
+            self.ready.set()
+
+    def refresh(self):
+        ignored_dirs = getattr(settings, 'SEARCH_IGNORED_DIRS', [])
+        paths = set(get_storage().versions(self.project_id, ignored_dirs=set(ignored_dirs)))
+        with self.lock:
+            self.paths = paths
+            self._snapshot = None
+            self.refreshed = time.monotonic()
+            self.refreshing = False
+
+    def maybe_refresh(self):
+        """Re-list the files in the background if the index is older than the refresh interval."""
+        interval = getattr(settings, 'QUICK_OPEN_REFRESH_INTERVAL', 30)
+        with self.lock:
+            if self.refreshing or time.monotonic() - self.refreshed < interval:
+                return
+            self.refreshing = True
+        threading.Thread(target=self.refresh, daemon=True).start()
+
+    def add(self, path):
+        with self.lock:
+            self.paths.add(path)
+            self._snapshot = None
+
+    def remove(self, path):
+        """Forget a file, or every file under a folder."""
+        prefix = path + '/'
+        with self.lock:
+            if path in self.paths:
+                self.paths.discard(path)
+            else:
+                self.paths = {p for p in self.paths if not p.startswith(prefix)}
+            self._snapshot = None
+
+    def rename(self, old_path, new_path):
+        prefix = old_path + '/'
+        with self.lock:
+            moved = {p for p in self.paths if p == old_path or p.startswith(prefix)}
+            self.paths -= moved
+            self.paths.update(new_path + p[len(old_path):] for p in moved)
+            self._snapshot = None
+
+    def snapshot(self):
+        """
+        Sorted paths, plus their lower-cased basenames and full paths, each
+        joined by newlines with the offset at which every entry starts.
+        """
+        with self.lock:
+            if self._snapshot is None:
+                paths = sorted(self.paths)
+                lower = [path.lower() for path in paths]
+                names = [path[path.rfind('/') + 1:] for path in lower]
+                self._snapshot = (paths, _joined(names), _joined(lower))
+            return self._snapshot
+
+
+def _joined(strings):
+    offsets = []
+    position = 0
+    for string in strings:
+        offsets.append(position)
+        position += len(string) + 1
+    return '\n'.join(strings), offsets
+
+
+def _collect_matches(pattern, joined, found, limit):
+    """Add the entries pattern matches in a joined string to found, up to limit."""
+    text, offsets = joined
+    for match in pattern.finditer(text):
+        if len(found) >= limit:
+            return
+        entry = bisect.bisect_right(offsets, match.start()) - 1
+        if entry not in found:
+            found[entry] = None
+
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def get_index(project_id, create=True):
+    with _indexes_lock:
+        index = _indexes.get(project_id)
+        if index is not None:
+            _indexes.move_to_end(project_id)
+            return index
+        if not create:
+            return None
+        index = _indexes[project_id] = PathIndex(project_id)
+        while len(_indexes) > getattr(settings, 'QUICK_OPEN_MAX_INDEXES', 32):
+            _indexes.popitem(last=False)
+    index.build()
+    return index
+
+
+def find_files(project_id, query, limit=50):
+    """
+    Rank the project's files against a fuzzy query.
+
+    Returns [{'id', 'path', 'name', 'score', 'positions'}], best first;
+    positions are the matched character indexes in path, for highlighting.
+    """
+    query = ''.join(query.lower().split())
+    index = get_index(project_id)
+    index.ready.wait()
+    index.maybe_refresh()
+    paths, names, full_paths = index.snapshot()
+    if not query:
+        return []
+
+    # Regexes find candidates in C, best tiers first: the query inside a file
+    # name, then its characters in order within a file name, then anywhere in
+    # the path. Scoring in Python stops at QUICK_OPEN_MAX_CANDIDATES. Each gap
+    # in the fuzzy pattern excludes the next wanted character, so it never
+    # backtracks.
+    fuzzy = re.compile(re.escape(query[0]) + ''.join(
+        f'[^\n{re.escape(char)}]*{re.escape(char)}' for char in query[1:]))
+    max_candidates = getattr(settings, 'QUICK_OPEN_MAX_CANDIDATES', 5000)
+    candidates = {}
+    for pattern, joined in ((re.compile(re.escape(query)), names),
+                            (fuzzy, names), (fuzzy, full_paths)):
+        _collect_matches(pattern, joined, candidates, max_candidates)
+    results = []
+    for entry in candidates:
+        path = paths[entry]
+        score, positions = score_path(query, path)
+        if score is not None:
+            results.append((score, path, positions))
+    results.sort(key=lambda result: (-result[0], result[1]))
+    return [{
+        'id': f'{project_id}/{path}',
+        'path': path,
+        'name': path[path.rfind('/') + 1:],
+        'score': round(score, 2),
+        'positions': positions,
+    } for score, path, positions in results[:limit]]
+
+
+@receiver(file_changed)
+def update_index(sender, project_id, path, event, old_path=None, **kwargs):
+    """Apply a change made through the file views to the project's path index, if loaded."""
+    index = get_index(project_id, create=False)
+    if index is None:
+        return
+    try:
+        path = clean_path(path) if path else ''
+        old_path = clean_path(old_path) if old_path else None
+    except ValueError:
+        return
+    if not path:
+        # The whole project was deleted or replaced; rebuild on next use
+        with _indexes_lock:
+            _indexes.pop(project_id, None)
+    elif event == 'deleted':
+        index.remove(path)
+    elif event == 'renamed' and old_path:
+        index.rename(old_path, path)
+    elif event != 'created' or get_storage().kind(project_id, path) == 'file':
+        index.add(path)
@@ -0,0 +1,34 @@
+"""
+WebSocket routes, served by online_code_editor/asgi.py.
+"""
+import logging
+import re
+
+from . import changes, collab, interactive, lsp
+from .websocket import WebSocket, WebSocketDisconnect
+
+logger = logging.getLogger(__name__)
+
+websocket_urlpatterns = [
+    (re.compile(r'^/ws/run/$'), interactive.run_interactive),
+    (re.compile(r'^/ws/collab/(?P<project_id>[^/]+)/$'), collab.collaborate),
+    (re.compile(r'^/ws/changes/(?P<project_id>[^/]+)/$'), changes.change_feed),
+    (re.compile(r'^/ws/lsp/(?P<project_id>[^/]+)/$'), lsp.language_server),
+]
+
+
+async def websocket_application(scope, receive, send):
+    websocket = WebSocket(scope, receive, send)
+    for pattern, handler in websocket_urlpatterns:
+        match = pattern.match(websocket.path)
+        if match:
+            try:
+                await handler(websocket, **match.groupdict())
+            except WebSocketDisconnect:
+                pass
+            except Exception as e:
+                logger.error(f"Error in websocket handler for {websocket.path}: {str(e)}", exc_info=True)
+                await websocket.close(1011)
+            return
+    # Closing before accept makes the server reject the handshake with 403
+    await websocket.close(4404)
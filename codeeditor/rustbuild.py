@@ -0,0 +1,262 @@
+"""
+Rust builds for prepare_program.
+
+A bare `rustc main.rs` recompiles everything on every run and only has
+std. Instead:
+
+- Each user and file name gets a persistent build slot under
+  RUST_WORKSPACE_DIR, where the source is compiled from a stable path
+  with incremental compilation, so running an edited program again only
+  recompiles what changed. At most RUST_INCREMENTAL_MAX_ENTRIES slots are
+  kept, least recently used removed first.
+- Popular crates (RUST_CRATES) are built once into a shared target
+  directory by `python manage.py build_rust_crates`, and every program
+  can use them: they are passed to rustc with --extern. Crates built by a
+  different rustc are ignored until rebuilt.
+- Unchanged sources reuse the executable from the build cache (see
+  cbuild), and compiles have their own RUST_COMPILE_TIMEOUT instead of
+  the run timeout.
+"""
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from . import metrics
+from .cbuild import BuildCache, CachedBuild
+from .executor import probe_process, run_process
+from .sandbox import bindable
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CRATES = 'rand=0.9,regex=1,itertools=0.14,serde=1:derive,serde_json=1'
+
+
+def workspace_dir(*parts):
+    return os.path.join(getattr(settings, 'RUST_WORKSPACE_DIR', os.path.join(tempfile.gettempdir(), 'codeeditor-rust')),
+                        *parts)
+
+
+def check_workspace_dir():
+    """Refuse to start if sandboxed builds couldn't bind the build slots and crates in RUST_WORKSPACE_DIR."""
+    if getattr(settings, 'SANDBOX_ENABLED', False) and not bindable(workspace_dir()):
+        raise ImproperlyConfigured(f'RUST_WORKSPACE_DIR must be under /tmp when SANDBOX_ENABLED is set, '
+                                   f'since build slots and crates are bound into the sandbox: {workspace_dir()}')
+
+
+def parse_crates(spec):
+    """'name=version[:feature+feature],...' as [(name, version, [features])]."""
+    crates = []
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        name, _, rest = item.partition('=')
+        version, _, features = rest.partition(':')
+        if not name.strip() or not version.strip():
+            raise ValueError(f'Invalid crate "{item}", expected name=version')
+        crates.append((name.strip(), version.strip(), [f for f in features.split('+') if f]))
+    return crates
+
+
+_identity = None
+_identity_lock = threading.Lock()
+
+
+def rustc_identity():
+    """rustc's full version, since crates are only usable by the compiler that built them."""
+    global _identity
+    with _identity_lock:
+        if _identity is None:
+            try:
+                _identity = probe_process(['rustc', '-vV'], capture_output=True, text=True,
+                                          timeout=10, check=True).stdout.strip()
+            except (OSError, subprocess.SubprocessError):
+                return None
+        return _identity
+
+
+def build_crates(offline=False, output=None):
+    """
+    Build RUST_CRATES into the shared target directory and record them in crates.json.
+
+    Runs cargo on the host, since crates have to be downloaded. Raises
+    RuntimeError if the build fails.
+    """
+    crates = parse_crates(getattr(settings, 'RUST_CRATES', DEFAULT_CRATES))
+    project = workspace_dir('crates')
+    os.makedirs(os.path.join(project, 'src'), exist_ok=True)
+    dependencies = []
+    for name, version, features in crates:
+        if features:
+            dependencies.append(f'{name} = {{ version = "{version}", features = {json.dumps(features)} }}')
+        else:
+            dependencies.append(f'{name} = "{version}"')
+    with open(os.path.join(project, 'Cargo.toml'), 'w') as f:
+        f.write('[package]\nname = "prelude"\nversion = "0.1.0"\nedition = "2021"\n\n'
+                '[lib]\npath = "src/lib.rs"\n\n[dependencies]\n' + '\n'.join(dependencies) + '\n')
+    open(os.path.join(project, 'src', 'lib.rs'), 'a').close()
+
+    manifest = os.path.join(project, 'Cargo.toml')
+    target = workspace_dir('target')
+    env = {**os.environ, 'CARGO_TARGET_DIR': target}
+    flags = ['--offline'] if offline else []
+    build = subprocess.run(['cargo', 'build', '--manifest-path', manifest, '--message-format=json', *flags],
+                           capture_output=True, text=True, env=env)
+    if output is not None:
+        output.write(build.stderr)
+    if build.returncode != 0:
+        raise RuntimeError(f'cargo build failed:\n{build.stderr.strip()[-2000:]}')
+    # Resolved for this host only, or cargo wants crates for every other platform too
+    host = next((line.split(':', 1)[1].strip() for line in (rustc_identity() or '').splitlines()
+                 if line.startswith('host:')), None)
+    if host:
+        flags += ['--filter-platform', host]
+    metadata = subprocess.run(['cargo', 'metadata', '--format-version', '1', '--manifest-path', manifest, *flags],
+                              capture_output=True, text=True, env=env)
+    if metadata.returncode != 0:
+        raise RuntimeError(f'cargo metadata failed:\n{metadata.stderr.strip()[-2000:]}')
+
+    # The extern name and package of each direct dependency, then the rlib cargo built for it
+    resolve = json.loads(metadata.stdout)['resolve']
+    root = next(node for node in resolve['nodes'] if node['id'] == resolve['root'])
+    direct = {dependency['pkg']: dependency['name'] for dependency in root['deps']}
+    externs = {}
+    for line in build.stdout.splitlines():
+        message = json.loads(line)
+        if message.get('reason') != 'compiler-artifact' or message.get('package_id') not in direct:
+            continue
+        rlibs = [path for path in message['filenames'] if path.endswith('.rlib')]
+        if rlibs:
+            externs[direct[message['package_id']]] = rlibs[0]
+
+    record = {'rustc': rustc_identity(), 'deps': os.path.join(target, 'debug', 'deps'), 'externs': externs}
+    temp_path = workspace_dir('crates.json.tmp')
+    with open(temp_path, 'w') as f:
+        json.dump(record, f, indent=2)
+    os.replace(temp_path, workspace_dir('crates.json'))
+    return externs
+
+
+_crates = (None, None)
+_crates_lock = threading.Lock()
+
+
+def prebuilt_crates():
+    """The crates.json record if it was built by this rustc, else None."""
+    global _crates
+    path = workspace_dir('crates.json')
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+    with _crates_lock:
+        if _crates[0] != mtime:
+            try:
+                with open(path) as f:
+                    record = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.error(f"Error reading {path}: {str(e)}")
+                record = None
+            if record is not None and record.get('rustc') != rustc_identity():
+                logger.warning('Prebuilt Rust crates were built by another rustc; run manage.py build_rust_crates')
+                record = None
+            elif (record is not None and getattr(settings, 'SANDBOX_ENABLED', False)
+                  and not bindable(record.get('deps', ''))):
+                # Recorded by a build into a workspace outside /tmp
+                logger.warning('Prebuilt Rust crates are outside /tmp, where the sandbox can\'t see them; '
+                               'run manage.py build_rust_crates')
+                record = None
+            _crates = (mtime, record)
+        return _crates[1]
+
+
+_build_cache = None
+_build_cache_lock = threading.Lock()
+
+
+def _cache():
+    global _build_cache
+    with _build_cache_lock:
+        if _build_cache is None:
+            _build_cache = BuildCache(workspace_dir('bin'), getattr(settings, 'RUST_BUILD_CACHE_SIZE', 512 * 1024 * 1024))
+        return _build_cache
+
+
+def _trim_slots(root, keep):
+    limit = getattr(settings, 'RUST_INCREMENTAL_MAX_ENTRIES', 64)
+    try:
+        slots = sorted((os.stat(os.path.join(root, name)).st_mtime, name) for name in os.listdir(root))
+    except OSError:
+        return
+    for _, name in slots[:max(len(slots) - limit, 0)]:
+        if name != keep:
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+
+def compile_program(source_file, output, work_dir, build_key=None):
+    """
+    Compile a Rust source file to output.
+
+    build_key (e.g. the user and file name) picks the incremental build
+    slot; without one the program is compiled from scratch. Returns a
+    subprocess.CompletedProcess-like result; a build cache hit returns a
+    CachedBuild without running rustc.
+    """
+    identity = rustc_identity()
+    if identity is None:
+        raise FileNotFoundError('rustc')
+    with open(source_file, 'rb') as f:
+        source = f.read()
+    crates = prebuilt_crates()
+    edition = getattr(settings, 'RUST_EDITION', '2021')
+    externs = sorted((crates or {}).get('externs', {}).items())
+
+    key = hashlib.sha256(b'\0'.join([identity.encode(), edition.encode(), json.dumps(externs).encode(), source]))
+    cache = _cache()
+    if cache.get(key.hexdigest(), output):
+        metrics.build_cache_lookups.inc(language='rust', result='hit')
+        return CachedBuild('rustc')
+    metrics.build_cache_lookups.inc(language='rust', result='miss')
+
+    args = ['rustc', '--edition', edition, '--crate-name', 'main']
+    binds = [work_dir]
+    if crates:
+        args += ['-L', f'dependency={crates["deps"]}']
+        args += [f'--extern={name}={path}' for name, path in externs]
+        binds.append(crates['deps'])
+    timeout = getattr(settings, 'RUST_COMPILE_TIMEOUT', 60)
+
+    if build_key is None:
+        result = run_process([*args, source_file, '-o', output], timeout=timeout, cwd=work_dir,
+                             binds=binds, language='rust', phase='compile')
+    else:
+        slots = workspace_dir('incremental')
+        slot_name = hashlib.sha256(build_key.encode('utf-8', 'surrogatepass')).hexdigest()[:32]
+        slot = os.path.join(slots, slot_name)
+        os.makedirs(slot, exist_ok=True)
+        # main.rs relative to the slot, so incremental state carries over and messages say main.rs
+        args += ['-C', f'incremental={slot}/incremental', 'main.rs', '-o', output]
+        with open(os.path.join(slot, '.lock'), 'w') as lock:
+            # The same user compiling twice at once takes turns in the slot
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(os.path.join(slot, 'main.rs'), 'wb') as f:
+                    f.write(source)
+                os.utime(slot)
+                result = run_process(args, timeout=timeout, cwd=slot, binds=[*binds, slot],
+                                     language='rust', phase='compile')
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        _trim_slots(slots, slot_name)
+    if result.returncode == 0:
+        cache.put(key.hexdigest(), output)
+    return result
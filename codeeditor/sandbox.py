@@ -0,0 +1,568 @@
+"""
+Namespace sandbox for running user programs.
+
+Every run gets fresh user, mount, PID and network namespaces, on top of a
+read-only per-language root filesystem with a tmpfs mounted at /tmp. The
+host root is never used: a language without a rootfs can't run. Runs are
+forked from a long-lived zygote process, so a run only costs a fork and a
+few mounts instead of a container start. Each run's address space, writable
+memory and process count are capped with rlimits; its own user namespace
+makes the process cap count that run's processes only.
+
+This module must not import Django: the zygote runs it as a plain script.
+"""
+import ctypes
+import json
+import os
+import resource
+import select
+import selectors
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+CLONE_NEWNS = 0x00020000
+CLONE_NEWUSER = 0x10000000
+CLONE_NEWPID = 0x20000000
+CLONE_NEWNET = 0x40000000
+
+MS_RDONLY = 0x1
+MS_NOSUID = 0x2
+MS_NODEV = 0x4
+MS_NOEXEC = 0x8
+MS_REMOUNT = 0x20
+MS_NOATIME = 0x400
+MS_NODIRATIME = 0x800
+MS_BIND = 0x1000
+MS_REC = 0x4000
+MS_PRIVATE = 0x40000
+MS_RELATIME = 0x200000
+
+ST_RELATIME = 0x1000
+PR_SET_NO_NEW_PRIVS = 38
+
+# uid/gid the program sees inside the sandbox (mapped to the server's own uid)
+SANDBOX_UID = 1000
+
+DEFAULT_PATH = '/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin'
+
+_libc = ctypes.CDLL(None, use_errno=True)
+
+
+class SandboxError(Exception):
+    """Raised when the sandbox itself (not the user program) fails."""
+
+
+def bindable(path):
+    """Whether a host path can be bound into the sandbox: only paths under /tmp can."""
+    return os.path.commonpath([os.path.realpath(path), '/tmp']) == '/tmp'
+
+
+class SandboxResult(subprocess.CompletedProcess):
+    """CompletedProcess with the wall time and peak memory of the run."""
+
+    def __init__(self, args, returncode, stdout, stderr, elapsed=0.0, max_rss=0):
+        super().__init__(args, returncode, stdout, stderr)
+        self.elapsed = elapsed
+        self.max_rss = max_rss
+
+
+def _unshare(flags):
+    if _libc.unshare(flags) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, f'unshare failed: {os.strerror(err)}')
+
+
+def _mount(source, target, fstype, flags, data=None):
+    encode = lambda value: value.encode() if value is not None else None
+    if _libc.mount(encode(source), encode(target), encode(fstype), flags, encode(data)) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, f'mount {target} failed: {os.strerror(err)}')
+
+
+def _write_file(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def _locked_mount_flags(path):
+    """Flags of the mount at path that a remount inside a user namespace must keep."""
+    st_flags = os.statvfs(path).f_flag
+    flags = st_flags & (MS_NOSUID | MS_NODEV | MS_NOEXEC | MS_NOATIME | MS_NODIRATIME)
+    if st_flags & ST_RELATIME:
+        flags |= MS_RELATIME
+    return flags
+
+
+def read_peak_memory(pid):
+    """Peak resident memory (VmHWM) of a live process in bytes, or 0."""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+def rootfs_for(config, language):
+    """The pre-built rootfs for a language (or the default one), or None if there is neither."""
+    rootfs_dir = config.get('rootfs_dir')
+    if rootfs_dir:
+        for name in (language, 'default'):
+            if name and os.path.isdir(os.path.join(rootfs_dir, name)):
+                return os.path.join(rootfs_dir, name)
+    return None
+
+
+def _enter_sandbox(request, config, staging, stdio):
+    """Build the sandbox filesystem and exec the program. Runs as PID 1."""
+    _mount('tmpfs', staging, 'tmpfs', MS_NOSUID | MS_NODEV, 'size=1m,mode=0755')
+    root = os.path.join(staging, 'root')
+    os.mkdir(root)
+
+    rootfs = rootfs_for(config, request.get('language'))
+    if rootfs is None:
+        raise SandboxError(f"No root filesystem for {request.get('language') or 'default'}")
+    _mount(rootfs, root, None, MS_BIND | MS_REC)
+    _mount(None, root, None, MS_REMOUNT | MS_BIND | MS_RDONLY | _locked_mount_flags(root))
+
+    scratch = os.path.join(root, 'tmp')
+    _mount('tmpfs', scratch, 'tmpfs', MS_NOSUID | MS_NODEV,
+           f"size={config.get('scratch_size_mb', 64)}m,mode=1777")
+
+    # Job files live under the host /tmp and are bound at the same path, so
+    # argv built by the executor stays valid inside the sandbox.
+    for path in request.get('binds', []):
+        path = os.path.realpath(path)
+        if not bindable(path):
+            raise SandboxError(f'Bind path must be under /tmp: {path}')
+        target = root + path
+        if os.path.isdir(path):
+            os.makedirs(target, exist_ok=True)
+        else:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            open(target, 'a').close()
+        _mount(path, target, None, MS_BIND)
+
+    _mount('proc', os.path.join(root, 'proc'), 'proc', MS_NOSUID | MS_NODEV | MS_NOEXEC)
+
+    os.chroot(root)
+    os.chdir(request.get('cwd') or '/tmp')
+
+    # The address space cap is the run's own (the judge's memory limit); the
+    # writable memory cap leaves out the address space runtimes like the JVM
+    # reserve but never touch, so it can apply to every run
+    memory_limit = request.get('memory_limit_mb')
+    if memory_limit:
+        limit = memory_limit * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    data_limit = max(config.get('memory_limit_mb', 0), memory_limit or 0)
+    if data_limit:
+        limit = data_limit * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_DATA, (limit, limit))
+    process_limit = config.get('process_limit', 0)
+    if process_limit:
+        resource.setrlimit(resource.RLIMIT_NPROC, (process_limit, process_limit))
+    file_limit = config.get('file_size_limit_mb', 16) * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_FSIZE, (file_limit, file_limit))
+    resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+    _libc.prctl(PR_SET_NO_NEW_PRIVS, 1, 0, 0, 0)
+
+    for target_fd, fd in enumerate(stdio):
+        os.dup2(fd, target_fd)
+    for fd in stdio:
+        if fd > 2:
+            os.close(fd)
+
+    env = {'PATH': DEFAULT_PATH, 'HOME': '/tmp', 'TMPDIR': '/tmp', 'LANG': 'C.UTF-8'}
+    env.update(request.get('env') or {})
+    args = request['args']
+    os.execvpe(args[0], args, env)
+
+
+def _run_job(request, fds, config, staging):
+    """Run one job in a child of the zygote and report its outcome."""
+    stdio, reply_fd = fds[:3], fds[3]
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    # A user namespace per run: RLIMIT_NPROC counts the processes of the
+    # user in the current user namespace, so this keeps one run's processes
+    # from counting against another's
+    uid, gid = os.getuid(), os.getgid()
+    _unshare(CLONE_NEWUSER | CLONE_NEWNS | CLONE_NEWPID | CLONE_NEWNET)
+    _write_file('/proc/self/setgroups', 'deny')
+    _write_file('/proc/self/uid_map', f'{uid} {uid} 1')
+    _write_file('/proc/self/gid_map', f'{gid} {gid} 1')
+
+    err_r, err_w = os.pipe()
+    start = time.monotonic()
+    pid = os.fork()
+    if pid == 0:
+        os.close(err_r)
+        os.close(reply_fd)
+        try:
+            _enter_sandbox(request, config, staging, stdio)
+        except BaseException as e:
+            os.write(err_w, str(e).encode('utf-8', 'replace')[:4096])
+        os._exit(127)
+
+    os.close(err_w)
+    for fd in stdio:
+        os.close(fd)
+
+    # The error pipe is close-on-exec, so EOF here means exec succeeded
+    setup_error = b''
+    while True:
+        chunk = os.read(err_r, 4096)
+        if not chunk:
+            break
+        setup_error += chunk
+    os.close(err_r)
+    if not setup_error:
+        # The program's pid in the server's PID namespace, so the server can
+        # signal it and read its /proc entry; the result follows at the end
+        os.write(reply_fd, json.dumps({'pid': pid}).encode('utf-8') + b'\n')
+
+    # The reply socket doubles as a kill switch: the parent shutting down its
+    # end (or dying) makes it readable before the program has exited.
+    pidfd = os.pidfd_open(pid)
+    deadline = start + request['timeout']
+    peak = 0
+    interval = 0.0005
+    while True:
+        peak = max(peak, read_peak_memory(pid))
+        remaining = deadline - time.monotonic()
+        ready, _, _ = select.select([pidfd, reply_fd], [], [], max(0.0, min(remaining, interval)))
+        interval = min(interval * 2, 0.01)
+        if pidfd in ready:
+            timed_out = False
+            break
+        if ready or remaining <= 0:
+            timed_out = not ready
+            os.kill(pid, signal.SIGKILL)
+            break
+    _, status, rusage = os.wait4(pid, 0)
+    os.close(pidfd)
+
+    reply = {
+        'returncode': os.waitstatus_to_exitcode(status),
+        'timed_out': timed_out,
+        'elapsed': time.monotonic() - start,
+        'max_rss': peak or rusage.ru_maxrss * 1024,
+        'error': setup_error.decode('utf-8', 'replace') or None,
+    }
+    os.write(reply_fd, json.dumps(reply).encode('utf-8'))
+
+
+def _zygote_main(sock_fd, config):
+    """
+    Zygote loop: enter a user namespace once, then fork a child per job.
+    """
+    sock = socket.socket(fileno=sock_fd)
+    uid, gid = os.getuid(), os.getgid()
+    staging = tempfile.mkdtemp(prefix='sandbox-')
+
+    _unshare(CLONE_NEWUSER | CLONE_NEWNS)
+    _write_file('/proc/self/setgroups', 'deny')
+    _write_file('/proc/self/uid_map', f'{SANDBOX_UID} {uid} 1')
+    _write_file('/proc/self/gid_map', f'{SANDBOX_UID} {gid} 1')
+    _mount(None, '/', None, MS_REC | MS_PRIVATE)
+
+    # Job children are reaped automatically; each re-enables SIGCHLD for itself
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    try:
+        while True:
+            msg, fds, _, _ = socket.recv_fds(sock, 65536, 4)
+            if not msg:
+                break
+            pid = os.fork()
+            if pid == 0:
+                sock.close()
+                status = 1
+                try:
+                    _run_job(json.loads(msg), fds, config, staging)
+                    status = 0
+                finally:
+                    os._exit(status)
+            for fd in fds:
+                os.close(fd)
+    finally:
+        os.rmdir(staging)
+
+
+class Zygote:
+    """Handle to a zygote process owned by this server process."""
+
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.sock, child_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), str(child_sock.fileno()), json.dumps(config)],
+            pass_fds=[child_sock.fileno()],
+            stdin=subprocess.DEVNULL,
+        )
+        child_sock.close()
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def submit(self, request, fds):
+        with self.lock:
+            socket.send_fds(self.sock, [json.dumps(request).encode('utf-8')], fds)
+
+    def close(self):
+        self.sock.close()
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+_zygote = None
+_zygote_lock = threading.Lock()
+
+
+def _load_config():
+    from django.conf import settings
+    return {
+        'rootfs_dir': getattr(settings, 'SANDBOX_ROOTFS_DIR', ''),
+        'scratch_size_mb': getattr(settings, 'SANDBOX_SCRATCH_SIZE_MB', 64),
+        'memory_limit_mb': getattr(settings, 'SANDBOX_MEMORY_LIMIT_MB', 1024),
+        'process_limit': getattr(settings, 'SANDBOX_PROCESS_LIMIT', 256),
+        'file_size_limit_mb': getattr(settings, 'SANDBOX_FILE_SIZE_LIMIT_MB', 16),
+        'output_limit': getattr(settings, 'SANDBOX_OUTPUT_LIMIT', 1024 * 1024),
+    }
+
+
+def check_rootfs_dir():
+    """Refuse to start sandboxed without SANDBOX_ROOTFS_DIR, since nothing could run."""
+    from django.conf import settings
+    from django.core.exceptions import ImproperlyConfigured
+    rootfs_dir = getattr(settings, 'SANDBOX_ROOTFS_DIR', '')
+    if getattr(settings, 'SANDBOX_ENABLED', False) and not (rootfs_dir and os.path.isdir(rootfs_dir)):
+        raise ImproperlyConfigured(f'SANDBOX_ROOTFS_DIR must hold a root filesystem per language when '
+                                   f'SANDBOX_ENABLED is set: {rootfs_dir}')
+
+
+def get_zygote():
+    """Return the running zygote, starting (or restarting) it if needed."""
+    global _zygote
+    with _zygote_lock:
+        if _zygote is None or not _zygote.alive():
+            _zygote = Zygote(_load_config())
+        return _zygote
+
+
+class SandboxProcess:
+    """
+    A program started in the sandbox, with a Popen-like interface.
+
+    stdin, stdout and stderr are unbuffered binary pipes. pid is the
+    program's pid as the server sees it, so it can be signalled and its
+    /proc entry read like a host process's.
+    """
+
+    def __init__(self, args, stdin, stdout, stderr, reply):
+        self.args = args
+        self.pid = None
+        self.stdin = os.fdopen(stdin, 'wb', buffering=0)
+        self.stdout = os.fdopen(stdout, 'rb', buffering=0)
+        self.stderr = os.fdopen(stderr, 'rb', buffering=0)
+        self.returncode = None
+        self.timed_out = False
+        self.elapsed = 0.0
+        self.max_rss = 0
+        self._reply = reply
+        self._reply_data = b''
+        self._reply_closed = False
+
+    def _receive(self, deadline):
+        """Read more of the reply; False if nothing arrived before deadline."""
+        remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+        ready, _, _ = select.select([self._reply], [], [], remaining)
+        if not ready:
+            return False
+        chunk = self._reply.recv(4096)
+        self._reply_data += chunk
+        self._reply_closed = not chunk
+        return True
+
+    def _wait_started(self, timeout):
+        """Wait until the program has been started and record its pid."""
+        deadline = time.monotonic() + timeout
+        while b'\n' not in self._reply_data and not self._reply_closed:
+            if not self._receive(deadline):
+                raise SandboxError('Sandbox did not start the program in time')
+        if b'\n' in self._reply_data:
+            line, self._reply_data = self._reply_data.split(b'\n', 1)
+            self.pid = json.loads(line)['pid']
+        else:
+            # Setup failed, so the result came instead
+            self._read_reply(0)
+
+    def _read_reply(self, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.returncode is None:
+            if not self._reply_closed:
+                if not self._receive(deadline):
+                    return False
+                continue
+            if not self._reply_data:
+                raise SandboxError('Sandbox exited without reporting a result')
+            self._finish(json.loads(self._reply_data))
+        return True
+
+    def _finish(self, reply):
+        self._reply.close()
+        if reply['error']:
+            self.returncode = -1
+            raise SandboxError(f"Sandbox setup failed: {reply['error']}")
+        self.returncode = reply['returncode']
+        self.timed_out = reply['timed_out']
+        self.elapsed = reply['elapsed']
+        self.max_rss = reply['max_rss']
+
+    def poll(self):
+        if self.returncode is None:
+            self._read_reply(0)
+        return self.returncode
+
+    def wait(self, timeout=None):
+        if self.returncode is None and not self._read_reply(timeout):
+            raise subprocess.TimeoutExpired(self.args, timeout)
+        return self.returncode
+
+    def kill(self):
+        if self.returncode is None:
+            try:
+                self._reply.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+    def close(self):
+        for stream in (self.stdin, self.stdout, self.stderr):
+            try:
+                stream.close()
+            except OSError:
+                pass
+
+
+def spawn(args, timeout, cwd=None, binds=(), language=None, env=None, memory_limit_mb=None):
+    """
+    Start args inside a fresh sandbox and return a SandboxProcess.
+
+    The program is killed once timeout seconds have passed.
+    """
+    zygote = get_zygote()
+    if rootfs_for(zygote.config, language) is None:
+        raise SandboxError(f"No sandbox root filesystem for {language or 'default'} "
+                           f"in {zygote.config.get('rootfs_dir')}")
+    stdin_r, stdin_w = os.pipe()
+    stdout_r, stdout_w = os.pipe()
+    stderr_r, stderr_w = os.pipe()
+    reply, child_reply = socket.socketpair()
+    child_fds = [stdin_r, stdout_w, stderr_w, child_reply.fileno()]
+    request = {
+        'args': list(args),
+        'timeout': timeout,
+        'cwd': cwd,
+        'binds': list(binds),
+        'language': language,
+        'env': env,
+        'memory_limit_mb': memory_limit_mb,
+    }
+    try:
+        zygote.submit(request, child_fds)
+    except OSError as e:
+        for fd in (stdin_w, stdout_r, stderr_r):
+            os.close(fd)
+        reply.close()
+        raise SandboxError(f'Sandbox zygote is not available: {e}')
+    finally:
+        for fd in child_fds[:3]:
+            os.close(fd)
+        child_reply.close()
+    process = SandboxProcess(args, stdin_w, stdout_r, stderr_r, reply)
+    try:
+        process._wait_started(timeout + 5)
+    except BaseException:
+        process.kill()
+        process.close()
+        raise
+    return process
+
+
+def _communicate(process, input_bytes, deadline, output_limit):
+    """Feed stdin and collect stdout and stderr until both are closed."""
+    stdin_fd = process.stdin.fileno()
+    buffers = {process.stdout.fileno(): bytearray(), process.stderr.fileno(): bytearray()}
+    sel = selectors.DefaultSelector()
+    for fd in buffers:
+        sel.register(fd, selectors.EVENT_READ)
+    if input_bytes:
+        os.set_blocking(stdin_fd, False)
+        sel.register(stdin_fd, selectors.EVENT_WRITE)
+    else:
+        process.stdin.close()
+    offset = 0
+    try:
+        while sel.get_map():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                process.kill()
+                raise SandboxError('Sandbox did not report a result in time')
+            for key, _ in sel.select(remaining):
+                fd = key.fd
+                if fd == stdin_fd:
+                    try:
+                        offset += os.write(fd, input_bytes[offset:offset + 65536])
+                    except BrokenPipeError:
+                        offset = len(input_bytes)
+                    if offset >= len(input_bytes):
+                        sel.unregister(fd)
+                        process.stdin.close()
+                    continue
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    sel.unregister(fd)
+                elif len(buffers[fd]) < output_limit:
+                    buffers[fd] += chunk
+    finally:
+        sel.close()
+    return (bytes(buffers[process.stdout.fileno()][:output_limit]),
+            bytes(buffers[process.stderr.fileno()][:output_limit]))
+
+
+def run(args, timeout, input=None, cwd=None, binds=(), language=None, env=None, memory_limit_mb=None):
+    """
+    Run args inside a fresh sandbox.
+
+    Mirrors subprocess.run(..., capture_output=True, text=True): returns a
+    SandboxResult and raises subprocess.TimeoutExpired on timeout.
+    """
+    process = spawn(args, timeout, cwd=cwd, binds=binds, language=language, env=env,
+                    memory_limit_mb=memory_limit_mb)
+    try:
+        deadline = time.monotonic() + timeout + 5
+        stdout, stderr = _communicate(process, (input or '').encode('utf-8'), deadline,
+                                      get_zygote().config['output_limit'])
+        process.wait(max(0.0, deadline - time.monotonic()))
+    finally:
+        process.close()
+
+    stdout = stdout.decode('utf-8', 'replace')
+    stderr = stderr.decode('utf-8', 'replace')
+    if process.timed_out:
+        raise subprocess.TimeoutExpired(args, timeout, output=stdout, stderr=stderr)
+    return SandboxResult(args, process.returncode, stdout, stderr,
+                         elapsed=process.elapsed, max_rss=process.max_rss)
+
+
+if __name__ == '__main__':
+    _zygote_main(int(sys.argv[1]), json.loads(sys.argv[2]))
@@ -0,0 +1,334 @@
+"""
+Admission control for code executions.
+
+Each user has a token bucket that limits how fast they can start runs. Runs
+that pass the bucket share a concurrency cap for the whole host (by default
+one per CPU core); when every slot is busy they wait in a weighted fair
+queue, so one user spamming Run cannot starve everybody else. If the
+expected wait would exceed the latency SLO the run is rejected straight
+away, and the view answers 429 with a Retry-After header.
+
+Every server process on the host shares the same limits. A running run
+holds exclusive locks on slot files in EXECUTION_SCHEDULER_DIR, which the
+kernel releases if its process dies. The fair queue, virtual time and
+average run time live in a state file there that processes update under
+a lock, and waiting runs poll it until they are at its head and slots are
+free. Token buckets are kept in the shared cache, so they follow a user
+across processes (and across machines with a shared cache backend).
+"""
+import fcntl
+import hashlib
+import itertools
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import metrics, tracing
+
+# How often a queued run checks whether it is its turn, in seconds
+POLL_INTERVAL = (0.002, 0.05)
+
+
+class AdmissionRejected(Exception):
+    """The run was not admitted; retry_after is a hint in seconds."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class Slots:
+    """
+    A budget shared by every server process on the host: count lock files
+    in directory. Each holder keeps one of them locked.
+    """
+
+    def __init__(self, directory, count):
+        self.directory = directory
+        self.count = count
+
+    def acquire(self):
+        """The descriptor of a free slot, now locked, or None if every slot is taken."""
+        os.makedirs(self.directory, exist_ok=True)
+        for index in range(self.count):
+            fd = os.open(os.path.join(self.directory, f'slot-{index}'), os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                os.close(fd)
+        return None
+
+    def acquire_many(self, count):
+        """Descriptors of count free slots, all locked, or None (holding none) if there aren't that many."""
+        fds = []
+        while len(fds) < count:
+            fd = self.acquire()
+            if fd is None:
+                for held in fds:
+                    os.close(held)
+                return None
+            fds.append(fd)
+        return fds
+
+    def taken(self):
+        """How many slots are held. Counting locks each free one for a moment."""
+        free = []
+        while True:
+            fd = self.acquire()
+            if fd is None:
+                break
+            free.append(fd)
+        for fd in free:
+            os.close(fd)
+        return self.count - len(free)
+
+
+class SharedState:
+    """A small JSON document in a file, read and written under an exclusive lock."""
+
+    def __init__(self, path, default):
+        self.path = path
+        self.default = default
+        # flock is per open file, so threads take turns on this process's descriptor
+        self.lock = threading.Lock()
+        self.fd = None
+        self.pid = None
+
+    def _descriptor(self):
+        # A forked server worker opens its own; a shared descriptor would share the lock
+        if self.fd is None or self.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            self.pid = os.getpid()
+        return self.fd
+
+    @contextmanager
+    def locked(self):
+        """Yield the document; changes made to it are saved when the block exits."""
+        with self.lock:
+            fd = self._descriptor()
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                os.lseek(fd, 0, os.SEEK_SET)
+                data = b''
+                while True:
+                    chunk = os.read(fd, 65536)
+                    if not chunk:
+                        break
+                    data += chunk
+                try:
+                    state = json.loads(data)
+                except ValueError:
+                    # New, or torn by a process that died mid-write
+                    state = json.loads(json.dumps(self.default))
+                try:
+                    yield state
+                finally:
+                    os.lseek(fd, 0, os.SEEK_SET)
+                    os.ftruncate(fd, 0)
+                    os.write(fd, json.dumps(state).encode('utf-8'))
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+class Admission:
+    """A run's claim on execution slots; use as a context manager."""
+
+    def __init__(self, scheduler, user, weight, cost, timed, rate_limited=True, slots=1):
+        self.scheduler = scheduler
+        self.user = user
+        self.weight = weight
+        self.cost = cost
+        self.slots = slots
+        self.timed = timed
+        self.rate_limited = rate_limited
+        self.started = None
+        self.held = []
+
+    def acquire(self):
+        with tracing.span('admission'):
+            self.held = self.scheduler._acquire(self)
+        self.started = time.monotonic()
+
+    def release(self):
+        if self.started is not None:
+            duration = time.monotonic() - self.started
+            self.scheduler._release(duration if self.timed else None, self.held)
+            self.held = []
+            self.started = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class ExecutionScheduler:
+    def __init__(self, max_concurrent, rate, burst, latency_slo, directory):
+        self.max_concurrent = max_concurrent
+        self.rate = rate
+        self.burst = burst
+        self.latency_slo = latency_slo
+        self.slots = Slots(os.path.join(directory, 'slots'), max_concurrent)
+        # Fair queuing: each run is tagged to start after the user's previous
+        # run finishes in virtual time, and the queue is served in finish-tag
+        # order, so heavy users fall behind light ones. Virtual time follows
+        # the start tag of the last dispatched run.
+        self.state = SharedState(os.path.join(directory, 'queue.json'), {
+            'virtual_time': 0.0, 'last_finish': {}, 'queue': [], 'average_duration': 1.0})
+        self.tickets = itertools.count()
+
+    def admit(self, user, weight=1.0, cost=1.0, timed=True, rate_limited=True, slots=1):
+        """
+        Return an Admission for one run. Untimed admissions (interactive
+        sessions, which mostly wait on the user) hold a slot but are left
+        out of the run-time average used for the SLO estimate. Runs that
+        were already rate limited elsewhere (jobs from a cluster dispatcher)
+        skip the user's token bucket. A batch that runs several programs at
+        once asks for that many slots; it gets at most the concurrency cap,
+        and admission.slots is how many it may run in parallel.
+        """
+        return Admission(self, user, weight, cost, timed, rate_limited,
+                         max(1, min(slots, self.max_concurrent)))
+
+    def stats(self):
+        with self.state.locked() as state:
+            self._prune(state)
+            queued = len(state['queue'])
+        return {'running': self.slots.taken(), 'queued': queued, 'capacity': self.max_concurrent}
+
+    def _take_token(self, user, now):
+        """
+        Take a token from the user's bucket; return 0 on success or the
+        seconds until one is available. The bucket is stored as the time
+        it will be full again less one token (GCRA), which is one value.
+        """
+        key = 'scheduler:bucket:' + hashlib.sha1(user.encode('utf-8', 'surrogatepass')).hexdigest()
+        refilled = max(cache.get(key) or now, now)
+        wait = refilled - now - (self.burst - 1) / self.rate
+        if wait > 0:
+            return wait
+        refilled += 1 / self.rate
+        cache.set(key, refilled, math.ceil(refilled - now) + 1)
+        return 0
+
+    def _prune(self, state):
+        """Drop tickets whose run gave up without saying so (its process died)."""
+        now = time.time()
+        alive = []
+        for ticket in state['queue']:
+            try:
+                os.kill(ticket['pid'], 0)
+            except ProcessLookupError:
+                continue
+            except PermissionError:
+                pass
+            if ticket['expires'] > now:
+                alive.append(ticket)
+        state['queue'] = alive
+        # Users whose last run already started in virtual time carry no state
+        state['last_finish'] = {user: tag for user, tag in state['last_finish'].items()
+                                if tag > state['virtual_time']}
+
+    def _acquire(self, admission):
+        user = admission.user
+        with self.state.locked() as state:
+            wait = admission.rate_limited and self._take_token(user, time.time())
+            if wait:
+                metrics.admission_rejections.inc(reason='rate_limit')
+                raise AdmissionRejected('Too many runs, please slow down', wait)
+
+            self._prune(state)
+            queue = state['queue']
+            previous_finish = state['last_finish'].get(user)
+            start_tag = max(state['virtual_time'], previous_finish or 0.0)
+            finish_tag = start_tag + admission.cost / admission.weight
+            if not queue:
+                held = self.slots.acquire_many(admission.slots)
+                if held is not None:
+                    state['last_finish'][user] = finish_tag
+                    state['virtual_time'] = start_tag
+                    return held
+
+            ahead = sum(1 for ticket in queue if ticket['finish_tag'] <= finish_tag)
+            expected_wait = (ahead + 1) * state['average_duration'] / self.max_concurrent
+            if expected_wait > self.latency_slo:
+                metrics.admission_rejections.inc(reason='busy')
+                raise AdmissionRejected('The server is busy, please retry shortly',
+                                        expected_wait - self.latency_slo)
+
+            state['last_finish'][user] = finish_tag
+            ticket_id = f'{os.getpid()}-{next(self.tickets)}'
+            queue.append({'id': ticket_id, 'user': user, 'slots': admission.slots, 'start_tag': start_tag,
+                          'finish_tag': finish_tag, 'previous_finish': previous_finish, 'pid': os.getpid(),
+                          'queued': time.time(), 'expires': time.time() + 2 * self.latency_slo + 1})
+            queue.sort(key=lambda ticket: (ticket['finish_tag'], ticket['queued']))
+
+        deadline = time.monotonic() + 2 * self.latency_slo
+        interval = POLL_INTERVAL[0]
+        while True:
+            time.sleep(interval)
+            interval = min(interval * 2, POLL_INTERVAL[1])
+            with self.state.locked() as state:
+                self._prune(state)
+                queue = state['queue']
+                index = next((i for i, ticket in enumerate(queue) if ticket['id'] == ticket_id), None)
+                # The head waits for enough free slots; nothing overtakes it
+                if index == 0:
+                    held = self.slots.acquire_many(admission.slots)
+                    if held is not None:
+                        queue.pop(0)
+                        state['virtual_time'] = max(state['virtual_time'], start_tag)
+                        return held
+                if index is None or time.monotonic() >= deadline:
+                    if index is not None:
+                        ticket = queue.pop(index)
+                        # The run never happens, so it mustn't push the user's later runs back
+                        if state['last_finish'].get(user) == ticket['finish_tag']:
+                            if ticket['previous_finish'] is None:
+                                state['last_finish'].pop(user)
+                            else:
+                                state['last_finish'][user] = ticket['previous_finish']
+                    metrics.admission_rejections.inc(reason='queue_timeout')
+                    raise AdmissionRejected('The server is busy, please retry shortly',
+                                            state['average_duration'])
+
+    def _release(self, duration, held):
+        for fd in held:
+            os.close(fd)
+        if duration is not None:
+            with self.state.locked() as state:
+                state['average_duration'] = 0.9 * state['average_duration'] + 0.1 * duration
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = ExecutionScheduler(
+                max_concurrent=getattr(settings, 'EXECUTION_MAX_CONCURRENT', 0) or os.cpu_count() or 1,
+                rate=getattr(settings, 'EXECUTION_RATE_PER_USER', 1.0),
+                burst=getattr(settings, 'EXECUTION_BURST_PER_USER', 5),
+                latency_slo=getattr(settings, 'EXECUTION_LATENCY_SLO', 5.0),
+                directory=(getattr(settings, 'EXECUTION_SCHEDULER_DIR', '')
+                           or os.path.join(tempfile.gettempdir(), 'codeeditor-scheduler')),
+            )
+        return _scheduler
+
+
+def user_weight(username):
+    return getattr(settings, 'EXECUTION_USER_WEIGHTS', {}).get(username, 1.0)
@@ -0,0 +1,336 @@
+"""
+Project-wide code search backed by a trigram index.
+
+Each project gets an in-memory inverted index from lower-cased trigrams to
+the files containing them. A query is reduced to the trigrams every match
+must contain, the posting lists are intersected to find candidate files,
+and only those files are read and matched line by line.
+
+Indexes are built in a background thread on the first search (which waits
+up to SEARCH_BUILD_WAIT seconds for it, then reports indexed: false with no
+results), kept current by the file views through the file_changed signal,
+and re-checked against file versions (see Storage.versions) in the
+background when a search finds them older than SEARCH_REFRESH_INTERVAL
+seconds, to pick up changes made by other server processes or outside the
+editor. A search never walks the project itself. Files are read through
+the storage backend, so search works with every backend.
+"""
+import logging
+import re
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
+
+from django.conf import settings
+from django.dispatch import receiver
+
+from .signals import file_changed
+from .storage import clean_path, get_storage
+
+logger = logging.getLogger(__name__)
+
+# Files read from the backend at a time while indexing or searching
+READ_BATCH = 64
+
+
+def _trigrams(text):
+    """The set of lower-cased trigrams in text, line by line."""
+    grams = set()
+    # Source files repeat lines a lot; each distinct line is only split once
+    for line in set(text.lower().split('\n')):
+        grams.update(zip(line, line[1:], line[2:]))
+    return grams
+
+
+def _text(data, max_size):
+    """File contents as text, or None for binary, oversized and unreadable files."""
+    if isinstance(data, OSError) or len(data) > max_size or b'\0' in data[:8192]:
+        return None
+    return data.decode('utf-8', errors='replace')
+
+
+def _batches(items):
+    items = list(items)
+    for start in range(0, len(items), READ_BATCH):
+        yield items[start:start + READ_BATCH]
+
+
+def _required_literals(parsed):
+    """Literal strings that every match of a parsed regex must contain."""
+    literals, run = [], []
+
+    def flush():
+        if run:
+            literals.append(''.join(run))
+            run.clear()
+
+    for op, value in parsed:
+        if op is sre_parse.LITERAL:
+            run.append(chr(value))
+        elif op is sre_parse.AT:
+            # Anchors are zero-width; they don't split a literal run
+            continue
+        elif op is sre_parse.SUBPATTERN:
+            flush()
+            literals.extend(_required_literals(value[-1]))
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and value[0] >= 1:
+            flush()
+            literals.extend(_required_literals(value[2]))
+        else:
+            flush()
+    flush()
+    return literals
+
+
+def query_trigrams(query, regex=False):
+    """Trigrams a line must contain to match; empty if the query is too loose to filter."""
+    if regex:
+        literals = _required_literals(sre_parse.parse(query))
+    else:
+        literals = query.split('\n')
+    grams = set()
+    for literal in literals:
+        literal = literal.lower()
+        grams.update(zip(literal, literal[1:], literal[2:]))
+    return grams
+
+
+class ProjectIndex:
+    def __init__(self, project_id):
+        self.project_id = project_id
+        self.lock = threading.Lock()
+        self.files = {}      # path -> (file id, version)
+        self.paths = []      # file id -> path, or None once the file is gone
+        self.postings = {}   # trigram -> array of file ids
+        self.dead = 0
+        self.ready = threading.Event()
+        self.refreshed = 0.0
+        self.refreshing = False
+        self.max_file_size = getattr(settings, 'SEARCH_MAX_FILE_SIZE', 1024 * 1024)
+        self.ignored_dirs = set(getattr(settings, 'SEARCH_IGNORED_DIRS', []))
+
+    def build(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            logger.error(f"Error building search index for {self.project_id}: {str(e)}")
+        finally:
+            self.ready.set()
+
+    def refresh(self):
+        """Re-index files whose version changed and drop removed ones."""
+        try:
+            versions = get_storage().versions(self.project_id, ignored_dirs=self.ignored_dirs)
+            changed = [path for path, version in versions.items()
+                       if self.files.get(path, (None, None))[1] != version]
+            for batch in _batches(changed):
+                self.update_many(batch)
+            for path in set(self.files) - set(versions):
+                self.remove(path)
+        finally:
+            with self.lock:
+                self.refreshed = time.monotonic()
+                self.refreshing = False
+
+    def maybe_refresh(self):
+        """Re-check the disk in the background if the index is older than the refresh interval."""
+        interval = getattr(settings, 'SEARCH_REFRESH_INTERVAL', 2)
+        with self.lock:
+            if self.refreshing or time.monotonic() - self.refreshed < interval:
+                return
+            self.refreshing = True
+
+        def refresh():
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"Error refreshing search index for {self.project_id}: {str(e)}")
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def update_many(self, paths):
+        """Re-index files, reading them in one backend call; unreadable ones are dropped."""
+        results = get_storage().read_many_versioned(self.project_id, paths)
+        for path, result in results.items():
+            if isinstance(result, IsADirectoryError):
+                continue
+            if isinstance(result, OSError):
+                self.remove(path)
+                continue
+            data, version = result
+            text = _text(data, self.max_file_size)
+            grams = _trigrams(text) if text is not None else ()
+            with self.lock:
+                self._remove(path)
+                file_id = len(self.paths)
+                self.paths.append(path)
+                self.files[path] = (file_id, version)
+                for gram in grams:
+                    posting = self.postings.get(gram)
+                    if posting is None:
+                        posting = self.postings[gram] = array('I')
+                    posting.append(file_id)
+                self._maybe_compact()
+
+    def remove(self, path):
+        """Forget a file, or every file under a folder."""
+        with self.lock:
+            prefix = path.rstrip('/') + '/'
+            for known in [p for p in self.files if p == path or p.startswith(prefix) or not path]:
+                self._remove(known)
+            self._maybe_compact()
+
+    def rename(self, old_path, new_path):
+        with self.lock:
+            prefix = old_path.rstrip('/') + '/'
+            for known in [p for p in self.files if p == old_path or p.startswith(prefix)]:
+                renamed = new_path + known[len(old_path):]
+                entry = self.files.pop(known)
+                self.files[renamed] = entry
+                self.paths[entry[0]] = renamed
+
+    def _remove(self, path):
+        entry = self.files.pop(path, None)
+        if entry is not None:
+            # Posting lists are append-only; the id is tombstoned until compaction
+            self.paths[entry[0]] = None
+            self.dead += 1
+
+    def _maybe_compact(self):
+        if self.dead < 1000 or self.dead < len(self.files):
+            return
+        remap = {}
+        paths = []
+        for file_id, path in enumerate(self.paths):
+            if path is not None:
+                remap[file_id] = len(paths)
+                paths.append(path)
+                self.files[path] = (remap[file_id],) + self.files[path][1:]
+        postings = {}
+        for gram, posting in self.postings.items():
+            alive = array('I', (remap[i] for i in posting if i in remap))
+            if alive:
+                postings[gram] = alive
+        self.paths, self.postings, self.dead = paths, postings, 0
+
+    def candidates(self, grams):
+        """Paths of files containing every trigram (all files if there are none)."""
+        with self.lock:
+            if not grams:
+                return sorted(self.files)
+            postings = [self.postings.get(gram) for gram in grams]
+            if not all(postings):
+                return []
+            postings.sort(key=len)
+            file_ids = set(postings[0])
+            for posting in postings[1:]:
+                file_ids.intersection_update(posting)
+                if not file_ids:
+                    return []
+            return sorted(path for path in map(self.paths.__getitem__, file_ids) if path is not None)
+
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def get_index(project_id, create=True):
+    """The project's index, created (and its build started) if needed."""
+    with _indexes_lock:
+        index = _indexes.get(project_id)
+        if index is not None:
+            _indexes.move_to_end(project_id)
+            return index
+        if not create:
+            return None
+        index = _indexes[project_id] = ProjectIndex(project_id)
+        while len(_indexes) > getattr(settings, 'SEARCH_MAX_INDEXES', 8):
+            _indexes.popitem(last=False)
+    threading.Thread(target=index.build, daemon=True).start()
+    return index
+
+
+def search_project(project_id, query, regex=False, case_sensitive=False, context=2,
+                   limit=200):
+    """
+    Find lines matching query (a substring, or a regex if regex is set).
+
+    Returns {'files': [{'id', 'path', 'matches': [{'line', 'column', 'text',
+    'before', 'after'}]}], 'total': n, 'truncated': bool, 'indexed': bool}.
+    Raises re.error for an invalid regex.
+    """
+    pattern = re.compile(query if regex else re.escape(query), 0 if case_sensitive else re.IGNORECASE)
+    grams = query_trigrams(query, regex)
+
+    index = get_index(project_id)
+    indexed = index.ready.wait(getattr(settings, 'SEARCH_BUILD_WAIT', 1))
+    if not indexed:
+        return {'files': [], 'total': 0, 'truncated': False, 'indexed': False}
+    index.maybe_refresh()
+    paths = index.candidates(grams)
+
+    files, total, truncated = [], 0, False
+    for path, data in _read_batched(project_id, paths):
+        text = _text(data, index.max_file_size)
+        if text is None:
+            continue
+        lines = text.split('\n')
+        matches = []
+        for number, line in enumerate(lines):
+            match = pattern.search(line)
+            if not match:
+                continue
+            if total >= limit:
+                truncated = True
+                break
+            total += 1
+            matches.append({
+                'line': number + 1,
+                'column': match.start() + 1,
+                'text': line[:1000],
+                'before': [l[:1000] for l in lines[max(0, number - context):number]],
+                'after': [l[:1000] for l in lines[number + 1:number + 1 + context]],
+            })
+        if matches:
+            files.append({'id': f'{project_id}/{path}', 'path': path, 'matches': matches})
+        if truncated:
+            break
+    return {'files': files, 'total': total, 'truncated': truncated, 'indexed': indexed}
+
+
+def _read_batched(project_id, paths):
+    """Yield (path, bytes or OSError) in order, fetching a batch at a time."""
+    storage = get_storage()
+    for batch in _batches(paths):
+        results = storage.read_many(project_id, batch)
+        for path in batch:
+            yield path, results[path]
+
+
+@receiver(file_changed)
+def update_index(sender, project_id, path, event, old_path=None, **kwargs):
+    """Apply a change made through the file views to the project's index, if loaded."""
+    index = get_index(project_id, create=False)
+    if index is None or not index.ready.is_set():
+        return
+    try:
+        path = clean_path(path) if path else ''
+        old_path = clean_path(old_path) if old_path else None
+    except ValueError:
+        return
+    if not path:
+        # The whole project was deleted or replaced; rebuild on next use
+        with _indexes_lock:
+            _indexes.pop(project_id, None)
+    elif event == 'deleted':
+        index.remove(path)
+    elif event == 'renamed' and old_path:
+        index.rename(old_path, path)
+    else:
+        # New folders come back as IsADirectoryError, which update_many skips
+        index.update_many([path])
@@ -0,0 +1,15 @@
+"""
+Signals sent by the file views, so features that keep derived state about
+a project's files can stay in sync without the views knowing about them.
+"""
+from django.dispatch import Signal
+
+# Sent with project_id, path (relative and '/'-separated; '' for the whole
+# project), event ('created', 'modified', 'deleted' or 'renamed') and, for
+# renames, old_path. event 'reset' with path '' means any file may have
+# changed, e.g. after a snapshot restore.
+file_changed = Signal()
+
+# Sent with project_id and path ('' for the whole project) just before a
+# file, folder or project is deleted, while its contents can still be read.
+files_deleting = Signal()
@@ -0,0 +1,250 @@
+"""
+File history and project snapshots.
+
+File contents are stored once, in a content-addressed blob store: each
+blob is the zlib-compressed content under its SHA-256, so identical files
+share one blob across saves, files and projects. FileVersion rows record
+each change made through the file views (a save that doesn't change the
+content adds nothing). ProjectSnapshot rows point at a manifest blob
+mapping every path in the project to its blob, so a snapshot costs one
+small blob plus whatever content the store hasn't seen yet. Project files
+are read and written through the storage backend; blobs are Blob rows in
+the database, so history works the same from every server. Blobs that no
+version or snapshot refers to any more are removed by collect_garbage (the
+collect_history_garbage command), which can also drop old history first.
+"""
+import hashlib
+import json
+import logging
+import zlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Max
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import Blob, FileVersion, ProjectSnapshot
+from .signals import file_changed, files_deleting
+from .storage import clean_path, get_storage
+
+logger = logging.getLogger(__name__)
+
+
+class BlobStore:
+    """Blob rows in the database, so every server sees the same history."""
+
+    def put(self, data):
+        """Store data if it isn't stored yet; return its SHA-256 hex digest."""
+        digest = hashlib.sha256(data).hexdigest()
+        now = timezone.now()
+        if not Blob.objects.filter(digest=digest).update(stored_at=now):
+            # Concurrent writers of the same blob are harmless
+            Blob.objects.bulk_create([Blob(digest=digest, data=zlib.compress(data, 6), size=len(data),
+                                           stored_at=now)], ignore_conflicts=True)
+        return digest
+
+    def get(self, digest):
+        data = Blob.objects.filter(digest=digest).values_list('data', flat=True).first()
+        if data is None:
+            raise FileNotFoundError(f'Blob {digest} not found')
+        return zlib.decompress(bytes(data))
+
+    def exists(self, digest):
+        return Blob.objects.filter(digest=digest).exists()
+
+
+def get_blob_store():
+    return BlobStore()
+
+
+# Files read from the backend at a time when snapshotting a project
+READ_BATCH = 64
+# Blobs stored again within this long are never collected, since the row
+# that refers to them may not be saved yet
+COLLECT_GRACE = timedelta(hours=1)
+# Blobs deleted per query when collecting
+DELETE_BATCH = 500
+
+
+def _keepable(data):
+    """The content if it can be kept, or None if the read failed or it is too large."""
+    if isinstance(data, OSError) or len(data) > settings.SNAPSHOT_MAX_FILE_SIZE:
+        return None
+    return data
+
+
+def _read_file(project_id, path):
+    """Raw file content, or None if it is missing or too large to keep."""
+    try:
+        return _keepable(get_storage().read(project_id, path))
+    except OSError:
+        return None
+
+
+def _read_files(project_id, paths):
+    """Yield (path, content or None) for several files, a batch of reads at a time."""
+    storage = get_storage()
+    for start in range(0, len(paths), READ_BATCH):
+        batch = paths[start:start + READ_BATCH]
+        results = storage.read_many(project_id, batch)
+        for path in batch:
+            yield path, _keepable(results[path])
+
+
+def latest_version(project_id, path):
+    return FileVersion.objects.filter(project_name=project_id, path=path).first()
+
+
+def record_version(project_id, path, event='modified', old_path=''):
+    """Record the file's current content unless it matches its latest version."""
+    data = _read_file(project_id, path)
+    if data is None:
+        return None
+    digest = get_blob_store().put(data)
+    latest = latest_version(project_id, path)
+    if latest is not None and latest.blob == digest and not old_path:
+        return latest
+    return FileVersion.objects.create(project_name=project_id, path=path, old_path=old_path,
+                                      event=event, blob=digest, size=len(data))
+
+
+def record_deletion(project_id, path):
+    latest = latest_version(project_id, path)
+    if latest is not None and latest.event != 'deleted':
+        FileVersion.objects.create(project_name=project_id, path=path, event='deleted')
+
+
+def _files_under(project_id, path):
+    """Paths of the files at or under path ('' for the whole project)."""
+    storage = get_storage()
+    if path and storage.kind(project_id, path) == 'file':
+        return [path]
+    prefix = path + '/' if path else ''
+    return sorted(file_path for file_path in storage.versions(project_id) if file_path.startswith(prefix))
+
+
+def create_snapshot(project_id, label=''):
+    """Store every file of the project and record a snapshot of the tree."""
+    store = get_blob_store()
+    manifest = {}
+    total_size = 0
+    for path, data in _read_files(project_id, _files_under(project_id, '')):
+        if data is not None:
+            manifest[path] = store.put(data)
+            total_size += len(data)
+    digest = store.put(json.dumps(manifest, sort_keys=True).encode('utf-8'))
+    return ProjectSnapshot.objects.create(project_name=project_id, label=label[:255], manifest=digest,
+                                          file_count=len(manifest), total_size=total_size)
+
+
+def read_manifest(snapshot):
+    return json.loads(get_blob_store().get(snapshot.manifest))
+
+
+def restore_snapshot(snapshot):
+    """
+    Make the project's files match a snapshot, after snapshotting the current
+    state so the restore itself can be undone. Returns the number of files
+    written and removed.
+    """
+    project_id = snapshot.project_name
+    storage = get_storage()
+    manifest = read_manifest(snapshot)
+    store = get_blob_store()
+    if storage.project_exists(project_id):
+        create_snapshot(project_id, label=f'Before restoring snapshot {snapshot.pk}')
+    else:
+        storage.create_project(project_id)
+
+    written, removed = [], 0
+    for path in _files_under(project_id, ''):
+        if path not in manifest:
+            storage.delete(project_id, path)
+            record_deletion(project_id, path)
+            removed += 1
+    with storage.batch():
+        for path, current in _read_files(project_id, sorted(manifest)):
+            if current is not None and hashlib.sha256(current).hexdigest() == manifest[path]:
+                continue
+            storage.write(project_id, path, store.get(manifest[path]))
+            written.append(path)
+    for path in written:
+        record_version(project_id, path, event='restored')
+    return {'written': len(written), 'removed': removed}
+
+
+def collect_garbage(keep_days=None):
+    """
+    Delete blobs that no file version or snapshot refers to. With keep_days,
+    first forget snapshots and file versions older than that many days,
+    except each file's latest version. Returns the counts removed.
+    """
+    removed = {'versions': 0, 'snapshots': 0, 'blobs': 0}
+    if keep_days is not None:
+        cutoff = timezone.now() - timedelta(days=keep_days)
+        latest = (FileVersion.objects.order_by().values('project_name', 'path')
+                  .annotate(latest=Max('id')).values('latest'))
+        removed['versions'], _ = (FileVersion.objects.filter(created_at__lt=cutoff)
+                                  .exclude(pk__in=latest).delete())
+        removed['snapshots'], _ = ProjectSnapshot.objects.filter(created_at__lt=cutoff).delete()
+
+    # Candidates first: anything stored again while the references are read is newer than the cutoff
+    cutoff = timezone.now() - COLLECT_GRACE
+    candidates = set(Blob.objects.filter(stored_at__lt=cutoff).values_list('digest', flat=True))
+    referenced = set(FileVersion.objects.exclude(blob='').values_list('blob', flat=True).distinct())
+    store = get_blob_store()
+    for digest in ProjectSnapshot.objects.values_list('manifest', flat=True).distinct():
+        referenced.add(digest)
+        try:
+            referenced.update(json.loads(store.get(digest)).values())
+        except FileNotFoundError:
+            logger.warning(f"Snapshot manifest {digest} is missing")
+    unused = sorted(candidates - referenced)
+    for start in range(0, len(unused), DELETE_BATCH):
+        deleted, _ = Blob.objects.filter(digest__in=unused[start:start + DELETE_BATCH],
+                                         stored_at__lt=cutoff).delete()
+        removed['blobs'] += deleted
+    return removed
+
+
+@receiver(files_deleting)
+def keep_before_delete(sender, project_id, path, **kwargs):
+    """Make sure what is about to be deleted can be restored."""
+    try:
+        path = clean_path(path) if path else ''
+    except ValueError:
+        return
+    if not settings.SNAPSHOTS_ENABLED:
+        return
+    if not path:
+        create_snapshot(project_id, label='Before project deletion')
+        return
+    for file_path in _files_under(project_id, path):
+        record_version(project_id, file_path)
+
+
+@receiver(file_changed)
+def record_change(sender, project_id, path, event, old_path=None, **kwargs):
+    try:
+        path = clean_path(path) if path else ''
+        old_path = clean_path(old_path) if old_path else None
+    except ValueError:
+        return
+    if not path or not settings.SNAPSHOTS_ENABLED:
+        return
+    if event == 'deleted':
+        known = (FileVersion.objects.filter(project_name=project_id, path__startswith=path)
+                 .order_by().values_list('path', flat=True).distinct())
+        for file_path in known:
+            if file_path == path or file_path.startswith(path + '/'):
+                record_deletion(project_id, file_path)
+    elif event == 'renamed' and old_path:
+        for file_path in _files_under(project_id, path):
+            previous = old_path + file_path[len(path):]
+            record_version(project_id, file_path, event='renamed', old_path=previous)
+            record_deletion(project_id, previous)
+    elif event in ('created', 'modified'):
+        # Only files are saved, but a created path may be a folder
+        for file_path in [path] if event == 'modified' else _files_under(project_id, path):
+            record_version(project_id, file_path, event=event)
@@ -0,0 +1,21 @@
+"""
+SQLite database backend (ENGINE 'codeeditor.sqlite'), Django's with
+tuned connections.
+
+SQLite (local and test deployments) is switched to write-ahead logging,
+so saves no longer block readers and one writer's fsync doesn't hold up
+the rest, with pragmas tuned for an app server: fsync only at WAL
+checkpoints, a larger page cache and memory-mapped reads. journal_mode
+is stored in the database file; the other pragmas last for the
+connection, so they are set on every new one. SQLITE_PRAGMAS overrides
+the defaults, and SQLITE_WAL=False leaves the database as it is.
+
+Transactions on SQLite also start with BEGIN IMMEDIATE, taking the write
+lock up front (Django 5.1's transaction_mode='IMMEDIATE'). A deferred
+transaction that reads and then writes, like a save in the database
+storage backend, can't wait for a concurrent writer: SQLite fails it with
+"database is locked" at once instead of honouring the busy timeout.
+Django 4.2 has no setting for it, so DatabaseWrapper overrides the
+private method its atomic() calls to begin; check that override when
+upgrading Django (and switch to the OPTIONS setting on 5.1 or later).
+"""
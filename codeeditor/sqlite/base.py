@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.db.backends.sqlite3 import base
+
+SQLITE_PRAGMAS = {
+    'synchronous': 'NORMAL',
+    'cache_size': '-20000',  # KiB
+    'temp_store': 'MEMORY',
+    'mmap_size': str(256 * 1024 * 1024),
+}
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        if getattr(settings, 'SQLITE_WAL', True):
+            conn.execute('PRAGMA journal_mode=WAL')
+            for name, value in getattr(settings, 'SQLITE_PRAGMAS', SQLITE_PRAGMAS).items():
+                conn.execute(f'PRAGMA {name}={value}')
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        # Called by atomic() to open the outermost transaction
+        self.cursor().execute('BEGIN IMMEDIATE')
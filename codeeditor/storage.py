@@ -0,0 +1,840 @@
+"""
+Where project files live.
+
+The file views go through get_storage() instead of touching ./projects
+directly, so a deployment can keep projects on local disk (the default),
+in the database (the File model's content column) or in an S3-compatible
+object store, selected by STORAGE_BACKEND. Paths are '/'-separated and
+relative to the project.
+
+Every backend is wrapped in CachedStorage, which can batch writes: inside
+``with storage.batch():`` writes are collected and sent to the backend
+together when the block exits (one transaction for the database, parallel
+uploads for S3), or dropped if it raises. For the remote backends it also
+keeps recently read files in memory (bounded by STORAGE_CACHE_SIZE bytes).
+A cached file is only served after checking that its version (the row's
+update time, the object's ETag) is still current, so writes made by other
+server processes show up at once; the check skips transferring content
+that hasn't changed.
+"""
+import errno
+import logging
+import os
+import posixpath
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from stat import S_ISDIR
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.db.models import Q
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import File, Project
+from .signals import file_changed
+
+logger = logging.getLogger(__name__)
+
+PROJECTS_DIR = os.path.join(os.getcwd(), 'projects')
+# Folders next to the local projects that imports extract into; not projects
+STAGING_PREFIX = '.import-'
+
+
+def clean_project_id(project_id):
+    """Raise ValueError unless project_id names a single directory."""
+    if not project_id or project_id in ('.', '..') or '/' in project_id or '\\' in project_id:
+        raise ValueError(f'Invalid project ID: {project_id}')
+    return project_id
+
+
+def clean_path(path):
+    """Normalised '/'-separated path inside a project; ValueError if it escapes it."""
+    path = posixpath.normpath(str(path).replace('\\', '/')).strip('/')
+    if path == '..' or path.startswith('../'):
+        raise ValueError(f'Invalid file path: {path}')
+    return '' if path == '.' else path
+
+
+def _not_found(path):
+    return FileNotFoundError(errno.ENOENT, 'No such file or directory', path)
+
+
+def is_ignored(path, ignored_dirs):
+    """Whether a file path is inside one of the ignored folders (by name)."""
+    return bool(ignored_dirs) and any(part in ignored_dirs for part in path.split('/')[:-1])
+
+
+def walk_project(root, ignored_dirs=(), with_stat=True):
+    """Yield ('/'-separated relative path, stat or None) for every file under a directory."""
+    stack = ['']
+    while stack:
+        rel_dir = stack.pop()
+        try:
+            entries = list(os.scandir(os.path.join(root, rel_dir)))
+        except OSError:
+            continue
+        for entry in entries:
+            rel_path = f'{rel_dir}/{entry.name}' if rel_dir else entry.name
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in ignored_dirs:
+                        stack.append(rel_path)
+                elif entry.is_file(follow_symlinks=False):
+                    yield rel_path, entry.stat(follow_symlinks=False) if with_stat else None
+            except OSError:
+                continue
+
+
+class Storage:
+    """
+    Backend interface. Read and write raw bytes; missing paths raise
+    FileNotFoundError, reading a folder raises IsADirectoryError and
+    deleting a non-empty folder raises OSError.
+    """
+    name = None
+    is_local = False
+
+    def local_path(self, project_id):
+        """The project's directory on this machine, for backends that have one."""
+        return None
+
+    def list_projects(self):
+        """[(project_id, created_at datetime)]"""
+        raise NotImplementedError
+
+    def project_exists(self, project_id):
+        raise NotImplementedError
+
+    def create_project(self, project_id):
+        raise NotImplementedError
+
+    def delete_project(self, project_id):
+        raise NotImplementedError
+
+    def kind(self, project_id, path):
+        """'file', 'folder' or None if nothing is there."""
+        raise NotImplementedError
+
+    def list_dir(self, project_id, path=''):
+        """[(name, is_folder)] directly inside a folder, sorted by name."""
+        raise NotImplementedError
+
+    def walk(self, project_id):
+        """[(path, is_folder)] for everything in the project, sorted by path."""
+        raise NotImplementedError
+
+    def versions(self, project_id, paths=None, ignored_dirs=()):
+        """
+        {path: version} for the given files, or for every file in the
+        project (outside ignored_dirs) if paths is None; missing files are
+        left out. A version is an opaque value that changes whenever the
+        file does, and is cheaper to get than the content.
+        """
+        raise NotImplementedError
+
+    def read(self, project_id, path):
+        return self.read_versioned(project_id, path)[0]
+
+    def read_versioned(self, project_id, path):
+        """(content, version) of a file."""
+        raise NotImplementedError
+
+    def read_many(self, project_id, paths):
+        """{path: bytes, or the OSError reading it raised} for several files."""
+        return {path: result if isinstance(result, OSError) else result[0]
+                for path, result in self.read_many_versioned(project_id, paths).items()}
+
+    def read_many_versioned(self, project_id, paths):
+        """{path: (bytes, version), or the OSError reading it raised} for several files."""
+        results = {}
+        for path in paths:
+            try:
+                results[path] = self.read_versioned(project_id, path)
+            except OSError as e:
+                results[path] = e
+        return results
+
+    def write(self, project_id, path, data):
+        """Create or replace a file, creating its parent folders."""
+        self.write_many(project_id, {path: data})
+
+    def write_many(self, project_id, files):
+        """Write {path: bytes} in one go."""
+        raise NotImplementedError
+
+    def make_dir(self, project_id, path):
+        raise NotImplementedError
+
+    def delete(self, project_id, path):
+        """Delete a file or an empty folder."""
+        raise NotImplementedError
+
+    def rename(self, project_id, old_path, new_path):
+        """Move a file or a folder and everything in it."""
+        raise NotImplementedError
+
+
+class LocalStorage(Storage):
+    name = 'local'
+    is_local = True
+
+    def __init__(self, root=PROJECTS_DIR):
+        self.root = os.path.abspath(root)
+
+    def local_path(self, project_id):
+        return os.path.join(self.root, clean_project_id(project_id))
+
+    def _full_path(self, project_id, path):
+        return os.path.join(self.local_path(project_id), clean_path(path))
+
+    def list_projects(self):
+        os.makedirs(self.root, exist_ok=True)
+        projects = []
+        for entry in os.scandir(self.root):
+            if entry.is_dir() and not entry.name.startswith(STAGING_PREFIX):
+                created_at = datetime.fromtimestamp(entry.stat().st_ctime)
+                projects.append((entry.name, created_at))
+        return projects
+
+    def project_exists(self, project_id):
+        return os.path.isdir(self.local_path(project_id))
+
+    def create_project(self, project_id):
+        os.makedirs(self.local_path(project_id), exist_ok=True)
+
+    def delete_project(self, project_id):
+        shutil.rmtree(self.local_path(project_id))
+
+    def kind(self, project_id, path):
+        full_path = self._full_path(project_id, path)
+        if os.path.isdir(full_path):
+            return 'folder'
+        return 'file' if os.path.exists(full_path) else None
+
+    def list_dir(self, project_id, path=''):
+        with os.scandir(self._full_path(project_id, path)) as entries:
+            return sorted((entry.name, entry.is_dir()) for entry in entries)
+
+    def walk(self, project_id):
+        root = self.local_path(project_id)
+        entries = []
+        for dir_path, dir_names, file_names in os.walk(root):
+            rel_dir = os.path.relpath(dir_path, root).replace(os.sep, '/')
+            prefix = '' if rel_dir == '.' else rel_dir + '/'
+            entries.extend((prefix + name, True) for name in dir_names)
+            entries.extend((prefix + name, False) for name in file_names)
+        return sorted(entries)
+
+    def versions(self, project_id, paths=None, ignored_dirs=()):
+        if paths is None:
+            return {path: (stat.st_mtime_ns, stat.st_size)
+                    for path, stat in walk_project(self.local_path(project_id), ignored_dirs)}
+        versions = {}
+        for path in paths:
+            try:
+                stat = os.stat(self._full_path(project_id, path))
+            except OSError:
+                continue
+            if not S_ISDIR(stat.st_mode):
+                versions[path] = (stat.st_mtime_ns, stat.st_size)
+        return versions
+
+    def read_versioned(self, project_id, path):
+        with open(self._full_path(project_id, path), 'rb') as f:
+            stat = os.fstat(f.fileno())
+            return f.read(), (stat.st_mtime_ns, stat.st_size)
+
+    def write_many(self, project_id, files):
+        for path, data in files.items():
+            full_path = self._full_path(project_id, path)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            with open(full_path, 'wb') as f:
+                f.write(data)
+
+    def make_dir(self, project_id, path):
+        os.makedirs(self._full_path(project_id, path), exist_ok=True)
+
+    def delete(self, project_id, path):
+        full_path = self._full_path(project_id, path)
+        if os.path.isdir(full_path):
+            os.rmdir(full_path)
+        else:
+            os.remove(full_path)
+
+    def rename(self, project_id, old_path, new_path):
+        new_full_path = self._full_path(project_id, new_path)
+        os.makedirs(os.path.dirname(new_full_path), exist_ok=True)
+        os.rename(self._full_path(project_id, old_path), new_full_path)
+
+
+class DatabaseStorage(Storage):
+    """
+    Projects as Project rows and files and folders as File rows. File
+    content is a text column, so binary files are stored decoded as UTF-8
+    with replacement characters.
+    """
+    name = 'database'
+
+    def _project(self, project_id, required=True):
+        project = Project.objects.filter(name=clean_project_id(project_id)).first()
+        if project is None and required:
+            raise _not_found(project_id)
+        return project
+
+    def _files(self, project_id):
+        return File.objects.filter(project=self._project(project_id))
+
+    def list_projects(self):
+        return list(Project.objects.order_by('name').values_list('name', 'created_at'))
+
+    def project_exists(self, project_id):
+        return self._project(project_id, required=False) is not None
+
+    def create_project(self, project_id):
+        if not self.project_exists(project_id):
+            Project.objects.create(name=project_id)
+
+    def delete_project(self, project_id):
+        self._project(project_id).delete()
+
+    def kind(self, project_id, path):
+        path = clean_path(path)
+        if not path:
+            return 'folder' if self.project_exists(project_id) else None
+        is_folder = self._files(project_id).filter(path=path).values_list('is_folder', flat=True).first()
+        if is_folder is None:
+            return None
+        return 'folder' if is_folder else 'file'
+
+    def list_dir(self, project_id, path=''):
+        path = clean_path(path)
+        files = self._files(project_id)
+        if path:
+            parent = files.filter(path=path, is_folder=True).first()
+            if parent is None:
+                raise _not_found(path)
+            files = files.filter(parent=parent)
+        else:
+            files = files.filter(parent__isnull=True)
+        return sorted(files.values_list('name', 'is_folder'))
+
+    def walk(self, project_id):
+        return sorted(self._files(project_id).values_list('path', 'is_folder'))
+
+    def versions(self, project_id, paths=None, ignored_dirs=()):
+        files = self._files(project_id).filter(is_folder=False)
+        if paths is not None:
+            files = files.filter(path__in=[clean_path(path) for path in paths])
+        # The row id as well, in case another file was moved onto the path
+        return {path: (pk, updated_at) for path, pk, updated_at in files.values_list('path', 'pk', 'updated_at')
+                if not is_ignored(path, ignored_dirs)}
+
+    def read_versioned(self, project_id, path):
+        result = self.read_many_versioned(project_id, [path])[clean_path(path)]
+        if isinstance(result, OSError):
+            raise result
+        return result
+
+    def read_many_versioned(self, project_id, paths):
+        paths = [clean_path(path) for path in paths]
+        rows = {path: row for path, *row in self._files(project_id).filter(path__in=paths)
+                .values_list('path', 'is_folder', 'content', 'pk', 'updated_at')}
+        results = {}
+        for path in paths:
+            row = rows.get(path)
+            if row is None:
+                results[path] = _not_found(path)
+            elif row[0]:
+                results[path] = IsADirectoryError(errno.EISDIR, 'Is a directory', path)
+            else:
+                results[path] = (row[1].encode('utf-8'), (row[2], row[3]))
+        return results
+
+    def _folder(self, project, path, cache):
+        """The File row of a folder, creating it and its parents as needed."""
+        if not path:
+            return None
+        if path not in cache:
+            parent = self._folder(project, posixpath.dirname(path), cache)
+            folder, _ = File.objects.get_or_create(
+                project=project, path=path,
+                defaults={'name': posixpath.basename(path), 'is_folder': True, 'parent': parent})
+            if not folder.is_folder:
+                raise NotADirectoryError(errno.ENOTDIR, 'Not a directory', path)
+            cache[path] = folder
+        return cache[path]
+
+    def write_many(self, project_id, files):
+        contents = {clean_path(path): data.decode('utf-8', errors='replace') for path, data in files.items()}
+        with transaction.atomic():
+            project = self._project(project_id)
+            existing = {f.path: f for f in File.objects.filter(project=project, path__in=list(contents))}
+            folders = {}
+            now = timezone.now()
+            updated, created = [], []
+            for path, content in contents.items():
+                row = existing.get(path)
+                if row is not None:
+                    if row.is_folder:
+                        raise IsADirectoryError(errno.EISDIR, 'Is a directory', path)
+                    row.content = content
+                    row.updated_at = now
+                    updated.append(row)
+                else:
+                    parent = self._folder(project, posixpath.dirname(path), folders)
+                    created.append(File(project=project, path=path, name=posixpath.basename(path),
+                                        content=content, parent=parent))
+            File.objects.bulk_update(updated, ['content', 'updated_at'])
+            File.objects.bulk_create(created)
+
+    def make_dir(self, project_id, path):
+        with transaction.atomic():
+            self._folder(self._project(project_id), clean_path(path), {})
+
+    def delete(self, project_id, path):
+        path = clean_path(path)
+        files = self._files(project_id)
+        row = files.filter(path=path).first()
+        if row is None:
+            raise _not_found(path)
+        if row.is_folder and files.filter(parent=row).exists():
+            raise OSError(errno.ENOTEMPTY, 'Directory not empty', path)
+        row.delete()
+
+    def rename(self, project_id, old_path, new_path):
+        old_path, new_path = clean_path(old_path), clean_path(new_path)
+        with transaction.atomic():
+            project = self._project(project_id)
+            rows = list(self._files(project_id).filter(Q(path=old_path) | Q(path__startswith=old_path + '/')))
+            if not rows:
+                raise _not_found(old_path)
+            parent = self._folder(project, posixpath.dirname(new_path), {})
+            for row in rows:
+                if row.path == old_path:
+                    row.name = posixpath.basename(new_path)
+                    row.parent = parent
+                row.path = new_path + row.path[len(old_path):]
+            File.objects.bulk_update(rows, ['path', 'name', 'parent'])
+
+
+class S3Storage(Storage):
+    """
+    Files as objects under S3_PREFIX<project>/<path> in S3_BUCKET, on AWS or
+    any S3-compatible server (set S3_ENDPOINT_URL, e.g. a local MinIO).
+    Folders exist while they hold files; empty ones are kept as
+    zero-byte "<path>/" marker objects. Renames copy then delete, so they
+    are not atomic.
+    """
+    name = 's3'
+
+    def __init__(self, bucket, prefix='', client=None, workers=8):
+        if client is None:
+            try:
+                import boto3
+            except ImportError:
+                raise ImproperlyConfigured('STORAGE_BACKEND = "s3" needs boto3 (pip install boto3)')
+            client = boto3.client('s3', endpoint_url=getattr(settings, 'S3_ENDPOINT_URL', '') or None,
+                                  region_name=getattr(settings, 'S3_REGION', '') or None)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.workers = workers
+
+    def _key(self, project_id, path=''):
+        return f'{self.prefix}{clean_project_id(project_id)}/{clean_path(path)}'
+
+    def _dir_key(self, project_id, path):
+        key = self._key(project_id, path)
+        return key if key.endswith('/') else key + '/'
+
+    def _list(self, prefix, delimiter=None, max_keys=None):
+        """Yield list_objects_v2 pages."""
+        kwargs = {'Bucket': self.bucket, 'Prefix': prefix}
+        if delimiter:
+            kwargs['Delimiter'] = delimiter
+        if max_keys:
+            kwargs['MaxKeys'] = max_keys
+        while True:
+            page = self.client.list_objects_v2(**kwargs)
+            yield page
+            if max_keys or not page.get('IsTruncated'):
+                return
+            kwargs['ContinuationToken'] = page['NextContinuationToken']
+
+    def _keys(self, prefix):
+        return [item['Key'] for page in self._list(prefix) for item in page.get('Contents', [])]
+
+    def _has_prefix(self, prefix):
+        page = next(self._list(prefix, max_keys=1))
+        return bool(page.get('Contents'))
+
+    def _is_missing(self, error):
+        code = error.response.get('Error', {}).get('Code', '')
+        return code in ('404', 'NoSuchKey', 'NotFound')
+
+    def _delete_keys(self, keys):
+        for start in range(0, len(keys), 1000):
+            self.client.delete_objects(Bucket=self.bucket, Delete={
+                'Objects': [{'Key': key} for key in keys[start:start + 1000]], 'Quiet': True})
+
+    def list_projects(self):
+        projects = []
+        for page in self._list(self.prefix, delimiter='/'):
+            for common in page.get('CommonPrefixes', []):
+                project_id = common['Prefix'][len(self.prefix):].rstrip('/')
+                created_at = timezone.now()
+                try:
+                    marker = self.client.head_object(Bucket=self.bucket, Key=common['Prefix'])
+                    created_at = marker['LastModified']
+                except Exception:
+                    pass
+                projects.append((project_id, created_at))
+        return projects
+
+    def project_exists(self, project_id):
+        return self._has_prefix(self._key(project_id))
+
+    def create_project(self, project_id):
+        self.client.put_object(Bucket=self.bucket, Key=self._key(project_id), Body=b'')
+
+    def delete_project(self, project_id):
+        self._delete_keys(self._keys(self._key(project_id)))
+
+    def kind(self, project_id, path):
+        if not clean_path(path):
+            return 'folder' if self.project_exists(project_id) else None
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(project_id, path))
+            return 'file'
+        except ClientError as e:
+            if not self._is_missing(e):
+                raise
+        return 'folder' if self._has_prefix(self._dir_key(project_id, path)) else None
+
+    def list_dir(self, project_id, path=''):
+        prefix = self._dir_key(project_id, path)
+        entries = set()
+        for page in self._list(prefix, delimiter='/'):
+            for common in page.get('CommonPrefixes', []):
+                entries.add((common['Prefix'][len(prefix):].rstrip('/'), True))
+            for item in page.get('Contents', []):
+                if item['Key'] != prefix:
+                    entries.add((item['Key'][len(prefix):], False))
+        if not entries and not self._has_prefix(prefix):
+            raise _not_found(path)
+        return sorted(entries)
+
+    def walk(self, project_id):
+        root = self._key(project_id)
+        entries = set()
+        for key in self._keys(root):
+            path = key[len(root):]
+            if not path:
+                continue
+            parts = path.rstrip('/').split('/')
+            for depth in range(1, len(parts)):
+                entries.add(('/'.join(parts[:depth]), True))
+            entries.add((path.rstrip('/'), path.endswith('/')))
+        return sorted(entries)
+
+    def versions(self, project_id, paths=None, ignored_dirs=()):
+        if paths is None:
+            root = self._key(project_id)
+            return {item['Key'][len(root):]: item['ETag'] for page in self._list(root)
+                    for item in page.get('Contents', [])
+                    if item['Key'] != root and not item['Key'].endswith('/')
+                    and not is_ignored(item['Key'][len(root):], ignored_dirs)}
+
+        from botocore.exceptions import ClientError
+
+        def head(path):
+            try:
+                return path, self.client.head_object(Bucket=self.bucket, Key=self._key(project_id, path))['ETag']
+            except ClientError as e:
+                if not self._is_missing(e):
+                    raise
+                return path, None
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            return {path: etag for path, etag in pool.map(head, paths) if etag is not None}
+
+    def read_versioned(self, project_id, path):
+        from botocore.exceptions import ClientError
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self._key(project_id, path))
+        except ClientError as e:
+            if self._is_missing(e):
+                if self._has_prefix(self._dir_key(project_id, path)):
+                    raise IsADirectoryError(errno.EISDIR, 'Is a directory', path)
+                raise _not_found(path)
+            raise
+        return response['Body'].read(), response['ETag']
+
+    def read_many_versioned(self, project_id, paths):
+        def get(path):
+            try:
+                return path, self.read_versioned(project_id, path)
+            except OSError as e:
+                return path, e
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            return dict(pool.map(get, paths))
+
+    def write_many(self, project_id, files):
+        def put(item):
+            path, data = item
+            self.client.put_object(Bucket=self.bucket, Key=self._key(project_id, path), Body=data)
+
+        if len(files) == 1:
+            put(next(iter(files.items())))
+            return
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            # list() re-raises the first failed upload
+            list(pool.map(put, files.items()))
+
+    def make_dir(self, project_id, path):
+        self.client.put_object(Bucket=self.bucket, Key=self._dir_key(project_id, path), Body=b'')
+
+    def delete(self, project_id, path):
+        if self.kind(project_id, path) == 'file':
+            self.client.delete_object(Bucket=self.bucket, Key=self._key(project_id, path))
+            return
+        prefix = self._dir_key(project_id, path)
+        keys = self._keys(prefix)
+        if not keys:
+            raise _not_found(path)
+        if keys != [prefix]:
+            raise OSError(errno.ENOTEMPTY, 'Directory not empty', path)
+        self.client.delete_object(Bucket=self.bucket, Key=prefix)
+
+    def rename(self, project_id, old_path, new_path):
+        old_key, new_key = self._key(project_id, old_path), self._key(project_id, new_path)
+        if self.kind(project_id, old_path) == 'file':
+            moves = [(old_key, new_key)]
+        else:
+            moves = [(key, new_key + '/' + key[len(old_key) + 1:]) for key in self._keys(old_key + '/')]
+        if not moves:
+            raise _not_found(old_path)
+
+        def copy(move):
+            self.client.copy_object(Bucket=self.bucket, Key=move[1],
+                                    CopySource={'Bucket': self.bucket, 'Key': move[0]})
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            list(pool.map(copy, moves))
+        self._delete_keys([old for old, _ in moves])
+
+
+class CachedStorage:
+    """A backend plus write batching and, for remote backends, a validated read cache."""
+
+    def __init__(self, backend, max_bytes):
+        self.backend = backend
+        # Local files are as cheap to read as to check, so they aren't cached
+        self.max_bytes = 0 if backend.is_local else max_bytes
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()  # (project_id, path) -> (version, data)
+        self.cached_bytes = 0
+        self.local = threading.local()
+
+    def __getattr__(self, name):
+        # Metadata calls (kind, list_dir, walk, versions, list_projects, ...) go straight through
+        return getattr(self.backend, name)
+
+    def _cache_get(self, key):
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is not None:
+                self.cache.move_to_end(key)
+            return entry
+
+    def _cache_put(self, key, version, data):
+        with self.lock:
+            # Whatever is cached is older than data, so it goes even if data isn't kept
+            self._cache_drop(key)
+            # One file may use at most an eighth of the cache
+            if len(data) > self.max_bytes // 8:
+                return
+            self.cache[key] = (version, data)
+            self.cached_bytes += len(data)
+            while self.cached_bytes > self.max_bytes:
+                _, (_, evicted) = self.cache.popitem(last=False)
+                self.cached_bytes -= len(evicted)
+
+    def _cache_drop(self, key):
+        entry = self.cache.pop(key, None)
+        if entry is not None:
+            self.cached_bytes -= len(entry[1])
+
+    def invalidate(self, project_id, path=''):
+        """Forget cached files at or under path ('' for the whole project)."""
+        prefix = path + '/' if path else ''
+        with self.lock:
+            for key in [k for k in self.cache
+                        if k[0] == project_id and (not path or k[1] == path or k[1].startswith(prefix))]:
+                self._cache_drop(key)
+
+    def _pending(self):
+        return getattr(self.local, 'pending', None)
+
+    @contextmanager
+    def batch(self):
+        """Collect writes until the block exits; nested batches join the outer one."""
+        if self._pending() is not None:
+            yield self
+            return
+        self.local.pending = {}
+        try:
+            yield self
+            self.flush()
+        finally:
+            self.local.pending = None
+
+    def flush(self):
+        pending = self._pending()
+        if not pending:
+            return
+        by_project = {}
+        for (project_id, path), data in pending.items():
+            by_project.setdefault(project_id, {})[path] = data
+        pending.clear()
+        for project_id, files in by_project.items():
+            self.backend.write_many(project_id, files)
+            self.invalidate_files(project_id, files)
+
+    def invalidate_files(self, project_id, paths):
+        with self.lock:
+            for path in paths:
+                self._cache_drop((project_id, path))
+
+    def read(self, project_id, path):
+        path = clean_path(path)
+        result = self.read_many(project_id, [path])[path]
+        if isinstance(result, OSError):
+            raise result
+        return result
+
+    def read_many(self, project_id, paths):
+        results = {}
+        pending = self._pending() or {}
+        cached = {}
+        missing = []
+        for path in paths:
+            key = (project_id, clean_path(path))
+            if key in pending:
+                results[key[1]] = pending[key]
+                continue
+            entry = self._cache_get(key) if self.max_bytes else None
+            if entry is not None:
+                cached[key[1]] = entry
+            else:
+                missing.append(key[1])
+        if cached:
+            # Serve cached copies that are still current, re-read the rest
+            current = self.backend.versions(project_id, list(cached))
+            for path, (version, data) in cached.items():
+                if current.get(path) == version:
+                    results[path] = data
+                else:
+                    missing.append(path)
+        if missing:
+            for path, result in self.backend.read_many_versioned(project_id, missing).items():
+                if isinstance(result, OSError):
+                    results[path] = result
+                    self.invalidate_files(project_id, [path])
+                    continue
+                data, version = result
+                results[path] = data
+                if self.max_bytes:
+                    self._cache_put((project_id, path), version, data)
+        return results
+
+    def write(self, project_id, path, data):
+        key = (project_id, clean_path(path))
+        pending = self._pending()
+        if pending is not None:
+            pending[key] = data
+            return
+        self.backend.write(*key, data)
+        # The new version is only known once the file is read back
+        self.invalidate_files(project_id, [key[1]])
+
+    def write_many(self, project_id, files):
+        with self.batch():
+            for path, data in files.items():
+                self.write(project_id, path, data)
+
+    def kind(self, project_id, path):
+        pending = self._pending()
+        if pending and (project_id, clean_path(path)) in pending:
+            return 'file'
+        return self.backend.kind(project_id, path)
+
+    def make_dir(self, project_id, path):
+        self.flush()
+        self.backend.make_dir(project_id, path)
+
+    def delete(self, project_id, path):
+        self.flush()
+        self.backend.delete(project_id, path)
+        self.invalidate(project_id, clean_path(path))
+
+    def rename(self, project_id, old_path, new_path):
+        self.flush()
+        self.backend.rename(project_id, old_path, new_path)
+        self.invalidate(project_id, clean_path(old_path))
+        self.invalidate(project_id, clean_path(new_path))
+
+    def delete_project(self, project_id):
+        self.flush()
+        self.backend.delete_project(project_id)
+        self.invalidate(project_id)
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def create_backend(name):
+    if name == 'local':
+        return LocalStorage()
+    if name == 'database':
+        return DatabaseStorage()
+    if name == 's3':
+        bucket = getattr(settings, 'S3_BUCKET', '')
+        if not bucket:
+            raise ImproperlyConfigured('STORAGE_BACKEND = "s3" needs S3_BUCKET')
+        return S3Storage(bucket, prefix=getattr(settings, 'S3_PREFIX', ''),
+                         workers=getattr(settings, 'STORAGE_WRITE_WORKERS', 8))
+    raise ImproperlyConfigured(f'Unknown STORAGE_BACKEND: {name}')
+
+
+def get_storage():
+    global _storage
+    with _storage_lock:
+        if _storage is None:
+            backend = create_backend(getattr(settings, 'STORAGE_BACKEND', 'local'))
+            _storage = CachedStorage(backend,
+                                     max_bytes=getattr(settings, 'STORAGE_CACHE_SIZE', 32 * 1024 * 1024))
+        return _storage
+
+
+@receiver(file_changed)
+def invalidate_cache(sender, project_id, path, event, old_path=None, **kwargs):
+    """Drop cached content for changes made around the storage API (restores, imports)."""
+    if _storage is None:
+        return
+    try:
+        path = clean_path(path) if path else ''
+        _storage.invalidate(project_id, path)
+        if old_path:
+            _storage.invalidate(project_id, clean_path(old_path))
+    except ValueError:
+        pass
@@ -1,3 +1,956 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import io
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import sqlite3
+import stat
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+import zipfile
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.contrib.sessions.backends.db import SessionStore
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from . import (archives, cluster, collab, fileops, interactive, judge, kernels, lsp, metrics, quickopen, sandbox, scheduler, search,
+               snapshots, storage, views)
+from .models import Blob, FileVersion, ProjectSnapshot
+from .sqlite import base as sqlite_backend
+
+try:
+    import boto3
+    from moto import mock_aws
+except ImportError:
+    boto3 = mock_aws = None
+
+
+class ArchiveTests(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def zip(self, files):
+        upload = io.BytesIO()
+        with zipfile.ZipFile(upload, 'w') as archive:
+            for name, content in files.items():
+                archive.writestr(name, content)
+        upload.seek(0)
+        return upload
+
+    def extract(self, upload):
+        dest = tempfile.mkdtemp(dir=self.root)
+        archives.extract_archive(upload, dest)
+        return sorted(path for path, _ in storage.walk_project(dest))
+
+    def test_paths_outside_the_project_are_refused(self):
+        for name in ['../evil.txt', 'a/../../evil.txt', '/etc/evil', 'C:/evil']:
+            with self.assertRaises(archives.ArchiveError, msg=name):
+                self.extract(self.zip({name: 'x'}))
+
+    def test_links_are_skipped(self):
+        upload = self.zip({'a.txt': 'a'})
+        with zipfile.ZipFile(upload, 'a') as archive:
+            link = zipfile.ZipInfo('link')
+            link.external_attr = (stat.S_IFLNK | 0o777) << 16
+            archive.writestr(link, '/etc/passwd')
+        upload.seek(0)
+        self.assertEqual(self.extract(upload), ['a.txt'])
+        upload = io.BytesIO()
+        with tarfile.open(fileobj=upload, mode='w:gz') as archive:
+            member = tarfile.TarInfo('link')
+            member.type, member.linkname = tarfile.SYMTYPE, '/etc/passwd'
+            archive.addfile(member)
+            member = tarfile.TarInfo('b.txt')
+            member.size = 1
+            archive.addfile(member, io.BytesIO(b'b'))
+        upload.seek(0)
+        self.assertEqual(self.extract(upload), ['b.txt'])
+
+    def test_limits(self):
+        with override_settings(ARCHIVE_MAX_FILES=2):
+            with self.assertRaisesRegex(archives.ArchiveError, 'more than 2 files'):
+                self.extract(self.zip({'a': '', 'b': '', 'c': ''}))
+        with override_settings(ARCHIVE_MAX_SIZE=10, ARCHIVE_CHUNK_SIZE=4):
+            with self.assertRaisesRegex(archives.ArchiveError, 'more than 10 bytes'):
+                self.extract(self.zip({'a': '12345', 'b': '123456'}))
+
+    def test_local_replace_is_undone_on_failure(self):
+        backend = storage.LocalStorage(self.root)
+        backend.create_project('p')
+        backend.write('p', 'old.txt', b'old')
+        rename = os.rename
+
+        def failing_rename(src, dst):
+            if dst == backend.local_path('p') and 'previous' not in src:
+                raise OSError('rename failed')
+            return rename(src, dst)
+
+        with unittest.mock.patch('os.rename', failing_rename), self.assertRaises(OSError):
+            archives.import_archive(self.zip({'new.txt': 'new'}), backend, 'p', replace=True)
+        self.assertEqual(sorted(backend.versions('p')), ['old.txt'])
+        archives.import_archive(self.zip({'new.txt': 'new'}), backend, 'p', replace=True)
+        self.assertEqual(sorted(backend.versions('p')), ['new.txt'])
+        # Staging folders next to the projects are gone and never listed
+        self.assertEqual(os.listdir(self.root), ['p'])
+
+    def test_remote_replace_uploads_before_deleting(self):
+        backend = storage.DatabaseStorage()
+        backend.create_project('p')
+        backend.write_many('p', {'a.txt': b'old', 'dir/b.txt': b'b', 'clash': b'file'})
+        upload = self.zip({'a.txt': 'new', 'clash/c.txt': 'c'})
+        with unittest.mock.patch.object(backend, 'write_many', side_effect=OSError('upload failed')), \
+                self.assertRaises(OSError):
+            archives.import_archive(upload, backend, 'p', replace=True)
+        # Only what stood in the way of the new folder went
+        self.assertEqual(sorted(backend.versions('p')), ['a.txt', 'dir/b.txt'])
+        upload.seek(0)
+        archives.import_archive(upload, backend, 'p', replace=True)
+        self.assertEqual(backend.walk('p'), [('a.txt', False), ('clash', True), ('clash/c.txt', False)])
+        self.assertEqual(backend.read('p', 'a.txt'), b'new')
+
+
+class CollaborationLockTests(TestCase):
+    def setUp(self):
+        self.lock_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(COLLAB_LOCK_DIR=self.lock_dir)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.lock_dir, ignore_errors=True)
+
+    def test_one_process_hosts_a_project(self):
+        # Separate registries stand in for server processes: flock locks are per open file
+        first, second = collab.Registry(), collab.Registry()
+        first._claim('p')
+        with self.assertRaises(collab.DocumentError):
+            second._claim('p')
+        second._claim('other')
+        first._release('p')
+        second._claim('p')
+        self.assertEqual(set(second.locks), {'p', 'other'})
+        second._release('p')
+        second._release('other')
+
+
+class OperationalTransformTests(TestCase):
+    ALPHABET = ['a', 'b', ' ', '\n', 'é', '😀', '𝄞']
+
+    def random_text(self, rng, length):
+        return ''.join(rng.choice(self.ALPHABET) for _ in range(length))
+
+    def random_ops(self, rng, text):
+        """A random edit of text that never splits a surrogate pair."""
+        ops = []
+        for char in text:
+            if rng.random() < 0.3:
+                ops.append(self.random_text(rng, rng.randint(1, 3)))
+            ops.append(-collab._units(char) if rng.random() < 0.3 else collab._units(char))
+        if rng.random() < 0.3:
+            ops.append(self.random_text(rng, rng.randint(1, 3)))
+        return collab.normalize(ops)
+
+    def test_transformed_ops_converge(self):
+        rng = random.Random(1)
+        for _ in range(500):
+            text = self.random_text(rng, rng.randint(0, 12))
+            a, b = self.random_ops(rng, text), self.random_ops(rng, text)
+            a2, b2 = collab.transform(a, b)
+            self.assertEqual(collab.apply(collab.apply(text, a), b2), collab.apply(collab.apply(text, b), a2),
+                             (text, a, b))
+
+    def test_concurrent_inserts_at_one_place(self):
+        a2, b2 = collab.transform([1, 'A', 1], [1, 'B', 1])
+        self.assertEqual(collab.apply(collab.apply('xy', [1, 'A', 1]), b2), 'xABy')
+        self.assertEqual(collab.apply(collab.apply('xy', [1, 'B', 1]), a2), 'xABy')
+
+    def test_positions_count_utf16_units(self):
+        self.assertEqual(collab.apply('a😀b', [1, -2, 1]), 'ab')
+        self.assertEqual(collab.apply('a😀b', [3, '𝄞', 1]), 'a😀𝄞b')
+        with self.assertRaisesRegex(ValueError, 'surrogate pair'):
+            collab.apply('a😀b', [2, -1, 1])
+        with self.assertRaisesRegex(ValueError, 'shorter'):
+            collab.apply('a😀b', [3])
+        with self.assertRaisesRegex(ValueError, 'unpaired surrogate'):
+            collab.normalize([1, '\ud83d'])
+
+    def test_transform_position(self):
+        # The cursor sits after "a😀" (3 units) in "a😀b"
+        self.assertEqual(collab.transform_position(3, ['😀', 4]), 5)
+        self.assertEqual(collab.transform_position(3, [4, 'x']), 3)
+        self.assertEqual(collab.transform_position(3, [1, -2, 1]), 1)
+        # In "abcd", deleting "abc" around a cursor after "ab" leaves it where "abc" was
+        self.assertEqual(collab.transform_position(2, [-3, 1]), 0)
+
+
+class KernelTests(TestCase):
+    def setUp(self):
+        self.slot_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(KERNELS_ENABLED=True)
+        self.settings_override.enable()
+        self.patcher = unittest.mock.patch.object(kernels, '_manager', kernels.KernelManager(4, 2, 600, self.slot_dir))
+        self.patcher.start()
+
+    def tearDown(self):
+        for kernel in kernels._manager.kernels.values():
+            kernel.close()
+        self.patcher.stop()
+        self.settings_override.disable()
+        shutil.rmtree(self.slot_dir, ignore_errors=True)
+
+    def run_cell(self, client, code):
+        response = client.post('/editor/run/session/', json.dumps({'project_id': 'p', 'code': code}),
+                               content_type='application/json')
+        return response.json()
+
+    def test_sessions_belong_to_the_browser_session(self):
+        first, second = Client(), Client()
+        self.run_cell(first, 'x = 42')
+        self.assertEqual(self.run_cell(first, 'x')['result'], '42')
+        self.assertIn('NameError', self.run_cell(second, 'x')['error'])
+
+    def test_kernel_budget_is_shared_by_processes(self):
+        # Another manager stands in for another server process holding all but one slot
+        other = kernels.KernelManager(4, 2, 600, self.slot_dir)
+        held = [other.slots.acquire() for _ in range(3)]
+        try:
+            manager = kernels._manager
+            manager.get('user:1', 'a')
+            self.assertIsNone(other.slots.acquire())
+            # The only kernel here is idle, so it makes room for the next one
+            manager.get('user:2', 'a')
+            self.assertEqual(list(manager.kernels), [('user:2', 'a')])
+            with manager.kernels[('user:2', 'a')].lock:
+                with self.assertRaises(kernels.KernelError) as raised:
+                    manager.get('user:3', 'a')
+            self.assertEqual(raised.exception.status, 503)
+        finally:
+            for fd in held:
+                os.close(fd)
+
+
+class FakeWebSocket:
+    def __init__(self, messages=()):
+        self.messages = list(messages)
+        self.sent = []
+
+    async def receive_json(self):
+        if not self.messages:
+            await asyncio.Event().wait()
+        return self.messages.pop(0)
+
+    async def send_json(self, data):
+        self.sent.append(data)
+
+
+class InteractiveTests(TestCase):
+    def test_background_children_are_killed_with_the_program(self):
+        async def run():
+            process = interactive.spawn_process(['sh', '-c', 'sleep 1000 & echo started'])
+            session = interactive.InteractiveSession(FakeWebSocket(['not a message']), process, 'shell',
+                                                     idle_timeout=30, max_duration=60, output_limit=1024)
+            try:
+                await asyncio.wait_for(session.run(), 10)
+            finally:
+                interactive._close_pipes(process)
+            return session.websocket.sent
+
+        sent = asyncio.run(run())
+        self.assertEqual(sent[0], {'type': 'stdout', 'data': 'started\n'})
+        self.assertEqual(sent[-1], {'type': 'exit', 'returncode': 0})
+
+    def test_submission_must_be_an_object_of_strings(self):
+        for submission in ([], 'x', {'code': 1}, {'code': 'print(1)', 'language': ['python']}):
+            websocket = FakeWebSocket([submission])
+            websocket.accept = websocket.close = unittest.mock.AsyncMock()
+            asyncio.run(interactive.run_interactive(websocket))
+            self.assertEqual(websocket.sent[0]['type'], 'error')
+
+class ClusterTests(TestCase):
+    """A dispatcher in the test process in front of runner nodes started as separate servers."""
+
+    SECRET = 'test-secret'
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.temp_dir = tempfile.mkdtemp()
+        cls.nodes = [cls.start_node(f'node{i}') for i in range(3)]
+        cls.urls = [url for url, _ in cls.nodes]
+
+    @classmethod
+    def tearDownClass(cls):
+        for _, process in cls.nodes:
+            cls.stop_node(process)
+        shutil.rmtree(cls.temp_dir, ignore_errors=True)
+        super().tearDownClass()
+
+    @classmethod
+    def start_node(cls, name):
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        env = {**os.environ, 'CLUSTER_SECRET': cls.SECRET, 'SANDBOX_ENABLED': 'False',
+               'CLUSTER_DRAIN_FILE': os.path.join(cls.temp_dir, f'{name}-draining')}
+        process = subprocess.Popen([sys.executable, 'manage.py', 'runserver', f'127.0.0.1:{port}', '--noreload'],
+                                   cwd=settings.BASE_DIR, env=env,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        url = f'http://127.0.0.1:{port}/editor/runner/'
+        health = cluster.Cluster([url], cls.SECRET)
+        deadline = time.monotonic() + 60
+        while True:
+            health.check(health.nodes[0])
+            if health.nodes[0].healthy:
+                return url, process
+            if process.poll() is not None or time.monotonic() > deadline:
+                cls.stop_node(process)
+                raise RuntimeError(f'Runner node {name} did not start')
+            time.sleep(0.2)
+
+    @staticmethod
+    def stop_node(process):
+        process.terminate()
+        process.wait(timeout=10)
+
+    def run_job(self, dispatcher, code, key=None):
+        return dispatcher.dispatch('run', 'user:1', {'code': code, 'language': 'python', 'stdin': ''}, key=key)
+
+    def test_jobs_run_on_the_nodes(self):
+        dispatcher = cluster.Cluster(self.urls, self.SECRET, routing='least_loaded')
+        for i in range(6):
+            data, status = self.run_job(dispatcher, f'print({i} * 2)')
+            self.assertEqual(status, 200)
+            self.assertEqual(data['output'].strip(), str(i * 2))
+
+    def test_undelivered_jobs_go_to_another_node(self):
+        url, process = self.start_node('stopped')
+        self.stop_node(process)
+        dispatcher = cluster.Cluster([url, *self.urls], self.SECRET)
+        # A job whose home on the ring is the stopped node
+        code = next(code for code in (f'print({i})' for i in range(1000))
+                    if dispatcher._ring_order(cluster.routing_key('python', code))[0].url == url)
+        data, status = self.run_job(dispatcher, code, key=cluster.routing_key('python', code))
+        self.assertEqual(status, 200)
+        self.assertFalse(dispatcher.nodes[0].healthy)
+
+    def test_unanswered_jobs_are_not_sent_again(self):
+        marker = os.path.join(self.temp_dir, 'runs')
+        code = f'open({marker!r}, "a").write("run\\n")\nimport time\ntime.sleep(3)\n'
+        dispatcher = cluster.Cluster(self.urls, self.SECRET, routing='least_loaded', request_timeout=1)
+        with self.assertRaises(cluster.JobLost) as raised:
+            self.run_job(dispatcher, code)
+        self.assertEqual(raised.exception.status, 504)
+        self.assertTrue(all(node.healthy for node in dispatcher.nodes))
+        time.sleep(3)
+        with open(marker) as f:
+            self.assertEqual(f.read(), 'run\n')
+
+
+class DatabaseStorageTests(TestCase):
+    def test_cache_sees_writes_from_other_servers(self):
+        backend = storage.DatabaseStorage()
+        backend.create_project('p')
+        first = storage.CachedStorage(backend, max_bytes=1024 * 1024)
+        second = storage.CachedStorage(backend, max_bytes=1024 * 1024)
+        first.write('p', 'a.txt', b'old')
+        self.assertEqual(second.read('p', 'a.txt'), b'old')
+        first.write('p', 'a.txt', b'new')
+        self.assertEqual(second.read('p', 'a.txt'), b'new')
+        # Another file moved onto the path is a new version too
+        first.write('p', 'b.txt', b'moved')
+        first.delete('p', 'a.txt')
+        first.rename('p', 'b.txt', 'a.txt')
+        self.assertEqual(second.read('p', 'a.txt'), b'moved')
+
+
+@unittest.skipIf(shutil.which('gcc') is None, 'needs gcc')
+class DiagnosticsTests(TestCase):
+    def setUp(self):
+        self.previous_storage = storage._storage
+        storage._storage = storage.CachedStorage(storage.DatabaseStorage(), max_bytes=0)
+        storage._storage.create_project('p')
+        self.client = Client(HTTP_HOST='localhost')
+
+    def tearDown(self):
+        storage._storage = self.previous_storage
+
+    def check(self, data):
+        return self.client.post('/editor/diagnostics/', json.dumps(data), content_type='application/json')
+
+    def test_local_includes_come_from_stored_headers(self):
+        storage._storage.write_many('p', {'include/util.h': b'int twice(int x);\n',
+                                          'src/main.c': b'#include "../include/util.h"\nint main(void) { return twice(1); }\n'})
+        response = self.check({'project_id': 'p', 'path': 'src/main.c'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['diagnostics'], [])
+        response = self.check({'project_id': 'p', 'path': 'src/other.c', 'content': '#include "missing.h"\n'})
+        self.assertEqual(response.json()['diagnostics'][0]['severity'], 'error')
+
+    def test_language_must_be_a_string(self):
+        self.assertEqual(self.check({'content': 'x', 'language': ['c']}).status_code, 400)
+
+
+class FileOperationTests(TestCase):
+    FILES = {'a.txt': b'a', 'b.txt': b'b', 'src/main.py': b'main'}
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def backends(self):
+        for backend in [storage.LocalStorage(self.root), storage.DatabaseStorage()]:
+            backend.create_project('p')
+            backend.write_many('p', self.FILES)
+            yield storage.CachedStorage(backend, max_bytes=1024 * 1024)
+
+    def test_all_or_nothing(self):
+        operations = [
+            {'op': 'write', 'path': 'a.txt', 'content': 'changed'},
+            {'op': 'create', 'path': 'lib/deep/new.py', 'content': 'new'},
+            {'op': 'move', 'from': 'b.txt', 'to': 'src/b.txt'},
+            {'op': 'delete', 'path': 'src', 'recursive': True},
+            {'op': 'delete', 'path': 'missing.txt'},
+        ]
+        for backend in self.backends():
+            with self.subTest(backend=backend.name):
+                before = backend.walk('p')
+                with self.assertRaises(fileops.OperationError) as raised:
+                    fileops.apply_operations(backend, 'p', operations)
+                self.assertEqual((raised.exception.index, raised.exception.status), (4, 404))
+                # Folders created on the way to new.py are gone too
+                self.assertEqual(backend.walk('p'), before)
+                self.assertEqual({path: backend.read('p', path) for path in self.FILES}, self.FILES)
+
+    def test_database_backend_rolls_back_without_undo(self):
+        backend = next(backend for backend in self.backends() if backend.name == 'database')
+        operations = [{'op': 'delete', 'path': 'a.txt'}, {'op': 'create', 'path': 'b.txt'}]
+        with unittest.mock.patch.object(fileops._Batch, 'rollback'), self.assertRaises(fileops.OperationError):
+            fileops.apply_operations(backend, 'p', operations)
+        self.assertEqual(backend.read('p', 'a.txt'), b'a')
+
+    def test_moves_into_themselves_are_refused(self):
+        backend = next(self.backends())
+        for target in ['src', 'src/inner', 'src/./inner/deeper']:
+            with self.assertRaisesRegex(fileops.OperationError, 'into itself'):
+                fileops.apply_operations(backend, 'p', [{'op': 'move', 'from': 'src', 'to': target}])
+        self.assertEqual(backend.walk('p'), [('a.txt', False), ('b.txt', False), ('src', True),
+                                             ('src/main.py', False)])
+
+
+class HistoryGarbageTests(TestCase):
+    def setUp(self):
+        self.store = snapshots.get_blob_store()
+
+    def age(self, days):
+        # Everything stored so far is older than the collection grace period
+        past = timezone.now() - datetime.timedelta(days=days)
+        Blob.objects.update(stored_at=past)
+        FileVersion.objects.update(created_at=past)
+        ProjectSnapshot.objects.update(created_at=past)
+
+    def version(self, path, content):
+        return FileVersion.objects.create(project_name='p', path=path, event='modified',
+                                          blob=self.store.put(content), size=len(content))
+
+    def test_blobs_live_in_the_database(self):
+        digest = self.store.put(b'shared')
+        self.assertEqual(self.store.put(b'shared'), digest)
+        self.assertEqual(Blob.objects.count(), 1)
+        self.assertEqual(snapshots.BlobStore().get(digest), b'shared')
+        with self.assertRaises(FileNotFoundError):
+            self.store.get('0' * 64)
+
+    def test_unreferenced_blobs_are_collected(self):
+        self.version('a.txt', b'kept by a version')
+        manifest = self.store.put(json.dumps({'b.txt': self.store.put(b'kept by a snapshot')}).encode('utf-8'))
+        ProjectSnapshot.objects.create(project_name='p', manifest=manifest)
+        orphan = self.store.put(b'orphan')
+        recent = self.store.put(b'stored again')
+        self.age(1)
+        self.store.put(b'stored again')
+        self.assertEqual(snapshots.collect_garbage()['blobs'], 1)
+        self.assertFalse(self.store.exists(orphan))
+        self.assertTrue(self.store.exists(recent))
+        self.assertEqual(Blob.objects.count(), 4)
+
+    def test_old_history_is_forgotten(self):
+        self.version('a.txt', b'one')
+        self.version('a.txt', b'two')
+        untouched = self.version('b.txt', b'untouched')
+        ProjectSnapshot.objects.create(project_name='p', manifest=self.store.put(b'{}'))
+        self.age(40)
+        latest = self.version('a.txt', b'three')
+        removed = snapshots.collect_garbage(keep_days=30)
+        self.assertEqual(removed, {'versions': 2, 'snapshots': 1, 'blobs': 3})
+        # A file's latest version stays however old it is
+        self.assertEqual(list(FileVersion.objects.all()), [latest, untouched])
+        self.assertTrue(self.store.exists(untouched.blob))
+
+class JudgeTests(TestCase):
+    ECHO = 'import sys\nprint(sys.stdin.read().upper())\n'
+
+    def judge(self, code, cases, **kwargs):
+        return judge.judge_submission(code, 'python', cases, **{'time_limit': 2, **kwargs})
+
+    def test_case_verdicts(self):
+        cases = [{'stdin': 'a', 'expected_output': 'A'}, {'stdin': 'b', 'expected_output': 'c'}]
+        self.assertEqual([case['verdict'] for case in self.judge(self.ECHO, cases)['cases']], ['AC', 'WA'])
+        self.assertEqual(self.judge('raise SystemExit(3)', cases)['verdict'], 'RE')
+        self.assertEqual(self.judge('while True: pass', cases[:1], time_limit=0.5)['verdict'], 'TLE')
+        result = self.judge('x = bytearray(512 * 1024 * 1024)', cases[:1], memory_limit_mb=64)
+        self.assertEqual(result['verdict'], 'MLE')
+
+    def test_overall_verdict_is_the_worst(self):
+        code = ('import sys, time\nn = int(sys.stdin.read())\n'
+                'if n == 1: raise ValueError\nif n == 2: time.sleep(5)\nprint(n)\n')
+        cases = [{'stdin': str(n), 'expected_output': '0'} for n in (0, 3, 2, 1)]
+        result = self.judge(code, cases)
+        self.assertEqual([case['verdict'] for case in result['cases']], ['AC', 'WA', 'TLE', 'RE'])
+        self.assertEqual(result['verdict'], 'RE')
+        self.assertEqual(self.judge(code, cases[:3])['verdict'], 'TLE')
+        self.assertEqual(result['passed'], 1)
+
+    @unittest.skipIf(shutil.which('gcc') is None, 'needs gcc')
+    def test_compile_error(self):
+        result = judge.judge_submission('int main( {', 'c', [{'stdin': ''}])
+        self.assertEqual(result['verdict'], 'CE')
+        self.assertEqual(result['cases'], [])
+
+    def test_limits_are_validated(self):
+        client = Client()
+        body = {'code': 'print(1)', 'cases': [{'stdin': '', 'expected_output': '1'}]}
+        post = lambda **data: client.post('/editor/run/batch/', json.dumps({**body, **data}),
+                                          content_type='application/json')
+        for limits in ({'time_limit': 0}, {'time_limit': 'nan'}, {'time_limit': 'soon'},
+                       {'memory_limit': settings.JUDGE_MIN_MEMORY_MB - 1}, {'cases': [{'stdin': 1}]},
+                       {'cases': [{}] * (settings.JUDGE_MAX_CASES + 1)}, {'optimization': 'O9'}):
+            self.assertEqual(post(**limits).status_code, 400, limits)
+        response = post(time_limit=10 ** 6, memory_limit=10 ** 6)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['verdict'], 'AC')
+
+    @unittest.skipIf(shutil.which('gcc') is None, 'needs gcc')
+    def test_runs_reuse_builds(self):
+        cache.clear()
+        # A fresh program, so the first build can't be in the cache yet
+        code = f'#include <stdio.h>\n/* {os.urandom(8).hex()} */\nint main(void) {{ puts("hi"); return 0; }}\n'
+        run = lambda: Client().post('/editor/run/', json.dumps({'code': code, 'language': 'c'}),
+                                    content_type='application/json').json()
+        self.assertEqual(run(), {'output': 'hi\n', 'build_cached': False})
+        self.assertEqual(run(), {'output': 'hi\n', 'build_cached': True})
+
+
+class LanguageServerWorkspaceTests(TransactionTestCase):
+    def setUp(self):
+        self.previous_storage = storage._storage
+        storage._storage = storage.CachedStorage(storage.DatabaseStorage(), max_bytes=0)
+        storage._storage.create_project('p')
+
+    def tearDown(self):
+        storage._storage = self.previous_storage
+
+    def flush(self):
+        lsp._sync_pool.submit(lambda: None).result()
+
+    def settle(self, workspace):
+        """Wait until queued updates, and any resync after a failed one, are done."""
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            self.flush()
+            with workspace.lock:
+                if not workspace.stale and workspace.retry is None:
+                    return
+            time.sleep(0.01)
+        self.fail('The workspace did not catch up')
+
+    def test_workspace_follows_saved_files(self):
+        storage._storage.write_many('p', {'main.py': b'import util\n', 'util.py': b'x = 1\n'})
+        workspace = asyncio.run(lsp.open_workspace('p'))
+        self.assertTrue(workspace.root.startswith(tempfile.gettempdir()))
+        with open(os.path.join(workspace.root, 'util.py'), 'rb') as f:
+            self.assertEqual(f.read(), b'x = 1\n')
+        storage._storage.write('p', 'util.py', b'x = 2\n')
+        views.notify_file_changed('p', 'util.py', 'modified')
+        storage._storage.rename('p', 'main.py', 'app/main.py')
+        views.notify_file_changed('p', 'app/main.py', 'renamed', old_path='main.py')
+        self.settle(workspace)
+        with open(os.path.join(workspace.root, 'util.py'), 'rb') as f:
+            self.assertEqual(f.read(), b'x = 2\n')
+        self.assertTrue(os.path.exists(os.path.join(workspace.root, 'app', 'main.py')))
+        self.assertFalse(os.path.exists(os.path.join(workspace.root, 'main.py')))
+        lsp.close_workspace(workspace)
+        self.flush()
+        self.assertFalse(os.path.exists(workspace.root))
+
+    def test_failed_update_resyncs(self):
+        storage._storage.write_many('p', {'a.py': b'a = 1\n'})
+        workspace = asyncio.run(lsp.open_workspace('p'))
+        read_many = storage._storage.read_many
+        failures = []
+
+        def flaky_read_many(*args, **kwargs):
+            if not failures:
+                failures.append(1)
+                raise RuntimeError('database table is locked')
+            return read_many(*args, **kwargs)
+
+        storage._storage.write_many('p', {'a.py': b'a = 2\n', 'b.py': b'b = 1\n'})
+        with unittest.mock.patch.object(storage._storage, 'read_many', flaky_read_many), \
+                unittest.mock.patch.object(lsp.Workspace, 'RESYNC_DELAYS', (0,)):
+            views.notify_file_changed('p', 'a.py', 'modified')
+            views.notify_file_changed('p', 'b.py', 'created')
+            self.settle(workspace)
+        self.assertEqual(failures, [1])
+        for name, content in [('a.py', b'a = 2\n'), ('b.py', b'b = 1\n')]:
+            with open(os.path.join(workspace.root, name), 'rb') as f:
+                self.assertEqual(f.read(), content)
+        lsp.close_workspace(workspace)
+        self.flush()
+
+    def test_connections_belong_to_the_browser_session(self):
+        session = SessionStore()
+        session['owner'] = 'abc'
+        session.save()
+        self.assertEqual(lsp._session_owner(session.session_key), 'session:abc')
+        self.assertIsNone(lsp._session_owner('unknown'))
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.registry = metrics.Registry()
+        self.runs = self.registry.register(metrics.Counter('runs_total', 'Runs.', ['language']))
+        self.busy = self.registry.register(metrics.Gauge('busy', 'Busy workers.'))
+        self.registry.directory = self.directory
+        self.registry.path = os.path.join(self.directory, f'{os.getpid()}-test.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def other_process(self, pid, runs, busy):
+        with open(os.path.join(self.directory, f'{pid}-other.json'), 'w') as f:
+            json.dump({'runs_total': [[['python'], runs]], 'busy': [[[], busy]]}, f)
+
+    def test_processes_are_added_up(self):
+        self.runs.inc(language='python')
+        self.busy.set(1)
+        # The test runner's parent process is alive; a pid past pid_max never is
+        self.other_process(os.getppid(), 2, 1)
+        self.other_process(2 ** 22 + 1, 4, 1)
+        rendered = self.registry.render()
+        self.assertIn('runs_total{language="python"} 7\n', rendered)
+        # An exited process's gauge is gone, its counter kept
+        self.assertIn('busy 2\n', rendered)
+        self.assertIn('exited.json', os.listdir(self.directory))
+        self.assertIn('runs_total{language="python"} 7\n', self.registry.render())
+
+    def test_unknown_methods_share_a_label(self):
+        Client().generic('BREW', '/metrics')
+        rendered = metrics.REGISTRY.render()
+        self.assertIn('method="other"', rendered)
+        self.assertNotIn('method="BREW"', rendered)
+
+class SchedulerTests(TestCase):
+    """Separate schedulers on one directory stand in for server processes."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        cache.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def scheduler(self, max_concurrent=1, rate=100.0, burst=100, latency_slo=30.0):
+        return scheduler.ExecutionScheduler(max_concurrent, rate, burst, latency_slo, self.directory)
+
+    def wait_queued(self, count):
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            with self.scheduler().state.locked() as state:
+                if len(state['queue']) >= count:
+                    return
+            time.sleep(0.01)
+        self.fail('runs were not queued')
+
+    def test_rate_limit_is_shared(self):
+        first, second = [self.scheduler(max_concurrent=4, rate=1.0, burst=2) for _ in range(2)]
+        with first.admit('u'), second.admit('u'):
+            with self.assertRaises(scheduler.AdmissionRejected) as raised:
+                first.admit('u').acquire()
+        self.assertEqual(raised.exception.retry_after, 1)
+        with first.admit('other'), first.admit('u', rate_limited=False):
+            pass
+
+    def test_slots_are_shared(self):
+        first, second = self.scheduler(max_concurrent=2), self.scheduler(max_concurrent=2)
+        with first.admit('a', slots=2) as admission:
+            self.assertEqual(admission.slots, 2)
+            self.assertEqual(second.stats(), {'running': 2, 'queued': 0, 'capacity': 2})
+        self.assertEqual(second.stats()['running'], 0)
+
+    def test_fair_queue_order(self):
+        holder, waiting = self.scheduler(), self.scheduler()
+        order = []
+
+        def run(user):
+            with waiting.admit(user):
+                order.append(user)
+
+        admission = holder.admit('holder')
+        admission.acquire()
+        threads = []
+        for count, user in enumerate(['heavy', 'heavy', 'heavy', 'light'], 1):
+            threads.append(threading.Thread(target=run, args=(user,)))
+            threads[-1].start()
+            self.wait_queued(count)
+        admission.release()
+        for thread in threads:
+            thread.join()
+        # The light user's run goes ahead of the heavy user's later ones
+        self.assertEqual(order, ['heavy', 'light', 'heavy', 'heavy'])
+
+    def test_busy_server_answers_429(self):
+        busy = self.scheduler(latency_slo=0.5)
+        with busy.admit('holder'), unittest.mock.patch.object(scheduler, '_scheduler', busy):
+            response = Client().post('/editor/run/', json.dumps({'code': 'print(1)', 'language': 'python'}),
+                                     content_type='application/json')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '1')
+
+    def test_abandoned_run_keeps_the_users_place(self):
+        timing_out = self.scheduler(latency_slo=0.6)
+        with timing_out.state.locked() as state:
+            state['average_duration'] = 0.1
+        with timing_out.admit('holder'):
+            with self.assertRaises(scheduler.AdmissionRejected):
+                timing_out.admit('u').acquire()
+            with timing_out.state.locked() as state:
+                self.assertEqual(state['queue'], [])
+                self.assertNotIn('u', state['last_finish'])
+
+@unittest.skipIf(mock_aws is None, 'needs boto3 and moto')
+class S3StorageTests(TestCase):
+    """The s3 backend against moto's in-process S3 stand-in."""
+
+    def setUp(self):
+        self.mock = mock_aws()
+        self.mock.start()
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket='projects')
+        self.backend = storage.S3Storage('projects', prefix='projects/', client=client)
+        self.settings_override = override_settings(STORAGE_BACKEND='s3', SEARCH_BUILD_WAIT=10)
+        self.settings_override.enable()
+        self.previous_storage = storage._storage
+        storage._storage = storage.CachedStorage(self.backend, max_bytes=1024 * 1024)
+        self.client = Client(HTTP_HOST='localhost')
+        # Indexes outlive a test; the next one reuses the project names
+        search._indexes.clear()
+        quickopen._indexes.clear()
+
+    def tearDown(self):
+        storage._storage = self.previous_storage
+        self.settings_override.disable()
+        self.mock.stop()
+
+    def post(self, url, data):
+        return self.client.post(url, json.dumps(data), content_type='application/json')
+
+    def make_project(self, name, files):
+        self.assertEqual(self.post('/editor/projects/create/', {'name': name}).status_code, 200)
+        for path, content in files.items():
+            response = self.post(f'/editor/files/{name}/{path}/save/', {'content': content})
+            self.assertEqual(response.status_code, 200, response.content)
+
+    def test_backend_round_trip(self):
+        self.backend.create_project('p')
+        self.backend.write_many('p', {'a.txt': b'one', 'src/b.py': b'two'})
+        self.assertEqual(self.backend.read('p', 'src/b.py'), b'two')
+        self.assertEqual(self.backend.kind('p', 'src'), 'folder')
+        self.assertEqual(sorted(self.backend.versions('p')), ['a.txt', 'src/b.py'])
+        self.assertEqual(self.backend.versions('p', ignored_dirs={'src'}).keys(), {'a.txt'})
+        self.assertEqual(self.backend.versions('p', ['a.txt', 'missing']).keys(), {'a.txt'})
+        self.backend.rename('p', 'src', 'lib')
+        self.assertEqual(self.backend.read_many('p', ['lib/b.py'])['lib/b.py'], b'two')
+        self.assertIsInstance(self.backend.read_many('p', ['src/b.py'])['src/b.py'], FileNotFoundError)
+        with self.assertRaises(IsADirectoryError):
+            self.backend.read('p', 'lib')
+
+    def test_cache_sees_writes_from_other_servers(self):
+        self.backend.create_project('p')
+        first = storage.CachedStorage(self.backend, max_bytes=1024 * 1024)
+        second = storage.CachedStorage(self.backend, max_bytes=1024 * 1024)
+        first.write('p', 'a.txt', b'old')
+        self.assertEqual(second.read('p', 'a.txt'), b'old')
+        first.write('p', 'a.txt', b'new')
+        self.assertEqual(second.read('p', 'a.txt'), b'new')
+        first.delete('p', 'a.txt')
+        with self.assertRaises(FileNotFoundError):
+            second.read('p', 'a.txt')
+
+    def test_cache_drops_a_file_that_grew_too_large(self):
+        self.backend.create_project('p')
+        cached = storage.CachedStorage(self.backend, max_bytes=800)
+        self.backend.write('p', 'a.txt', b'small')
+        cached.read('p', 'a.txt')
+        self.backend.write('p', 'a.txt', b'x' * 200)
+        self.assertEqual(cached.read('p', 'a.txt'), b'x' * 200)
+        self.assertEqual(cached.cache, {})
+        self.assertEqual(cached.cached_bytes, 0)
+
+    def test_search_and_quick_open(self):
+        self.make_project('p', {'main.py': 'def greet():\n    return "hello"\n', 'docs/readme.md': 'Hello there'})
+        results = self.client.get('/editor/projects/p/search/', {'q': 'hello'}).json()
+        self.assertTrue(results['indexed'])
+        self.assertEqual(sorted(f['path'] for f in results['files']), ['docs/readme.md', 'main.py'])
+        self.post('/editor/files/p/main.py/save/', {'content': 'print("bye")\n'})
+        results = self.client.get('/editor/projects/p/search/', {'q': 'hello'}).json()
+        self.assertEqual([f['path'] for f in results['files']], ['docs/readme.md'])
+        files = self.client.get('/editor/projects/p/quick-open/', {'q': 'rdme'}).json()['files']
+        self.assertEqual(files[0]['path'], 'docs/readme.md')
+
+    def test_export_and_import(self):
+        self.make_project('p', {'main.py': 'print(1)\n', 'lib/util.py': 'X = 2\n'})
+        response = self.client.get('/editor/projects/p/export/')
+        self.assertEqual(response.status_code, 200)
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+        self.assertEqual(archive.read('lib/util.py'), b'X = 2\n')
+
+        upload = io.BytesIO()
+        with zipfile.ZipFile(upload, 'w') as new_archive:
+            new_archive.writestr('only.txt', 'replaced')
+        upload.seek(0)
+        upload.name = 'p.zip'
+        response = self.client.post('/editor/projects/p/import/', {'archive': upload, 'replace': '1'})
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(sorted(self.backend.versions('p')), ['only.txt'])
+        self.assertEqual(self.backend.read('p', 'only.txt'), b'replaced')
+
+    def test_history_and_snapshots(self):
+        self.make_project('p', {'a.txt': 'first'})
+        self.post('/editor/files/p/a.txt/save/', {'content': 'second'})
+        versions = self.client.get('/editor/projects/p/history/', {'path': 'a.txt'}).json()['versions']
+        self.assertEqual(len(versions), 2)
+        response = self.post(f'/editor/projects/p/history/{versions[-1]["id"]}/restore/', {})
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(self.backend.read('p', 'a.txt'), b'first')
+
+        snapshot = self.post('/editor/projects/p/snapshots/', {'label': 'before'}).json()
+        self.post('/editor/files/p/b.txt/save/', {'content': 'later'})
+        response = self.post(f'/editor/projects/p/snapshots/{snapshot["id"]}/restore/', {})
+        self.assertEqual(response.json()['removed'], 1)
+        self.assertEqual(sorted(self.backend.versions('p')), ['a.txt'])
+
+
+class SQLiteBackendTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'db.sqlite3')
+        self.wrapper = sqlite_backend.DatabaseWrapper({**connection.settings_dict, 'NAME': self.path}, 'probe')
+
+    def tearDown(self):
+        self.wrapper.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def pragma(self, name):
+        with self.wrapper.cursor() as cursor:
+            cursor.execute(f'PRAGMA {name}')
+            return cursor.fetchone()[0]
+
+    def test_pragmas(self):
+        self.assertEqual(self.pragma('journal_mode'), 'wal')
+        self.assertEqual(self.pragma('synchronous'), 1)  # NORMAL
+        self.assertEqual(self.pragma('temp_store'), 2)  # MEMORY
+        self.assertEqual(self.pragma('cache_size'), -20000)
+
+    def test_transactions_take_the_write_lock_at_once(self):
+        with self.wrapper.cursor() as cursor:
+            cursor.execute('CREATE TABLE t (x INTEGER)')
+        self.wrapper.set_autocommit(False)
+        try:
+            self.wrapper._start_transaction_under_autocommit()
+            other = sqlite3.connect(self.path, timeout=0)
+            # A deferred BEGIN would take no lock until the transaction writes
+            with self.assertRaisesRegex(sqlite3.OperationalError, 'locked'):
+                other.execute('INSERT INTO t VALUES (1)')
+            other.close()
+        finally:
+            self.wrapper.rollback()
+            self.wrapper.set_autocommit(True)
+
+
+def user_namespaces_work():
+    probe = 'from codeeditor import sandbox; sandbox._unshare(sandbox.CLONE_NEWUSER)'
+    return sys.platform == 'linux' and subprocess.run([sys.executable, '-c', probe], cwd=settings.BASE_DIR,
+                                                      capture_output=True).returncode == 0
+
+
+@unittest.skipUnless(shutil.which('ldd') and user_namespaces_work(), 'needs unprivileged user namespaces')
+class SandboxTests(TestCase):
+    """Runs in a rootfs holding just sh and cat, with the libraries they link."""
+
+    def setUp(self):
+        self.rootfs_dir = tempfile.mkdtemp()
+        root = os.path.join(self.rootfs_dir, 'shell')
+        for directory in ('tmp', 'proc'):
+            os.makedirs(os.path.join(root, directory))
+        for program in ('sh', 'cat'):
+            binary = shutil.which(program)
+            linked = re.findall(r'(/\S+) \(0x', subprocess.run(['ldd', binary], capture_output=True, text=True).stdout)
+            for path in [binary, *linked]:
+                os.makedirs(os.path.dirname(root + path), exist_ok=True)
+                shutil.copy(path, root + path)
+        self.settings_override = override_settings(SANDBOX_ENABLED=True, SANDBOX_ROOTFS_DIR=self.rootfs_dir,
+                                                   SANDBOX_PROCESS_LIMIT=16)
+        self.settings_override.enable()
+        sandbox._zygote = None
+
+    def tearDown(self):
+        if sandbox._zygote is not None:
+            sandbox._zygote.close()
+            sandbox._zygote = None
+        self.settings_override.disable()
+        shutil.rmtree(self.rootfs_dir, ignore_errors=True)
+
+    def sh(self, script):
+        return sandbox.run(['sh', '-c', script], timeout=10, language='shell')
+
+    def test_isolation(self):
+        result = self.sh(f'echo $$; echo x > /probe; test -e {settings.BASE_DIR}/manage.py && echo host; '
+                         'cat /proc/net/dev; echo scratch > /tmp/file && cat /tmp/file')
+        lines = result.stdout.splitlines()
+        # PID 1, nothing of the host's filesystem, a read-only root, a writable /tmp
+        self.assertEqual(lines[0], '1')
+        self.assertNotIn('host', lines)
+        self.assertIn('Read-only file system', result.stderr)
+        self.assertEqual(lines[-1], 'scratch')
+        # Only a loopback interface, which is down
+        self.assertEqual([line.split(':')[0].strip() for line in lines if ':' in line], ['lo'])
+
+    def test_no_rootfs_means_no_run(self):
+        with self.assertRaises(sandbox.SandboxError):
+            sandbox.run(['sh', '-c', 'true'], timeout=10, language='python')
+
+    @unittest.skipIf(os.getuid() == 0, 'root is exempt from RLIMIT_NPROC')
+    def test_process_limit(self):
+        # A pipeline of busy subshells; the shell exits once a fork fails, and every process in the sandbox with it
+        result = self.sh(' | '.join(['(while :; do :; done)'] * 40) + '; echo started')
+        self.assertNotIn('started', result.stdout)
+        self.assertIn('fork', result.stderr)
@@ -0,0 +1,212 @@
+"""
+Lightweight request tracing.
+
+TracingMiddleware opens a trace per request; views, the JSON middleware
+and the executor add nested spans with ``with tracing.span('compile'):``.
+Outside a trace, span() does nothing, so library code can call it freely.
+
+Finished traces are summed into a Server-Timing header (one entry per
+span name) and, if sampled, exported in Zipkin v2 JSON format to
+TRACING_EXPORT_FILE (one JSON list per line) and/or POSTed to
+TRACING_COLLECTOR_URL (e.g. http://zipkin:9411/api/v2/spans) from a
+background thread, so exporting never delays the response.
+"""
+import contextvars
+import functools
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_current_span = contextvars.ContextVar('codeeditor_current_span', default=None)
+
+TRACEPARENT_RE = re.compile(r'^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+
+
+def _new_id(bits):
+    return f'{random.getrandbits(bits):0{bits // 4}x}'
+
+
+class Trace:
+    def __init__(self, trace_id=None, parent_id=None, sampled=True):
+        self.trace_id = trace_id or _new_id(128)
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.spans = []
+
+    def server_timing(self):
+        """Total duration per span name, in the order the names first appear."""
+        totals = {}
+        for span in sorted(self.spans, key=lambda span: span.start):
+            totals[span.name] = totals.get(span.name, 0.0) + span.duration
+        return ', '.join(f'{name};dur={duration * 1000:.1f}' for name, duration in totals.items())
+
+    def to_zipkin(self):
+        return [span.to_zipkin() for span in self.spans]
+
+
+class Span:
+    __slots__ = ('trace', 'name', 'span_id', 'parent_id', 'attributes',
+                 'timestamp', 'start', 'duration')
+
+    def __init__(self, trace, name, parent_id, attributes):
+        self.trace = trace
+        self.name = name
+        self.span_id = _new_id(64)
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.timestamp = time.time()
+        self.start = time.perf_counter()
+        self.duration = 0.0
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_zipkin(self):
+        span = {
+            'traceId': self.trace.trace_id,
+            'id': self.span_id,
+            'name': self.name,
+            'timestamp': int(self.timestamp * 1e6),
+            'duration': max(1, int(self.duration * 1e6)),
+            'localEndpoint': {'serviceName': 'online_code_editor'},
+            'tags': {key: str(value) for key, value in self.attributes.items()},
+        }
+        if self.parent_id:
+            span['parentId'] = self.parent_id
+        return span
+
+
+@contextmanager
+def _open_span(trace, name, parent_id, attributes):
+    span = Span(trace, name, parent_id, attributes)
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.attributes['error'] = type(e).__name__
+        raise
+    finally:
+        span.duration = time.perf_counter() - span.start
+        _current_span.reset(token)
+        trace.spans.append(span)
+
+
+def span(name, **attributes):
+    """Time a block as a child of the current span; a no-op outside a trace."""
+    parent = _current_span.get()
+    if parent is None:
+        return _noop_span()
+    return _open_span(parent.trace, name, parent.span_id, attributes)
+
+
+@contextmanager
+def _noop_span():
+    yield None
+
+
+def current_trace():
+    span = _current_span.get()
+    return span.trace if span else None
+
+
+def traceparent():
+    """W3C traceparent header continuing the current span in another service, or None."""
+    span = _current_span.get()
+    if span is None:
+        return None
+    return f"00-{span.trace.trace_id}-{span.span_id}-{'01' if span.trace.sampled else '00'}"
+
+
+@contextmanager
+def start_trace(name, traceparent=None, **attributes):
+    """
+    Open a trace with a root span. A W3C traceparent header continues the
+    caller's trace and keeps its sampling decision.
+    """
+    match = TRACEPARENT_RE.match(traceparent or '')
+    if match:
+        trace = Trace(match.group(1), match.group(2), sampled=match.group(3) == '01')
+    else:
+        trace = Trace(sampled=random.random() < settings.TRACING_SAMPLE_RATE)
+    with _open_span(trace, name, trace.parent_id, attributes) as root:
+        yield root
+    if trace.sampled:
+        _exporter().submit(trace)
+
+
+def traced(view):
+    """Wrap a view in a 'view' span tagged with its name."""
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        with span('view', view=view.__name__):
+            return view(request, *args, **kwargs)
+    return wrapper
+
+
+class Exporter:
+    """Writes finished traces from a daemon thread; drops them if it falls behind."""
+
+    def __init__(self, path, url, max_queue=1000):
+        self.path = path
+        self.url = url
+        self.queue = queue.Queue(max_queue)
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, trace):
+        if not (self.path or self.url):
+            return
+        try:
+            self.queue.put_nowait(trace)
+        except queue.Full:
+            return
+        with self.lock:
+            # Started lazily so forked server workers each get their own thread
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < 100:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            spans = [span for trace in batch for span in trace.to_zipkin()]
+            try:
+                self._export(spans)
+            except Exception as e:
+                logger.error(f"Error exporting traces: {str(e)}")
+
+    def _export(self, spans):
+        if self.path:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(spans) + '\n')
+        if self.url:
+            request = urllib.request.Request(self.url, data=json.dumps(spans).encode('utf-8'),
+                                             headers={'Content-Type': 'application/json'})
+            urllib.request.urlopen(request, timeout=5).close()
+
+
+_exporter_instance = None
+
+
+def _exporter():
+    global _exporter_instance
+    if _exporter_instance is None:
+        _exporter_instance = Exporter(settings.TRACING_EXPORT_FILE, settings.TRACING_COLLECTOR_URL)
+    return _exporter_instance
@@ -7,11 +7,30 @@ urlpatterns = [
     path('projects/', views.list_projects, name='list_projects'),
     path('projects/<str:project_id>/files/', views.list_project_files, name='list_project_files'),
     path('projects/<str:project_id>/files/create/', views.create_file, name='create_file'),
+    path('projects/<str:project_id>/files/batch/', views.bulk_file_operations, name='bulk_file_operations'),
+    path('projects/<str:project_id>/files/open/', views.open_files, name='open_files'),
+    path('projects/<str:project_id>/search/', views.search_files, name='search_files'),
+    path('projects/<str:project_id>/quick-open/', views.quick_open, name='quick_open'),
+    path('projects/<str:project_id>/export/', views.export_project, name='export_project'),
+    path('projects/<str:project_id>/import/', views.import_project, name='import_project'),
     path('projects/<str:project_id>/delete/', views.delete_project, name='delete_project'),
-    path('files/<path:file_id>/', views.get_file_content, name='get_file_content'),
+    path('projects/<str:project_id>/history/', views.file_history, name='file_history'),
+    path('projects/<str:project_id>/history/<int:version_id>/', views.file_version, name='file_version'),
+    path('projects/<str:project_id>/history/<int:version_id>/restore/', views.restore_file_version, name='restore_file_version'),
+    path('projects/<str:project_id>/snapshots/', views.project_snapshots, name='project_snapshots'),
+    path('projects/<str:project_id>/snapshots/<int:snapshot_id>/restore/', views.restore_project_snapshot, name='restore_project_snapshot'),
     path('files/<path:file_id>/save/', views.save_file, name='save_file'),
     path('files/<path:file_id>/delete/', views.delete_file, name='delete_file'),
     path('files/<path:file_id>/rename/', views.rename_file, name='rename_file'),
+    # Must follow the action routes above, since <path:> also matches 'x/save'
+    path('files/<path:file_id>/', views.get_file_content, name='get_file_content'),
     path('run/', views.run_code, name='run_code'),
+    path('run/batch/', views.run_batch, name='run_batch'),
+    path('run/session/', views.run_session, name='run_session'),
+    path('run/sessions/', views.python_sessions, name='python_sessions'),
+    path('diagnostics/', views.diagnostics, name='diagnostics'),
+    path('runner/jobs/', views.runner_jobs, name='runner_jobs'),
+    path('runner/health/', views.runner_health, name='runner_health'),
+    path('runner/drain/', views.runner_drain, name='runner_drain'),
 ]
  
\ No newline at end of file
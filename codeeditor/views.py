@@ -5,9 +5,32 @@ from django.views.decorators.http import require_http_methods, require_GET
 from django.core.exceptions import PermissionDenied
 from django.http import Http404
 from django.middleware.csrf import get_token
-from .executor import execute_code
+from .executor import TOOLCHAINS, execute_code, prepare_program, run_process, work_directory
+from .sandbox import SandboxError
+from .judge import judge_submission
+from .kernels import KernelError, get_kernel_manager
+from .scheduler import AdmissionRejected, get_scheduler, user_weight
+from .quickopen import find_files
+from .search import search_project
+from .storage import clean_path, clean_project_id, get_storage
+from .archives import ArchiveError, FORMATS, import_archive, iter_archive
+from .fileops import OperationError, apply_operations
+from .cbuild import OPTIMIZATION_LEVELS
+from .cluster import ClusterUnavailable, JobLost, get_cluster, routing_key
+from . import cluster
+from .compress import compressed_json_response
+from .diagnostics import DiagnosticsError, check as check_source, language_for
+from .signals import file_changed, files_deleting
+from .models import FileVersion, ProjectSnapshot
+from . import listings, snapshots
+from . import metrics, tracing
+from django.conf import settings
+import hashlib
 import json
 import os
+import posixpath
+import re
+import secrets
 from datetime import datetime
 import shutil
 import tempfile
@@ -18,7 +41,7 @@ from django.views.decorators.csrf import ensure_csrf_cookie
 from django.views.decorators.csrf import csrf_protect
 from django.middleware.csrf import get_token
 from django.views.decorators.http import require_GET
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.core.serializers.json import DjangoJSONEncoder
 from urllib.parse import unquote
 
@@ -28,29 +51,33 @@ logger = logging.getLogger(__name__)
 # Create your views here.
 
 @ensure_csrf_cookie
+@tracing.traced
 def editor(request):
+    # Start the session now, so WebSocket connections (language servers) know whose they are
+    session_owner(request)
     return render(request, 'editor.html')
 
 @csrf_exempt
 @require_http_methods(["POST"])
+@tracing.traced
 def create_project(request):
     try:
-        data = json.loads(request.body)
+        data = load_json_body(request)
         project_name = data.get('name')
         
         if not project_name:
             return JsonResponse({'error': 'Project name is required'}, status=400)
+        try:
+            clean_project_id(project_name)
+        except ValueError:
+            return JsonResponse({'error': 'Invalid project name'}, status=400)
             
-        # Create projects directory if it doesn't exist
-        projects_dir = os.path.join(os.getcwd(), 'projects')
-        os.makedirs(projects_dir, exist_ok=True)
-            
-        # Create project directory
-        project_dir = os.path.join(projects_dir, project_name)
-        if os.path.exists(project_dir):
+        storage = get_storage()
+        if storage.project_exists(project_name):
             return JsonResponse({'error': 'Project already exists'}, status=400)
             
-        os.makedirs(project_dir, exist_ok=True)
+        storage.create_project(project_name)
+        listings.invalidate('projects')
         
         # Create project metadata
         project_data = {
@@ -64,68 +91,210 @@ def create_project(request):
         return JsonResponse({'error': str(e)}, status=500)
 
 @require_http_methods(["GET"])
+@tracing.traced
 def list_projects(request):
     try:
-        projects_dir = os.path.join(os.getcwd(), 'projects')
-        if not os.path.exists(projects_dir):
-            os.makedirs(projects_dir, exist_ok=True)
-            
-        projects = []
-        for project_name in os.listdir(projects_dir):
-            project_dir = os.path.join(projects_dir, project_name)
-            if os.path.isdir(project_dir):
-                # Get creation time
-                created_at = datetime.fromtimestamp(os.path.getctime(project_dir))
+        def load_projects():
+            projects = []
+            for project_name, created_at in get_storage().list_projects():
                 projects.append({
                     'id': project_name,
                     'name': project_name,
                     'created_at': created_at.isoformat()
                 })
+            return projects
                 
-        return JsonResponse({'projects': projects})
+        return JsonResponse({'projects': listings.project_list(load_projects)})
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
-def build_file_tree(base_path, rel_path=""):
-    abs_path = os.path.join(base_path, rel_path)
+def build_file_tree(entries):
+    """Nest storage walk() output, [(path, is_folder)] sorted by path, into the editor's tree"""
     items = []
-    for entry in sorted(os.listdir(abs_path)):
-        entry_path = os.path.join(abs_path, entry)
-        rel_entry_path = os.path.join(rel_path, entry) if rel_path else entry
-        if os.path.isdir(entry_path):
-            items.append({
-                "id": f"{rel_entry_path.replace(os.sep, '/')}",
-                "name": entry,
-                "is_folder": True,
-                "children": build_file_tree(base_path, rel_entry_path)
-            })
-        else:
-            items.append({
-                "id": f"{rel_entry_path.replace(os.sep, '/')}",
-                "name": entry,
-                "is_folder": False
-            })
+    folders = {'': items}
+    for path, is_folder in entries:
+        parent, _, name = path.rpartition('/')
+        siblings = folders.get(parent)
+        if siblings is None:
+            continue
+        item = {
+            "id": path,
+            "name": name,
+            "is_folder": is_folder
+        }
+        if is_folder:
+            item["children"] = folders[path] = []
+        siblings.append(item)
     return items
 
 @require_http_methods(["GET"])
+@tracing.traced
 def list_project_files(request, project_id):
     try:
-        base_dir = os.path.abspath(os.getcwd())
-        projects_dir = os.path.normpath(os.path.join(base_dir, 'projects'))
-        project_dir = os.path.normpath(os.path.join(projects_dir, project_id))
-        if not os.path.exists(project_dir):
+        storage = get_storage()
+
+        def load_tree():
+            # None (not cached) for a missing project
+            if not storage.project_exists(project_id):
+                return None
+            return build_file_tree(storage.walk(project_id))
+
+        files = listings.file_tree(project_id, load_tree)
+        if files is None:
             return json_response({'error': 'Project not found'}, status=404)
-        files = build_file_tree(project_dir)
         return json_response({"files": files})
+    except ValueError as e:
+        return json_response({'error': str(e)}, status=400)
     except Exception as e:
         logger.error(f"Error listing project files: {str(e)}")
         return json_response({'error': str(e)}, status=500)
 
+@require_http_methods(["GET"])
+@tracing.traced
+def search_files(request, project_id):
+    """
+    Search a project's files.
+
+    Query: q (required), regex=1 to treat q as a regular expression,
+    case=1 for a case-sensitive search, context (lines around each match)
+    and limit (maximum number of matches).
+    """
+    try:
+        query = request.GET.get('q', '')
+        if not query:
+            return json_response({'error': 'Search query is required'}, status=400)
+        if len(query) > settings.SEARCH_MAX_QUERY_LENGTH:
+            return json_response({'error': 'Search query is too long'}, status=400)
+        try:
+            context = min(max(int(request.GET.get('context', 2)), 0), 10)
+            limit = min(max(int(request.GET.get('limit', 200)), 1), settings.SEARCH_MAX_RESULTS)
+        except ValueError:
+            return json_response({'error': 'Invalid context or limit'}, status=400)
+
+        storage = get_storage()
+        try:
+            clean_project_id(project_id)
+        except ValueError:
+            return json_response({'error': 'Invalid project path'}, status=400)
+        if not storage.project_exists(project_id):
+            return json_response({'error': 'Project not found'}, status=404)
+
+        try:
+            results = search_project(project_id, query,
+                                     regex=request.GET.get('regex') == '1',
+                                     case_sensitive=request.GET.get('case') == '1',
+                                     context=context, limit=limit)
+        except re.error as e:
+            return json_response({'error': f'Invalid regular expression: {str(e)}'}, status=400)
+        return json_response(results)
+    except Exception as e:
+        logger.error(f"Error searching project {project_id}: {str(e)}")
+        return json_response({'error': str(e)}, status=500)
+
+@require_http_methods(["GET"])
+@tracing.traced
+def quick_open(request, project_id):
+    """Fuzzy-match file paths in a project: ?q=...&limit=50"""
+    try:
+        query = request.GET.get('q', '')[:256]
+        try:
+            limit = min(max(int(request.GET.get('limit', 50)), 1), 500)
+        except ValueError:
+            return json_response({'error': 'Invalid limit'}, status=400)
+
+        storage = get_storage()
+        try:
+            clean_project_id(project_id)
+        except ValueError:
+            return json_response({'error': 'Invalid project path'}, status=400)
+        if not storage.project_exists(project_id):
+            return json_response({'error': 'Project not found'}, status=404)
+
+        return json_response({'files': find_files(project_id, query, limit=limit)})
+    except Exception as e:
+        logger.error(f"Error in quick open for project {project_id}: {str(e)}")
+        return json_response({'error': str(e)}, status=500)
+
+@require_http_methods(["GET"])
+@tracing.traced
+def export_project(request, project_id):
+    """Download a project as ?format=zip (default) or tar.gz, streamed as it is compressed"""
+    try:
+        archive_format = request.GET.get('format', 'zip')
+        if archive_format not in FORMATS:
+            return json_response({'error': f"Unsupported format, use one of: {', '.join(FORMATS)}"}, status=400)
+        storage = get_storage()
+        try:
+            clean_project_id(project_id)
+        except ValueError:
+            return json_response({'error': 'Invalid project path'}, status=400)
+        if not storage.project_exists(project_id):
+            return json_response({'error': 'Project not found'}, status=404)
+
+        content_type, extension = FORMATS[archive_format]
+        response = StreamingHttpResponse(iter_archive(storage, project_id, archive_format), content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="{project_id}{extension}"'
+        return response
+    except Exception as e:
+        logger.error(f"Error exporting project {project_id}: {str(e)}")
+        return json_response({'error': str(e)}, status=500)
+
+@csrf_exempt
+@require_http_methods(["POST"])
+@tracing.traced
+def import_project(request, project_id):
+    """
+    Create a project from an uploaded zip or tar archive (multipart field
+    "archive"). Pass replace=1 to overwrite an existing project.
+    """
+    try:
+        storage = get_storage()
+        try:
+            clean_project_id(project_id)
+        except ValueError:
+            return json_response({'error': 'Invalid project path'}, status=400)
+        too_large = {'error': f'Archive is larger than {settings.ARCHIVE_MAX_UPLOAD_SIZE} bytes'}
+        # Refuse before Django spools the upload to disk (allowing for the multipart overhead)
+        if int(request.META.get('CONTENT_LENGTH') or 0) > settings.ARCHIVE_MAX_UPLOAD_SIZE + 64 * 1024:
+            return json_response(too_large, status=413)
+        upload = request.FILES.get('archive')
+        if upload is None:
+            return json_response({'error': 'No archive uploaded'}, status=400)
+        if upload.size > settings.ARCHIVE_MAX_UPLOAD_SIZE:
+            return json_response(too_large, status=413)
+        replace = request.POST.get('replace') == '1'
+        exists = storage.project_exists(project_id)
+        if exists and not replace:
+            return json_response({'error': 'Project already exists'}, status=400)
+
+        if exists:
+            # Keep a snapshot of what is about to be replaced
+            notify_files_deleting(project_id, '')
+        try:
+            with tracing.span('import_archive'):
+                file_count, total_size = import_archive(upload, storage, project_id, replace=replace)
+        except ArchiveError as e:
+            return json_response({'error': str(e)}, status=400)
+        except FileExistsError:
+            return json_response({'error': 'Project already exists'}, status=400)
+        notify_file_changed(project_id, '', 'reset')
+
+        return json_response({
+            'id': project_id,
+            'name': project_id,
+            'files': file_count,
+            'size': total_size
+        })
+    except Exception as e:
+        logger.error(f"Error importing project {project_id}: {str(e)}")
+        return json_response({'error': str(e)}, status=500)
+
 @csrf_exempt
 @require_http_methods(["POST"])
+@tracing.traced
 def create_file(request, project_id):
     try:
-        data = json.loads(request.body)
+        data = load_json_body(request)
         file_name = data.get('name')
         is_folder = data.get('is_folder', False)
         parent_path = data.get('parent_path', '')
@@ -133,24 +302,25 @@ def create_file(request, project_id):
         if not file_name:
             return JsonResponse({'error': 'File name is required'}, status=400)
             
-        projects_dir = os.path.join(os.getcwd(), 'projects')
-        project_dir = os.path.join(projects_dir, project_id)
+        storage = get_storage()
+        try:
+            # Full path including parent directory if specified
+            rel_path = storage_path(project_id, posixpath.join(parent_path or '', file_name))
+        except ValueError:
+            return JsonResponse({'error': 'Invalid file path'}, status=400)
         
-        if not os.path.exists(project_dir):
+        if not storage.project_exists(project_id):
             return JsonResponse({'error': 'Project not found'}, status=404)
             
-        # Create full path including parent directory if specified
-        file_path = os.path.join(project_dir, parent_path, file_name)
-        if os.path.exists(file_path):
+        if storage.kind(project_id, rel_path) is not None:
             return JsonResponse({'error': 'File already exists'}, status=400)
             
         if is_folder:
-            os.makedirs(file_path, exist_ok=True)
+            storage.make_dir(project_id, rel_path)
         else:
-            with open(file_path, 'w') as f:
-                f.write('')
+            storage.write(project_id, rel_path, b'')
                 
-        rel_path = os.path.relpath(file_path, project_dir)
+        notify_file_changed(project_id, rel_path, 'created')
         return JsonResponse({
             'id': f"{project_id}/{rel_path}",  # Include project_id in the file ID
             'name': file_name,
@@ -160,6 +330,52 @@ def create_file(request, project_id):
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
+@csrf_exempt
+@require_http_methods(["POST"])
+@tracing.traced
+def bulk_file_operations(request, project_id):
+    """
+    Apply {"operations": [...]} (create, write, move, delete; see fileops)
+    in one request, all or nothing, and return the project's new file tree.
+    """
+    try:
+        try:
+            data = load_json_body(request)
+        except json.JSONDecodeError:
+            return json_response({'error': 'Invalid JSON data'}, status=400)
+        operations = data.get('operations')
+        if not isinstance(operations, list) or not operations:
+            return json_response({'error': 'A list of operations is required'}, status=400)
+        if len(operations) > settings.BULK_MAX_OPERATIONS:
+            return json_response({'error': f'At most {settings.BULK_MAX_OPERATIONS} operations per request'}, status=400)
+
+        storage = get_storage()
+        try:
+            clean_project_id(project_id)
+        except ValueError:
+            return json_response({'error': 'Invalid project path'}, status=400)
+        if not storage.project_exists(project_id):
+            return json_response({'error': 'Project not found'}, status=404)
+
+        try:
+            with tracing.span('file_operations', count=len(operations)):
+                results, changes = apply_operations(
+                    storage, project_id, operations,
+                    before_delete=lambda path: notify_files_deleting(project_id, path))
+        except OperationError as e:
+            return json_response({'error': str(e), 'index': e.index}, status=e.status)
+        for path, event, old_path in changes:
+            notify_file_changed(project_id, path, event, old_path=old_path)
+
+        return json_response({
+            'success': True,
+            'results': results,
+            'files': build_file_tree(storage.walk(project_id))
+        })
+    except Exception as e:
+        logger.error(f"Error applying file operations in project {project_id}: {str(e)}")
+        return json_response({'error': str(e)}, status=500)
+
 def json_response(data, status=200):
     """Standardized JSON response helper"""
     try:
@@ -173,7 +389,64 @@ def json_error_response(error_message, status=500):
     logger.error(f"Returning JSON error response: {error_message} (status: {status})")
     return json_response({'error': error_message}, status=status)
 
+def storage_path(project_id, file_path):
+    """A file's path within its project for the storage API; ValueError if either is invalid"""
+    clean_project_id(project_id)
+    path = clean_path(file_path)
+    if not path:
+        raise ValueError('Invalid file path')
+    return path
+
+def notify_files_deleting(project_id, path):
+    """Let files_deleting receivers (history, ...) keep what is about to be deleted"""
+    path = path.replace(os.sep, '/')
+    for receiver, result in files_deleting.send_robust(sender=None, project_id=project_id, path=path):
+        if isinstance(result, Exception):
+            logger.error(f"Error in files_deleting receiver {receiver.__name__}: {str(result)}")
+
+def notify_file_changed(project_id, path, event, **kwargs):
+    """Tell file_changed receivers (search index, ...) about a change made here"""
+    path = path.replace(os.sep, '/')
+    for receiver, result in file_changed.send_robust(sender=None, project_id=project_id,
+                                                     path=path, event=event, **kwargs):
+        if isinstance(result, Exception):
+            logger.error(f"Error in file_changed receiver {receiver.__name__}: {str(result)}")
+
+def load_json_body(request):
+    """Decode the JSON request body"""
+    with tracing.span('decode_json', bytes=len(request.body)):
+        return json.loads(request.body)
+
+def execution_user(request):
+    """Who a run is for: the logged-in user, or else the client address"""
+    if request.user.is_authenticated:
+        return f'user:{request.user.pk}'
+    return f"addr:{request.META.get('REMOTE_ADDR', '')}"
+
+def session_owner(request):
+    """Who owns state kept between requests (Python sessions): the logged-in user, or else the browser session"""
+    if request.user.is_authenticated:
+        return f'user:{request.user.pk}'
+    # A random id rather than the session key, which would let anyone who sees it take over the session
+    return f"session:{request.session.setdefault('owner', secrets.token_hex(16))}"
+
+def execution_weight(request):
+    """The requesting user's share of the fair queue"""
+    return user_weight(request.user.get_username()) if request.user.is_authenticated else 1.0
+
+def admit_execution(request, cost=1, slots=1):
+    """Claim execution slots for the requesting user (or client address)"""
+    return get_scheduler().admit(execution_user(request), weight=execution_weight(request), cost=cost,
+                                 slots=slots)
+
+def too_many_requests(error):
+    """429 response for a run the scheduler turned away"""
+    response = json_response({'error': str(error), 'retry_after': error.retry_after}, status=429)
+    response['Retry-After'] = str(error.retry_after)
+    return response
+
 @require_GET
+@tracing.traced
 def get_file_content(request, file_id):
     """
     Get the content of a file.
@@ -202,66 +475,39 @@ def get_file_content(request, file_id):
             logger.error(f"Invalid project_id or file_path: project_id={project_id}, file_path={file_path}")
             return json_response({'error': 'Invalid project ID or file path'}, status=400)
 
-        # Normalize paths
         try:
-            # Get the absolute path to the projects directory
-            base_dir = os.path.abspath(os.getcwd())
-            projects_dir = os.path.normpath(os.path.join(base_dir, 'projects'))
-            
-            # Ensure the projects directory exists
-            if not os.path.exists(projects_dir):
-                logger.info(f"Creating projects directory: {projects_dir}")
-                os.makedirs(projects_dir)
-            
-            # Construct and normalize the project directory path
-            project_dir = os.path.normpath(os.path.join(projects_dir, project_id))
-            
-            # Construct and normalize the full file path
-            full_path = os.path.normpath(os.path.join(project_dir, file_path))
-            
-            # Log the paths for debugging
-            logger.debug(f"Base directory: {base_dir}")
-            logger.debug(f"Projects directory: {projects_dir}")
-            logger.debug(f"Project directory: {project_dir}")
-            logger.debug(f"Full file path: {full_path}")
-            
-            # Security check: ensure the file is within the projects directory
-            if not full_path.startswith(projects_dir):
-                logger.error(f"Security check failed: {full_path} is not within {projects_dir}")
+            storage = get_storage()
+            try:
+                path = storage_path(project_id, file_path)
+            except ValueError:
+                logger.error(f"Security check failed: {file_path} is not within project {project_id}")
                 return json_response({'error': 'Invalid file path'}, status=400)
             
             # Check if project exists
-            if not os.path.exists(project_dir):
-                logger.error(f"Project directory not found: {project_dir}")
+            if not storage.project_exists(project_id):
+                logger.error(f"Project not found: {project_id}")
                 return json_response({'error': 'Project not found'}, status=404)
             
             # Check if file exists
-            if not os.path.exists(full_path):
-                logger.error(f"File not found: {full_path}")
+            kind = storage.kind(project_id, path)
+            if kind is None:
+                logger.error(f"File not found: {file_id}")
                 return json_response({'error': 'File not found'}, status=404)
             
             # Check if path is a directory
-            if os.path.isdir(full_path):
-                logger.error(f"Path is a directory: {full_path}")
+            if kind == 'folder':
+                logger.error(f"Path is a directory: {file_id}")
                 return json_response({'error': 'Cannot get content of a directory'}, status=400)
             
-            # Read file content
+            # Read file content, replacing bytes that aren't valid UTF-8
             try:
-                # First try to read with UTF-8
-                try:
-                    with open(full_path, 'r', encoding='utf-8') as f:
-                        content = f.read()
-                    logger.debug(f"Successfully read file: {full_path} with UTF-8 encoding")
-                except UnicodeDecodeError:
-                    # If UTF-8 fails, try with binary mode and decode
-                    with open(full_path, 'rb') as f:
-                        content = f.read().decode('utf-8', errors='replace')
-                    logger.debug(f"Successfully read file: {full_path} with binary mode and UTF-8 decode")
+                content = storage.read(project_id, path).decode('utf-8', errors='replace')
+                logger.debug(f"Successfully read file: {file_id}")
             except PermissionError:
-                logger.error(f"Permission denied reading file: {full_path}")
+                logger.error(f"Permission denied reading file: {file_id}")
                 return json_response({'error': 'Permission denied'}, status=403)
             except Exception as e:
-                logger.error(f"Error reading file {full_path}: {str(e)}")
+                logger.error(f"Error reading file {file_id}: {str(e)}")
                 return json_response({'error': f'Error reading file: {str(e)}'}, status=500)
             
             # Return file data
@@ -285,8 +531,91 @@ def get_file_content(request, file_id):
         logger.error(f"Unexpected error in get_file_content for {file_id}: {str(e)}")
         return json_response({'error': f'Unexpected error: {str(e)}'}, status=500)
 
+def content_etag(data):
+    return hashlib.blake2b(data, digest_size=12).hexdigest()
+
 @csrf_exempt
 @require_http_methods(["POST"])
+@tracing.traced
+def open_files(request, project_id):
+    """
+    Read many files in one request: {"paths": [...], "etags": {path: etag}}.
+    Files whose etag still matches come back as {"unchanged": true} without
+    content. The response is compressed if the client accepts it.
+    """
+    try:
+        try:
+            data = load_json_body(request)
+        except json.JSONDecodeError:
+            return json_response({'error': 'Invalid JSON data'}, status=400)
+        paths = data.get('paths')
+        etags = data.get('etags') or {}
+        if (not isinstance(paths, list) or not paths or not isinstance(etags, dict)
+                or not all(isinstance(path, str) for path in paths)):
+            return json_response({'error': 'A list of paths is required'}, status=400)
+        if len(paths) > settings.OPEN_FILES_MAX_FILES:
+            return json_response({'error': f'At most {settings.OPEN_FILES_MAX_FILES} files per request'}, status=400)
+
+        storage = get_storage()
+        try:
+            clean_project_id(project_id)
+        except ValueError:
+            return json_response({'error': 'Invalid project path'}, status=400)
+        if not storage.project_exists(project_id):
+            return json_response({'error': 'Project not found'}, status=404)
+
+        valid = {}
+        for path in paths:
+            try:
+                valid[path] = storage_path(project_id, path)
+            except ValueError:
+                pass
+        with tracing.span('read_files', count=len(valid)):
+            contents = storage.read_many(project_id, sorted(set(valid.values())))
+
+        files = []
+        budget = settings.OPEN_FILES_MAX_BYTES
+        for path in paths:
+            clean = valid.get(path)
+            if clean is None:
+                files.append({'path': path, 'error': 'Invalid file path', 'status': 400})
+                continue
+            content = contents[clean]
+            if isinstance(content, IsADirectoryError):
+                files.append({'path': path, 'error': 'Cannot get content of a directory', 'status': 400})
+                continue
+            if isinstance(content, FileNotFoundError):
+                files.append({'path': path, 'error': 'File not found', 'status': 404})
+                continue
+            if isinstance(content, Exception):
+                files.append({'path': path, 'error': f'Error reading file: {str(content)}', 'status': 500})
+                continue
+            etag = content_etag(content)
+            entry = {
+                'id': f"{project_id}/{clean}",
+                'name': posixpath.basename(clean),
+                'path': clean,
+                'etag': etag
+            }
+            if etags.get(path) == etag:
+                entry['unchanged'] = True
+            elif len(content) > budget:
+                # Over the response budget; the client can fetch it on its own
+                entry.update({'error': 'Response size limit reached', 'status': 413})
+            else:
+                budget -= len(content)
+                entry['content'] = content.decode('utf-8', errors='replace')
+            files.append(entry)
+
+        with tracing.span('compress'):
+            return compressed_json_response(request, {'files': files})
+    except Exception as e:
+        logger.error(f"Error opening files in project {project_id}: {str(e)}")
+        return json_response({'error': str(e)}, status=500)
+
+@csrf_exempt
+@require_http_methods(["POST"])
+@tracing.traced
 def save_file(request, file_id):
     try:
         # Extract project_id and file_path from file_id
@@ -297,48 +626,33 @@ def save_file(request, file_id):
         project_id, file_path = parts
         
         try:
-            data = json.loads(request.body)
+            data = load_json_body(request)
             content = data.get('content', '')
         except json.JSONDecodeError:
             return json_response({'error': 'Invalid JSON data'}, status=400)
 
-        # Normalize paths
+        storage = get_storage()
         try:
-            base_dir = os.path.abspath(os.getcwd())
-            projects_dir = os.path.normpath(os.path.join(base_dir, 'projects'))
-            project_dir = os.path.normpath(os.path.join(projects_dir, project_id))
-            full_path = os.path.normpath(os.path.join(project_dir, file_path))
-            
-            # Security check: ensure the file is within the projects directory
-            if not full_path.startswith(projects_dir):
-                logger.error(f"Security check failed: {full_path} is not within {projects_dir}")
-                return json_response({'error': 'Invalid file path'}, status=400)
-            
-            # Ensure project directory exists
-            if not os.path.exists(project_dir):
-                logger.error(f"Project directory not found: {project_dir}")
-                return json_response({'error': 'Project not found'}, status=404)
-            
-            # Ensure parent directory exists
-            parent_dir = os.path.dirname(full_path)
-            if not os.path.exists(parent_dir):
-                os.makedirs(parent_dir, exist_ok=True)
-            
-            logger.debug(f"Full file path: {full_path}")
-        except Exception as e:
-            logger.error(f"Error processing file path: {str(e)}")
-            return json_response({'error': 'Error processing file path'}, status=500)
+            path = storage_path(project_id, file_path)
+        except ValueError:
+            logger.error(f"Security check failed: {file_path} is not within project {project_id}")
+            return json_response({'error': 'Invalid file path'}, status=400)
+
+        # Ensure project exists
+        if not storage.project_exists(project_id):
+            logger.error(f"Project not found: {project_id}")
+            return json_response({'error': 'Project not found'}, status=404)
 
         # Validate file is not a directory
-        if os.path.exists(full_path) and os.path.isdir(full_path):
-            logger.error(f"Path is a directory: {full_path}")
+        if storage.kind(project_id, path) == 'folder':
+            logger.error(f"Path is a directory: {file_id}")
             return json_response({'error': 'Cannot save content to a directory'}, status=400)
 
-        # Write content to file
+        # Write content to file (parent folders are created as needed)
         try:
-            with open(full_path, 'w', encoding='utf-8') as f:
-                f.write(content)
-            logger.debug(f"Successfully saved file: {full_path}")
+            storage.write(project_id, path, content.encode('utf-8'))
+            logger.debug(f"Successfully saved file: {file_id}")
+            notify_file_changed(project_id, path, 'modified')
             return json_response({
                 'success': True,
                 'message': 'File saved successfully',
@@ -349,10 +663,10 @@ def save_file(request, file_id):
                 }
             })
         except PermissionError:
-            logger.error(f"Permission denied writing to file: {full_path}")
+            logger.error(f"Permission denied writing to file: {file_id}")
             return json_response({'error': 'Permission denied'}, status=403)
         except Exception as e:
-            logger.error(f"Error writing to file {full_path}: {str(e)}")
+            logger.error(f"Error writing to file {file_id}: {str(e)}")
             return json_response({'error': f'Error writing to file: {str(e)}'}, status=500)
 
     except Exception as e:
@@ -361,6 +675,7 @@ def save_file(request, file_id):
 
 @csrf_exempt
 @require_http_methods(["POST"])
+@tracing.traced
 def delete_file(request, file_id):
     try:
         logger.info(f"Attempting to delete file: {file_id}")
@@ -376,32 +691,31 @@ def delete_file(request, file_id):
             
         project_id, file_path = parts
         
-        # Get the absolute path to the projects directory
-        base_dir = os.path.abspath(os.getcwd())
-        projects_dir = os.path.normpath(os.path.join(base_dir, 'projects'))
-        project_dir = os.path.normpath(os.path.join(projects_dir, project_id))
-        full_path = os.path.normpath(os.path.join(project_dir, file_path))
-        
-        # Security check: ensure the file is within the projects directory
-        if not full_path.startswith(projects_dir):
-            logger.error(f"Security check failed: {full_path} is not within {projects_dir}")
+        storage = get_storage()
+        try:
+            path = storage_path(project_id, file_path)
+        except ValueError:
+            logger.error(f"Security check failed: {file_path} is not within project {project_id}")
             return json_response({'error': 'Invalid file path'}, status=400)
         
         # Check if file exists
-        if not os.path.exists(full_path):
-            logger.error(f"File not found: {full_path}")
+        kind = storage.kind(project_id, path) if storage.project_exists(project_id) else None
+        if kind is None:
+            logger.error(f"File not found: {file_id}")
             return json_response({'error': 'File not found'}, status=404)
             
         try:
-            if os.path.isdir(full_path):
+            if kind == 'folder':
                 # Check if directory is empty
-                if os.listdir(full_path):
+                if storage.list_dir(project_id, path):
                     return json_response({'error': 'Cannot delete non-empty directory'}, status=400)
-                shutil.rmtree(full_path)
-                logger.info(f"Successfully deleted directory: {full_path}")
+                storage.delete(project_id, path)
+                logger.info(f"Successfully deleted directory: {file_id}")
             else:
-                os.remove(full_path)
-                logger.info(f"Successfully deleted file: {full_path}")
+                notify_files_deleting(project_id, path)
+                storage.delete(project_id, path)
+                logger.info(f"Successfully deleted file: {file_id}")
+            notify_file_changed(project_id, path, 'deleted')
                 
             return json_response({
                 'success': True,
@@ -410,17 +724,17 @@ def delete_file(request, file_id):
                     'id': file_id,
                     'name': os.path.basename(file_path),
                     'path': file_path,
-                    'is_folder': os.path.isdir(full_path)
+                    'is_folder': kind == 'folder'
                 }
             })
         except PermissionError:
-            logger.error(f"Permission denied deleting file: {full_path}")
+            logger.error(f"Permission denied deleting file: {file_id}")
             return json_response({'error': 'Permission denied'}, status=403)
         except OSError as e:
-            logger.error(f"OS error deleting file {full_path}: {str(e)}")
+            logger.error(f"OS error deleting file {file_id}: {str(e)}")
             return json_response({'error': f'Error deleting file: {str(e)}'}, status=500)
         except Exception as e:
-            logger.error(f"Error deleting file {full_path}: {str(e)}")
+            logger.error(f"Error deleting file {file_id}: {str(e)}")
             return json_response({'error': f'Error deleting file: {str(e)}'}, status=500)
             
     except Exception as e:
@@ -429,6 +743,7 @@ def delete_file(request, file_id):
 
 @csrf_exempt
 @require_http_methods(["POST"])
+@tracing.traced
 def rename_file(request, file_id):
     try:
         # Extract project_id and file_path from file_id
@@ -439,7 +754,7 @@ def rename_file(request, file_id):
         project_id, file_path = parts
         
         try:
-            data = json.loads(request.body)
+            data = load_json_body(request)
             new_name = data.get('new_name')
         except json.JSONDecodeError:
             return json_response({'error': 'Invalid JSON data'}, status=400)
@@ -447,24 +762,25 @@ def rename_file(request, file_id):
         if not new_name:
             return json_response({'error': 'New name is required'}, status=400)
             
-        projects_dir = os.path.join(os.getcwd(), 'projects')
-        old_path = os.path.join(projects_dir, project_id, file_path)
+        storage = get_storage()
+        try:
+            old_path = storage_path(project_id, file_path)
+            # The new name is relative to the directory containing the file
+            new_rel_path = storage_path(project_id, posixpath.join(posixpath.dirname(old_path), new_name))
+        except ValueError:
+            return json_response({'error': 'Invalid file path'}, status=400)
         
-        if not os.path.exists(old_path):
+        kind = storage.kind(project_id, old_path) if storage.project_exists(project_id) else None
+        if kind is None:
             return json_response({'error': 'File not found'}, status=404)
             
-        # Get the directory containing the file
-        dir_path = os.path.dirname(old_path)
-        new_path = os.path.join(dir_path, new_name)
-        
-        if os.path.exists(new_path):
+        if storage.kind(project_id, new_rel_path) is not None:
             return json_response({'error': 'A file with this name already exists'}, status=400)
             
-        os.rename(old_path, new_path)
+        storage.rename(project_id, old_path, new_rel_path)
         
-        # Calculate new relative path
-        new_rel_path = os.path.relpath(new_path, os.path.join(projects_dir, project_id))
         new_file_id = f"{project_id}/{new_rel_path}"
+        notify_file_changed(project_id, new_rel_path, 'renamed', old_path=old_path)
         
         return json_response({
             'success': True,
@@ -473,96 +789,504 @@ def rename_file(request, file_id):
                 'id': new_file_id,
                 'name': new_name,
                 'path': new_rel_path,
-                'is_folder': os.path.isdir(new_path)
+                'is_folder': kind == 'folder'
             }
         })
     except Exception as e:
         logger.error(f"Error renaming file {file_id}: {str(e)}")
         return json_response({'error': str(e)}, status=500)
 
+def run_snippet(code, language, stdin, filename='', build_key=None):
+    """
+    Build and run code in a temporary directory; returns (response data,
+    status). Compiled languages go through prepare_program, so C, C++ and
+    Rust builds come from the build cache when they can, and the result
+    says so in 'build_cached'.
+    """
+    if language not in TOOLCHAINS:
+        return {'error': f'Unsupported language: {language}'}, 400
+    with work_directory() as temp_dir:
+        try:
+            prepared = prepare_program(code, language, temp_dir, filename or None, build_key=build_key)
+            if 'error' in prepared:
+                return {'error': prepared['error']}, 200 if prepared.get('compile_error') else 500
+            result = run_process(prepared['args'], input=stdin, cwd=temp_dir, binds=[temp_dir], language=language)
+        except subprocess.TimeoutExpired:
+            return {'error': 'Code execution timed out'}, 408
+        except SandboxError as e:
+            logger.error(f"Sandbox failure in run_code: {str(e)}")
+            return {'error': 'Execution sandbox is unavailable'}, 503
+        except Exception as e:
+            return {'error': str(e)}, 500
+
+    data = {'output': result.stdout} if result.returncode == 0 else {'error': result.stderr}
+    if 'cached' in prepared:
+        data['build_cached'] = prepared['cached']
+    return data, 200
+
 @csrf_exempt
 @require_http_methods(["POST"])
+@tracing.traced
 def run_code(request):
     try:
-        data = json.loads(request.body)
+        data = load_json_body(request)
         code = data.get('code', '')
         language = data.get('language', 'python')
         filename = data.get('filename', '')
+        stdin = data.get('stdin', '')
         
         if not code:
             return JsonResponse({'error': 'No code provided'}, status=400)
             
-        # Create a temporary directory for execution
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # Write code to a temporary file
-            file_ext = {
-                'python': '.py',
-                'javascript': '.js',
-                'java': '.java',
-                'cpp': '.cpp',
-                'c': '.c',
-                'php': '.php',
-                'ruby': '.rb',
-                'go': '.go',
-                'rust': '.rs',
-                'swift': '.swift',
-                'kotlin': '.kt',
-                'typescript': '.ts'
-            }.get(language, '.txt')
-            
-            temp_file = os.path.join(temp_dir, f'temp{file_ext}')
-            with open(temp_file, 'w', encoding='utf-8') as f:
-                f.write(code)
-                
-            # Execute the code based on language
-            try:
-                if language == 'python':
-                    result = subprocess.run(['python', temp_file], 
-                                         capture_output=True, 
-                                         text=True, 
-                                         timeout=10)
-                elif language == 'javascript':
-                    result = subprocess.run(['node', temp_file], 
-                                         capture_output=True, 
-                                         text=True, 
-                                         timeout=10)
-                else:
-                    return JsonResponse({'error': f'Unsupported language: {language}'}, status=400)
-                    
-                if result.returncode == 0:
-                    return JsonResponse({'output': result.stdout})
-                else:
-                    return JsonResponse({'error': result.stderr})
-                    
-            except subprocess.TimeoutExpired:
-                return JsonResponse({'error': 'Code execution timed out'}, status=408)
-            except Exception as e:
-                return JsonResponse({'error': str(e)}, status=500)
+        # Wait for an execution slot, then run here or on a runner node
+        dispatcher = get_cluster()
+        with admit_execution(request):
+            user = execution_user(request)
+            if dispatcher is not None:
+                result, status = dispatcher.dispatch('run', user,
+                                                  {'code': code, 'language': language, 'stdin': stdin,
+                                                   'filename': filename, 'build_key': user},
+                                                  key=routing_key(language, code),
+                                                  weight=execution_weight(request))
+            else:
+                result, status = run_snippet(code, language, stdin, filename, build_key=user)
+        return JsonResponse(result, status=status)
                 
+    except AdmissionRejected as e:
+        return too_many_requests(e)
+    except ClusterUnavailable as e:
+        return JsonResponse({'error': str(e)}, status=503)
+    except JobLost as e:
+        return JsonResponse({'error': str(e)}, status=e.status)
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
 @csrf_exempt
 @require_http_methods(["POST"])
+@tracing.traced
+def run_batch(request):
+    """
+    Judge one submission against many test cases.
+
+    Body: {code, language, filename, time_limit, memory_limit, optimization
+           (C/C++: 'O0'-'O3' or 'Os'), cases: [{stdin, expected_output}, ...]}
+    """
+    try:
+        try:
+            data = load_json_body(request)
+        except json.JSONDecodeError:
+            return json_response({'error': 'Invalid JSON data'}, status=400)
+
+        code = data.get('code', '')
+        language = data.get('language', 'python')
+        cases = data.get('cases')
+        if not code:
+            return json_response({'error': 'No code provided'}, status=400)
+        if not isinstance(cases, list) or not cases:
+            return json_response({'error': 'At least one test case is required'}, status=400)
+        if len(cases) > settings.JUDGE_MAX_CASES:
+            return json_response({'error': f'At most {settings.JUDGE_MAX_CASES} test cases are allowed'}, status=400)
+        if not all(isinstance(case, dict) for case in cases):
+            return json_response({'error': 'Each test case must be an object'}, status=400)
+        if not all(isinstance(case.get('stdin', ''), str) and isinstance(case.get('expected_output', ''), str)
+                   for case in cases):
+            return json_response({'error': 'Test case stdin and expected_output must be strings'}, status=400)
+
+        try:
+            time_limit = min(float(data.get('time_limit', 2)), settings.JUDGE_MAX_TIME_LIMIT)
+            memory_limit = min(int(data.get('memory_limit', 256)), settings.JUDGE_MAX_MEMORY_MB)
+        except (TypeError, ValueError):
+            return json_response({'error': 'Invalid time or memory limit'}, status=400)
+        # The comparisons are False for NaN, so it is rejected too
+        if not time_limit > 0 or not memory_limit >= settings.JUDGE_MIN_MEMORY_MB:
+            return json_response({'error': f'time_limit must be positive and memory_limit at least '
+                                           f'{settings.JUDGE_MIN_MEMORY_MB} MB'}, status=400)
+        optimization = data.get('optimization') or None
+        if optimization is not None and optimization not in OPTIMIZATION_LEVELS:
+            return json_response({'error': f'optimization must be one of {", ".join(OPTIMIZATION_LEVELS)}'}, status=400)
+
+        job = {'code': code, 'language': language, 'cases': cases,
+               'filename': data.get('filename', ''),
+               'time_limit': time_limit,
+               'memory_limit_mb': memory_limit,
+               'optimization': optimization,
+               'build_key': execution_user(request)}
+        # A batch costs one run per case in the fair queue, and judging it
+        # here holds a slot for each case it runs in parallel
+        dispatcher = get_cluster()
+        with admit_execution(request, cost=len(cases), slots=1 if dispatcher else len(cases)) as admission:
+            if dispatcher is not None:
+                result, status = dispatcher.dispatch('batch', execution_user(request), job,
+                                                  key=routing_key(language, code),
+                                                  weight=execution_weight(request))
+                return json_response(result, status=status)
+            result = judge_submission(**job, max_workers=admission.slots)
+        return json_response(result)
+    except AdmissionRejected as e:
+        return too_many_requests(e)
+    except ClusterUnavailable as e:
+        return json_response({'error': str(e)}, status=503)
+    except JobLost as e:
+        return json_response({'error': str(e)}, status=e.status)
+    except Exception as e:
+        logger.error(f"Error in run_batch: {str(e)}")
+        return json_response({'error': str(e)}, status=500)
+
+@csrf_exempt
+@require_http_methods(["POST"])
+@tracing.traced
+def run_session(request):
+    """
+    Run a Python cell in the caller's kernel for a project, which keeps
+    its variables and imports from earlier cells.
+
+    Body: {project_id, code, stdin}. Returns {output, stderr, error, result
+    (repr of a final expression), execution_count, elapsed, kernel_started}.
+    """
+    if not settings.KERNELS_ENABLED:
+        return json_response({'error': 'Python sessions are disabled on this server'}, status=404)
+    try:
+        try:
+            data = load_json_body(request)
+        except json.JSONDecodeError:
+            return json_response({'error': 'Invalid JSON data'}, status=400)
+        code = data.get('code', '')
+        stdin = data.get('stdin') or ''
+        if not code or not isinstance(code, str):
+            return json_response({'error': 'No code provided'}, status=400)
+        if not isinstance(stdin, str):
+            return json_response({'error': 'stdin must be a string'}, status=400)
+        project_id = clean_project_id(data.get('project_id') or '')
+
+        with admit_execution(request):
+            result = get_kernel_manager().execute(session_owner(request), project_id, code, stdin)
+        return json_response(result)
+    except ValueError as e:
+        return json_response({'error': str(e)}, status=400)
+    except KernelError as e:
+        return json_response({'error': str(e), 'kernel_lost': e.kernel_lost}, status=e.status)
+    except AdmissionRejected as e:
+        return too_many_requests(e)
+    except SandboxError as e:
+        logger.error(f"Sandbox failure in run_session: {str(e)}")
+        return json_response({'error': 'Execution sandbox is unavailable'}, status=503)
+    except Exception as e:
+        logger.error(f"Error in run_session: {str(e)}")
+        return json_response({'error': str(e)}, status=500)
+
+@csrf_exempt
+@require_http_methods(["GET", "POST"])
+@tracing.traced
+def python_sessions(request):
+    """
+    GET lists the caller's live kernels; POST {project_id} shuts down the
+    one for that project, so the next cell starts from a clean namespace.
+    """
+    try:
+        manager = get_kernel_manager()
+        user = session_owner(request)
+        if request.method == 'GET':
+            return json_response({'sessions': manager.list(user)})
+        try:
+            data = load_json_body(request)
+        except json.JSONDecodeError:
+            return json_response({'error': 'Invalid JSON data'}, status=400)
+        project_id = clean_project_id(data.get('project_id') or '')
+        return json_response({'shutdown': manager.shutdown(user, project_id)})
+    except ValueError as e:
+        return json_response({'error': str(e)}, status=400)
+    except Exception as e:
+        logger.error(f"Error in python_sessions: {str(e)}")
+        return json_response({'error': str(e)}, status=500)
+
+@csrf_exempt
+@require_http_methods(["POST"])
+@tracing.traced
+def diagnostics(request):
+    """
+    Syntax errors and lint warnings for a file, without running it.
+
+    Body: {content, language, project_id, path}. content defaults to the
+    saved file; language defaults to the one for path's extension. Results
+    are cached per file and content, so repeated checks are cheap.
+    """
+    try:
+        try:
+            data = load_json_body(request)
+        except json.JSONDecodeError:
+            return json_response({'error': 'Invalid JSON data'}, status=400)
+        content = data.get('content')
+        language = data.get('language') or None
+        project_id = data.get('project_id') or None
+        path = data.get('path') or None
+        if language is not None and not isinstance(language, str):
+            return json_response({'error': 'language must be a string'}, status=400)
+        if project_id is not None:
+            project_id = clean_project_id(project_id)
+            if path is not None:
+                path = storage_path(project_id, path)
+        language = language or language_for(path)
+        if content is None:
+            if project_id is None or path is None:
+                return json_response({'error': 'No content provided'}, status=400)
+            try:
+                content = get_storage().read(project_id, path).decode('utf-8')
+            except (FileNotFoundError, IsADirectoryError):
+                return json_response({'error': 'File not found'}, status=404)
+            except UnicodeDecodeError:
+                return json_response({'error': 'File is not text'}, status=400)
+        if not isinstance(content, str):
+            return json_response({'error': 'content must be a string'}, status=400)
+        if len(content) > settings.DIAGNOSTICS_MAX_SIZE:
+            return json_response({'error': 'File is too large to check'}, status=413)
+
+        result = check_source(content, language=language, project_id=project_id, path=path,
+                              admit=lambda: admit_execution(request))
+        if result is None:
+            return json_response({'language': language, 'supported': False, 'diagnostics': []})
+        found, cached = result
+        return json_response({'language': language, 'supported': True, 'diagnostics': found, 'cached': cached})
+    except ValueError as e:
+        return json_response({'error': str(e)}, status=400)
+    except DiagnosticsError as e:
+        logger.error(f"Checker failure in diagnostics: {str(e)}")
+        return json_response({'error': str(e)}, status=503)
+    except AdmissionRejected as e:
+        return too_many_requests(e)
+    except SandboxError as e:
+        logger.error(f"Sandbox failure in diagnostics: {str(e)}")
+        return json_response({'error': 'Execution sandbox is unavailable'}, status=503)
+    except Exception as e:
+        logger.error(f"Error in diagnostics: {str(e)}")
+        return json_response({'error': str(e)}, status=500)
+
+def version_data(version):
+    return {
+        'id': version.pk,
+        'path': version.path,
+        'old_path': version.old_path,
+        'event': version.event,
+        'hash': version.blob,
+        'size': version.size,
+        'created_at': version.created_at.isoformat(),
+    }
+
+def snapshot_data(snapshot):
+    return {
+        'id': snapshot.pk,
+        'label': snapshot.label,
+        'file_count': snapshot.file_count,
+        'total_size': snapshot.total_size,
+        'created_at': snapshot.created_at.isoformat(),
+    }
+
+@require_http_methods(["GET"])
+@tracing.traced
+def file_history(request, project_id):
+    """Recorded versions of one file (?path=...) or of the whole project, newest first"""
+    try:
+        try:
+            limit = min(max(int(request.GET.get('limit', 100)), 1), 1000)
+        except ValueError:
+            return json_response({'error': 'Invalid limit'}, status=400)
+        versions = FileVersion.objects.filter(project_name=project_id)
+        path = request.GET.get('path', '').strip('/')
+        if path:
+            versions = versions.filter(path=path)
+        return json_response({'versions': [version_data(v) for v in versions[:limit]]})
+    except Exception as e:
+        logger.error(f"Error listing history for project {project_id}: {str(e)}")
+        return json_response({'error': str(e)}, status=500)
+
+@require_http_methods(["GET"])
+@tracing.traced
+def file_version(request, project_id, version_id):
+    """A recorded version of a file, with its content"""
+    try:
+        version = FileVersion.objects.filter(project_name=project_id, pk=version_id).first()
+        if version is None:
+            return json_response({'error': 'Version not found'}, status=404)
+        data = version_data(version)
+        if version.blob:
+            data['content'] = snapshots.get_blob_store().get(version.blob).decode('utf-8', errors='replace')
+        return json_response(data)
+    except Exception as e:
+        logger.error(f"Error reading version {version_id} of project {project_id}: {str(e)}")
+        return json_response({'error': str(e)}, status=500)
+
+@csrf_exempt
+@require_http_methods(["POST"])
+@tracing.traced
+def restore_file_version(request, project_id, version_id):
+    """Write a recorded version back to its path"""
+    try:
+        try:
+            clean_project_id(project_id)
+        except ValueError:
+            return json_response({'error': 'Invalid project path'}, status=400)
+        version = FileVersion.objects.filter(project_name=project_id, pk=version_id).first()
+        if version is None:
+            return json_response({'error': 'Version not found'}, status=404)
+        if not version.blob:
+            return json_response({'error': 'This version records a deletion'}, status=400)
+
+        try:
+            path = clean_path(version.path)
+        except ValueError:
+            path = ''
+        if not path:
+            return json_response({'error': 'Invalid file path'}, status=400)
+        get_storage().write(project_id, path, snapshots.get_blob_store().get(version.blob))
+        snapshots.record_version(project_id, path, event='restored')
+        notify_file_changed(project_id, path, 'modified')
+        return json_response({
+            'success': True,
+            'file': {
+                'id': f"{project_id}/{path}",
+                'name': os.path.basename(path),
+                'path': path
+            }
+        })
+    except Exception as e:
+        logger.error(f"Error restoring version {version_id} of project {project_id}: {str(e)}")
+        return json_response({'error': str(e)}, status=500)
+
+@csrf_exempt
+@require_http_methods(["GET", "POST"])
+@tracing.traced
+def project_snapshots(request, project_id):
+    """GET lists a project's snapshots; POST {label} takes a new one"""
+    try:
+        try:
+            clean_project_id(project_id)
+        except ValueError:
+            return json_response({'error': 'Invalid project path'}, status=400)
+        if request.method == 'GET':
+            snapshot_list = ProjectSnapshot.objects.filter(project_name=project_id)[:100]
+            return json_response({'snapshots': [snapshot_data(s) for s in snapshot_list]})
+
+        if not get_storage().project_exists(project_id):
+            return json_response({'error': 'Project not found'}, status=404)
+        try:
+            data = load_json_body(request) if request.body else {}
+        except json.JSONDecodeError:
+            return json_response({'error': 'Invalid JSON data'}, status=400)
+        snapshot = snapshots.create_snapshot(project_id, label=str(data.get('label', '')))
+        return json_response(snapshot_data(snapshot))
+    except Exception as e:
+        logger.error(f"Error handling snapshots for project {project_id}: {str(e)}")
+        return json_response({'error': str(e)}, status=500)
+
+@csrf_exempt
+@require_http_methods(["POST"])
+@tracing.traced
+def restore_project_snapshot(request, project_id, snapshot_id):
+    """Make a project (even a deleted one) match one of its snapshots"""
+    try:
+        try:
+            clean_project_id(project_id)
+        except ValueError:
+            return json_response({'error': 'Invalid project path'}, status=400)
+        snapshot = ProjectSnapshot.objects.filter(project_name=project_id, pk=snapshot_id).first()
+        if snapshot is None:
+            return json_response({'error': 'Snapshot not found'}, status=404)
+        result = snapshots.restore_snapshot(snapshot)
+        notify_file_changed(project_id, '', 'reset')
+        return json_response({'success': True, **result})
+    except Exception as e:
+        logger.error(f"Error restoring snapshot {snapshot_id} of project {project_id}: {str(e)}")
+        return json_response({'error': str(e)}, status=500)
+
+@csrf_exempt
+@require_http_methods(["POST"])
+@tracing.traced
 def delete_project(request, project_id):
     try:
-        # Get the absolute path to the projects directory
-        base_dir = os.path.abspath(os.getcwd())
-        projects_dir = os.path.normpath(os.path.join(base_dir, 'projects'))
-        project_dir = os.path.normpath(os.path.join(projects_dir, project_id))
-        
-        # Security check: ensure the project is within the projects directory
-        if not project_dir.startswith(projects_dir):
+        storage = get_storage()
+        try:
+            clean_project_id(project_id)
+        except ValueError:
             return json_response({'error': 'Invalid project path'}, status=400)
         
         # Check if project exists
-        if not os.path.exists(project_dir):
+        if not storage.project_exists(project_id):
             return json_response({'error': 'Project not found'}, status=404)
         
-        # Delete the project directory and all its contents
-        shutil.rmtree(project_dir)
+        # Delete the project and all its contents (a snapshot is kept)
+        notify_files_deleting(project_id, '')
+        storage.delete_project(project_id)
+        notify_file_changed(project_id, '', 'deleted')
         
         return json_response({'success': True, 'message': 'Project deleted successfully'})
     except Exception as e:
         logger.error(f"Error deleting project {project_id}: {str(e)}")
         return json_response({'error': f'Error deleting project: {str(e)}'}, status=500)
+
+@csrf_exempt
+@require_http_methods(["POST"])
+@tracing.traced
+def runner_jobs(request):
+    """
+    Run a job for a cluster dispatcher (see codeeditor/cluster.py).
+
+    Body: {kind: 'run' | 'batch', user, weight, args}; answers with what
+    run_code or run_batch would have.
+    """
+    if not cluster.authorized(request):
+        return json_response({'error': 'Forbidden'}, status=403)
+    if cluster.draining():
+        return json_response({'error': 'Runner node is draining', 'draining': True}, status=503)
+    try:
+        try:
+            data = load_json_body(request)
+            kind, user, args = data['kind'], data['user'], data['args']
+        except (json.JSONDecodeError, KeyError, TypeError):
+            return json_response({'error': 'Invalid job'}, status=400)
+        if kind not in ('run', 'batch'):
+            return json_response({'error': f'Unknown job kind: {kind}'}, status=400)
+
+        # The dispatcher already rate limited the user; this only waits for a local slot
+        cost = max(len(args.get('cases') or ()) if kind == 'batch' else 1, 1)
+        with cluster.running_job(), get_scheduler().admit(user, weight=data.get('weight', 1.0), cost=cost,
+                                                          rate_limited=False, slots=cost) as admission:
+            if kind == 'run':
+                result, status = run_snippet(args.get('code', ''), args.get('language', 'python'),
+                                             args.get('stdin', ''), args.get('filename', ''), args.get('build_key'))
+                return json_response(result, status=status)
+            return json_response(judge_submission(**{**args, 'max_workers': admission.slots}))
+    except AdmissionRejected as e:
+        return too_many_requests(e)
+    except Exception as e:
+        logger.error(f"Error in runner_jobs: {str(e)}")
+        return json_response({'error': str(e)}, status=500)
+
+@require_GET
+@tracing.traced
+def runner_health(request):
+    """Load and drain state of this runner node"""
+    if not cluster.authorized(request):
+        return json_response({'error': 'Forbidden'}, status=403)
+    return json_response(cluster.node_status())
+
+@csrf_exempt
+@require_http_methods(["POST"])
+@tracing.traced
+def runner_drain(request):
+    """Stop (or, with {"drain": false}, resume) taking new jobs on this runner node"""
+    if not cluster.authorized(request):
+        return json_response({'error': 'Forbidden'}, status=403)
+    try:
+        data = load_json_body(request) if request.body else {}
+    except json.JSONDecodeError:
+        return json_response({'error': 'Invalid JSON data'}, status=400)
+    cluster.set_draining(data.get('drain', True))
+    return json_response(cluster.node_status())
+
+@require_GET
+@tracing.traced
+def metrics_view(request):
+    """Prometheus scrape endpoint; needs a bearer token if METRICS_TOKEN is set"""
+    token = settings.METRICS_TOKEN
+    if token and request.headers.get('Authorization', '') != f'Bearer {token}':
+        return HttpResponse('Unauthorized\n', status=401, content_type='text/plain')
+    return HttpResponse(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
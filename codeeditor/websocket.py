@@ -0,0 +1,65 @@
+"""
+Minimal WebSocket support on top of the raw ASGI interface.
+
+Django only speaks HTTP, so online_code_editor/asgi.py hands websocket
+scopes to codeeditor.routing, which wraps them in a WebSocket object.
+"""
+import json
+
+from django.http import parse_cookie
+
+
+class WebSocketDisconnect(Exception):
+    """Raised when the client has closed the connection."""
+
+    def __init__(self, code=1000):
+        super().__init__(code)
+        self.code = code
+
+
+class WebSocket:
+    def __init__(self, scope, receive, send):
+        self.scope = scope
+        self.path = scope['path']
+        self.query_string = scope.get('query_string', b'').decode('latin-1')
+        self._receive = receive
+        self._send = send
+        self.accepted = False
+        self.closed = False
+
+    @property
+    def cookies(self):
+        header = '; '.join(value.decode('latin-1') for name, value in self.scope.get('headers', ())
+                           if name == b'cookie')
+        return parse_cookie(header)
+
+    async def accept(self):
+        message = await self._receive()
+        if message['type'] != 'websocket.connect':
+            raise WebSocketDisconnect()
+        await self._send({'type': 'websocket.accept'})
+        self.accepted = True
+
+    async def receive_text(self):
+        message = await self._receive()
+        if message['type'] == 'websocket.disconnect':
+            self.closed = True
+            raise WebSocketDisconnect(message.get('code', 1000))
+        if message.get('text') is not None:
+            return message['text']
+        return message.get('bytes', b'').decode('utf-8', 'replace')
+
+    async def receive_json(self):
+        return json.loads(await self.receive_text())
+
+    async def send_text(self, text):
+        if not self.closed:
+            await self._send({'type': 'websocket.send', 'text': text})
+
+    async def send_json(self, data):
+        await self.send_text(json.dumps(data))
+
+    async def close(self, code=1000):
+        if not self.closed:
+            self.closed = True
+            await self._send({'type': 'websocket.close', 'code': code})
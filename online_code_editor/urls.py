@@ -17,10 +17,12 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 from django.views.generic import RedirectView
+from codeeditor.views import metrics_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('accounts/', include('django.contrib.auth.urls')),
     path('', RedirectView.as_view(pattern_name='editor'), name='home'),
     path('editor/', include('codeeditor.urls')),
+    path('metrics', metrics_view, name='metrics'),
 ]
\ No newline at end of file
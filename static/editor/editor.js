@@ -0,0 +1,2010 @@
+// Initialize CodeMirror
+const editor = CodeMirror(document.getElementById('editor'), {
+    mode: 'python',
+    theme: 'monokai',
+    lineNumbers: true,
+    autoCloseBrackets: true,
+    matchBrackets: true,
+    indentUnit: 4,
+    tabSize: 4,
+    lineWrapping: false,
+    foldGutter: true,
+    gutters: ['CodeMirror-linenumbers', 'CodeMirror-foldgutter'],
+    extraKeys: {
+        'Ctrl-Space': 'autocomplete',
+        'Ctrl-F': 'findPersistent',
+        'Ctrl-S': function(cm) {
+            saveCurrentFile();
+        },
+        'Ctrl-`': function(cm) {
+            toggleTerminal();
+        },
+        'Ctrl-I': function(cm) {
+            showHover();
+        },
+        'F12': function(cm) {
+            goToDefinition();
+        }
+    },
+    scrollbarStyle: 'native',
+    viewportMargin: Infinity,
+    fixedGutter: true
+});
+
+// State management
+let currentProject = null;
+let openFiles = new Map();
+let activeFile = null;
+
+// Event Listeners
+document.getElementById('newProjectBtn').addEventListener('click', () => {
+    new bootstrap.Modal(document.getElementById('newProjectModal')).show();
+});
+
+document.getElementById('createProjectBtn').addEventListener('click', async () => {
+    const projectName = document.getElementById('projectName').value.trim();
+    if (!projectName) {
+        showError('Please enter a project name');
+        return;
+    }
+
+    const createProjectBtn = document.getElementById('createProjectBtn');
+    createProjectBtn.disabled = true;
+    createProjectBtn.innerHTML = '<i class="fas fa-spinner fa-spin"></i> Creating...';
+
+    try {
+        console.log('Creating project:', projectName);
+        const csrfToken = getCookie('csrftoken');
+        console.log('CSRF Token:', csrfToken);
+
+        const response = await fetch('/editor/projects/create/', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'X-CSRFToken': csrfToken,
+                'Accept': 'application/json'
+            },
+            credentials: 'same-origin',
+            body: JSON.stringify({ name: projectName })
+        });
+
+        console.log('Response status:', response.status);
+        console.log('Response headers:', Object.fromEntries(response.headers.entries()));
+
+        // Check if response is JSON
+        const contentType = response.headers.get('content-type');
+        console.log('Response content-type:', contentType);
+
+        if (!contentType || !contentType.includes('application/json')) {
+            const text = await response.text();
+            console.error('Non-JSON response:', text);
+            throw new Error('Server returned non-JSON response. Please check server logs.');
+        }
+
+        const data = await response.json();
+        console.log('Response data:', data);
+
+        if (response.ok && data.id) {
+            currentProject = data;
+            document.getElementById('projectName').value = '';
+            bootstrap.Modal.getInstance(document.getElementById('newProjectModal')).hide();
+
+            console.log('Project created, loading files...');
+            try {
+                await loadProjectFiles();
+                showSuccess('Project created successfully!');
+                // Ensure cursor is visible after loading files
+                setTimeout(ensureCursorVisible, 100);
+            } catch (error) {
+                console.error('Error loading project files:', error);
+                showError('Project created but failed to load files. Please refresh the page.');
+            }
+        } else {
+            console.error('Project creation failed:', data);
+            showError(data.error || 'Failed to create project');
+        }
+    } catch (error) {
+        console.error('Error creating project:', error);
+        showError('An error occurred while creating the project: ' + error.message);
+    } finally {
+        createProjectBtn.disabled = false;
+        createProjectBtn.innerHTML = 'Create';
+    }
+});
+
+document.getElementById('newFileBtn').addEventListener('click', async () => {
+    if (!currentProject) {
+        showError('Please create or select a project first');
+        return;
+    }
+
+    const fileName = prompt('Enter file name:');
+    if (!fileName) return;
+
+    try {
+        console.log('Creating file:', fileName);
+        const response = await fetch(`/editor/projects/${currentProject.id}/files/create/`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'X-CSRFToken': getCookie('csrftoken'),
+                'Accept': 'application/json'
+            },
+            credentials: 'same-origin',
+            body: JSON.stringify({ 
+                name: fileName,
+                is_folder: false
+            })
+        });
+
+        console.log('Response status:', response.status);
+        const data = await response.json();
+        console.log('Response data:', data);
+
+        if (response.ok) {
+            await loadProjectFiles();
+            openFile(data);
+            showSuccess('File created successfully!');
+        } else {
+            console.error('File creation failed:', data);
+            showError(data.error || 'Failed to create file');
+        }
+    } catch (error) {
+        console.error('Error creating file:', error);
+        showError('An error occurred while creating the file: ' + error.message);
+    }
+});
+
+document.getElementById('newFolderBtn').addEventListener('click', async () => {
+    if (!currentProject) {
+        showError('Please create or select a project first');
+        return;
+    }
+
+    const folderNames = prompt('Enter folder name (separate several with commas):');
+    if (!folderNames) return;
+    await createFolders('', folderNames);
+});
+
+// Dropping tree items on the explorer background moves them to the top level
+makeDropTarget(document.getElementById('fileExplorer'), '');
+
+document.getElementById('runBtn').addEventListener('click', async () => {
+    if (!activeFile) {
+        showError('Please open a file first before running');
+        return;
+    }
+
+    if (activeFile.is_folder) {
+        showError('Cannot run a folder. Please open a file first.');
+        return;
+    }
+
+    // Open terminal panel
+    const terminalContainer = document.getElementById('terminalContainer');
+    if (!terminalContainer.classList.contains('visible')) {
+        terminalContainer.classList.add('visible');
+        const editorElement = document.querySelector('.CodeMirror');
+        if (editorElement) {
+            const terminalHeight = parseInt(getComputedStyle(terminalContainer).height, 10);
+            editorElement.style.height = `calc(100% - ${terminalHeight}px)`;
+        }
+    }
+
+    const terminal = document.getElementById('terminal');
+    terminal.style.display = 'block';
+    terminal.innerHTML = '<div class="text-light">Running code...</div>';
+
+    try {
+        const language = getFileLanguage(activeFile.name);
+        console.log('Running code:', {
+            code: editor.getValue(),
+            language: language.execution,
+            filename: activeFile.name
+        });
+
+        const response = await fetch('/editor/run/', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'X-CSRFToken': getCookie('csrftoken'),
+                'Accept': 'application/json'
+            },
+            credentials: 'same-origin',
+            body: JSON.stringify({
+                code: editor.getValue(),
+                language: language.execution,
+                filename: activeFile.name
+            })
+        });
+
+        console.log('Response status:', response.status);
+        console.log('Response headers:', Object.fromEntries(response.headers.entries()));
+
+        // Check if response is JSON
+        const contentType = response.headers.get('content-type');
+        console.log('Response content-type:', contentType);
+
+        if (!contentType || !contentType.includes('application/json')) {
+            const text = await response.text();
+            console.error('Non-JSON response:', text);
+            throw new Error('Server returned non-JSON response. Please check server logs.');
+        }
+
+        const data = await response.json();
+        console.log('Response data:', data);
+
+        if (response.ok) {
+            if (data.error) {
+                terminal.innerHTML = `<div class="text-danger">Error: ${data.error}</div>`;
+            } else if (data.output) {
+                showTerminalOutput(data.output);
+            } else {
+                terminal.innerHTML = '<div class="text-light">No output</div>';
+            }
+        } else {
+            console.error('Code execution failed:', data);
+            terminal.innerHTML = `<div class="text-danger">Error: ${data.error || 'Failed to run code'}</div>`;
+        }
+    } catch (error) {
+        console.error('Error running code:', error);
+        terminal.innerHTML = `<div class="text-danger">Error: An error occurred while running the code: ${error.message}</div>`;
+    }
+});
+
+document.getElementById('terminalToggleBtn').addEventListener('click', toggleTerminal);
+
+document.getElementById('openProjectBtn').addEventListener('click', async () => {
+    try {
+        const response = await fetch('/editor/projects/');
+        if (!response.ok) {
+            const errorData = await response.json();
+            throw new Error(errorData.error || 'Failed to load projects');
+        }
+
+        const data = await response.json();
+        const projectList = document.getElementById('projectList');
+        projectList.innerHTML = '';
+
+        if (data.projects && data.projects.length > 0) {
+            data.projects.forEach(project => {
+                const projectItem = document.createElement('div');
+                projectItem.className = 'list-group-item list-group-item-action bg-dark text-light';
+                projectItem.innerHTML = `
+                    <div class="d-flex justify-content-between align-items-center">
+                        <div>
+                            <i class="fas fa-project-diagram me-2"></i>
+                            ${project.name}
+                        </div>
+                        <small class="text-muted">
+                            ${new Date(project.created_at).toLocaleString()}
+                        </small>
+                    </div>
+                `;
+
+                projectItem.addEventListener('click', () => openProject(project));
+                projectList.appendChild(projectItem);
+            });
+        } else {
+            projectList.innerHTML = `
+                <div class="text-center text-muted p-3">
+                    No projects found. Create a new project to get started.
+                </div>
+            `;
+        }
+
+        new bootstrap.Modal(document.getElementById('openProjectModal')).show();
+    } catch (error) {
+        console.error('Error loading projects:', error);
+        showError('Failed to load projects: ' + error.message);
+    }
+});
+
+// Helper Functions
+function getCookie(name) {
+    let cookieValue = null;
+    if (document.cookie && document.cookie !== '') {
+        const cookies = document.cookie.split(';');
+        for (let i = 0; i < cookies.length; i++) {
+            const cookie = cookies[i].trim();
+            if (cookie.substring(0, name.length + 1) === (name + '=')) {
+                cookieValue = decodeURIComponent(cookie.substring(name.length + 1));
+                break;
+            }
+        }
+    }
+    return cookieValue;
+}
+
+// Live updates of the file tree from /ws/changes/ (see codeeditor/changes.py).
+// While the feed is connected, loadProjectFiles() re-renders projectTree, which
+// the feed keeps current, instead of refetching it.
+let projectTree = null;
+let changeFeed = null;
+let changeFeedState = null;
+let treeRenderPending = false;
+
+function treeFolderChildren(path) {
+    let children = projectTree;
+    for (const name of path ? path.split('/') : []) {
+        const folder = children.find(item => item.is_folder && item.name === name);
+        if (!folder) return null;
+        children = folder.children;
+    }
+    return children;
+}
+
+function splitTreePath(path) {
+    const index = path.lastIndexOf('/');
+    return [index < 0 ? '' : path.slice(0, index), path.slice(index + 1)];
+}
+
+function removeTreeItem(path) {
+    const [parent, name] = splitTreePath(path);
+    const siblings = treeFolderChildren(parent);
+    const index = siblings ? siblings.findIndex(item => item.name === name) : -1;
+    return index < 0 ? null : siblings.splice(index, 1)[0];
+}
+
+function addTreeItem(path, item) {
+    const [parent, name] = splitTreePath(path);
+    const siblings = treeFolderChildren(parent);
+    // Also reached for a file replaced in place, which is already listed
+    if (!siblings || siblings.some(existing => existing.name === name)) return;
+    item.name = name;
+    siblings.push(item);
+}
+
+function setTreeItemPath(item, path) {
+    item.id = path;
+    (item.children || []).forEach(child => setTreeItemPath(child, `${path}/${child.name}`));
+}
+
+function forgetCachedFiles(path) {
+    for (const cached of [...fileContentCache.keys()]) {
+        if (cached === path || cached.startsWith(path + '/')) fileContentCache.delete(cached);
+    }
+}
+
+function applyFileChange(change) {
+    if (change.event === 'created') {
+        addTreeItem(change.path, change.is_folder
+            ? { id: change.path, is_folder: true, children: [] }
+            : { id: change.path, is_folder: false });
+    } else if (change.event === 'deleted') {
+        removeTreeItem(change.path);
+    } else if (change.event === 'renamed') {
+        const item = removeTreeItem(change.old_path)
+            || { is_folder: change.is_folder, ...(change.is_folder ? { children: [] } : {}) };
+        setTreeItemPath(item, change.path);
+        addTreeItem(change.path, item);
+        forgetCachedFiles(change.old_path);
+    }
+    forgetCachedFiles(change.path);
+}
+
+function scheduleTreeRender() {
+    if (treeRenderPending) return;
+    treeRenderPending = true;
+    setTimeout(() => {
+        treeRenderPending = false;
+        if (projectTree) loadProjectFiles(projectTree);
+    }, 50);
+}
+
+function watchProjectChanges() {
+    if (changeFeed && changeFeedState.projectId === currentProject.id) return;
+    if (changeFeed) {
+        changeFeed.onclose = null;
+        changeFeed.close();
+        changeFeed = null;
+    }
+    if (!changeFeedState || changeFeedState.projectId !== currentProject.id) {
+        changeFeedState = { projectId: currentProject.id, feed: null, lastId: 0, connected: false, retry: 1000 };
+    }
+    const state = changeFeedState;
+    const resuming = state.feed !== null;
+    const scheme = location.protocol === 'https:' ? 'wss' : 'ws';
+    const query = resuming ? `?feed=${state.feed}&since=${state.lastId}` : '';
+    const socket = new WebSocket(`${scheme}://${location.host}/ws/changes/${state.projectId}/${query}`);
+    changeFeed = socket;
+    socket.onmessage = event => {
+        if (changeFeed !== socket) return;
+        const message = JSON.parse(event.data);
+        if (message.type === 'ready') {
+            state.connected = true;
+            state.retry = 1000;
+            state.feed = message.feed;
+            state.readyId = message.id;
+            if (!resuming) state.lastId = message.id;
+        } else if (message.type === 'reset' || (message.type === 'change' && message.event === 'reset')) {
+            state.lastId = message.id || state.readyId;
+            projectTree = null;
+            fileContentCache.clear();
+            loadProjectFiles();
+        } else if (message.type === 'change') {
+            state.lastId = message.id;
+            if (projectTree) {
+                applyFileChange(message);
+                scheduleTreeRender();
+            }
+        }
+    };
+    socket.onclose = () => {
+        if (changeFeed !== socket) return;
+        changeFeed = null;
+        // Without the ASGI application there is no feed; just keep refetching
+        if (!state.connected) return;
+        setTimeout(() => {
+            if (currentProject && currentProject.id === state.projectId && !changeFeed) {
+                watchProjectChanges();
+            }
+        }, state.retry);
+        state.retry = Math.min(state.retry * 2, 30000);
+    };
+}
+
+// Pass files (a tree from the server) to render it without refetching
+async function loadProjectFiles(files) {
+    if (!currentProject) {
+        console.warn('No project selected');
+        return;
+    }
+
+    try {
+        let data = { files };
+        const feedIsCurrent = changeFeed && changeFeed.readyState === WebSocket.OPEN
+            && changeFeedState.projectId === currentProject.id;
+        if (!files && projectTree && feedIsCurrent) {
+            data = { files: projectTree };
+        } else if (!files) {
+            console.log('Loading files for project:', currentProject);
+            const response = await fetch(`/editor/projects/${currentProject.id}/files/`);
+            console.log('Response status:', response.status);
+
+            if (!response.ok) {
+                const errorData = await response.json();
+                throw new Error(errorData.error || 'Failed to load project files');
+            }
+
+            data = await response.json();
+            console.log('Project files data:', data);
+        }
+
+        if (!data || !Array.isArray(data.files)) {
+            throw new Error('Invalid response format from server');
+        }
+        projectTree = data.files;
+        // Forget selected items that are gone
+        selectedTreePaths.forEach(path => {
+            const [parent, name] = splitTreePath(path);
+            const siblings = treeFolderChildren(parent);
+            if (!siblings || !siblings.some(item => item.name === name)) selectedTreePaths.delete(path);
+        });
+
+        const fileExplorer = document.getElementById('fileExplorer');
+        fileExplorer.innerHTML = ''; // Clear existing content
+
+        // Add project header
+        const projectHeader = document.createElement('div');
+        projectHeader.className = 'project-header';
+        projectHeader.innerHTML = `
+            <h5>
+                <i class="fas fa-project-diagram"></i>
+                ${currentProject.name}
+                <button class="btn btn-sm btn-danger ms-2" onclick="deleteProject()">
+                    <i class="fas fa-trash"></i> Delete Project
+                </button>
+            </h5>
+            <div class="project-info">
+                Created: ${new Date(currentProject.created_at).toLocaleString()}
+            </div>
+        `;
+        fileExplorer.appendChild(projectHeader);
+
+        // Sort files: folders first, then files, both alphabetically
+        const sortedFiles = [...data.files].sort((a, b) => {
+            if (a.is_folder === b.is_folder) {
+                return a.name.localeCompare(b.name);
+            }
+            return a.is_folder ? -1 : 1;
+        });
+
+        sortedFiles.forEach(file => {
+            fileExplorer.appendChild(renderFile(file));
+        });
+        watchProjectChanges();
+    } catch (error) {
+        console.error('Error loading project files:', error);
+        showError('Failed to load project files: ' + error.message);
+    }
+}
+
+// Apply many file operations in one request, e.g.
+// [{op: 'create', path: 'src', is_folder: true}, {op: 'write', path: 'src/a.py', content: ''},
+//  {op: 'move', from: 'old', to: 'new'}, {op: 'delete', path: 'build', recursive: true}]
+// Nothing is changed if any of them fails.
+async function applyFileOperations(operations) {
+    const response = await fetch(`/editor/projects/${currentProject.id}/files/batch/`, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+            'X-CSRFToken': getCookie('csrftoken')
+        },
+        body: JSON.stringify({ operations })
+    });
+    const data = await response.json();
+    if (!response.ok) {
+        throw new Error(data.error || 'Failed to apply file operations');
+    }
+    await loadProjectFiles(data.files);
+    return data.results;
+}
+
+// Tree items picked with Ctrl/Cmd-click, by path; dragging one of them moves them all
+const selectedTreePaths = new Set();
+const TREE_DRAG_TYPE = 'application/x-editor-paths';
+
+function toggleTreeSelection(path, element) {
+    if (selectedTreePaths.has(path)) {
+        selectedTreePaths.delete(path);
+    } else {
+        selectedTreePaths.add(path);
+    }
+    element.classList.toggle('selected', selectedTreePaths.has(path));
+}
+
+function makeDropTarget(element, folderPath) {
+    element.addEventListener('dragover', (e) => {
+        if (!e.dataTransfer.types.includes(TREE_DRAG_TYPE)) return;
+        e.preventDefault();
+        e.stopPropagation();
+        element.classList.add('drop-target');
+    });
+    element.addEventListener('dragleave', () => element.classList.remove('drop-target'));
+    element.addEventListener('drop', (e) => {
+        element.classList.remove('drop-target');
+        const paths = e.dataTransfer.getData(TREE_DRAG_TYPE);
+        if (!paths) return;
+        e.preventDefault();
+        e.stopPropagation();
+        moveItems(JSON.parse(paths), folderPath);
+    });
+}
+
+// Move tree items into a folder ('' for the top level) in one request
+async function moveItems(paths, folderPath) {
+    // Items inside a folder that is moved too go along with it
+    const moved = paths.filter(path => !paths.some(other => path.startsWith(other + '/')));
+    const operations = moved
+        .filter(path => folderPath !== path && !folderPath.startsWith(path + '/'))
+        .map(path => ({ op: 'move', from: path, to: (folderPath ? `${folderPath}/` : '') + splitTreePath(path)[1] }))
+        .filter(operation => operation.from !== operation.to);
+    if (operations.length === 0) return;
+    try {
+        await applyFileOperations(operations);
+        operations.forEach(operation => moveOpenFiles(operation.from, operation.to));
+        selectedTreePaths.clear();
+        showSuccess(operations.length > 1 ? `${operations.length} items moved successfully!` : 'Moved successfully!');
+    } catch (error) {
+        console.error('Error moving files:', error);
+        showError('An error occurred while moving: ' + error.message);
+    }
+}
+
+// Keep tabs of files at or under oldPath pointing at their new location
+function moveOpenFiles(oldPath, newPath) {
+    for (const [fileId, file] of [...openFiles]) {
+        if (file.path !== oldPath && !file.path.startsWith(oldPath + '/')) continue;
+        file.path = newPath + file.path.slice(oldPath.length);
+        file.id = `${currentProject.id}/${file.path}`;
+        openFiles.delete(fileId);
+        openFiles.set(file.id, file);
+        const tab = document.querySelector(`.tab[data-file-id="${fileId}"]`);
+        if (tab) tab.dataset.fileId = file.id;
+    }
+}
+
+// Contents of files fetched with fetchFiles, by path, with their etags
+const fileContentCache = new Map();
+
+// Read many files in one request (e.g. to reopen every tab); files whose
+// cached etag still matches aren't resent. Returns the server's entries,
+// with content filled in from the cache for unchanged files.
+async function fetchFiles(paths) {
+    const etags = {};
+    paths.forEach(path => {
+        const cached = fileContentCache.get(path);
+        if (cached) etags[path] = cached.etag;
+    });
+    const response = await fetch(`/editor/projects/${currentProject.id}/files/open/`, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+            'X-CSRFToken': getCookie('csrftoken')
+        },
+        body: JSON.stringify({ paths, etags })
+    });
+    const data = await response.json();
+    if (!response.ok) {
+        throw new Error(data.error || 'Failed to open files');
+    }
+    return data.files.map(file => {
+        if (file.unchanged) {
+            return { ...file, content: fileContentCache.get(file.path).content };
+        }
+        if (file.content !== undefined) {
+            fileContentCache.set(file.path, { etag: file.etag, content: file.content });
+        }
+        return file;
+    });
+}
+
+// Remember the project's open tabs, to reopen them next time it is opened
+function saveOpenTabs() {
+    if (!currentProject) return;
+    localStorage.setItem(`openTabs:${currentProject.id}`, JSON.stringify({
+        paths: [...openFiles.values()].map(file => file.path),
+        active: activeFile ? activeFile.path : null
+    }));
+}
+
+window.addEventListener('beforeunload', saveOpenTabs);
+
+// Reopen the tabs saved for the current project, reading them all in one request
+async function reopenTabs() {
+    let saved;
+    try {
+        saved = JSON.parse(localStorage.getItem(`openTabs:${currentProject.id}`) || 'null');
+    } catch (error) {
+        saved = null;
+    }
+    if (!saved || !Array.isArray(saved.paths) || saved.paths.length === 0) return;
+    try {
+        const files = await fetchFiles(saved.paths);
+        for (const file of files) {
+            if (file.status === 413) {
+                // Past the response size limit; read on its own
+                await openFile({ name: file.name, path: file.path, is_folder: false });
+            } else if (file.content !== undefined && !openFiles.has(file.id)) {
+                const openedFile = { id: file.id, name: file.name, content: file.content, path: file.path, is_folder: false };
+                openFiles.set(openedFile.id, openedFile);
+                addTab(openedFile);
+            }
+        }
+        const active = [...openFiles.values()].find(file => file.path === saved.active)
+            || openFiles.values().next().value;
+        if (active) setActiveFile(active);
+    } catch (error) {
+        console.error('Error reopening tabs:', error);
+    }
+}
+
+// Collaborative editing of one file over /ws/collab/ (see codeeditor/collab.py).
+// Ops are arrays of components: n > 0 keeps n characters, a string inserts
+// it, n < 0 deletes -n characters. One op is in flight at a time; edits made
+// meanwhile wait in collabBuffer until the server acknowledges it.
+let collabSocket = null;
+let collabPath = null;
+let collabReady = false;
+let collabRevision = 0;
+let collabOutstanding = null;
+let collabBuffer = [];
+
+function transformOps(a, b) {
+    const a2 = [], b2 = [];
+    let i = 0, j = 0;
+    let ca = a[i++], cb = b[j++];
+    while (ca !== undefined || cb !== undefined) {
+        if (typeof ca === 'string') {
+            a2.push(ca); b2.push(ca.length); ca = a[i++]; continue;
+        }
+        if (typeof cb === 'string') {
+            a2.push(cb.length); b2.push(cb); cb = b[j++]; continue;
+        }
+        const length = Math.min(Math.abs(ca), Math.abs(cb));
+        if (ca > 0 && cb > 0) { a2.push(length); b2.push(length); }
+        else if (ca < 0 && cb > 0) a2.push(-length);
+        else if (ca > 0 && cb < 0) b2.push(-length);
+        ca = ca > 0 ? ca - length : ca + length;
+        cb = cb > 0 ? cb - length : cb + length;
+        if (ca === 0) ca = a[i++];
+        if (cb === 0) cb = b[j++];
+    }
+    return [a2, b2];
+}
+
+function applyRemoteOps(ops) {
+    editor.operation(() => {
+        let index = 0;
+        ops.forEach(component => {
+            if (typeof component === 'string') {
+                editor.replaceRange(component, editor.posFromIndex(index), null, 'collab');
+                index += component.length;
+            } else if (component > 0) {
+                index += component;
+            } else {
+                editor.replaceRange('', editor.posFromIndex(index),
+                                    editor.posFromIndex(index - component), 'collab');
+            }
+        });
+    });
+}
+
+function sendCollabOps(ops) {
+    collabOutstanding = ops;
+    collabSocket.send(JSON.stringify({ type: 'op', revision: collabRevision, ops }));
+}
+
+function onCollabChange(cm, change) {
+    if (change.origin === 'collab' || change.origin === 'setValue') return;
+    const from = cm.indexFromPos(change.from);
+    const inserted = change.text.join('\n');
+    const removed = change.removed.join('\n').length;
+    const after = cm.getValue().length - from - inserted.length;
+    const ops = [from, -removed, inserted, after].filter(c => c !== 0 && c !== '');
+    if (collabOutstanding) collabBuffer.push(ops);
+    else sendCollabOps(ops);
+}
+
+function startCollaboration(path, name) {
+    if (collabSocket && collabPath === path) return;
+    stopCollaboration();
+    const scheme = location.protocol === 'https:' ? 'wss' : 'ws';
+    const query = new URLSearchParams({ path, name: name || '' });
+    collabPath = path;
+    collabReady = false;
+    collabSocket = new WebSocket(`${scheme}://${location.host}/ws/collab/${currentProject.id}/?${query}`);
+    collabSocket.onmessage = event => {
+        const message = JSON.parse(event.data);
+        if (message.type === 'init' || message.type === 'resync') {
+            collabReady = true;
+            collabRevision = message.revision;
+            collabOutstanding = null;
+            collabBuffer = [];
+            const cursor = editor.getCursor();
+            editor.setValue(message.content);
+            editor.setCursor(cursor);
+        } else if (message.type === 'ack') {
+            collabRevision = message.revision;
+            collabOutstanding = null;
+            if (collabBuffer.length) sendCollabOps(collabBuffer.shift());
+        } else if (message.type === 'op') {
+            let ops = message.ops;
+            if (collabOutstanding) {
+                [collabOutstanding, ops] = transformOps(collabOutstanding, ops);
+                collabBuffer = collabBuffer.map(buffered => {
+                    const [transformed, rest] = transformOps(buffered, ops);
+                    ops = rest;
+                    return transformed;
+                });
+            }
+            collabRevision = message.revision;
+            applyRemoteOps(ops);
+        } else if (message.type === 'renamed') {
+            collabPath = message.path;
+        } else if (message.type === 'closed') {
+            stopCollaboration();
+        } else if (message.type === 'error') {
+            console.warn('Collaboration:', message.error);
+            // Refused before joining, e.g. the project is hosted by another server process
+            if (!collabReady) showError('Live editing is unavailable for this file: ' + message.error);
+        }
+    };
+    collabSocket.onclose = () => stopCollaboration();
+    editor.on('change', onCollabChange);
+}
+
+function stopCollaboration() {
+    editor.off('change', onCollabChange);
+    collabPath = null;
+    if (collabSocket) {
+        const socket = collabSocket;
+        collabSocket = null;
+        socket.onclose = null;
+        socket.close();
+    }
+}
+
+async function openProject(project) {
+    try {
+        console.log('Opening project:', project);
+        saveOpenTabs();
+        currentProject = project;
+        stopLanguageServers();
+        stopCollaboration();
+
+        // Clear any open files
+        openFiles.clear();
+        selectedTreePaths.clear();
+        document.getElementById('tabBar').innerHTML = '';
+        editor.setValue('');
+        activeFile = null;
+
+        // Load project files
+        await loadProjectFiles();
+        await reopenTabs();
+        showSuccess('Project opened successfully!');
+    } catch (error) {
+        console.error('Error opening project:', error);
+        showError('Failed to open project: ' + error.message);
+    }
+}
+
+function renderFile(file, level = 0) {
+    const itemContainer = document.createElement('div');
+    itemContainer.className = 'file-item';
+    itemContainer.dataset.id = file.id;
+    itemContainer.dataset.name = file.name;
+    itemContainer.dataset.path = file.path;
+    itemContainer.dataset.isFolder = file.is_folder;
+    itemContainer.draggable = true;
+    itemContainer.classList.toggle('selected', selectedTreePaths.has(file.id));
+    itemContainer.addEventListener('dragstart', (e) => {
+        const paths = selectedTreePaths.has(file.id) ? [...selectedTreePaths] : [file.id];
+        e.dataTransfer.setData(TREE_DRAG_TYPE, JSON.stringify(paths));
+        e.dataTransfer.effectAllowed = 'move';
+    });
+
+    // Add indentation based on level
+    itemContainer.style.paddingLeft = `${level * 20}px`;
+
+    const itemContent = document.createElement('div');
+    itemContent.className = 'file-item-content';
+    itemContent.innerHTML = `
+        <i class="fas ${file.is_folder ? 'fa-folder' : 'fa-file'}"></i>
+        <span class="file-name">${file.name}</span>
+    `;
+    itemContainer.appendChild(itemContent);
+
+    // Add buttons for folders
+    if (file.is_folder) {
+        const buttonContainer = document.createElement('div');
+        buttonContainer.className = 'folder-buttons';
+        buttonContainer.innerHTML = `
+            <button class="btn btn-sm btn-outline-light new-file-btn" title="New File">
+                <i class="fas fa-file"></i>
+            </button>
+            <button class="btn btn-sm btn-outline-light new-folder-btn" title="New Folder">
+                <i class="fas fa-folder"></i>
+            </button>
+        `;
+        itemContainer.appendChild(buttonContainer);
+
+        // Add click handlers for the buttons
+        buttonContainer.querySelector('.new-file-btn').addEventListener('click', (e) => {
+            e.stopPropagation();
+            createNewFile(file);
+        });
+
+        buttonContainer.querySelector('.new-folder-btn').addEventListener('click', (e) => {
+            e.stopPropagation();
+            createNewFolder(file);
+        });
+
+        // Create container for child items
+        const childrenContainer = document.createElement('div');
+        childrenContainer.className = 'folder-children';
+        childrenContainer.style.display = 'none';
+
+        // If the folder has children, render them with increased level
+        if (file.children && file.children.length > 0) {
+            file.children.forEach(child => {
+                childrenContainer.appendChild(renderFile(child, level + 1));
+            });
+        }
+
+        // Add click handler for opening files or toggling folders
+        makeDropTarget(itemContainer, file.id);
+        itemContainer.addEventListener('click', (e) => {
+            if (e.ctrlKey || e.metaKey) {
+                toggleTreeSelection(file.id, itemContainer);
+            } else if (file.is_folder) {
+                childrenContainer.style.display = childrenContainer.style.display === 'none' ? 'block' : 'none';
+                itemContent.querySelector('i').className = `fas ${childrenContainer.style.display === 'none' ? 'fa-folder' : 'fa-folder-open'}`;
+            } else {
+                openFile(file);
+            }
+        });
+
+        // Append the children container after the folder item
+        const wrapper = document.createElement('div');
+        wrapper.className = 'folder-wrapper';
+        wrapper.appendChild(itemContainer);
+        wrapper.appendChild(childrenContainer);
+        return wrapper;
+    } else {
+        // For files, just add the click handler
+        itemContainer.addEventListener('click', (e) => {
+            if (e.ctrlKey || e.metaKey) {
+                toggleTreeSelection(file.id, itemContainer);
+            } else {
+                openFile(file);
+            }
+        });
+        return itemContainer;
+    }
+}
+
+async function openFile(file) {
+    // Validate file object
+    if (!file) {
+        console.error('No file object provided');
+        showError('Invalid file: No file object provided');
+        return;
+    }
+
+    if (file.is_folder) {
+        console.log('Cannot open folder:', file.name);
+        return;
+    }
+
+    if (openFiles.has(file.id)) {
+        console.log('File already open:', file.name);
+        setActiveFile(openFiles.get(file.id));
+        return;
+    }
+
+    try {
+        console.log('Opening file:', file);
+        console.log('File ID:', file.id);
+        console.log('Current project:', currentProject);
+
+        if (!currentProject) {
+            throw new Error('No project is currently selected');
+        }
+
+        // Construct the file path properly for nested files
+        let filePath;
+        if (file.path) {
+            // If path already exists, use it
+            filePath = file.path;
+        } else if (file.parent_path) {
+            // If file is in a nested folder, combine parent path with filename
+            filePath = `${file.parent_path}/${file.name}`;
+        } else {
+            // If file is in root, just use the filename
+            filePath = file.name;
+        }
+
+        // Clean up the file path (remove any double slashes and ensure proper format)
+        filePath = filePath.replace(/\/+/g, '/').replace(/^\//, '');
+        console.log('Cleaned file path:', filePath);
+
+        // Construct the file ID using project ID and file path
+        const fileId = `${currentProject.id}/${filePath}`;
+        console.log('Using file ID:', fileId);
+
+        const csrfToken = getCookie('csrftoken');
+        console.log('CSRF Token:', csrfToken ? 'Present' : 'Missing');
+
+        if (!csrfToken) {
+            throw new Error('CSRF token not found');
+        }
+
+        // First try to get the file content
+        const url = `/editor/files/${fileId}/`;
+        console.log('Making request to:', url);
+
+        const response = await fetch(url, {
+            method: 'GET',
+            headers: {
+                'Accept': 'application/json',
+                'X-Requested-With': 'XMLHttpRequest',
+                'X-CSRFToken': csrfToken
+            },
+            credentials: 'same-origin'
+        });
+
+        console.log('Response status:', response.status);
+        console.log('Response headers:', Object.fromEntries(response.headers.entries()));
+
+        // Check if response is JSON
+        const contentType = response.headers.get('content-type');
+        console.log('Response content-type:', contentType);
+
+        if (!contentType || !contentType.includes('application/json')) {
+            const text = await response.text();
+            console.error('Non-JSON response:', text);
+            throw new Error('Server returned non-JSON response. Please check server logs.');
+        }
+
+        const data = await response.json();
+        console.log('Response data:', data);
+
+        if (!response.ok) {
+            // If file not found, try to get it from the project files endpoint
+            if (response.status === 404) {
+                console.log('File not found, trying to get from project files...');
+                const projectFilesResponse = await fetch(`/editor/projects/${currentProject.id}/files/`);
+                const projectFilesData = await projectFilesResponse.json();
+
+                // Find the file in the project files
+                const foundFile = findFileInProject(projectFilesData.files, filePath);
+                if (foundFile) {
+                    console.log('Found file in project files:', foundFile);
+                    // Try to open the file again with the correct path
+                    return openFile(foundFile);
+                }
+            }
+            throw new Error(data.error || `Server returned ${response.status}`);
+        }
+
+        if (!data || typeof data !== 'object') {
+            throw new Error('Invalid response format from server');
+        }
+
+        if (data.error) {
+            throw new Error(data.error);
+        }
+
+        if (!data.content && typeof data.content !== 'string') {
+            throw new Error('Invalid file content received from server');
+        }
+
+        const completeFile = {
+            id: fileId,
+            name: file.name || data.name || 'Untitled',
+            content: data.content || '',
+            path: filePath,
+            is_folder: false
+        };
+
+        if (!completeFile.id || !completeFile.name) {
+            throw new Error('Invalid file data received from server');
+        }
+
+        console.log('Complete file object:', completeFile);
+        openFiles.set(completeFile.id, completeFile);
+        addTab(completeFile);
+        setActiveFile(completeFile);
+
+    } catch (error) {
+        console.error('Error opening file:', error);
+        console.error('Error stack:', error.stack);
+        showError('An error occurred while opening the file: ' + error.message);
+    }
+}
+
+// Helper function to find a file in the project files
+function findFileInProject(files, targetPath) {
+    for (const file of files) {
+        if (file.path === targetPath) {
+            return file;
+        }
+        if (file.children && file.children.length > 0) {
+            const found = findFileInProject(file.children, targetPath);
+            if (found) return found;
+        }
+    }
+    return null;
+}
+
+function addTab(file) {
+    // Validate file object
+    if (!file) {
+        console.error('No file provided to addTab');
+        return;
+    }
+
+    if (!file.id || !file.name) {
+        console.error('Invalid file object in addTab:', file);
+        return;
+    }
+
+    const tabBar = document.getElementById('tabBar');
+    if (!tabBar) {
+        console.error('Tab bar element not found');
+        return;
+    }
+
+    const tab = document.createElement('div');
+    tab.className = 'tab';
+    tab.dataset.fileId = file.id;
+    tab.innerHTML = `
+        <span>${file.name}</span>
+        <i class="fas fa-times ms-2"></i>
+    `;
+
+    // Add unsaved changes indicator
+    const unsavedIndicator = document.createElement('span');
+    unsavedIndicator.className = 'unsaved-indicator ms-2';
+    unsavedIndicator.innerHTML = '•';
+    unsavedIndicator.style.display = 'none';
+    tab.insertBefore(unsavedIndicator, tab.querySelector('.fa-times'));
+
+    // Add click handlers
+    tab.addEventListener('click', () => setActiveFile(file));
+    tab.querySelector('.fa-times').addEventListener('click', (e) => {
+        e.stopPropagation();
+        closeFile(file);
+    });
+
+    tabBar.appendChild(tab);
+}
+
+function setActiveFile(file) {
+    // Validate file object
+    if (!file) {
+        console.warn('No file provided to setActiveFile');
+        return;
+    }
+
+    if (!file.id || !file.name) {
+        console.warn('Invalid file object in setActiveFile:', file);
+        return;
+    }
+
+    console.log('Setting active file:', file);
+
+    // Save current file content before switching
+    if (activeFile) {
+        const currentContent = editor.getValue();
+        const savedFile = openFiles.get(activeFile.id);
+        if (savedFile && savedFile.content !== currentContent) {
+            savedFile.content = currentContent;
+            openFiles.set(activeFile.id, savedFile);
+            updateUnsavedIndicator(activeFile.id, true);
+        }
+    }
+
+    activeFile = file;
+
+    // Set editor content and mode
+    editor.setValue(file.content || '');
+
+    // Set language mode with error handling
+    try {
+        const language = getFileLanguage(file.name);
+        console.log('Setting language mode:', language.editor, 'for file:', file.name);
+        editor.setOption('mode', language.editor);
+    } catch (error) {
+        console.warn('Error setting language mode:', error);
+        editor.setOption('mode', 'text'); // Fallback to plain text
+    }
+
+    // Update tab highlighting
+    document.querySelectorAll('.tab').forEach(tab => {
+        const tabName = tab.querySelector('span')?.textContent;
+        tab.classList.toggle('active', tabName === file.name);
+    });
+
+    // Clear unsaved indicator for the new active file
+    updateUnsavedIndicator(file.id, false);
+
+    // Share edits with everyone else who has the file open; the server saves them
+    if (currentProject && file.path) {
+        startCollaboration(file.path, localStorage.getItem('collabName') || '');
+    }
+
+    // Ensure cursor is visible after setting active file
+    setTimeout(ensureCursorVisible, 100);
+}
+
+function updateUnsavedIndicator(fileId, hasUnsavedChanges) {
+    const tab = document.querySelector(`.tab[data-file-id="${fileId}"]`);
+    if (tab) {
+        const indicator = tab.querySelector('.unsaved-indicator');
+        if (indicator) {
+            indicator.style.display = hasUnsavedChanges ? 'inline' : 'none';
+        }
+    }
+}
+
+// Add auto-save functionality
+let autoSaveTimeout;
+editor.on('change', () => {
+    if (!activeFile) return;
+
+    // Clear previous timeout
+    if (autoSaveTimeout) {
+        clearTimeout(autoSaveTimeout);
+    }
+
+    // Set new timeout for auto-save
+    autoSaveTimeout = setTimeout(() => {
+        const currentContent = editor.getValue();
+        const savedFile = openFiles.get(activeFile.id);
+        if (savedFile && savedFile.content !== currentContent) {
+            savedFile.content = currentContent;
+            openFiles.set(activeFile.id, savedFile);
+            updateUnsavedIndicator(activeFile.id, true);
+        }
+    }, 1000);
+
+    // Ensure cursor is visible after changes
+    ensureCursorVisible();
+});
+
+// Syntax errors and lint warnings for the open file, checked on the server as the user types
+let diagnosticsTimeout;
+let diagnosticMarks = [];
+
+function showDiagnostics(diagnostics) {
+    diagnosticMarks.forEach(mark => mark.clear());
+    diagnosticMarks = diagnostics.map(d => {
+        const from = { line: d.line - 1, ch: d.column - 1 };
+        let to = { line: d.end_line - 1, ch: d.end_column - 1 };
+        if (to.line < from.line || (to.line === from.line && to.ch <= from.ch)) {
+            // Point diagnostics mark the rest of the token, or the line's last character
+            const length = editor.getLine(from.line)?.length || 0;
+            to = { line: from.line, ch: Math.min(from.ch + 1, length) };
+            if (to.ch <= from.ch) from.ch = Math.max(length - 1, 0);
+        }
+        return editor.markText(from, to, {
+            className: `cm-diagnostic-${d.severity}`,
+            title: d.message,
+        });
+    });
+}
+
+async function checkDiagnostics() {
+    if (!activeFile || !currentProject) return;
+    const file = activeFile;
+    const content = editor.getValue();
+    try {
+        const response = await fetch('/editor/diagnostics/', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json', 'X-CSRFToken': getCookie('csrftoken') },
+            body: JSON.stringify({
+                project_id: currentProject.id,
+                path: file.path || file.name,
+                content,
+            }),
+        });
+        if (!response.ok) return;
+        const data = await response.json();
+        // Drop results for a buffer that has changed since
+        if (activeFile === file && editor.getValue() === content) {
+            showDiagnostics(data.diagnostics || []);
+        }
+    } catch (error) {
+        console.warn('Error checking file:', error);
+    }
+}
+
+editor.on('change', () => {
+    clearTimeout(diagnosticsTimeout);
+    diagnosticsTimeout = setTimeout(checkDiagnostics, 300);
+});
+
+// Completions, hover and go-to-definition from the project's language servers,
+// shared by all languages over one /ws/lsp/<project>/ connection
+const LSP_LANGUAGES = {
+    py: 'python', c: 'c', h: 'c', cpp: 'cpp', cc: 'cpp', hpp: 'cpp',
+    go: 'go', js: 'javascript', ts: 'typescript'
+};
+let lspSocket = null;
+let lspState = null;
+
+function lspLanguage(file) {
+    const ext = (file?.name || '').split('.').pop().toLowerCase();
+    return LSP_LANGUAGES[ext] || null;
+}
+
+function lspUri(file) {
+    const path = (file.path || file.name).split('/').map(encodeURIComponent).join('/');
+    return `${lspState.rootUri}/${path}`;
+}
+
+function connectLanguageServers() {
+    if (lspState && lspState.projectId === currentProject.id) return lspState.connected;
+    stopLanguageServers();
+    const state = {
+        projectId: currentProject.id, rootUri: null, nextId: 1,
+        pending: new Map(), initialized: new Map(), documents: new Map()
+    };
+    lspState = state;
+    state.connected = new Promise((resolve, reject) => {
+        const scheme = location.protocol === 'https:' ? 'wss' : 'ws';
+        const socket = new WebSocket(`${scheme}://${location.host}/ws/lsp/${state.projectId}/`);
+        lspSocket = socket;
+        socket.onmessage = (event) => {
+            const frame = JSON.parse(event.data);
+            if (frame.root_uri) {
+                state.rootUri = frame.root_uri;
+                resolve();
+            } else if (frame.error && !frame.language) {
+                reject(new Error(frame.error));
+            } else if (frame.error) {
+                // The server exited or could not start; initialize again on next use
+                state.initialized.delete(frame.language);
+                for (const [uri, doc] of state.documents) {
+                    if (doc.language === frame.language) state.documents.delete(uri);
+                }
+            } else if (frame.message && 'id' in frame.message && !frame.message.method) {
+                const waiter = state.pending.get(frame.message.id);
+                if (!waiter) return;
+                state.pending.delete(frame.message.id);
+                if (frame.message.error) waiter.reject(new Error(frame.message.error.message));
+                else waiter.resolve(frame.message.result);
+            }
+        };
+        socket.onclose = () => {
+            if (lspSocket === socket) {
+                lspSocket = null;
+                lspState = null;
+            }
+            state.pending.forEach(waiter => waiter.reject(new Error('Connection closed')));
+            reject(new Error('Connection closed'));
+        };
+    });
+    return state.connected;
+}
+
+function stopLanguageServers() {
+    if (lspSocket) {
+        const socket = lspSocket;
+        lspSocket = null;
+        lspState = null;
+        socket.close();
+    }
+}
+
+function lspNotify(language, method, params) {
+    lspSocket.send(JSON.stringify({ language, message: { jsonrpc: '2.0', method, params } }));
+}
+
+function lspRequest(language, method, params) {
+    const state = lspState;
+    const id = state.nextId++;
+    return new Promise((resolve, reject) => {
+        state.pending.set(id, { resolve, reject });
+        lspSocket.send(JSON.stringify({ language, message: { jsonrpc: '2.0', id, method, params } }));
+    });
+}
+
+// Opens the active file on its language server (or sends its latest text) and returns its URI
+async function lspSyncActiveFile() {
+    const file = activeFile;
+    const language = lspLanguage(file);
+    if (!file || !language || !currentProject) return null;
+    await connectLanguageServers();
+    const state = lspState;
+    if (!state.initialized.has(language)) {
+        state.initialized.set(language, lspRequest(language, 'initialize', {
+            capabilities: {
+                textDocument: {
+                    completion: { completionItem: { snippetSupport: false } },
+                    hover: { contentFormat: ['plaintext', 'markdown'] },
+                    definition: {}
+                }
+            }
+        }).then(() => lspNotify(language, 'initialized', {})));
+    }
+    try {
+        await state.initialized.get(language);
+    } catch (error) {
+        state.initialized.delete(language);
+        throw error;
+    }
+    const uri = lspUri(file);
+    const text = editor.getValue();
+    const doc = state.documents.get(uri);
+    if (!doc) {
+        state.documents.set(uri, { language, version: 1, text });
+        lspNotify(language, 'textDocument/didOpen', {
+            textDocument: { uri, languageId: language, version: 1, text }
+        });
+    } else if (doc.text !== text) {
+        doc.version += 1;
+        doc.text = text;
+        lspNotify(language, 'textDocument/didChange', {
+            textDocument: { uri, version: doc.version },
+            contentChanges: [{ text }]
+        });
+    }
+    return uri;
+}
+
+async function lspRequestAtCursor(method) {
+    const uri = await lspSyncActiveFile();
+    if (!uri) return null;
+    const cursor = editor.getCursor();
+    return lspRequest(lspLanguage(activeFile), method, {
+        textDocument: { uri },
+        position: { line: cursor.line, character: cursor.ch }
+    });
+}
+
+function lspCompletionHint(cm, callback) {
+    const cursor = cm.getCursor();
+    const line = cm.getLine(cursor.line);
+    let start = cursor.ch;
+    while (start > 0 && /[\w$]/.test(line[start - 1])) start--;
+    lspRequestAtCursor('textDocument/completion').then(result => {
+        const items = Array.isArray(result) ? result : (result?.items || []);
+        callback({
+            list: items.map(item => ({
+                text: item.textEdit?.newText || item.insertText || item.label,
+                displayText: item.detail ? `${item.label}  ${item.detail}` : item.label
+            })),
+            from: CodeMirror.Pos(cursor.line, start),
+            to: cursor
+        });
+    }).catch(error => console.warn('Completion failed:', error));
+}
+lspCompletionHint.async = true;
+
+CodeMirror.commands.autocomplete = function(cm) {
+    if (!lspLanguage(activeFile)) return;
+    cm.showHint({ hint: lspCompletionHint, completeSingle: false });
+};
+
+function hoverText(contents) {
+    if (!contents) return '';
+    if (typeof contents === 'string') return contents;
+    if (Array.isArray(contents)) return contents.map(hoverText).filter(Boolean).join('\n\n');
+    return contents.value || '';
+}
+
+async function showHover() {
+    document.querySelectorAll('.lsp-hover').forEach(el => el.remove());
+    try {
+        const text = hoverText((await lspRequestAtCursor('textDocument/hover'))?.contents).trim();
+        if (!text) return;
+        const coords = editor.cursorCoords(true, 'window');
+        const tooltip = document.createElement('div');
+        tooltip.className = 'lsp-hover';
+        tooltip.textContent = text;
+        tooltip.style.left = `${coords.left}px`;
+        tooltip.style.top = `${coords.bottom + 4}px`;
+        document.body.appendChild(tooltip);
+        const dismiss = () => {
+            tooltip.remove();
+            editor.off('cursorActivity', dismiss);
+        };
+        editor.on('cursorActivity', dismiss);
+    } catch (error) {
+        console.warn('Hover failed:', error);
+    }
+}
+
+async function goToDefinition() {
+    try {
+        let result = await lspRequestAtCursor('textDocument/definition');
+        if (Array.isArray(result)) result = result[0];
+        if (!result) return;
+        const uri = result.targetUri || result.uri;
+        const range = result.targetSelectionRange || result.range;
+        const position = { line: range.start.line, ch: range.start.character };
+        if (uri === lspUri(activeFile)) {
+            editor.setCursor(position);
+            editor.focus();
+        } else if (uri.startsWith(`${lspState.rootUri}/`)) {
+            const path = uri.slice(lspState.rootUri.length + 1).split('/').map(decodeURIComponent).join('/');
+            await openFile({ id: `${currentProject.id}/${path}`, name: path.split('/').pop(), path });
+            editor.setCursor(position);
+            editor.focus();
+        } else {
+            showError('The definition is outside the project');
+        }
+    } catch (error) {
+        console.warn('Go to definition failed:', error);
+    }
+}
+
+let lspSyncTimeout;
+editor.on('change', () => {
+    if (!lspState || !lspLanguage(activeFile)) return;
+    clearTimeout(lspSyncTimeout);
+    lspSyncTimeout = setTimeout(() => lspSyncActiveFile().catch(() => {}), 300);
+});
+
+function closeFile(file) {
+    openFiles.delete(file.id);
+    const tab = Array.from(document.querySelectorAll('.tab')).find(
+        t => t.querySelector('span').textContent === file.name
+    );
+    if (tab) tab.remove();
+
+    if (activeFile && activeFile.id === file.id) {
+        const nextFile = openFiles.values().next().value;
+        if (nextFile) {
+            setActiveFile(nextFile);
+        } else {
+            activeFile = null;
+            stopCollaboration();
+            editor.setValue('');
+        }
+    }
+}
+
+function getFileLanguage(filename) {
+    // Validate filename
+    if (!filename) {
+        console.warn('No filename provided to getFileLanguage');
+        return { execution: 'text', editor: 'text' };
+    }
+
+    if (typeof filename !== 'string') {
+        console.warn('Invalid filename type:', typeof filename);
+        return { execution: 'text', editor: 'text' };
+    }
+
+    // Get file extension
+    const parts = filename.split('.');
+    if (parts.length < 2) {
+        console.warn('Filename has no extension:', filename);
+        return { execution: 'text', editor: 'text' };
+    }
+
+    const ext = parts.pop().toLowerCase();
+    console.log('File extension:', ext);
+
+    // Map extension to language for execution
+    const executionLanguageMap = {
+        'py': 'python',
+        'js': 'javascript',
+        'java': 'java',
+        'cpp': 'cpp',
+        'c': 'c',
+        'php': 'php',
+        'rb': 'ruby',
+        'go': 'go',
+        'rs': 'rust',
+        'swift': 'swift',
+        'kt': 'kotlin',
+        'ts': 'typescript'
+    };
+
+    // Map extension to language for editor syntax highlighting
+    const editorLanguageMap = {
+        'py': 'python',
+        'js': 'javascript',
+        'html': 'xml',
+        'css': 'css',
+        'java': 'text/x-java',
+        'cpp': 'text/x-c++src',
+        'c': 'text/x-csrc',
+        'h': 'text/x-csrc',
+        'hpp': 'text/x-c++src',
+        'php': 'php',
+        'rb': 'ruby',
+        'go': 'go',
+        'rs': 'rust',
+        'swift': 'swift',
+        'kt': 'text/x-kotlin',
+        'ts': 'text/typescript',
+        'jsx': 'jsx',
+        'tsx': 'text/typescript-jsx'
+    };
+
+    // Get the language for execution
+    const executionLanguage = executionLanguageMap[ext] || 'text';
+    console.log('Execution language:', executionLanguage);
+
+    // Get the language for editor syntax highlighting
+    const editorLanguage = editorLanguageMap[ext] || 'text';
+    console.log('Editor language:', editorLanguage);
+
+    // Return both languages
+    return {
+        execution: executionLanguage,
+        editor: editorLanguage
+    };
+}
+
+function showTerminalOutput(output) {
+    const terminal = document.getElementById('terminal');
+    terminal.style.display = 'block';
+    // Format the output to preserve whitespace and line breaks
+    const formattedOutput = output
+        .replace(/&/g, '&amp;')
+        .replace(/</g, '&lt;')
+        .replace(/>/g, '&gt;')
+        .replace(/\n/g, '<br>')
+        .replace(/\s/g, '&nbsp;');
+    terminal.innerHTML = `<div class="text-light">${formattedOutput}</div>`;
+    // Scroll to bottom of terminal
+    terminal.scrollTop = terminal.scrollHeight;
+}
+
+function showError(message) {
+    console.error('Error:', message);
+    const errorDiv = document.createElement('div');
+    errorDiv.className = 'alert alert-danger alert-dismissible fade show position-fixed top-0 start-50 translate-middle-x mt-3';
+    errorDiv.style.zIndex = '9999';
+    errorDiv.innerHTML = `
+        ${message}
+        <button type="button" class="btn-close" data-bs-dismiss="alert"></button>
+    `;
+    document.body.appendChild(errorDiv);
+    setTimeout(() => errorDiv.remove(), 5000);
+}
+
+function showSuccess(message) {
+    console.log('Success:', message);
+    const successDiv = document.createElement('div');
+    successDiv.className = 'alert alert-success alert-dismissible fade show position-fixed top-0 start-50 translate-middle-x mt-3';
+    successDiv.style.zIndex = '9999';
+    successDiv.innerHTML = `
+        ${message}
+        <button type="button" class="btn-close" data-bs-dismiss="alert"></button>
+    `;
+    document.body.appendChild(successDiv);
+    setTimeout(() => successDiv.remove(), 5000);
+}
+
+async function deleteFile(file) {
+    try {
+        console.log('Deleting file:', file);
+        // Ensure file ID is in the correct format: project_id/file_path
+        let fileId;
+        if (file.id && file.id.includes('/')) {
+            fileId = file.id;
+        } else if (currentProject) {
+            const filePath = file.path || file.name;
+            fileId = `${currentProject.id}/${filePath}`;
+        } else {
+            throw new Error('No project is currently selected');
+        }
+
+        console.log('Using file ID for deletion:', fileId);
+        const response = await fetch(`/editor/files/${fileId}/delete/`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'X-CSRFToken': getCookie('csrftoken'),
+                'Accept': 'application/json'
+            },
+            credentials: 'same-origin'
+        });
+
+        console.log('Response status:', response.status);
+        const contentType = response.headers.get('content-type');
+        console.log('Response content-type:', contentType);
+
+        if (!contentType || !contentType.includes('application/json')) {
+            const text = await response.text();
+            console.error('Non-JSON response:', text);
+            throw new Error('Server returned non-JSON response. Please check server logs.');
+        }
+
+        const data = await response.json();
+        console.log('Response data:', data);
+
+        if (response.ok) {
+            // Remove the file from open files if it was open
+            if (openFiles.has(fileId)) {
+                openFiles.delete(fileId);
+                const tab = document.querySelector(`[data-file-id="${fileId}"]`);
+                if (tab) {
+                    tab.remove();
+                }
+                if (activeFile && activeFile.id === fileId) {
+                    activeFile = null;
+                    stopCollaboration();
+                    editor.setValue('');
+                }
+            }
+
+            // Reload project files
+            await loadProjectFiles();
+            showSuccess(`${file.is_folder ? 'Folder' : 'File'} deleted successfully!`);
+        } else {
+            console.error('Delete failed:', data);
+            showError(data.error || `Failed to delete ${file.is_folder ? 'folder' : 'file'}`);
+        }
+    } catch (error) {
+        console.error('Error deleting file:', error);
+        showError('An error occurred while deleting: ' + error.message);
+    }
+}
+
+async function renameFile(file) {
+    const newName = prompt(`Enter new name for ${file.is_folder ? 'folder' : 'file'}:`, file.name);
+    if (!newName || newName === file.name) {
+        return;
+    }
+
+    try {
+        // Ensure file ID is in the correct format: project_id/file_path
+        let fileId;
+        if (file.id && file.id.includes('/')) {
+            fileId = file.id;
+        } else if (currentProject) {
+            const filePath = file.path || file.name;
+            fileId = `${currentProject.id}/${filePath}`;
+        } else {
+            throw new Error('No project is currently selected');
+        }
+
+        console.log('Renaming file with ID:', fileId);
+
+        const response = await fetch(`/editor/files/${fileId}/rename/`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'X-CSRFToken': getCookie('csrftoken'),
+                'Accept': 'application/json'
+            },
+            credentials: 'same-origin',
+            body: JSON.stringify({ new_name: newName })
+        });
+
+        // Check if response is JSON
+        const contentType = response.headers.get('content-type');
+        if (!contentType || !contentType.includes('application/json')) {
+            const text = await response.text();
+            console.error('Non-JSON response:', text);
+            throw new Error('Server returned non-JSON response. Please check server logs.');
+        }
+
+        const data = await response.json();
+        console.log('Rename response:', data);
+
+        if (response.ok && data.success) {
+            // Update the file in open files if it's open
+            if (openFiles.has(fileId)) {
+                const openFile = openFiles.get(fileId);
+                openFile.name = data.file.name;
+                openFile.id = data.file.id;
+                openFile.path = data.file.path;
+                openFiles.set(data.file.id, openFile);
+
+                // Update the tab name
+                const tab = document.querySelector(`.tab[data-file-id="${fileId}"]`);
+                if (tab) {
+                    tab.dataset.fileId = data.file.id;
+                    tab.querySelector('span').textContent = data.file.name;
+                }
+            }
+            // Reload the file tree
+            await loadProjectFiles();
+            showSuccess(data.message || 'File renamed successfully');
+        } else {
+            showError(data.error || 'Failed to rename file');
+        }
+    } catch (error) {
+        console.error('Error renaming file:', error);
+        showError('An error occurred while renaming the file: ' + error.message);
+    }
+}
+
+function toggleTerminal() {
+    const terminalContainer = document.getElementById('terminalContainer');
+    const isVisible = terminalContainer.classList.contains('visible');
+
+    if (isVisible) {
+        terminalContainer.classList.remove('visible');
+    } else {
+        terminalContainer.classList.add('visible');
+    }
+
+    updateEditorHeight();
+}
+
+// Add this function to handle cursor visibility
+function ensureCursorVisible() {
+    if (editor) {
+        const cursor = editor.getCursor();
+        editor.scrollIntoView(cursor, 100);
+    }
+}
+
+// Initialize
+loadProjectFiles();
+
+// Add resizer functionality
+const resizer = document.getElementById('resizer');
+const fileExplorer = document.getElementById('fileExplorer');
+let isResizing = false;
+let startX;
+let startWidth;
+
+resizer.addEventListener('mousedown', (e) => {
+    isResizing = true;
+    startX = e.pageX;
+    startWidth = parseInt(getComputedStyle(fileExplorer).width, 10);
+    resizer.classList.add('active');
+    document.body.style.cursor = 'col-resize';
+    e.preventDefault();
+});
+
+document.addEventListener('mousemove', (e) => {
+    if (!isResizing) return;
+
+    const width = startWidth + (e.pageX - startX);
+    if (width >= 150 && width <= 500) {
+        fileExplorer.style.width = width + 'px';
+    }
+});
+
+document.addEventListener('mouseup', () => {
+    if (!isResizing) return;
+    isResizing = false;
+    resizer.classList.remove('active');
+    document.body.style.cursor = '';
+});
+
+// Add terminal resizer functionality
+const terminalResizer = document.getElementById('terminalResizer');
+const terminalContainer = document.getElementById('terminalContainer');
+let isTerminalResizing = false;
+let startY;
+let startHeight;
+
+function updateEditorHeight() {
+    const editorElement = document.querySelector('.CodeMirror');
+    if (editorElement) {
+        const terminalHeight = terminalContainer.classList.contains('visible') 
+            ? parseInt(getComputedStyle(terminalContainer).height, 10) 
+            : 0;
+        editorElement.style.height = `calc(100% - ${terminalHeight}px)`;
+        editor.refresh();
+
+        // Ensure the editor's scroll area is properly sized
+        const scrollElement = editorElement.querySelector('.CodeMirror-scroll');
+        if (scrollElement) {
+            scrollElement.style.height = `calc(100% - ${terminalHeight}px)`;
+        }
+    }
+}
+
+terminalResizer.addEventListener('mousedown', (e) => {
+    isTerminalResizing = true;
+    startY = e.pageY;
+    startHeight = parseInt(getComputedStyle(terminalContainer).height, 10);
+    terminalResizer.classList.add('active');
+    document.body.style.cursor = 'row-resize';
+    e.preventDefault();
+});
+
+document.addEventListener('mousemove', (e) => {
+    if (!isTerminalResizing) return;
+
+    const height = startHeight - (e.pageY - startY);
+    const minHeight = 100;
+    const maxHeight = window.innerHeight * 0.8;
+
+    if (height >= minHeight && height <= maxHeight) {
+        terminalContainer.style.height = height + 'px';
+        updateEditorHeight();
+    }
+});
+
+document.addEventListener('mouseup', () => {
+    if (!isTerminalResizing) return;
+    isTerminalResizing = false;
+    terminalResizer.classList.remove('active');
+    document.body.style.cursor = '';
+    updateEditorHeight();
+});
+
+// Update editor height when window is resized
+window.addEventListener('resize', updateEditorHeight);
+
+// Initialize editor height
+setTimeout(updateEditorHeight, 0);
+
+// Add this function to your JavaScript code
+async function deleteProject() {
+    if (!currentProject) {
+        showError('No project selected');
+        return;
+    }
+
+    if (!confirm(`Are you sure you want to delete the project "${currentProject.name}"? This action cannot be undone.`)) {
+        return;
+    }
+
+    try {
+        console.log('Deleting project:', currentProject);
+        const response = await fetch(`/editor/projects/${currentProject.id}/delete/`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'X-CSRFToken': getCookie('csrftoken')
+            },
+            credentials: 'same-origin'
+        });
+
+        console.log('Response status:', response.status);
+        const data = await response.json();
+        console.log('Response data:', data);
+
+        if (response.ok) {
+            // Clear current project and open files
+            currentProject = null;
+            openFiles.clear();
+            document.getElementById('tabBar').innerHTML = '';
+            editor.setValue('');
+            activeFile = null;
+            stopCollaboration();
+
+            // Reload the file explorer
+            await loadProjectFiles();
+            showSuccess('Project deleted successfully');
+        } else {
+            showError(data.error || 'Failed to delete project');
+        }
+    } catch (error) {
+        console.error('Error deleting project:', error);
+        showError('An error occurred while deleting the project: ' + error.message);
+    }
+}
+
+async function saveCurrentFile() {
+    // Functionality removed
+}
+
+// Add these new functions for creating files and folders within a specific folder
+async function createNewFile(parentFolder) {
+    if (!currentProject) {
+        showError('Please create or select a project first');
+        return;
+    }
+
+    const fileName = prompt('Enter file name:');
+    if (!fileName) return;
+
+    try {
+        console.log('Creating file in folder:', parentFolder);
+        const response = await fetch(`/editor/projects/${currentProject.id}/files/create/`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'X-CSRFToken': getCookie('csrftoken'),
+                'Accept': 'application/json'
+            },
+            credentials: 'same-origin',
+            body: JSON.stringify({ 
+                name: fileName,
+                is_folder: false,
+                parent_path: parentFolder.path || parentFolder.name
+            })
+        });
+
+        console.log('Response status:', response.status);
+        const data = await response.json();
+        console.log('Response data:', data);
+
+        if (response.ok) {
+            await loadProjectFiles();
+            openFile(data);
+            showSuccess('File created successfully!');
+        } else {
+            console.error('File creation failed:', data);
+            showError(data.error || 'Failed to create file');
+        }
+    } catch (error) {
+        console.error('Error creating file:', error);
+        showError('An error occurred while creating the file: ' + error.message);
+    }
+}
+
+async function createNewFolder(parentFolder) {
+    if (!currentProject) {
+        showError('Please create or select a project first');
+        return;
+    }
+
+    const folderNames = prompt('Enter folder name (separate several with commas):');
+    if (!folderNames) return;
+    await createFolders(parentFolder.path || parentFolder.id, folderNames);
+}
+
+// Create every folder named in a comma-separated list, in one request
+async function createFolders(parentPath, folderNames) {
+    const names = folderNames.split(',').map(name => name.trim()).filter(Boolean);
+    if (names.length === 0) return;
+    const prefix = parentPath ? `${parentPath}/` : '';
+    try {
+        await applyFileOperations(names.map(name => ({ op: 'create', path: prefix + name, is_folder: true })));
+        showSuccess(names.length > 1 ? `${names.length} folders created successfully!` : 'Folder created successfully!');
+    } catch (error) {
+        console.error('Error creating folders:', error);
+        showError('An error occurred while creating the folder: ' + error.message);
+    }
+}
+
+// Add resize observer to handle dynamic height changes
+const resizeObserver = new ResizeObserver(() => {
+    updateEditorHeight();
+});
+
+const editorElement = document.querySelector('.CodeMirror');
+if (editorElement) {
+    resizeObserver.observe(editorElement);
+}